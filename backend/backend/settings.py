@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import socket
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -121,7 +122,8 @@ AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME', 'us-east-1')
-AWS_S3_FILE_OVERWRITE = False
+# Playlists are rewritten in place under the same key on every update
+AWS_S3_FILE_OVERWRITE = True
 AWS_DEFAULT_ACL = 'public-read'
 AWS_S3_VERIFY = True
 
@@ -132,6 +134,160 @@ MEDIA_URL = f'https://{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/'
 # HLS and FFmpeg settings
 HLS_MEDIA_ROOT = 'hls_media'  # This will now be a prefix in S3
 FFMPEG_LOG_DIR = 'ffmpeg_logs'  # This will now be a prefix in S3
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+HLS_PROBE_TIMEOUT = 8  # seconds
+HLS_PROBE_CACHE_TTL = 3600  # seconds a camera's codec probe is reused
+# RTSP transports a probe tries in turn; each camera's stored probe
+# remembers the one that worked, and its streams use it
+HLS_PROBE_TRANSPORTS = ['tcp', 'udp']
+
+# Default adaptive-bitrate ladder (video_bitrate in kbit/s), used when a
+# stream is started with "abr": true and no "renditions" of its own
+HLS_ABR_LADDER = [
+    {'name': '1080p', 'height': 1080, 'video_bitrate': 5000},
+    {'name': '720p', 'height': 720, 'video_bitrate': 2800},
+    {'name': '360p', 'height': 360, 'video_bitrate': 800},
+]
+HLS_ABR_MAX_RENDITIONS = 6
+HLS_START_TIMEOUT = 10  # seconds for FFmpeg to write its first playlist
+HLS_UPLOAD_TIMEOUT = 10  # further seconds for that playlist to reach storage
+HLS_STREAM_HISTORY = 100  # stopped or failed streams whose status is kept
+# Bulk starts (start_hls/bulk/): cameras started at a time, by default and at
+# most, cameras per request, and how often remote nodes are asked for readiness
+HLS_BULK_START_CONCURRENCY = 8
+HLS_BULK_START_MAX_CONCURRENCY = 32
+HLS_BULK_START_MAX = 500
+HLS_BULK_START_POLL_INTERVAL = 0.5
+
+# Shared segment upload pool (see viewer/upload_pool.py)
+HLS_UPLOAD_WORKERS = int(os.environ.get('HLS_UPLOAD_WORKERS', 8))
+HLS_UPLOAD_MAX_QUEUE = int(os.environ.get('HLS_UPLOAD_MAX_QUEUE', 20))  # pending segments per stream
+HLS_UPLOAD_POLL_INTERVAL = 0.5  # seconds between checks of each stream's playlist
+# 'poll' has FFmpeg write into a working directory the upload pool polls;
+# 'push' has it PUT segments and playlists to this server (hls_ingest), which
+# caches and uploads them from memory. FFmpeg reaches the server at HLS_INGEST_URL.
+HLS_INGEST = os.environ.get('HLS_INGEST', 'poll')
+HLS_INGEST_URL = os.environ.get('HLS_INGEST_URL', 'http://127.0.0.1:8000')
+
+# Background deletion of stopped streams' objects (see viewer/cleanup.py)
+HLS_CLEANUP_WORKERS = int(os.environ.get('HLS_CLEANUP_WORKERS', 4))  # parallel delete_objects batches
+HLS_CLEANUP_RETRIES = 3  # attempts per stream prefix
+HLS_CLEANUP_RETRY_DELAY = 30  # seconds between attempts
+HLS_CLEANUP_SWEEP_INTERVAL = int(os.environ.get('HLS_CLEANUP_SWEEP_INTERVAL', 600))  # orphan sweeps; 0 disables
+# Server processes (Daphne or another ASGI server, runserver) start the registry heartbeat and the
+# orphan sweeper in the background (see ViewerConfig.ready); '0' turns both off
+HLS_BACKGROUND_TASKS = os.environ.get('HLS_BACKGROUND_TASKS', '1') == '1'
+# Servers other than Daphne, Uvicorn, Gunicorn, Hypercorn and runserver are
+# not recognized as such; HLS_SERVING=1 marks their processes as serving
+HLS_SERVING = os.environ.get('HLS_SERVING') == '1'
+HLS_CLEANUP_ORPHAN_AGE = 900  # seconds an unowned prefix must go unwritten before it is swept
+
+# FFmpeg supervision and admission control (see viewer/supervisor.py)
+HLS_MAX_TRANSCODES = int(os.environ['HLS_MAX_TRANSCODES']) if 'HLS_MAX_TRANSCODES' in os.environ else None
+HLS_TRANSCODES_PER_CPU = 1  # node capacity when HLS_MAX_TRANSCODES is unset
+HLS_ADMISSION_POLICY = 'reject'  # or 'queue' streams until a transcode slot frees up
+HLS_ADMISSION_QUEUE_MAX = 50
+HLS_ADMISSION_QUEUE_TIMEOUT = 120  # seconds a queued stream waits before failing
+HLS_SUPERVISOR_INTERVAL = 1  # seconds between health checks
+HLS_STALL_TIMEOUT = 10  # seconds without new output before FFmpeg is restarted
+HLS_RESTART_BACKOFF = 1  # seconds before the first restart, doubling each time
+HLS_RESTART_BACKOFF_MAX = 60
+HLS_RESTART_MAX_ATTEMPTS = 8  # consecutive failed restarts before giving up
+HLS_RESTART_RESET_AFTER = 60  # seconds of healthy output that reset the backoff
+
+# Streams nobody has watched (playlist fetches via hls_serve, WebSocket
+# watches) for this many seconds are stopped; 0 disables
+HLS_IDLE_TIMEOUT = int(os.environ.get('HLS_IDLE_TIMEOUT', 300))
+HLS_IDLE_CHECK_INTERVAL = 5  # seconds between idle checks
+HLS_VIEWER_WINDOW = 15  # seconds a playlist fetch counts its player as a viewer
+
+# Multi-node deployments (see viewer/registry.py). Setting HLS_NODE_URL to
+# the address other nodes reach this one at makes it join the cluster:
+# it heartbeats into the registry, takes streams placed on it and forwards
+# requests for streams it does not run to the node that does.
+HLS_NODE_ID = os.environ.get('HLS_NODE_ID', f'{socket.gethostname()}-{os.getpid()}')
+HLS_NODE_URL = os.environ.get('HLS_NODE_URL')
+HLS_REGISTRY = os.environ.get('HLS_REGISTRY', 'db')  # or 'redis'
+HLS_REDIS_URL = os.environ.get('HLS_REDIS_URL')
+# Signs requests one node forwards to another; must be the same on every
+# node and is required once HLS_NODE_URL is set
+HLS_CLUSTER_SECRET = os.environ.get('HLS_CLUSTER_SECRET')
+HLS_FORWARD_MAX_AGE = 30  # seconds a forwarded request's signature stays valid
+HLS_HEARTBEAT_INTERVAL = 5  # seconds
+HLS_NODE_TIMEOUT = 15  # seconds without a heartbeat before a node counts as gone
+HLS_OWNER_CACHE_TTL = 2  # seconds a stream's owner is cached per process
+HLS_PROXY_TIMEOUT = 30  # seconds; must outlast a blocking LL-HLS playlist reload
+
+# Where segments live unless a stream asks otherwise: 's3' uploads them to
+# Django's default storage, 'local' serves them from HLS_LOCAL_ROOT on this
+# server (see viewer/segment_store.py)
+HLS_SEGMENT_STORE = os.environ.get('HLS_SEGMENT_STORE', 's3')
+HLS_LOCAL_ROOT = os.environ.get('HLS_LOCAL_ROOT', str(MEDIA_ROOT / 'hls_local'))  # e.g. a tmpfs mount
+# Internal nginx location aliased to HLS_LOCAL_ROOT (e.g. '/hls-local/');
+# when set, local files are handed to nginx with X-Accel-Redirect
+HLS_LOCAL_ACCEL_REDIRECT = os.environ.get('HLS_LOCAL_ACCEL_REDIRECT')
+
+# In-memory cache of recently uploaded playlists and segments behind hls_serve
+HLS_CACHE_MAX_BYTES = int(os.environ.get('HLS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+HLS_CACHE_PLAYLIST_TTL = 2  # seconds; each upload replaces the cached playlist anyway
+HLS_CACHE_SEGMENT_TTL = 120  # seconds, unless the segment rotates out first
+HLS_PLAYLIST_MAX_AGE = 1  # Cache-Control max-age sent with live playlists
+
+# Low-latency HLS ("low_latency": true), served from memory by hls_serve
+HLS_LL_PART_TARGET = 0.2  # seconds per partial segment
+HLS_LL_SEGMENT_TARGET = 2.0  # seconds per full segment
+HLS_LL_WINDOW = 6  # full segments kept in memory per stream
+
+# Motion gating ("motion": true): FFmpeg also writes small grayscale frames
+# that are diffed to find motion, and a transcoded stream is re-encoded at a
+# low frame rate and bitrate while its scene is static (see viewer/motion.py)
+HLS_MOTION_FPS = 2  # frames a second the detector looks at
+HLS_MOTION_SIZE = (64, 36)  # width, height the detector's frames are scaled to
+HLS_MOTION_PIXEL_THRESHOLD = 25  # luma change (0-255) that counts a pixel as changed
+HLS_MOTION_AREA = 0.005  # share of changed pixels that counts as motion
+HLS_MOTION_HOLD = 5  # seconds without motion that end a motion event
+HLS_MOTION_IDLE_AFTER = 30  # seconds without motion before switching to the idle encode
+HLS_MOTION_IDLE_FPS = 2
+HLS_MOTION_IDLE_BITRATE = 250  # kbit/s
+HLS_MOTION_MAX_EVENTS = 500  # motion events kept per stream
+
+# Snapshots (/snapshot/<stream_id>.jpg): each stream's FFmpeg keeps its
+# latest frame as a small JPEG, which is re-read at most every MAX_AGE seconds
+HLS_SNAPSHOT_INTERVAL = 5  # seconds between frames FFmpeg writes; 0 turns snapshots off
+HLS_SNAPSHOT_HEIGHT = 360
+HLS_SNAPSHOT_MAX_AGE = 5  # seconds; also the responses' Cache-Control max-age
+HLS_SNAPSHOT_MAX_BATCH = 100  # streams per /snapshots/ request
+
+# DVR recording ("record": true): rotated segments stay in storage for the
+# stream's retention and are cataloged by time (see viewer/recording.py)
+HLS_RECORD_RETENTION = int(os.environ.get('HLS_RECORD_RETENTION', 24 * 3600))  # seconds
+# Expiry runs in the one server process started with HLS_RECORD_EXPIRY=1 (or
+# from cron with manage.py expire_recordings); several would race over the same rows
+HLS_RECORD_EXPIRY = os.environ.get('HLS_RECORD_EXPIRY') == '1'
+HLS_RECORD_EXPIRE_INTERVAL = 300  # seconds between deletions of expired segments; 0 disables
+HLS_RECORD_MAX_SEGMENT = 60  # seconds; longest segment a range lookup has to reach back for
+HLS_RECORD_MAX_PLAYLIST = 20000  # segments in one recording playlist (~11 h of 2 s segments)
+
+# Mosaics (/mosaics/): each source is decoded once into small frames that
+# any number of mosaics tile into one stream (see viewer/mosaic.py)
+HLS_MOSAIC_SIZE = (1920, 1080)  # default output size
+HLS_MOSAIC_MAX_SIZE = (3840, 2160)
+HLS_MOSAIC_MAX_SOURCES = 25
+HLS_MOSAIC_FPS = 10  # frames a second of the tiles and the output
+HLS_MOSAIC_BITRATE = 4000  # kbit/s
+HLS_MOSAIC_TILE_HEIGHT = 360  # height sources are decoded down to
+HLS_MOSAIC_FEED_WAIT = 5  # seconds a new mosaic waits for its sources' first frames
+HLS_MOSAIC_FRAME_RATE = 2  # frames a second for snapshots and MJPEG viewers
+
+# fMP4 over the WebSocket ("format": "fmp4") for Media Source Extensions players
+WS_MSE_FRAGMENT_DURATION = 0.2  # seconds per fragment; one is also cut at every keyframe
+WS_MSE_MAX_BACKLOG = 50  # fragments a slow client may have waiting before it skips to the next keyframe
+
+# Multiplexed WebSocket connections (the viewer.framed.v1 subprotocol)
+WS_MAX_CHANNELS = 64  # cameras one connection may subscribe to
+WS_BATCH_MAX_BYTES = 1024 * 1024  # upper bound on a client's "batch_bytes"
+WS_BATCH_MAX_DELAY = 0.1  # seconds; upper bound on a client's "batch_delay"
 
 # CORS settings - Allow all origins for development
 CORS_ALLOW_ALL_ORIGINS = True 
@@ -147,6 +303,14 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     }
 }
+# Several nodes need a shared layer to message each other's consumers
+if HLS_REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [HLS_REDIS_URL]},
+        }
+    }
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -0,0 +1,79 @@
+import time
+from django.conf import settings
+
+
+class ViewerActivity:
+    """
+    When each HLS stream was last watched.
+
+    Players re-fetch the playlist every few seconds, so hls_serve touches a
+    stream on every playlist request. WebSocket clients can also hold a
+    stream open for as long as they are connected. A stream nobody has
+    touched or held for its idle timeout can be stopped. Viewers are
+    counted as the holders plus the distinct players (by address and user
+    agent) that fetched a playlist within HLS_VIEWER_WINDOW.
+    """
+    def __init__(self):
+        self.last_seen = {}
+        self.holders = {}
+        self.players = {}
+
+    def touch(self, stream_id, viewer=None):
+        now = time.monotonic()
+        self.last_seen[stream_id] = now
+        if viewer is not None:
+            players = self.players.setdefault(stream_id, {})
+            players[viewer] = now
+            cutoff = now - settings.HLS_VIEWER_WINDOW
+            for key, seen in list(players.items()):
+                if seen < cutoff:
+                    del players[key]
+
+    def hold(self, stream_id):
+        self.holders[stream_id] = self.holders.get(stream_id, 0) + 1
+        self.touch(stream_id)
+
+    def release(self, stream_id):
+        count = self.holders.get(stream_id, 0) - 1
+        if count > 0:
+            self.holders[stream_id] = count
+        else:
+            self.holders.pop(stream_id, None)
+        # The idle period starts when the last holder leaves
+        self.touch(stream_id)
+
+    def forget(self, stream_id):
+        self.last_seen.pop(stream_id, None)
+        self.players.pop(stream_id, None)
+
+    def viewers(self, stream_id):
+        # Also read by the registry heartbeat thread, so only copies are iterated
+        cutoff = time.monotonic() - settings.HLS_VIEWER_WINDOW
+        seen = list(self.players.get(stream_id, {}).values())
+        return self.holders.get(stream_id, 0) + sum(1 for t in seen if t >= cutoff)
+
+    def idle_for(self, stream_id):
+        """Seconds since the stream was last watched; 0 while it is held."""
+        if self.holders.get(stream_id):
+            return 0
+        last_seen = self.last_seen.get(stream_id)
+        if last_seen is None:
+            return 0
+        return time.monotonic() - last_seen
+
+    def stats(self, stream_id):
+        return {
+            'viewers': self.viewers(stream_id),
+            'idle_for': round(self.idle_for(stream_id), 1),
+        }
+
+
+_activity = None
+
+
+def get_activity():
+    # Only changed from the event loop, so no lock is needed
+    global _activity
+    if _activity is None:
+        _activity = ViewerActivity()
+    return _activity
@@ -1,5 +1,46 @@
+import os
+import sys
 from django.apps import AppConfig
+from django.conf import settings
+
+
+# Programs that serve the ASGI application, run directly or with python -m
+SERVER_PROGRAMS = ('daphne', 'uvicorn', 'gunicorn', 'hypercorn')
+
+
+def _serving():
+    """
+    Whether this process is known to serve requests: an ASGI server from
+    SERVER_PROGRAMS, runserver, or any process with HLS_SERVING set. Tests,
+    workers, scripts and other manage.py commands are not.
+    """
+    if settings.HLS_SERVING:
+        return True
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if program == '__main__.py':
+        program = os.path.basename(os.path.dirname(sys.argv[0]))
+    if program in SERVER_PROGRAMS:
+        return True
+    # runserver's autoreloader serves from a child process
+    return program == 'manage.py' and sys.argv[1:2] == ['runserver'] and \
+        (os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv)
+
 
 class ViewerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'viewer'
+
+    def ready(self):
+        from . import registry
+        registry.check_configuration()
+        # Background threads run in server processes only, never in
+        # migrate, tests, the benchmarks or other importers of the app
+        if not _serving():
+            return
+        from . import cleanup, hls_stream, recording
+        if settings.HLS_BACKGROUND_TASKS:
+            if registry.cluster_enabled():
+                registry.start_heartbeat(hls_stream.node_snapshot)
+            cleanup.start_sweeper(hls_stream.is_stream_live)
+        if settings.HLS_RECORD_EXPIRY:
+            recording.start_expiry()
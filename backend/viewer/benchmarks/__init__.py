@@ -0,0 +1,97 @@
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import django
+
+
+def fake_ffmpeg_binary(directory=None):
+    """
+    Write an executable wrapper around fake_ffmpeg.py that can be used as
+    settings.FFMPEG_BINARY, and return its path.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ffmpeg.py')
+    directory = directory or tempfile.mkdtemp(prefix='fake_ffmpeg_')
+    path = os.path.join(directory, 'ffmpeg')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def looped_source_binary(ffmpeg, clip, directory=None):
+    """
+    Write an executable that runs the real `ffmpeg` with every camera input
+    replaced by `clip` played in a loop (see looped_source.py), and return
+    its path for use as settings.FFMPEG_BINARY.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'looped_source.py')
+    directory = directory or tempfile.mkdtemp(prefix='looped_source_')
+    path = os.path.join(directory, 'ffmpeg-looped')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "{ffmpeg}" "{clip}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def make_test_clip(ffmpeg, path, seconds=10, size='1280x720', fps=25):
+    """
+    Encode an H.264 clip of FFmpeg's lavfi test pattern with a keyframe
+    every second, like a typical camera stream. Raises CalledProcessError
+    if FFmpeg fails.
+    """
+    subprocess.run([
+        ffmpeg, '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={fps}',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(seconds),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(fps), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        path,
+    ], check=True, capture_output=True)
+    return path
+
+
+def filesystem_storages(location):
+    """A STORAGES setting that keeps every upload on local disk under `location`."""
+    options = {'location': location}
+    if django.VERSION >= (5, 1):
+        # Playlists are rewritten under the same name, like S3 with overwrite on
+        options['allow_overwrite'] = True
+    return {
+        'default': {
+            'BACKEND': 'django.core.files.storage.FileSystemStorage',
+            'OPTIONS': options,
+        },
+        'staticfiles': {
+            'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+        },
+    }
+
+
+class DelayedStorage:
+    """
+    Wraps a storage so exists/open/save each cost `delay` seconds, roughly
+    one S3 round trip, for benchmarking without a bucket.
+    """
+    def __init__(self, storage, delay):
+        self.storage = storage
+        self.delay = delay
+
+    def exists(self, name):
+        time.sleep(self.delay)
+        return self.storage.exists(name)
+
+    def open(self, name, mode='rb'):
+        time.sleep(self.delay)
+        return self.storage.open(name, mode)
+
+    def save(self, name, content, max_length=None):
+        time.sleep(self.delay)
+        return self.storage.save(name, content, max_length=max_length)
+
+    def delete(self, name):
+        time.sleep(self.delay)
+        return self.storage.delete(name)
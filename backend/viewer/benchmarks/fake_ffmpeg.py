@@ -0,0 +1,153 @@
+"""
+Stand-in for the FFmpeg HLS command used by the benchmarks.
+
+Accepts the same arguments start_hls_stream passes to FFmpeg, ignores the
+input, and writes dummy segments plus a rolling playlist at the -hls_time
+cadence, deleting rotated segments like -hls_flags delete_segments. It
+honours -hls_start_number_source epoch and the program_date_time flag, and
+rewrites a snapshot output (`-f image2 -update 1 ... PATH`) with each segment. With
+-progress pipe:N it reports one progress block per segment on that fd.
+The MJPEG commands the WebSocket broadcasters run (`-f mjpeg ... -`) get
+JPEG-shaped frames on stdout at their -r rate instead, and a mosaic tile
+feed (only a JPEG output) rewrites its JPEG at its fps filter's rate. A motion detector
+output (`-f rawvideo -`) gets grayscale frames on stdout at its fps filter's
+rate, changing every frame for FAKE_FFMPEG_MOTION_SECONDS and then static.
+Run as FFPROBE_BINARY (`-show_entries ...`), it answers after
+FAKE_FFPROBE_DELAY with a 720p H.264 camera with AAC audio.
+
+Environment:
+    FAKE_FFMPEG_SEGMENT_BYTES  size of each segment (default 500000)
+    FAKE_FFMPEG_STARTUP        seconds before the first segment (default 1)
+    FAKE_FFMPEG_JPEG_BYTES     size of each MJPEG frame (default 20000)
+    FAKE_FFMPEG_MOTION_SECONDS seconds of motion at the start (default 0)
+    FAKE_FFPROBE_DELAY         seconds a probe takes (default 1)
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+def option(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+def write_atomic(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def progress_writer(args):
+    target = option(args, '-progress')
+    if not target or not target.startswith('pipe:'):
+        return None
+    return os.fdopen(int(target[len('pipe:'):]), 'w', buffering=1)
+
+
+def mjpeg(args):
+    rate = float(option(args, '-r', '2'))
+    frame = b'\xff\xd8' + b'\x00' * (int(os.environ.get('FAKE_FFMPEG_JPEG_BYTES', 20_000)) - 4) + b'\xff\xd9'
+    while True:
+        sys.stdout.buffer.write(frame)
+        sys.stdout.buffer.flush()
+        time.sleep(1 / rate)
+
+
+def motion_frames(args):
+    filters = option(args, '-vf', '')
+    rate = float(re.search(r'fps=([\d.]+)', filters).group(1))
+    width, height = map(int, re.search(r'scale=(\d+):(\d+)', filters).groups())
+    moving_until = time.monotonic() + float(os.environ.get('FAKE_FFMPEG_MOTION_SECONDS', 0))
+    count = 0
+    while True:
+        # Alternating black and white frames for motion, mid-grey once static
+        level = (0, 255)[count % 2] if time.monotonic() < moving_until else 128
+        sys.stdout.buffer.write(bytes([level]) * (width * height))
+        sys.stdout.buffer.flush()
+        count += 1
+        time.sleep(1 / rate)
+
+
+def ffprobe():
+    time.sleep(float(os.environ.get('FAKE_FFPROBE_DELAY', 1)))
+    sys.stdout.write(json.dumps({'streams': [
+        {'codec_type': 'video', 'codec_name': 'h264', 'profile': 'Main', 'width': 1280, 'height': 720,
+         'avg_frame_rate': '25/1'},
+        {'codec_type': 'audio', 'codec_name': 'aac'},
+    ]}))
+
+
+def tile_frames(args):
+    rate = float(re.search(r'fps=([\d.]+)', option(args, '-vf', '')).group(1))
+    time.sleep(float(os.environ.get('FAKE_FFMPEG_STARTUP', 1)))
+    count = 0
+    while True:
+        write_atomic(args[-1], b'\xff\xd8' + count.to_bytes(8, 'big') + b'\xff\xd9')
+        count += 1
+        time.sleep(1 / rate)
+
+
+def main(args):
+    if '-show_entries' in args:
+        return ffprobe()
+    if 'mjpeg' in args and args[-1] == '-':
+        return mjpeg(args)
+    if args[-1].endswith('.jpg'):
+        return tile_frames(args)
+    if 'rawvideo' in args:
+        threading.Thread(target=motion_frames, args=(args,), daemon=True).start()
+    playlist_path = args[-1]
+    directory = os.path.dirname(playlist_path)
+    pattern = option(args, '-hls_segment_filename', os.path.join(directory, 'stream%d.ts'))
+    segment_time = float(option(args, '-hls_time', '2'))
+    list_size = int(option(args, '-hls_list_size', '10'))
+    segment_bytes = int(os.environ.get('FAKE_FFMPEG_SEGMENT_BYTES', 500_000))
+    program_date_time = 'program_date_time' in option(args, '-hls_flags', '')
+    snapshot = args[args.index('-update') + 4] if '-update' in args else None
+    progress = progress_writer(args)
+    time.sleep(float(os.environ.get('FAKE_FFMPEG_STARTUP', 1)))
+
+    payload = b'\x47' + b'\x00' * (segment_bytes - 1)
+    start = int(time.time()) if option(args, '-hls_start_number_source') == 'epoch' else 0
+    sequence = start
+    started_at = {}
+    while True:
+        started_at[sequence] = time.time() - segment_time
+        write_atomic(pattern % sequence, payload)
+        if snapshot:
+            write_atomic(snapshot, b'\xff\xd8' + sequence.to_bytes(8, 'big') + b'\xff\xd9')
+        sequence += 1
+        first = max(start, sequence - list_size)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{int(segment_time)}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for i in range(first, sequence):
+            if program_date_time:
+                date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started_at[i]))
+                lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{date}.{int(started_at[i] * 1000) % 1000:03d}+0000')
+            lines += [f'#EXTINF:{segment_time:.6f},', os.path.basename(pattern % i)]
+        write_atomic(playlist_path, ('\n'.join(lines) + '\n').encode())
+        if progress is not None:
+            written = sequence - start
+            frames = int(written * segment_time * 25)
+            kbps = segment_bytes * 8 / segment_time / 1000
+            progress.write(f'frame={frames}\nfps=25.00\nbitrate={kbps:.1f}kbits/s\n'
+                           f'total_size={written * segment_bytes}\nout_time_us={int(written * segment_time * 1e6)}\n'
+                           f'drop_frames=0\nspeed=1.00x\nprogress=continue\n')
+        started_at.pop(first - 1, None)
+        stale = first - 2
+        if stale >= start:
+            try:
+                os.remove(pattern % stale)
+            except FileNotFoundError:
+                pass
+        time.sleep(segment_time)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
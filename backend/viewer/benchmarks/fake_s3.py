@@ -0,0 +1,69 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class FakeS3Client:
+    """
+    In-memory stand-in for the boto3 S3 client calls the cleanup code makes:
+    put_object, list_objects_v2 (MaxKeys, ContinuationToken, Delimiter) and
+    delete_objects, including its 1000-key limit. `delay` is added to every
+    call to mimic S3 round trips.
+    """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.objects = {}
+        self.calls = {'list_objects_v2': 0, 'delete_objects': 0}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body=b'', LastModified=None):
+        with self._lock:
+            self.objects[Key] = LastModified or datetime.now(timezone.utc)
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, Delimiter=None):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls['list_objects_v2'] += 1
+            keys = sorted(k for k in self.objects if k.startswith(Prefix))
+            contents, prefixes = [], []
+            last = None
+            for key in keys:
+                if ContinuationToken is not None:
+                    # Tokens are the last key or common prefix of the previous page
+                    if key <= ContinuationToken or (ContinuationToken.endswith(Delimiter or '\0')
+                                                    and key.startswith(ContinuationToken)):
+                        continue
+                rest = key[len(Prefix):]
+                common = Prefix + rest.split(Delimiter)[0] + Delimiter if Delimiter and Delimiter in rest else None
+                if common is not None and prefixes and prefixes[-1]['Prefix'] == common:
+                    continue
+                if len(contents) + len(prefixes) == MaxKeys:
+                    return self._page(contents, prefixes, last, truncated=True)
+                if common is not None:
+                    prefixes.append({'Prefix': common})
+                    last = common
+                else:
+                    contents.append({'Key': key, 'LastModified': self.objects[key]})
+                    last = key
+            return self._page(contents, prefixes, last, truncated=False)
+
+    def _page(self, contents, prefixes, last, truncated):
+        page = {'IsTruncated': truncated, 'KeyCount': len(contents) + len(prefixes)}
+        if contents:
+            page['Contents'] = contents
+        if prefixes:
+            page['CommonPrefixes'] = prefixes
+        if truncated:
+            page['NextContinuationToken'] = last
+        return page
+
+    def delete_objects(self, Bucket, Delete):
+        time.sleep(self.delay)
+        objects = Delete['Objects']
+        if len(objects) > 1000:
+            raise ValueError('MalformedXML: delete_objects takes at most 1000 keys')
+        with self._lock:
+            self.calls['delete_objects'] += 1
+            for obj in objects:
+                self.objects.pop(obj['Key'], None)
+        return {} if Delete.get('Quiet') else {'Deleted': [{'Key': obj['Key']} for obj in objects]}
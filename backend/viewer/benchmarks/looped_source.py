@@ -0,0 +1,39 @@
+"""
+Runs a real FFmpeg with the camera swapped for a local file played in a
+loop at its native rate, so benchmarks exercise the real encode and mux
+path without a camera or network.
+
+Usage: looped_source.py FFMPEG CLIP ARGS...
+
+ARGS are the arguments the viewer would pass to FFmpeg. The first `-i` is
+replaced with `-re -stream_loop -1 -i CLIP`, and the RTSP-only input
+options, which FFmpeg rejects for files, are dropped.
+"""
+import os
+import sys
+
+RTSP_OPTIONS = ('-rtsp_transport', '-rtsp_flags')
+
+
+def rewrite(args, clip):
+    out = []
+    replaced = False
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if not replaced and arg in RTSP_OPTIONS:
+            i += 2
+            continue
+        if not replaced and arg == '-i':
+            out += ['-re', '-stream_loop', '-1', '-i', clip]
+            replaced = True
+            i += 2
+            continue
+        out.append(arg)
+        i += 1
+    return out
+
+
+if __name__ == '__main__':
+    ffmpeg, clip = sys.argv[1], sys.argv[2]
+    os.execvp(ffmpeg, [ffmpeg] + rewrite(sys.argv[3:], clip))
@@ -0,0 +1,35 @@
+"""
+Raw gray video frames that carry their own capture time.
+
+The top rows of each frame are a barcode of the wall-clock time in
+milliseconds (one white or black cell per bit, most significant first), so
+a decoded frame or a screenshot of a player says when it was captured.
+"""
+
+BITS = 48
+STRIP_ROWS = 32
+
+
+def timestamp_frame(width, height, captured_at, index=0):
+    """Return one width x height gray frame stamped with `captured_at` (seconds)."""
+    stamp = int(captured_at * 1000)
+    cell = width // BITS
+    code = bytearray(width)
+    for bit in range(BITS):
+        if stamp >> (BITS - 1 - bit) & 1:
+            code[bit * cell:(bit + 1) * cell] = b'\xff' * cell
+    # A moving bar gives the encoder something to do between keyframes
+    row = bytearray(b'\x80') * width
+    x = (index * 8) % max(width - 16, 1)
+    row[x:x + 16] = b'\xff' * 16
+    return bytes(code) * STRIP_ROWS + bytes(row) * (height - STRIP_ROWS)
+
+
+def read_timestamp(frame, width):
+    """Recover the capture time (seconds) from a decoded gray frame."""
+    cell = width // BITS
+    row = STRIP_ROWS // 2 * width
+    stamp = 0
+    for bit in range(BITS):
+        stamp = stamp << 1 | (frame[row + bit * cell + cell // 2] > 127)
+    return stamp / 1000
@@ -0,0 +1,295 @@
+import asyncio
+import time
+from collections import deque
+from django.conf import settings
+from .ffmpeg_commands import build_mse_command
+from .fmp4 import FragmentReader, codec_string, parse_fragment, parse_init_segment
+from .jpeg_parser import JPEGFrameParser
+from .probe import probe_stream
+from .rtsp import camera_key
+
+# One broadcaster per output format and normalized camera URL (credentials included)
+active_broadcasters = {}
+
+# What the transcode path produces (-profile:v baseline), for init segments
+# whose codec cannot be read
+DEFAULT_MSE_CODEC = 'avc1.42E01E'
+
+
+class MJPEGBroadcaster:
+    """
+    Runs a single MJPEG FFmpeg process for one camera and publishes every
+    frame to all subscribed consumers.
+
+    Subscribers implement non-blocking `push_frame(jpeg, sequence,
+    captured_at)` and `push_event(payload)`, normally backed by a
+    FrameOutbox, so a slow viewer never holds up the read loop or the other
+    viewers. Frames are numbered from 1 per broadcaster and stamped with the
+    wall-clock time they were read. The broadcaster is reference-counted by
+    its subscribers: the FFmpeg process is killed as soon as the last one
+    unsubscribes.
+    """
+    # Bytes of FFmpeg output buffered before the pipe is paused
+    read_limit = 1 << 20
+
+    def __init__(self, key, url):
+        self.key = key
+        self.url = url
+        self.subscribers = set()
+        self.process = None
+        self.task = None
+        self.started = False
+        self.frame_count = 0
+        self.stderr_tail = deque(maxlen=10)
+
+    def build_command(self):
+        return [
+            settings.FFMPEG_BINARY,
+            '-rtsp_transport', 'tcp',
+            '-i', self.url,
+            '-f', 'mjpeg',
+            '-q:v', '5',
+            '-update', '1',
+            '-r', '2',  # 2 fps for demo
+            '-'
+        ]
+
+    @classmethod
+    def key_for(cls, url):
+        return camera_key(url)
+
+    async def prepare(self):
+        """Runs before build_command(); subclasses probe the camera here."""
+
+    def join(self, subscriber):
+        """Catch up a subscriber that joins a running broadcaster."""
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def publish_frame(self, jpeg):
+        captured_at = time.time()
+        for subscriber in list(self.subscribers):
+            subscriber.push_frame(jpeg, self.frame_count, captured_at)
+
+    def publish_event(self, payload):
+        for subscriber in list(self.subscribers):
+            subscriber.push_event(payload)
+
+    def last_error_lines(self):
+        return '\n'.join(self.stderr_tail)
+
+    async def _drain_stderr(self):
+        # Keep reading so FFmpeg never blocks on a full stderr pipe
+        while True:
+            line = await self.process.stderr.readline()
+            if not line:
+                break
+            self.stderr_tail.append(line.decode(errors='ignore').rstrip())
+
+    async def read_output(self):
+        parser = JPEGFrameParser(max_chunk=self.read_limit)
+        while True:
+            chunk = await self.process.stdout.read(parser.chunk_size)
+            if not chunk:
+                break
+            for jpeg in parser.feed(chunk):
+                self.frame_count += 1
+                self.publish_frame(jpeg)
+
+    async def run(self):
+        try:
+            await self.prepare()
+            self.process = await asyncio.create_subprocess_exec(
+                *self.build_command(),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=self.read_limit
+            )
+        except Exception as e:
+            self.publish_event({'error': f'Could not start FFmpeg: {str(e)}'})
+            self._close()
+            return
+
+        self.started = True
+        self.publish_event({'message': 'Streaming started'})
+        stderr_task = asyncio.ensure_future(self._drain_stderr())
+
+        # Stream the RTSP as a continuous live stream
+        try:
+            await self.read_output()
+            await self._wait_for_exit(stderr_task)
+            # After streaming, check for FFmpeg errors
+            if self.frame_count == 0:
+                self.publish_event({'error': f'No frames received. FFmpeg error:\n{self.last_error_lines()}'})
+            self.publish_event({'message': f'Stream ended after {self.frame_count} frames'})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.publish_event({'error': f'Error streaming: {str(e)}\nFFmpeg error:\n{self.last_error_lines()}'})
+        finally:
+            stderr_task.cancel()
+            if self.process.returncode is None:
+                self.process.kill()
+                await self.process.wait()
+            self._close()
+
+    async def _wait_for_exit(self, stderr_task):
+        try:
+            await asyncio.wait_for(stderr_task, timeout=5)
+        except asyncio.TimeoutError:
+            pass
+
+    def _close(self):
+        if active_broadcasters.get(self.key) is self:
+            del active_broadcasters[self.key]
+        self.subscribers.clear()
+
+
+class FMP4Broadcaster(MJPEGBroadcaster):
+    """
+    Runs one fragmented-MP4 FFmpeg process per camera for Media Source
+    Extensions players, copying H.264 cameras and encoding the rest.
+
+    Subscribers get an {"mse": {"mime": ...}} event, then the init segment
+    through `push_init(data)`, then every [styp] moof mdat fragment through
+    `push_media(data, keyframe, sequence, captured_at)`. The init segment
+    and the fragments since the latest keyframe are kept, so a late joiner
+    can start decoding at once instead of waiting for the next keyframe.
+    """
+    read_size = 65536
+
+    def __init__(self, key, url):
+        super().__init__(key, url)
+        self.probe = None
+        self.mode = 'transcode'
+        self.init_segment = None
+        self.tracks = {}
+        self.mime = None
+        self.gop = []
+
+    @classmethod
+    def key_for(cls, url):
+        return f'fmp4:{camera_key(url)}'
+
+    async def prepare(self):
+        try:
+            self.probe = await probe_stream(self.url)
+        except Exception as e:
+            print(f"Error probing camera, falling back to transcoding: {e}")
+        # Browsers decode H.264 everywhere; anything else is re-encoded
+        self.mode = 'copy' if self.probe and self.probe.get('video_codec') == 'h264' else 'transcode'
+
+    def build_command(self):
+        return build_mse_command(self.url, self.mode, self.probe, settings.WS_MSE_FRAGMENT_DURATION)
+
+    async def read_output(self):
+        reader = FragmentReader()
+        while True:
+            chunk = await self.process.stdout.read(self.read_size)
+            if not chunk:
+                break
+            for kind, data in reader.feed(chunk):
+                if kind == 'init':
+                    self.set_init_segment(data)
+                elif self.init_segment is not None:
+                    self.add_fragment(data)
+
+    def set_init_segment(self, data):
+        self.init_segment = data
+        self.tracks = parse_init_segment(data)
+        self.mime = f'video/mp4; codecs="{codec_string(data) or DEFAULT_MSE_CODEC}"'
+        self.gop = []
+        for subscriber in list(self.subscribers):
+            self.join(subscriber)
+
+    def add_fragment(self, data):
+        info = parse_fragment(data, self.tracks)
+        keyframe = bool(info and info['independent'])
+        self.frame_count += 1
+        fragment = (data, self.frame_count, time.time())
+        if keyframe:
+            self.gop = [fragment]
+        elif self.gop:
+            self.gop.append(fragment)
+            if len(self.gop) > settings.WS_MSE_MAX_BACKLOG:
+                # Too long to replay; late joiners wait for the next keyframe instead
+                self.gop = []
+        for subscriber in list(self.subscribers):
+            subscriber.push_media(data, keyframe, *fragment[1:])
+
+    def join(self, subscriber):
+        if self.init_segment is None:
+            return
+        subscriber.push_event({'mse': {'mime': self.mime}})
+        subscriber.push_init(self.init_segment)
+        for i, (data, sequence, captured_at) in enumerate(self.gop):
+            subscriber.push_media(data, i == 0, sequence, captured_at)
+
+
+class MosaicBroadcaster(MJPEGBroadcaster):
+    """
+    Streams a mosaic to WebSocket viewers as MJPEG. The mosaic's compositor
+    already keeps its newest frame as a JPEG (see build_mosaic_command), so
+    this FFmpeg only re-reads that file HLS_MOSAIC_FRAME_RATE times a second
+    and copies it out; nothing is decoded or encoded again.
+    """
+    @classmethod
+    def key_for(cls, url):
+        return f'mosaic:{url}'
+
+    def build_command(self):
+        return [
+            settings.FFMPEG_BINARY,
+            '-re',
+            '-f', 'image2',
+            '-loop', '1',
+            '-framerate', str(settings.HLS_MOSAIC_FRAME_RATE),
+            '-i', self.url,
+            '-c:v', 'copy',
+            '-f', 'mjpeg',
+            '-',
+        ]
+
+
+# Broadcaster per WebSocket "format"
+BROADCASTERS = {
+    'mjpeg': MJPEGBroadcaster,
+    'fmp4': FMP4Broadcaster,
+}
+
+
+def subscribe(url, subscriber, broadcaster_class=MJPEGBroadcaster):
+    """
+    Attach a subscriber to the broadcaster for `url`, starting FFmpeg if this
+    is the first viewer of that camera in that format. Returns the broadcaster.
+    """
+    key = broadcaster_class.key_for(url)
+    broadcaster = active_broadcasters.get(key)
+    if broadcaster is None:
+        broadcaster = active_broadcasters[key] = broadcaster_class(key, url)
+        broadcaster.subscribers.add(subscriber)
+        broadcaster.start()
+    else:
+        broadcaster.subscribers.add(subscriber)
+        broadcaster.join(subscriber)
+    return broadcaster
+
+
+async def unsubscribe(broadcaster, subscriber):
+    """
+    Detach a subscriber; the last one out stops the camera's FFmpeg process.
+    """
+    broadcaster.subscribers.discard(subscriber)
+    if not broadcaster.subscribers:
+        if active_broadcasters.get(broadcaster.key) is broadcaster:
+            del active_broadcasters[broadcaster.key]
+        await broadcaster.stop()
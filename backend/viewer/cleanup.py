@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db import close_old_connections
+from .upload_pool import get_s3_client
+
+# The most keys one delete_objects call accepts
+DELETE_BATCH = 1000
+
+
+def list_keys(client, bucket, prefix, before=None):
+    """
+    Yield the keys under `prefix` a page (up to 1000) at a time, following
+    continuation tokens. With `before`, objects modified after it are left out.
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': DELETE_BATCH}
+    while True:
+        response = client.list_objects_v2(**kwargs)
+        keys = [obj['Key'] for obj in response.get('Contents', [])
+                if before is None or obj['LastModified'] <= before]
+        if keys:
+            yield keys
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def delete_prefix(client, bucket, prefix, executor, before=None):
+    """
+    Delete the objects under `prefix` (modified up to `before`), one
+    delete_objects call per page of keys. Batches run on `executor` while
+    listing carries on. Returns (deleted, failed) object counts.
+    """
+    futures = []
+    for keys in list_keys(client, bucket, prefix, before):
+        batch = {'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        futures.append((len(keys), executor.submit(client.delete_objects, Bucket=bucket, Delete=batch)))
+    deleted = failed = 0
+    for count, future in futures:
+        try:
+            errors = len(future.result().get('Errors', []))
+        except Exception as e:
+            print(f"Error deleting a batch under {prefix}: {e}")
+            errors = count
+        deleted += count - errors
+        failed += errors
+    return deleted, failed
+
+
+class CleanupWorker:
+    """
+    Background deletion of stopped streams' objects from S3.
+
+    schedule() queues a prefix and returns at once. A worker thread works
+    through the queue, fanning each prefix's 1000-key batches out to a pool
+    of HLS_CLEANUP_WORKERS threads. Only objects written before the prefix
+    was scheduled are deleted, so a stream restarted under the same id (a
+    registered camera) keeps its new segments. Failed prefixes are retried
+    HLS_CLEANUP_RETRIES times, HLS_CLEANUP_RETRY_DELAY seconds apart.
+    """
+    def __init__(self, client=None, bucket=None, workers=None):
+        self._client = client
+        self.bucket = bucket or settings.AWS_STORAGE_BUCKET_NAME
+        self.workers = workers or settings.HLS_CLEANUP_WORKERS
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._busy = False
+        self._retrying = 0
+        self._thread = None
+        self._executor = None
+        self.prefixes_cleaned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.last_error = None
+
+    @property
+    def client(self):
+        return self._client or get_s3_client()
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='hls-cleanup-batch')
+            self._thread = threading.Thread(target=self._run, name='hls-cleanup', daemon=True)
+        self._thread.start()
+
+    def schedule(self, prefix, before=None):
+        """Queue deletion of everything under `prefix` modified up to `before` (default: now)."""
+        before = before or datetime.now(timezone.utc)
+        with self._cond:
+            self._pending.append((prefix, before, 0))
+            self._cond.notify_all()
+        self.start()
+
+    def _retry(self, job):
+        with self._cond:
+            self._retrying -= 1
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                prefix, before, attempts = self._pending.popleft()
+                self._busy = True
+            try:
+                deleted, failed = delete_prefix(self.client, self.bucket, prefix, self._executor, before)
+                error = f'{failed} objects under {prefix} could not be deleted' if failed else None
+            except Exception as e:
+                deleted, failed, error = 0, 0, f'Error cleaning up {prefix}: {e}'
+            with self._cond:
+                self._busy = False
+                self.deleted += deleted
+                if error is None:
+                    self.prefixes_cleaned += 1
+                elif attempts + 1 < settings.HLS_CLEANUP_RETRIES:
+                    self._retrying += 1
+                    timer = threading.Timer(settings.HLS_CLEANUP_RETRY_DELAY, self._retry,
+                                            args=[(prefix, before, attempts + 1)])
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self.failed += failed
+                    self.last_error = error
+                    print(error)
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is queued, running or waiting to be retried."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._pending or self._busy or self._retrying:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending) + self._busy + self._retrying,
+                'prefixes_cleaned': self.prefixes_cleaned,
+                'deleted_objects': self.deleted,
+                'failed_objects': self.failed,
+                'last_error': self.last_error,
+            }
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_cleanup_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = CleanupWorker()
+        return _worker
+
+
+def find_orphans(client, bucket, is_live, min_age):
+    """
+    Yield (stream_id, prefix) for every stream prefix under HLS_MEDIA_ROOT
+    that `is_live(stream_id)` disowns and that nothing was written to in
+    the last `min_age` seconds.
+    """
+    root = f'{settings.HLS_MEDIA_ROOT}/'
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+    kwargs = {'Bucket': bucket, 'Prefix': root, 'Delimiter': '/'}
+    while True:
+        response = client.list_objects_v2(**kwargs)
+        for common in response.get('CommonPrefixes', []):
+            prefix = common['Prefix']
+            stream_id = prefix[len(root):-1]
+            if is_live(stream_id) or _written_since(client, bucket, prefix, cutoff):
+                continue
+            yield stream_id, prefix
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _written_since(client, bucket, prefix, cutoff):
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = client.list_objects_v2(**kwargs)
+        if any(obj['LastModified'] > cutoff for obj in response.get('Contents', [])):
+            return True
+        if not response.get('IsTruncated'):
+            return False
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def sweep(is_live, worker=None, dry_run=False):
+    """
+    Queue every orphaned stream prefix for deletion and return their stream
+    ids. Orphans are left behind by streams whose node died or whose
+    cleanup failed.
+    """
+    worker = worker or get_cleanup_worker()
+    min_age = settings.HLS_CLEANUP_ORPHAN_AGE
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+    orphans = []
+    for stream_id, prefix in find_orphans(worker.client, worker.bucket, is_live, min_age):
+        orphans.append(stream_id)
+        if not dry_run:
+            worker.schedule(prefix, before=cutoff)
+    return orphans
+
+
+_sweeper = None
+
+
+def start_sweeper(is_live):
+    """Run sweep() every HLS_CLEANUP_SWEEP_INTERVAL seconds from a daemon thread."""
+    global _sweeper
+    if _sweeper is not None or not settings.HLS_CLEANUP_SWEEP_INTERVAL or not settings.AWS_STORAGE_BUCKET_NAME:
+        return
+
+    def run():
+        while True:
+            time.sleep(settings.HLS_CLEANUP_SWEEP_INTERVAL)
+            try:
+                orphans = sweep(is_live)
+                if orphans:
+                    print(f"Cleaning up {len(orphans)} orphaned stream prefixes")
+            except Exception as e:
+                print(f"Orphan sweep failed: {e}")
+            finally:
+                close_old_connections()
+
+    _sweeper = threading.Thread(target=run, name='hls-cleanup-sweeper', daemon=True)
+    _sweeper.start()
@@ -1,102 +1,230 @@
 import json
-import asyncio
+import os
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from . import broadcast, envelope
+from .activity import get_activity
+from .delivery import FrameOutbox
+from .envelope import EnvelopeWriter
+from .mosaic import active_mosaics
+from .rtsp import build_rtsp_url, camera_label
+
+
+def stream_source(data, stream_format):
+    """
+    (url, broadcaster class, label) of what a request asks to watch: a
+    camera ("url", "username", "password") or a running mosaic ("mosaic":
+    its stream id, MJPEG only). Raises ValueError.
+    """
+    if stream_format not in broadcast.BROADCASTERS:
+        raise ValueError(f'Unknown format: {stream_format}')
+    if data.get('mosaic') is not None:
+        mosaic = active_mosaics.get(data['mosaic'])
+        if mosaic is None:
+            raise ValueError('Unknown mosaic')
+        if stream_format != 'mjpeg':
+            raise ValueError('Mosaics are streamed as mjpeg')
+        if not os.path.exists(mosaic.frame_path):
+            raise ValueError('Mosaic is not ready yet')
+        return mosaic.frame_path, broadcast.MosaicBroadcaster, f"mosaic {data['mosaic']}"
+    url = build_rtsp_url(data.get('url'), data.get('username'), data.get('password'))
+    return url, broadcast.BROADCASTERS[stream_format], camera_label(url)
+
+
+class ChannelSubscription:
+    """
+    One camera on a framed connection. Its own FrameOutbox keeps a slow
+    camera's backlog from holding up the others; what it sends is wrapped
+    in envelopes tagged with its channel id and written through the
+    connection's shared EnvelopeWriter.
+    """
+    def __init__(self, channel, writer, mode, label):
+        self.channel = channel
+        self.writer = writer
+        self.broadcaster = None
+        self.outbox = FrameOutbox(self.deliver, mode=mode, label=label, metadata=True)
+
+    def push_frame(self, jpeg, sequence=None, captured_at=None):
+        self.outbox.put_frame(jpeg, sequence, captured_at)
+
+    def push_init(self, data):
+        self.outbox.put_init(data)
+
+    def push_media(self, data, keyframe, sequence=None, captured_at=None):
+        self.outbox.put_media(data, keyframe, sequence, captured_at)
+
+    def push_event(self, payload):
+        self.outbox.put_event(payload)
+
+    async def deliver(self, kind, payload, sequence, captured_at):
+        if kind == 'event':
+            payload = json.dumps(payload).encode()
+        await self.writer.write(envelope.TYPES[kind], self.channel, payload, sequence, captured_at)
+
+    async def close(self):
+        if self.broadcaster is not None:
+            broadcaster, self.broadcaster = self.broadcaster, None
+            await broadcast.unsubscribe(broadcaster, self)
+        await self.outbox.stop()
+
 
 class StreamConsumer(AsyncWebsocketConsumer):
+    broadcaster = None
+    outbox = None
+    writer = None
+
     async def connect(self):
-        await self.accept()
-        await self.send(text_data=json.dumps({
-            'message': 'WebSocket connection established.'
-        }))
+        # HLS streams this client keeps alive (see the "watch" action)
+        self.watching = []
+        # Framed connections: channel id -> ChannelSubscription
+        self.subscriptions = {}
+        if envelope.SUBPROTOCOL in self.scope.get('subprotocols', []):
+            self.writer = EnvelopeWriter(self.send_envelopes)
+            await self.accept(envelope.SUBPROTOCOL)
+        else:
+            await self.accept()
+        await self.reply({'message': 'WebSocket connection established.'})
 
     async def disconnect(self, close_code):
-        # On disconnect, FFmpeg process will be killed automatically by the event loop
-        pass
+        # Release our reference; the camera's FFmpeg stops with its last viewer
+        await self.leave()
+        for subscription in list(self.subscriptions.values()):
+            await subscription.close()
+        self.subscriptions = {}
+        if self.writer is not None:
+            self.writer.close()
+        activity = get_activity()
+        for stream_id in self.watching:
+            activity.release(stream_id)
+        self.watching = []
+
+    async def leave(self):
+        if self.broadcaster is not None:
+            broadcaster, self.broadcaster = self.broadcaster, None
+            await broadcast.unsubscribe(broadcaster, self)
+        if self.outbox is not None:
+            outbox, self.outbox = self.outbox, None
+            await outbox.stop()
+
+    async def reply(self, payload):
+        # Framed connections get control messages as EVENT envelopes on channel 0
+        if self.writer is not None:
+            await self.writer.write(envelope.EVENT, 0, json.dumps(payload).encode())
+        else:
+            await self.send(text_data=json.dumps(payload))
+
+    async def send_envelopes(self, data):
+        await self.send(bytes_data=data)
 
     async def receive(self, text_data=None, bytes_data=None):
         data = json.loads(text_data)
-        url = data.get('url')
-        username = data.get('username')
-        password = data.get('password')
-
-        # Build FFmpeg command for MJPEG output
-        # If credentials provided, insert them into the URL
-        if username and password:
-            url_parts = url.split('rtsp://')
-            if len(url_parts) == 2:
-                url = f"rtsp://{username}:{password}@{url_parts[1]}"
-        
-        ffmpeg_cmd = [
-            'ffmpeg',
-            '-rtsp_transport', 'tcp',
-            '-i', url,
-            '-f', 'mjpeg',
-            '-q:v', '5',
-            '-update', '1',
-            '-r', '2',  # 2 fps for demo
-            '-'
-        ]
+        if data.get('action') in ('watch', 'unwatch'):
+            await self.watch(data.get('stream_id'), data['action'] == 'watch')
+            return
+        if self.writer is not None:
+            await self.receive_framed(data)
+            return
+        if data.get('action') == 'stats':
+            stats = self.outbox.stats() if self.outbox else None
+            await self.reply({'stats': stats})
+            return
+
         try:
-            process = await asyncio.create_subprocess_exec(
-                *ffmpeg_cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            url, broadcaster_class, label = stream_source(data, data.get('format', 'mjpeg'))
+            outbox = FrameOutbox(self.deliver, mode=data.get('delivery', 'latest'), label=label)
         except Exception as e:
-            await self.send(text_data=json.dumps({
-                'error': f'Could not start FFmpeg: {str(e)}'
-            }))
+            await self.reply({'error': f'Invalid stream request: {str(e)}'})
             return
 
-        await self.send(text_data=json.dumps({'message': 'Streaming started'}))
+        # Switching cameras releases the previous one first
+        await self.leave()
+        self.outbox = outbox
+        self.outbox.start()
+        self.broadcaster = broadcast.subscribe(url, self, broadcaster_class)
+        if self.broadcaster.started:
+            # Joining a camera someone else is already watching
+            self.push_event({'message': 'Streaming started'})
 
-        # Stream the RTSP as a continuous live stream
-        boundary = b'\xff\xd8'  # JPEG SOI marker
-        buffer = b''
-        ffmpeg_stderr = b''
-        frame_count = 0
+    async def receive_framed(self, data):
+        action = data.get('action', 'subscribe')
+        if action == 'subscribe':
+            await self.subscribe(data)
+        elif action == 'unsubscribe':
+            subscription = self.subscriptions.pop(data.get('channel'), None)
+            if subscription is None:
+                await self.reply({'error': 'Unknown channel'})
+                return
+            await subscription.close()
+            await self.reply({'unsubscribed': {'channel': subscription.channel}})
+        elif action == 'configure':
+            try:
+                batch_bytes = min(int(data.get('batch_bytes', 0)), settings.WS_BATCH_MAX_BYTES)
+                batch_delay = min(float(data.get('batch_delay', 0)), settings.WS_BATCH_MAX_DELAY)
+            except (TypeError, ValueError):
+                await self.reply({'error': 'batch_bytes and batch_delay must be numbers'})
+                return
+            await self.writer.configure(max(batch_bytes, 0), max(batch_delay, 0))
+            await self.reply({'configured': {'batch_bytes': self.writer.max_bytes,
+                                             'batch_delay': self.writer.max_delay}})
+        elif action == 'stats':
+            await self.reply({'stats': {
+                'connection': self.writer.stats(),
+                'channels': {channel: subscription.outbox.stats()
+                             for channel, subscription in self.subscriptions.items()},
+            }})
+        else:
+            await self.reply({'error': f'Unknown action: {action}'})
+
+    async def subscribe(self, data):
         try:
-            while True:
-                chunk = await process.stdout.read(4096)
-                if not chunk:
-                    # Try to read from stderr for errors
-                    ffmpeg_stderr += await process.stderr.read(4096)
-                    break
-                buffer += chunk
-                # Look for JPEG SOI/EOI markers
-                while True:
-                    start = buffer.find(b'\xff\xd8')
-                    end = buffer.find(b'\xff\xd9', start)
-                    if start != -1 and end != -1:
-                        jpeg = buffer[start:end+2]
-                        buffer = buffer[end+2:]
-                        await self.send(bytes_data=jpeg)
-                        frame_count += 1
-                    else:
-                        break
-            # After streaming, check for FFmpeg errors
-            if frame_count == 0:
-                # Read remaining stderr
-                while True:
-                    err_chunk = await process.stderr.read(4096)
-                    if not err_chunk:
-                        break
-                    ffmpeg_stderr += err_chunk
-                err_text = ffmpeg_stderr.decode(errors='ignore').splitlines()
-                last_lines = '\n'.join(err_text[-10:])  # Send last 10 lines of error
-                await self.send(text_data=json.dumps({'error': f'No frames received. FFmpeg error:\n{last_lines}'}))
-            await self.send(text_data=json.dumps({'message': f'Stream ended after {frame_count} frames'}))
+            if len(self.subscriptions) >= settings.WS_MAX_CHANNELS:
+                raise ValueError(f'At most {settings.WS_MAX_CHANNELS} channels per connection')
+            url, broadcaster_class, label = stream_source(data, data.get('format', 'mjpeg'))
+            channel = next(i for i in range(1, 1 << 16) if i not in self.subscriptions)
+            subscription = ChannelSubscription(channel, self.writer, data.get('delivery', 'latest'), label)
         except Exception as e:
-            # Read remaining stderr
-            while True:
-                err_chunk = await process.stderr.read(4096)
-                if not err_chunk:
-                    break
-                ffmpeg_stderr += err_chunk
-            err_text = ffmpeg_stderr.decode(errors='ignore').splitlines()
-            last_lines = '\n'.join(err_text[-10:])
-            await self.send(text_data=json.dumps({'error': f'Error streaming: {str(e)}\nFFmpeg error:\n{last_lines}'}))
-        finally:
-            if process.returncode is None:
-                process.kill()
-                await process.wait()
+            await self.reply({'error': f'Invalid stream request: {str(e)}'})
+            return
+
+        self.subscriptions[channel] = subscription
+        # The client learns the channel id before any envelope tagged with it
+        await self.reply({'subscribed': {'channel': channel, 'camera': label}})
+        subscription.outbox.start()
+        subscription.broadcaster = broadcast.subscribe(url, subscription, broadcaster_class)
+        if subscription.broadcaster.started:
+            subscription.push_event({'message': 'Streaming started'})
+
+    async def watch(self, stream_id, watching):
+        # A watched HLS stream is not stopped as idle while this socket is open
+        if not isinstance(stream_id, str):
+            await self.reply({'error': 'stream_id required'})
+            return
+        if watching:
+            get_activity().hold(stream_id)
+            self.watching.append(stream_id)
+        elif stream_id in self.watching:
+            get_activity().release(stream_id)
+            self.watching.remove(stream_id)
+        await self.reply({'watching': list(self.watching)})
+
+    def push_frame(self, jpeg, sequence=None, captured_at=None):
+        if self.outbox is not None:
+            self.outbox.put_frame(jpeg, sequence, captured_at)
+
+    def push_init(self, data):
+        if self.outbox is not None:
+            self.outbox.put_init(data)
+
+    def push_media(self, data, keyframe, sequence=None, captured_at=None):
+        if self.outbox is not None:
+            self.outbox.put_media(data, keyframe, sequence, captured_at)
+
+    def push_event(self, payload):
+        if self.outbox is not None:
+            self.outbox.put_event(payload)
+
+    async def deliver(self, kind, payload):
+        if kind == 'event':
+            await self.send(text_data=json.dumps(payload))
+        else:
+            await self.send(bytes_data=payload)
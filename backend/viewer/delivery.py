@@ -0,0 +1,153 @@
+import asyncio
+import time
+from collections import deque
+from django.conf import settings
+from . import metrics
+
+# Frames a connection may have waiting, by delivery mode. 'latest' keeps only
+# the newest frame so a slow client skips ahead; 'queue' smooths over short
+# hiccups but still drops the oldest frame once full.
+DELIVERY_MODES = {
+    'latest': 1,
+    'queue': 30,
+}
+
+
+class FrameOutbox:
+    """
+    Per-connection outbox that decouples the camera reader from the socket.
+
+    put_frame() never blocks: if the client has not drained the previous
+    frames, the oldest waiting frame is dropped in favour of the new one, so a
+    slow client only lowers its own frame rate. Control events are never
+    dropped. A sender task calls `send(kind, payload)` for each item, where
+    kind is 'frame', 'event', 'init' or 'media'; with `metadata`, it calls
+    `send(kind, payload, sequence, captured_at)` instead, passing on what
+    the broadcaster numbered the frame (None for events and init segments).
+    Frames sent and dropped are also counted in the node's metrics under
+    `label` (the camera).
+
+    fMP4 fragments ('media') depend on the ones before them, so they are
+    not dropped one at a time: a client with more than WS_MSE_MAX_BACKLOG
+    waiting loses the whole backlog and resumes at the next keyframe. Init
+    segments are never dropped.
+    """
+    def __init__(self, send, mode='latest', label='', metadata=False):
+        if mode not in DELIVERY_MODES:
+            raise ValueError(f'Unknown delivery mode: {mode}')
+        self.send = send
+        self.mode = mode
+        self.label = label
+        self.metadata = metadata
+        self.max_frames = DELIVERY_MODES[mode]
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.last_send_lag = None
+        self.max_send_lag = 0.0
+        self._items = deque()
+        self._waiting_frames = 0
+        self._skip_to_keyframe = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def put_frame(self, frame, sequence=None, captured_at=None):
+        if self._waiting_frames >= self.max_frames:
+            self._drop_oldest_frame()
+        self._items.append(('frame', frame, time.monotonic(), sequence, captured_at))
+        self._waiting_frames += 1
+        self._wakeup.set()
+
+    def put_init(self, data):
+        self._items.append(('init', data, time.monotonic(), None, None))
+        # A decoder given a new init segment must start at a keyframe
+        self._skip_to_keyframe = True
+        self._wakeup.set()
+
+    def put_media(self, data, keyframe, sequence=None, captured_at=None):
+        if keyframe:
+            self._skip_to_keyframe = False
+        elif self._skip_to_keyframe:
+            self._count_dropped(1)
+            return
+        if self._waiting_frames >= settings.WS_MSE_MAX_BACKLOG:
+            self._drop_media()
+            if not keyframe:
+                self._skip_to_keyframe = True
+                self._count_dropped(1)
+                return
+        self._items.append(('media', data, time.monotonic(), sequence, captured_at))
+        self._waiting_frames += 1
+        self._wakeup.set()
+
+    def put_event(self, payload):
+        self._items.append(('event', payload, time.monotonic(), None, None))
+        self._wakeup.set()
+
+    def _drop_oldest_frame(self):
+        for item in self._items:
+            if item[0] == 'frame':
+                self._items.remove(item)
+                self._waiting_frames -= 1
+                self._count_dropped(1)
+                return
+
+    def _drop_media(self):
+        kept = deque(item for item in self._items if item[0] != 'media')
+        self._count_dropped(len(self._items) - len(kept))
+        self._items = kept
+        self._waiting_frames = 0
+
+    def _count_dropped(self, count):
+        self.frames_dropped += count
+        metrics.WS_FRAMES_DROPPED.inc(count, camera=self.label)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._items:
+                kind, payload, queued_at, sequence, captured_at = self._items.popleft()
+                if kind in ('frame', 'media'):
+                    self._waiting_frames -= 1
+                try:
+                    if self.metadata:
+                        await self.send(kind, payload, sequence, captured_at)
+                    else:
+                        await self.send(kind, payload)
+                except Exception as e:
+                    # The socket is gone; disconnect() will clean up
+                    print(f"Error sending to WebSocket client: {e}")
+                    return
+                if kind in ('frame', 'media'):
+                    lag = time.monotonic() - queued_at
+                    self.frames_sent += 1
+                    self.bytes_sent += len(payload)
+                    self.last_send_lag = lag
+                    self.max_send_lag = max(self.max_send_lag, lag)
+                    metrics.WS_FRAMES_SENT.inc(camera=self.label)
+                    metrics.WS_BYTES_SENT.inc(len(payload), camera=self.label)
+
+    def stats(self):
+        return {
+            'delivery': self.mode,
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'bytes_sent': self.bytes_sent,
+            'queued_frames': self._waiting_frames,
+            'last_send_lag': self.last_send_lag,
+            'max_send_lag': self.max_send_lag,
+        }
@@ -0,0 +1,138 @@
+import asyncio
+import struct
+
+# Clients ask for the multiplexed protocol by offering this subprotocol
+SUBPROTOCOL = 'viewer.framed.v1'
+
+# Every binary message on such a socket is one or more envelopes back to
+# back, each a fixed 19-byte big-endian header followed by its payload:
+#   type         u8   JPEG, INIT, MEDIA or EVENT (below)
+#   channel      u16  the subscription it belongs to; 0 for the connection
+#   sequence     u32  the camera's frame number (0 for init segments and events)
+#   captured_at  u64  microseconds since the Unix epoch the frame was read (0 if unknown)
+#   length       u32  payload bytes
+# EVENT payloads are UTF-8 JSON; the others are the bytes the legacy
+# protocol sends as a whole message.
+HEADER = struct.Struct('>BHIQI')
+
+JPEG = 1
+INIT = 2
+MEDIA = 3
+EVENT = 4
+
+# FrameOutbox item kinds to envelope types
+TYPES = {'frame': JPEG, 'init': INIT, 'media': MEDIA, 'event': EVENT}
+
+
+def pack(frame_type, channel, payload, sequence=None, captured_at=None):
+    """The header for one envelope; send it followed by `payload`."""
+    timestamp = int(captured_at * 1_000_000) if captured_at is not None else 0
+    return HEADER.pack(frame_type, channel, (sequence or 0) & 0xFFFFFFFF, timestamp, len(payload))
+
+
+def unpack(message):
+    """
+    Yield (type, channel, sequence, captured_at, payload) for every envelope
+    in a message, with captured_at in seconds (None if unset). Raises
+    ValueError on a truncated message.
+    """
+    view = memoryview(message)
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < HEADER.size:
+            raise ValueError('Truncated envelope header')
+        frame_type, channel, sequence, timestamp, length = HEADER.unpack_from(view, offset)
+        offset += HEADER.size
+        if len(view) - offset < length:
+            raise ValueError('Truncated envelope payload')
+        payload = bytes(view[offset:offset + length])
+        offset += length
+        yield frame_type, channel, sequence, timestamp / 1_000_000 if timestamp else None, payload
+
+
+class EnvelopeWriter:
+    """
+    Writes envelopes to one socket through `send(data)`, optionally
+    coalescing them.
+
+    With `max_bytes` unset every envelope is its own message. Otherwise
+    envelopes are held until `max_bytes` have built up or the oldest has
+    waited `max_delay` seconds, and sent as one message, which saves a
+    WebSocket frame and a send per envelope on walls of many small streams.
+    An envelope at least `max_bytes` long flushes what is held along with it.
+    """
+    def __init__(self, send, max_bytes=0, max_delay=0):
+        self.send = send
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.messages_sent = 0
+        self.envelopes_sent = 0
+        self.bytes_sent = 0
+        self._parts = []
+        self._held = 0
+        self._size = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def configure(self, max_bytes, max_delay):
+        await self.flush()
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+    async def write(self, frame_type, channel, payload, sequence=None, captured_at=None):
+        header = pack(frame_type, channel, payload, sequence, captured_at)
+        if not self.max_bytes:
+            await self._send([header, payload], 1)
+            return
+        self._parts += (header, payload)
+        self._held += 1
+        self._size += len(header) + len(payload)
+        if self._size >= self.max_bytes or not self.max_delay:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        asyncio.ensure_future(self._flush_quietly())
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            # The socket is gone; disconnect() will clean up
+            print(f"Error sending to WebSocket client: {e}")
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._parts:
+            return
+        parts, count = self._parts, self._held
+        self._parts, self._held, self._size = [], 0, 0
+        await self._send(parts, count)
+
+    async def _send(self, parts, count):
+        data = b''.join(parts)
+        # Batches flushed by the timer and by write() go out in order
+        async with self._lock:
+            await self.send(data)
+        self.messages_sent += 1
+        self.envelopes_sent += count
+        self.bytes_sent += len(data)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._parts, self._held, self._size = [], 0, 0
+
+    def stats(self):
+        return {
+            'batch_bytes': self.max_bytes,
+            'batch_delay': self.max_delay,
+            'messages_sent': self.messages_sent,
+            'envelopes_sent': self.envelopes_sent,
+            'bytes_sent': self.bytes_sent,
+        }
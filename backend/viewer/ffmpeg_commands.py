@@ -0,0 +1,396 @@
+import os
+import re
+from django.conf import settings
+
+# Codecs browsers can play straight out of the camera, and the HLS segment
+# container each one needs
+PASSTHROUGH_CODECS = {
+    'h264': 'mpegts',
+    'hevc': 'fmp4',
+}
+
+
+def choose_mode(requested, probe):
+    """
+    Pick 'copy' or 'transcode' for a stream.
+
+    `requested` is 'auto', 'copy' or 'transcode'; `probe` is the result of
+    probe_stream (or None if probing failed). Copy is only used when the
+    source codec can be segmented as-is, otherwise we fall back to transcoding.
+    """
+    if requested == 'transcode':
+        return 'transcode'
+    if probe and probe.get('video_codec') in PASSTHROUGH_CODECS:
+        return 'copy'
+    return 'transcode'
+
+
+def source_transport(probe):
+    """The RTSP transport the camera was last probed over (TCP if unknown)."""
+    return (probe or {}).get('transport') or 'tcp'
+
+
+def input_args(url, transport='tcp'):
+    args = ['-fflags', 'nobuffer', '-rtsp_transport', transport]
+    if transport == 'tcp':
+        args += ['-rtsp_flags', 'prefer_tcp']
+    return args + ['-i', url]
+
+
+def transcode_video_args(fps=None, bitrate=2000):
+    """
+    H.264 encode at `bitrate` kbit/s. With `fps` the output frame rate is
+    capped and the GOP shortened to match, so segments stay ~2 s long.
+    """
+    args = [
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-tune', 'zerolatency',
+        '-profile:v', 'baseline',
+        '-b:v', f'{bitrate}k',
+        '-maxrate', f'{bitrate * 5 // 4}k',
+        '-bufsize', f'{bitrate * 5 // 2}k',
+        '-g', str(fps * 2) if fps else '30',
+    ]
+    if fps:
+        args += ['-r', str(fps)]
+    return args
+
+
+def copy_video_args(probe):
+    args = ['-c:v', 'copy']
+    if probe['video_codec'] == 'hevc':
+        # Safari and MSE only accept HEVC in fMP4 tagged as hvc1
+        args += ['-tag:v', 'hvc1']
+    return args
+
+
+def audio_args(mode, probe):
+    if mode == 'copy' and probe:
+        if probe.get('audio_codec') is None:
+            return ['-an']
+        if probe['audio_codec'] == 'aac':
+            return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-b:a', '128k']
+
+
+def hls_output_args(output_dir, segment_type='mpegts', record=False, push=False):
+    flags = 'delete_segments+append_list+independent_segments'
+    if record:
+        # Recorded segments are cataloged by wall-clock time
+        flags += '+program_date_time'
+    args = [
+        '-f', 'hls',
+        # With -c:v copy the muxer can only cut on source keyframes, so
+        # segments are keyframe-aligned and roughly hls_time long
+        '-hls_time', '2',
+        '-hls_list_size', '10',
+        '-hls_flags', flags,
+        '-hls_segment_type', segment_type,
+    ]
+    if record:
+        # Numbering from the Unix time keeps a restarted stream from
+        # overwriting segments it recorded before
+        args += ['-hls_start_number_source', 'epoch']
+    if push:
+        # output_dir is an hls_ingest URL: PUT every segment and playlist
+        # over one kept-alive connection, and DELETE rotated segments
+        args += ['-method', 'PUT', '-http_persistent', '1']
+    if segment_type == 'fmp4':
+        args += [
+            '-hls_fmp4_init_filename', 'init.mp4',
+            '-hls_segment_filename', os.path.join(output_dir, 'stream%d.m4s'),
+        ]
+    else:
+        args += ['-hls_segment_filename', os.path.join(output_dir, 'stream%d.ts')]
+    args.append(os.path.join(output_dir, 'stream.m3u8'))
+    return args
+
+
+def motion_output_args():
+    """
+    An extra output on stdout for the motion detector: the video as raw
+    grayscale frames of HLS_MOTION_SIZE, HLS_MOTION_FPS a second.
+    """
+    width, height = settings.HLS_MOTION_SIZE
+    return [
+        '-map', '0:v:0',
+        '-vf', f'fps={settings.HLS_MOTION_FPS},scale={width}:{height},format=gray',
+        '-f', 'rawvideo',
+        '-',
+    ]
+
+
+def jpeg_update_args(path):
+    """JPEG output keeping only the newest frame at `path`, renamed into place."""
+    return ['-q:v', '5', '-f', 'image2', '-update', '1', '-atomic_writing', '1', path]
+
+
+def snapshot_output_args(path):
+    """
+    An extra output for the snapshot API: every HLS_SNAPSHOT_INTERVAL
+    seconds the current frame, HLS_SNAPSHOT_HEIGHT pixels high, replaces
+    the JPEG at `path` (renamed into place, so readers never see half a file).
+    """
+    return [
+        '-map', '0:v:0',
+        '-vf', f'fps=1/{settings.HLS_SNAPSHOT_INTERVAL},scale=-2:{settings.HLS_SNAPSHOT_HEIGHT}',
+    ] + jpeg_update_args(path)
+
+
+def build_hls_command(url, output_dir, mode='transcode', probe=None, motion=False, idle=False, record=False,
+                      snapshot=None, push=False):
+    """
+    FFmpeg command that reads `url` and writes a live HLS playlist
+    (stream.m3u8) plus segments into `output_dir`.
+
+    With `motion`, grayscale frames for the motion detector are also written
+    to stdout. `idle` encodes a static scene at HLS_MOTION_IDLE_FPS and
+    HLS_MOTION_IDLE_BITRATE instead of the full rate. `record` tags
+    segments with their wall-clock time and gives them names that stay
+    unique across restarts (see recording.py). `snapshot` is a path the
+    latest frame is kept at as a JPEG (see snapshot_output_args). With
+    `push`, `output_dir` is the stream's hls_ingest URL instead of a directory.
+    """
+    cmd = [settings.FFMPEG_BINARY]
+    if (motion or snapshot) and mode == 'copy':
+        # Only the side outputs decode a copied stream; keyframes are enough for them
+        cmd += ['-skip_frame', 'nokey']
+    cmd += input_args(url, source_transport(probe))
+    if motion:
+        cmd += motion_output_args()
+    if snapshot:
+        cmd += snapshot_output_args(snapshot)
+    if mode == 'copy':
+        cmd += copy_video_args(probe)
+        segment_type = PASSTHROUGH_CODECS[probe['video_codec']]
+    elif idle:
+        cmd += transcode_video_args(settings.HLS_MOTION_IDLE_FPS, settings.HLS_MOTION_IDLE_BITRATE)
+        segment_type = 'mpegts'
+    else:
+        cmd += transcode_video_args()
+        segment_type = 'mpegts'
+    cmd += audio_args(mode, probe)
+    cmd += hls_output_args(output_dir, segment_type, record, push)
+    return cmd
+
+
+def fragmented_mp4_args(part_target):
+    """
+    Write fragmented MP4 to stdout, cutting a fragment (one LL-HLS part)
+    every `part_target` seconds and at every keyframe.
+    """
+    return [
+        '-f', 'mp4',
+        '-movflags', 'empty_moov+default_base_moof+frag_keyframe',
+        '-frag_duration', str(int(part_target * 1000000)),
+        '-flush_packets', '1',
+        'pipe:1',
+    ]
+
+
+def build_llhls_command(url, mode='transcode', probe=None, part_target=0.2, source_args=None, snapshot=None):
+    """
+    FFmpeg command for low-latency HLS: a single fMP4 stream on stdout that
+    LowLatencyHLSStore splits into parts and segments. `source_args`
+    replaces the RTSP input (the latency benchmark feeds a test source).
+    `snapshot` is as for build_hls_command.
+    """
+    cmd = [settings.FFMPEG_BINARY]
+    if snapshot and mode == 'copy':
+        cmd += ['-skip_frame', 'nokey']
+    cmd += source_args or input_args(url, source_transport(probe))
+    if snapshot:
+        cmd += snapshot_output_args(snapshot)
+    cmd += ['-map', '0:v:0']
+    if mode == 'copy':
+        cmd += copy_video_args(probe)
+    else:
+        cmd += transcode_video_args()
+    if probe and probe.get('audio_codec'):
+        cmd += ['-map', '0:a:0'] + audio_args(mode, probe)
+    else:
+        cmd += ['-an']
+    cmd += fragmented_mp4_args(part_target)
+    return cmd
+
+
+def build_mse_command(url, mode='transcode', probe=None, fragment_duration=0.2):
+    """
+    FFmpeg command for WebSocket (Media Source Extensions) playback: the
+    camera's video as fragmented MP4 on stdout, copied when browsers can
+    play it as-is. Audio is left out, as in the MJPEG mode.
+    """
+    cmd = [settings.FFMPEG_BINARY] + input_args(url, source_transport(probe)) + ['-map', '0:v:0']
+    if mode == 'copy':
+        cmd += copy_video_args(probe)
+    else:
+        cmd += transcode_video_args()
+    cmd += ['-an']
+    cmd += fragmented_mp4_args(fragment_duration)
+    return cmd
+
+
+def normalize_ladder(renditions, probe=None):
+    """
+    Validate an ABR rendition ladder, e.g.
+    [{"name": "720p", "height": 720, "video_bitrate": 2800}, ...]
+    (bitrates in kbit/s), highest first. Renditions taller than the source
+    are skipped when the probe knows its height. Raises ValueError.
+    """
+    if not isinstance(renditions, list) or not renditions:
+        raise ValueError('renditions must be a non-empty list')
+    if len(renditions) > settings.HLS_ABR_MAX_RENDITIONS:
+        raise ValueError(f'At most {settings.HLS_ABR_MAX_RENDITIONS} renditions are allowed')
+    ladder = []
+    for rendition in renditions:
+        try:
+            name = str(rendition['name'])
+            height = int(rendition['height'])
+            bitrate = int(rendition['video_bitrate'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Each rendition needs a name, height and video_bitrate (kbit/s)')
+        if not re.fullmatch(r'[\w-]+', name):
+            raise ValueError(f'Invalid rendition name: {name}')
+        if height <= 0 or height % 2 or bitrate <= 0:
+            raise ValueError(f'Invalid height or bitrate for rendition {name}')
+        ladder.append({'name': name, 'height': height, 'video_bitrate': bitrate})
+    if len({r['name'] for r in ladder}) != len(ladder):
+        raise ValueError('Rendition names must be unique')
+    ladder.sort(key=lambda r: r['height'], reverse=True)
+    source_height = probe.get('height') if probe else None
+    if source_height:
+        fitting = [r for r in ladder if r['height'] <= source_height]
+        ladder = fitting or ladder[-1:]
+    return ladder
+
+
+def build_abr_command(url, output_dir, ladder, probe=None, snapshot=None, push=False):
+    """
+    FFmpeg command that decodes `url` once and encodes every rendition of
+    `ladder` in the same process, writing master.m3u8 plus one variant
+    playlist and segment set per rendition (`<name>/stream.m3u8`).
+    `snapshot` and `push` are as for build_hls_command.
+    """
+    count = len(ladder)
+    has_audio = bool(probe and probe.get('audio_codec'))
+    splits = ''.join(f'[v{i}]' for i in range(count))
+    filters = [f'[0:v]split={count}{splits}']
+    for i, rendition in enumerate(ladder):
+        filters.append(f"[v{i}]scale=-2:{rendition['height']}[v{i}out]")
+
+    cmd = [settings.FFMPEG_BINARY] + input_args(url, source_transport(probe))
+    if snapshot:
+        cmd += snapshot_output_args(snapshot)
+    cmd += ['-filter_complex', ';'.join(filters)]
+    for i in range(count):
+        cmd += ['-map', f'[v{i}out]']
+        if has_audio:
+            cmd += ['-map', '0:a:0']
+    cmd += [
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-tune', 'zerolatency',
+        '-profile:v', 'main',
+        # Identical, scene-cut-free GOPs keep segments aligned across
+        # renditions so players can switch at any segment boundary
+        '-g', '30',
+        '-keyint_min', '30',
+        '-sc_threshold', '0',
+    ]
+    for i, rendition in enumerate(ladder):
+        bitrate = rendition['video_bitrate']
+        cmd += [
+            f'-b:v:{i}', f'{bitrate}k',
+            f'-maxrate:v:{i}', f'{bitrate * 5 // 4}k',
+            f'-bufsize:v:{i}', f'{bitrate * 2}k',
+        ]
+    if has_audio:
+        cmd += ['-c:a', 'aac', '-b:a', '128k']
+
+    stream_map = []
+    for i, rendition in enumerate(ladder):
+        entry = f'v:{i}'
+        if has_audio:
+            entry += f',a:{i}'
+        stream_map.append(f"{entry},name:{rendition['name']}")
+    cmd += [
+        '-f', 'hls',
+        '-hls_time', '2',
+        '-hls_list_size', '10',
+        '-hls_flags', 'delete_segments+append_list+independent_segments',
+        '-hls_segment_type', 'mpegts',
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', ' '.join(stream_map),
+        '-hls_segment_filename', os.path.join(output_dir, '%v', 'stream%d.ts'),
+    ]
+    if push:
+        cmd += ['-method', 'PUT', '-http_persistent', '1']
+    cmd.append(os.path.join(output_dir, '%v', 'stream.m3u8'))
+    return cmd
+
+
+def build_tile_feed_command(url, path, probe=None, hls=False):
+    """
+    FFmpeg command that keeps one mosaic tile fresh: the video of `url`,
+    HLS_MOSAIC_TILE_HEIGHT pixels high at HLS_MOSAIC_FPS, replacing the
+    JPEG at `path` with every frame. The decoder skips H.264 deblocking,
+    which the downscale hides anyway. With `hls`, `url` is the playlist of
+    a running stream instead of a camera, so the camera is not opened twice.
+    """
+    cmd = [settings.FFMPEG_BINARY, '-skip_loop_filter', 'all']
+    if hls:
+        cmd += ['-live_start_index', '-1', '-i', url]
+    else:
+        cmd += input_args(url, source_transport(probe))
+    cmd += [
+        '-map', '0:v:0',
+        '-an',
+        '-vf', f'fps={settings.HLS_MOSAIC_FPS},scale=-2:{settings.HLS_MOSAIC_TILE_HEIGHT}',
+    ]
+    return cmd + jpeg_update_args(path)
+
+
+def build_mosaic_command(tiles, output_dir, width, height, frame_path=None):
+    """
+    FFmpeg command that stacks tile frames into one `width`x`height` HLS
+    stream (stream.m3u8 in `output_dir`) at HLS_MOSAIC_FPS.
+
+    `tiles` are (path, x, y, w, h): the JPEG a tile feed keeps current (or
+    None, for black until it has one) and where it goes, in pixels. Each
+    frame is letterboxed into its tile. With `frame_path` the mosaic's
+    newest frame is also kept there as a JPEG, HLS_MOSAIC_FRAME_RATE a
+    second, for snapshots and WebSocket viewers.
+    """
+    fps = settings.HLS_MOSAIC_FPS
+    cmd = [settings.FFMPEG_BINARY]
+    for path, *_ in tiles:
+        # Every input is read in real time; image2 re-opens the file for
+        # each frame, so a looped JPEG follows its feed
+        if path is None:
+            cmd += ['-re', '-f', 'lavfi', '-i', f'color=black:s=16x16:r={fps}']
+        else:
+            cmd += ['-re', '-f', 'image2', '-loop', '1', '-framerate', str(fps), '-i', path]
+    # With a frame output the stacked video is split between the two
+    stacked = '[mosaic]' if frame_path else '[hls]'
+    filters = []
+    for i, (_, x, y, w, h) in enumerate(tiles):
+        filters.append(f'[{i}:v]scale={w}:{h}:force_original_aspect_ratio=decrease:force_divisible_by=2,'
+                       f'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p[t{i}]')
+    if len(tiles) > 1:
+        layout = '|'.join(f'{x}_{y}' for _, x, y, _, _ in tiles)
+        inputs = ''.join(f'[t{i}]' for i in range(len(tiles)))
+        filters.append(f'{inputs}xstack=inputs={len(tiles)}:layout={layout}:fill=black,'
+                       f'pad={width}:{height}{stacked}')
+    else:
+        _, x, y, _, _ = tiles[0]
+        filters.append(f'[t0]pad={width}:{height}:{x}:{y}{stacked}')
+    if frame_path:
+        filters.append(f'[mosaic]split=2[hls][frame];[frame]fps={settings.HLS_MOSAIC_FRAME_RATE}[jpeg]')
+    cmd += ['-filter_complex', ';'.join(filters)]
+    if frame_path:
+        cmd += ['-map', '[jpeg]'] + jpeg_update_args(frame_path)
+    cmd += ['-map', '[hls]', '-an']
+    cmd += transcode_video_args(fps, settings.HLS_MOSAIC_BITRATE)
+    cmd += hls_output_args(output_dir)
+    return cmd
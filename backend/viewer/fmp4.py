@@ -0,0 +1,283 @@
+import struct
+
+# Boxes whose payload is just more boxes
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'moof', b'traf', b'edts'}
+
+# Sample flags (ISO/IEC 14496-12 8.8.3.1)
+SAMPLE_IS_NON_SYNC = 0x00010000
+
+# tfhd flags
+TFHD_BASE_DATA_OFFSET = 0x000001
+TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+TFHD_DEFAULT_SAMPLE_SIZE = 0x000010
+TFHD_DEFAULT_SAMPLE_FLAGS = 0x000020
+
+# trun flags
+TRUN_DATA_OFFSET = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+TRUN_SAMPLE_DURATION = 0x000100
+TRUN_SAMPLE_SIZE = 0x000200
+TRUN_SAMPLE_FLAGS = 0x000400
+TRUN_SAMPLE_CTO = 0x000800
+
+
+class BoxReader:
+    """
+    Incremental splitter for a fragmented MP4 byte stream.
+
+    feed() returns complete top-level boxes as (type, bytes) tuples. Like
+    JPEGFrameParser it keeps one bytearray and a resume offset, so box
+    payloads are copied out once and only headers are ever re-examined.
+    """
+    def __init__(self, max_box_size=64 << 20):
+        self.max_box_size = max_box_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def feed(self, chunk):
+        buf = self._buffer
+        buf += chunk
+        boxes = []
+        with memoryview(buf) as view:
+            while True:
+                header = _read_header(buf, self._offset)
+                if header is None:
+                    break
+                size, box_type, _ = header
+                if size > self.max_box_size:
+                    raise ValueError(f'{box_type!r} box of {size} bytes exceeds the limit')
+                if len(buf) - self._offset < size:
+                    break
+                boxes.append((box_type, bytes(view[self._offset:self._offset + size])))
+                self._offset += size
+        if self._offset:
+            del buf[:self._offset]
+            self._offset = 0
+        return boxes
+
+
+class FragmentReader:
+    """
+    Splits a fragmented MP4 byte stream on box boundaries into the init
+    segment (everything up to and including moov) and media fragments
+    (everything up to and including each mdat, i.e. [styp] moof mdat).
+
+    feed() returns ('init' | 'fragment', bytes) tuples. Box headers are
+    scanned in place and each finished group is copied out of the buffer
+    exactly once, so a fragment is never reassembled from separate boxes.
+    """
+    def __init__(self, max_box_size=64 << 20):
+        self.max_box_size = max_box_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def feed(self, chunk):
+        buf = self._buffer
+        buf += chunk
+        groups = []
+        with memoryview(buf) as view:
+            cursor = self._offset
+            while True:
+                header = _read_header(buf, cursor)
+                if header is None:
+                    break
+                size, box_type, _ = header
+                if size > self.max_box_size:
+                    raise ValueError(f'{box_type!r} box of {size} bytes exceeds the limit')
+                if len(buf) - cursor < size:
+                    break
+                cursor += size
+                if box_type in (b'moov', b'mdat'):
+                    kind = 'init' if box_type == b'moov' else 'fragment'
+                    groups.append((kind, bytes(view[self._offset:cursor])))
+                    self._offset = cursor
+        if self._offset:
+            del buf[:self._offset]
+            self._offset = 0
+        return groups
+
+
+def codec_string(init):
+    """
+    The RFC 6381 codecs value of an H.264 track in an init segment (e.g.
+    'avc1.42E01E'), as MediaSource.addSourceBuffer() needs it, or None if
+    there is none.
+    """
+    stsd = _first(init, [b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd'])
+    if stsd is None:
+        return None
+    # version/flags and entry count, then the first sample entry
+    entry = next(iter_boxes(init, stsd + 8), None)
+    if entry is None:
+        return None
+    entry_type, payload, entry_end = entry
+    # A VisualSampleEntry's fixed fields take 78 bytes before its child boxes
+    for box_type, config, config_end in iter_boxes(init, payload + 78, entry_end):
+        if entry_type in (b'avc1', b'avc3') and box_type == b'avcC' and config_end - config >= 4:
+            return f'{entry_type.decode()}.{bytes(init[config + 1:config + 4]).hex().upper()}'
+    return None
+
+
+def _read_header(buf, offset):
+    """Return (size, type, header_length) for the box at offset, or None if incomplete."""
+    if len(buf) - offset < 8:
+        return None
+    size, box_type = struct.unpack_from('>I4s', buf, offset)
+    header_length = 8
+    if size == 1:
+        if len(buf) - offset < 16:
+            return None
+        size = struct.unpack_from('>Q', buf, offset + 8)[0]
+        header_length = 16
+    elif size == 0:
+        raise ValueError('Boxes extending to end of file are not supported in a live stream')
+    if size < header_length:
+        raise ValueError(f'Invalid size {size} for {box_type!r} box')
+    return size, box_type, header_length
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, payload_start, box_end) for each box in data[start:end]."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        header = _read_header(data, offset)
+        if header is None:
+            return
+        size, box_type, header_length = header
+        yield box_type, offset + header_length, offset + size
+        offset += size
+
+
+def find_boxes(data, path, start=0, end=None):
+    """
+    Yield (payload_start, box_end) for every box matching `path`, a list of
+    box types descending through container boxes, e.g. [b'moov', b'trak'].
+    """
+    for box_type, payload, box_end in iter_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            yield payload, box_end
+        elif box_type in CONTAINER_BOXES:
+            yield from find_boxes(data, path[1:], payload, box_end)
+
+
+def _first(data, path, start=0, end=None):
+    return next(find_boxes(data, path, start, end), (None, None))[0]
+
+
+def parse_init_segment(data):
+    """
+    Read per-track details from an init segment (ftyp + moov):
+    {track_id: {'handler', 'timescale', 'default_sample_duration', 'default_sample_flags'}}
+    """
+    tracks = {}
+    moov, moov_end = next(find_boxes(data, [b'moov']), (None, None))
+    if moov is None:
+        raise ValueError('Init segment has no moov box')
+    for trak, trak_end in find_boxes(data, [b'trak'], moov, moov_end):
+        tkhd = _first(data, [b'tkhd'], trak, trak_end)
+        mdhd = _first(data, [b'mdia', b'mdhd'], trak, trak_end)
+        hdlr = _first(data, [b'mdia', b'hdlr'], trak, trak_end)
+        if tkhd is None or mdhd is None:
+            continue
+        version = data[tkhd]
+        track_id = struct.unpack_from('>I', data, tkhd + (20 if version == 1 else 12))[0]
+        version = data[mdhd]
+        timescale = struct.unpack_from('>I', data, mdhd + (20 if version == 1 else 12))[0]
+        handler = bytes(data[hdlr + 8:hdlr + 12]).decode('ascii', 'ignore') if hdlr is not None else ''
+        tracks[track_id] = {
+            'handler': handler,
+            'timescale': timescale,
+            'default_sample_duration': 0,
+            'default_sample_flags': 0,
+        }
+    for trex, _ in find_boxes(data, [b'mvex', b'trex'], moov, moov_end):
+        track_id, _, duration, _, flags = struct.unpack_from('>IIIII', data, trex + 4)
+        if track_id in tracks:
+            tracks[track_id]['default_sample_duration'] = duration
+            tracks[track_id]['default_sample_flags'] = flags
+    return tracks
+
+
+def parse_fragment(moof, tracks, handler='vide'):
+    """
+    Summarize a moof box for the first track with `handler`:
+    {'base_time', 'duration' (seconds), 'samples', 'independent'}.
+    Returns None if the fragment carries no samples for that track.
+    """
+    for traf, traf_end in find_boxes(moof, [b'moof', b'traf']):
+        tfhd = _first(moof, [b'tfhd'], traf, traf_end)
+        if tfhd is None:
+            continue
+        flags = struct.unpack_from('>I', moof, tfhd)[0] & 0xFFFFFF
+        track_id = struct.unpack_from('>I', moof, tfhd + 4)[0]
+        track = tracks.get(track_id)
+        if track is None or track['handler'] != handler:
+            continue
+        offset = tfhd + 8
+        if flags & TFHD_BASE_DATA_OFFSET:
+            offset += 8
+        if flags & TFHD_SAMPLE_DESCRIPTION_INDEX:
+            offset += 4
+        default_duration = track['default_sample_duration']
+        default_flags = track['default_sample_flags']
+        if flags & TFHD_DEFAULT_SAMPLE_DURATION:
+            default_duration = struct.unpack_from('>I', moof, offset)[0]
+            offset += 4
+        if flags & TFHD_DEFAULT_SAMPLE_SIZE:
+            offset += 4
+        if flags & TFHD_DEFAULT_SAMPLE_FLAGS:
+            default_flags = struct.unpack_from('>I', moof, offset)[0]
+
+        base_time = 0
+        tfdt = _first(moof, [b'tfdt'], traf, traf_end)
+        if tfdt is not None:
+            if moof[tfdt] == 1:
+                base_time = struct.unpack_from('>Q', moof, tfdt + 4)[0]
+            else:
+                base_time = struct.unpack_from('>I', moof, tfdt + 4)[0]
+
+        samples = 0
+        duration = 0
+        first_flags = None
+        for trun, _ in find_boxes(moof, [b'trun'], traf, traf_end):
+            run_flags = struct.unpack_from('>I', moof, trun)[0] & 0xFFFFFF
+            count = struct.unpack_from('>I', moof, trun + 4)[0]
+            offset = trun + 8
+            if run_flags & TRUN_DATA_OFFSET:
+                offset += 4
+            run_first_flags = None
+            if run_flags & TRUN_FIRST_SAMPLE_FLAGS:
+                run_first_flags = struct.unpack_from('>I', moof, offset)[0]
+                offset += 4
+            fields = [TRUN_SAMPLE_DURATION, TRUN_SAMPLE_SIZE, TRUN_SAMPLE_FLAGS, TRUN_SAMPLE_CTO]
+            for i in range(count):
+                sample_duration = default_duration
+                sample_flags = default_flags
+                for field in fields:
+                    if not run_flags & field:
+                        continue
+                    value = struct.unpack_from('>I', moof, offset)[0]
+                    offset += 4
+                    if field == TRUN_SAMPLE_DURATION:
+                        sample_duration = value
+                    elif field == TRUN_SAMPLE_FLAGS:
+                        sample_flags = value
+                if i == 0 and run_first_flags is not None:
+                    sample_flags = run_first_flags
+                if first_flags is None:
+                    first_flags = sample_flags
+                duration += sample_duration
+            samples += count
+        if not samples:
+            return None
+        return {
+            'base_time': base_time / track['timescale'],
+            'duration': duration / track['timescale'],
+            'samples': samples,
+            'independent': not (first_flags & SAMPLE_IS_NON_SYNC),
+        }
+    return None
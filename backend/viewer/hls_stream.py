@@ -1,26 +1,131 @@
 import os
 import uuid
 import json
-import subprocess
+import shutil
 import time
-from urllib.parse import urlparse, urlunparse
-from django.http import JsonResponse, Http404, FileResponse
+import asyncio
+import base64
+import hmac
+import posixpath
+import secrets
+from collections import OrderedDict
+from urllib.parse import urlencode
+from django.http import JsonResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, F, Max, Min, Sum
+from django.urls import reverse
+from django.utils.http import http_date, parse_etags
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 import tempfile
-import boto3
-from botocore.exceptions import ClientError
+from .activity import get_activity
+from .cleanup import get_cleanup_worker
+from .models import Camera, RecordedSegment
+from .mosaic import active_mosaics
+from .motion import MotionDetector
+from .recording import Recorder, build_playlist, find_segments
+from .ffmpeg_commands import (
+    PASSTHROUGH_CODECS, build_abr_command, build_hls_command, build_llhls_command, choose_mode, normalize_ladder
+)
+from .llhls import LowLatencyHLSStore, PlaylistRequestError, ingest
+from .probe import probe_stream
+from . import metrics, registry
+from .segment_cache import get_segment_cache
+from .segment_store import cache_control, content_type, get_segment_store
+from .snapshots import SNAPSHOT_NAME, get_snapshot_cache
+from .stream_options import parse_stream_options
+from .supervisor import CapacityError, SupervisedProcess, get_supervisor, stream_cost
+from .upload_pool import get_upload_scheduler
 
-# Dictionary to keep track of active FFmpeg processes by stream_id
-active_ffmpeg_processes = {}
+# FFmpeg working directories by stream_id, removed when the stream stops
+stream_temp_dirs = {}
+# Lifecycle of each stream: ['queued' ->] 'starting' -> 'ready' | 'failed', then 'stopped'
+stream_states = {}
+# States of the last HLS_STREAM_HISTORY streams to stop or fail, oldest
+# first; they leave stream_states once their process is gone
+stream_history = OrderedDict()
+# Background readiness watchers by stream_id (held so they are not collected)
+startup_tasks = {}
+# Segment store (local disk or S3) each stream was started with
+stream_segment_stores = {}
+# In-memory media for low-latency streams, and the tasks reading FFmpeg's
+# stdout (LL-HLS media, or motion frames) by stream_id
+llhls_stores = {}
+ingest_tasks = {}
+# Motion detectors of motion-gated streams
+motion_detectors = {}
+# Segment catalogers of recorded streams
+recorders = {}
+# Receivers of streams whose FFmpeg pushes its output to hls_ingest
+pushed_outputs = {}
+# Starts of bulk requests, held so they finish even if the client goes away
+bulk_start_tasks = set()
+# On-demand starts of registered cameras in progress, by camera name
+camera_starts = {}
+# Background task stopping streams nobody is watching
+idle_reaper = None
+
+
+def _remove_temp_dir(stream_id):
+    temp_dir = stream_temp_dirs.pop(stream_id, None)
+    if temp_dir:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 @csrf_exempt
-def start_hls_stream(request):
+async def start_hls_stream(request):
     """
-    POST: {"url": ..., "username": ..., "password": ...}
-    Returns: {"stream_id": ..., "playlist_url": ...}
+    POST: {"url": ..., "username": ..., "password": ..., "mode": "auto" | "copy" | "transcode",
+           "abr": true, "renditions": [{"name": "720p", "height": 720, "video_bitrate": 2800}, ...],
+           "low_latency": true, "store": "s3" | "local", "admission": "reject" | "queue",
+           "idle_timeout": 300, "motion": true, "record": true, "retention": 86400,
+           "ingest": "poll" | "push"}
+    Returns: {"stream_id": ..., "playlist_url": ..., "status_url": ..., "state": "starting", "mode": ...}
+
+    In "auto" (the default) the source is passed through untouched when its
+    codec allows it and transcoded to H.264 otherwise; "mode" in the response
+    says which was chosen. With "abr" (or a custom "renditions" ladder) one
+    decode feeds several encodes and playlist_url points at master.m3u8,
+    whose variants live in per-rendition subdirectories. "low_latency"
+    serves LL-HLS (~200 ms fMP4 parts, blocking playlist reload) straight
+    from this server's memory instead of going through storage. "store"
+    picks where segments live (default HLS_SEGMENT_STORE): "s3" uploads
+    them to Django's default storage, "local" has FFmpeg write them
+    straight into HLS_LOCAL_ROOT, served by this server.
+
+    "motion" has FFmpeg also write a few small grayscale frames a second,
+    which are diffed to find motion (see motion.py). Motion events are
+    listed by motion_events. While nothing moves, a transcoded stream is
+    re-encoded at HLS_MOTION_IDLE_FPS and HLS_MOTION_IDLE_BITRATE, and it
+    returns to the full rate on the next motion. A copied stream is only
+    indexed.
+
+    "record" keeps the stream's segments in storage for "retention" seconds
+    (default HLS_RECORD_RETENTION) instead of deleting them as they rotate
+    out, and catalogs them by time so any range can be played back through
+    recording_playlist (see recording.py). It needs the "s3" store.
+
+    "ingest" (default HLS_INGEST, for the "s3" store) picks how segments get
+    from FFmpeg to storage: "poll" has the upload pool poll FFmpeg's working
+    directory; "push" has FFmpeg PUT every segment and playlist to
+    hls_ingest, which caches and uploads them from memory as they arrive.
+
+    FFmpeg is launched and the response returned straight away; poll
+    status_url until state is "ready" (first segment uploaded) or "failed".
+    Each node accepts a limited number of transcodes (see supervisor.py).
+    When it is full the request gets a 503, or with "admission": "queue"
+    the stream waits in state "queued" until a slot frees up. Once ready,
+    FFmpeg is restarted if it exits or stops producing segments.
+
+    A stream nobody has watched for "idle_timeout" seconds (default
+    HLS_IDLE_TIMEOUT; 0 or null disables) is stopped as if stop_hls_stream
+    had been called. Watching means fetching its playlist through hls_serve
+    or holding it from a WebSocket ({"action": "watch", "stream_id": ...});
+    players reading the playlist straight from the bucket are not seen.
+
+    With several nodes (HLS_NODE_URL set), the request is forwarded to the
+    live node with the most free transcode slots, and status, stop and
+    hls_serve requests for a stream are forwarded to the node running it.
     """
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
@@ -28,202 +133,1190 @@ def start_hls_stream(request):
         data = json.loads(request.body.decode('utf-8'))
     except Exception:
         data = {}
-    rtsp_url_from_user = data.get('url')
-    username_override = data.get('username')
-    password_override = data.get('password')
-
-    if not rtsp_url_from_user:
-        return JsonResponse({'error': 'Missing RTSP URL'}, status=400)
-
-    try:
-        parsed_url = urlparse(rtsp_url_from_user)
-        
-        final_hostname = parsed_url.hostname
-        if not final_hostname:
-            return JsonResponse({'error': 'Invalid RTSP URL: Hostname missing.'}, status=400)
-
-        # Determine the effective username and password
-        effective_username = username_override if username_override else parsed_url.username
-        effective_password = password_override if password_override else parsed_url.password
-        
-        if not password_override and parsed_url.password and '@' in parsed_url.password:
-            effective_password = parsed_url.password.split('@', 1)[0]
-
-        netloc_parts = []
-        if effective_username:
-            userinfo = effective_username
-            if effective_password:
-                userinfo += f":{effective_password}"
-            netloc_parts.append(f"{userinfo}@")
-        
-        netloc_parts.append(final_hostname) 
-        if parsed_url.port:
-            netloc_parts.append(f":{parsed_url.port}")
-        
-        new_netloc_str = "".join(netloc_parts)
-        
-        final_rtsp_url_for_ffmpeg = urlunparse((
-            parsed_url.scheme if parsed_url.scheme else 'rtsp',
-            new_netloc_str,
-            parsed_url.path if parsed_url.path else '/',
-            parsed_url.params,
-            parsed_url.query,
-            parsed_url.fragment
-        ))
+    if registry.cluster_enabled() and not registry.is_forwarded(request):
+        # Run the stream on whichever node has the most room for it
+        node = await sync_to_async(registry.place_stream)(_estimated_cost(data))
+        if node is not None and node['node_id'] != settings.HLS_NODE_ID:
+            return await registry.forward(request, node)
+    return await _start_stream(data)
+
+
+def _estimated_cost(data):
+    # Placement happens before the probe, so "auto" counts as an encode
+    renditions = data.get('renditions')
+    if data.get('abr') or renditions:
+        return len(renditions) if isinstance(renditions, list) else len(settings.HLS_ABR_LADDER)
+    return stream_cost(data.get('mode', 'auto'))
+
+
+@csrf_exempt
+async def bulk_start_hls_streams(request):
+    """
+    POST: {"cameras": [<start_hls_stream body>, ...], "defaults": {...}, "concurrency": 8, "wait": true}
+    Returns: newline-delimited JSON, one line per event as it happens:
+        {"index": 0, "status": 200, "stream_id": ..., "state": "starting", ...}  a camera's start_hls_stream response
+        {"index": 0, "stream_id": ..., "state": "ready" | "failed", "error": ..., "elapsed": ...}  once it is up
+        {"done": true, "cameras": ..., "started": ..., "ready": ..., "failed": ..., "elapsed": ...}  last
+
+    Brings a whole site online in one request. Each camera's fields are
+    laid over "defaults". Starts (probe and FFmpeg launch) run "concurrency"
+    at a time (default HLS_BULK_START_CONCURRENCY, at most
+    HLS_BULK_START_MAX_CONCURRENCY), so the cameras and this node are not
+    all hit at once; stored probes make restarts skip ffprobe. With "wait"
+    (the default) each started camera gets a second line once it is ready
+    or has failed; "elapsed" is seconds since the request. With several
+    nodes each camera is placed like a start_hls_stream request. Starts
+    carry on if the client goes away.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except Exception:
+        data = {}
+    cameras = data.get('cameras')
+    defaults = data.get('defaults') or {}
+    concurrency = data.get('concurrency', settings.HLS_BULK_START_CONCURRENCY)
+    if not isinstance(cameras, list) or not cameras or not all(isinstance(c, dict) for c in cameras):
+        return JsonResponse({'error': 'cameras must be a non-empty list of start_hls_stream bodies'}, status=400)
+    if len(cameras) > settings.HLS_BULK_START_MAX:
+        return JsonResponse({'error': f'At most {settings.HLS_BULK_START_MAX} cameras per request'}, status=400)
+    if not isinstance(defaults, dict):
+        return JsonResponse({'error': 'defaults must be an object'}, status=400)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        return JsonResponse({'error': 'concurrency must be a positive integer'}, status=400)
+    concurrency = min(concurrency, settings.HLS_BULK_START_MAX_CONCURRENCY)
+    bodies = [{**defaults, **camera} for camera in cameras]
+    return StreamingHttpResponse(_bulk_start_events(bodies, concurrency, bool(data.get('wait', True))),
+                                 content_type='application/x-ndjson')
+
+
+async def _bulk_start_events(bodies, concurrency, wait):
+    loop = asyncio.get_running_loop()
+    began = loop.time()
+    events = asyncio.Queue()
+    slots = asyncio.Semaphore(concurrency)
+    counts = {'started': 0, 'ready': 0, 'failed': 0}
+
+    async def start(index, body):
+        try:
+            async with slots:
+                status, result, node = await _bulk_start_one(body)
+            events.put_nowait({'index': index, 'status': status, **result})
+            if status != 200:
+                counts['failed'] += 1
+                return
+            counts['started'] += 1
+            if not wait:
+                return
+            state = await _wait_started(result['stream_id'], node)
+            counts['ready' if state['state'] == 'ready' else 'failed'] += 1
+            events.put_nowait({'index': index, 'stream_id': result['stream_id'], **state,
+                               'elapsed': round(loop.time() - began, 3)})
+        except Exception as e:
+            print(f"Bulk start of camera {index} failed: {e}")
+            counts['failed'] += 1
+            events.put_nowait({'index': index, 'status': 500, 'error': str(e)})
+        finally:
+            # One None per camera tells the stream below it is finished
+            events.put_nowait(None)
+
+    for index, body in enumerate(bodies):
+        task = asyncio.ensure_future(start(index, body))
+        bulk_start_tasks.add(task)
+        task.add_done_callback(bulk_start_tasks.discard)
+    remaining = len(bodies)
+    while remaining:
+        event = await events.get()
+        if event is None:
+            remaining -= 1
+            continue
+        yield json.dumps(event) + '\n'
+    yield json.dumps({'done': True, 'cameras': len(bodies), **counts,
+                      'elapsed': round(loop.time() - began, 3)}) + '\n'
+
+
+async def _bulk_start_one(body):
+    """Start one camera of a bulk start here or on the node placed for it: (status, body, node)."""
+    if registry.cluster_enabled():
+        node = await sync_to_async(registry.place_stream)(_estimated_cost(body))
+        if node is not None and node['node_id'] != settings.HLS_NODE_ID:
+            status, result = await registry.post_json(node, reverse('start_hls_stream'), body)
+            return status, result, node
+    response = await _start_stream(body)
+    return response.status_code, json.loads(response.content), None
+
+
+async def _wait_started(stream_id, node=None):
+    """Wait until a stream started here (or on `node`) is ready or has failed: {"state", ["error"]}."""
+    if node is None:
+        task = startup_tasks.get(stream_id)
+        if task is not None:
+            # Not awaited directly: a queued stream stopped before it ran is cancelled
+            await asyncio.wait([task])
+        state = stream_state(stream_id) or {}
+        result = {'state': state.get('state', 'stopped')}
+    else:
+        path = reverse('hls_stream_status', args=[stream_id])
+        while True:
+            try:
+                state = await registry.get_json(node, path)
+            except Exception as e:
+                return {'state': 'failed', 'error': f"Node {node['node_id']} is unreachable: {e}"}
+            if state.get('state') not in ('queued', 'starting'):
+                break
+            await asyncio.sleep(settings.HLS_BULK_START_POLL_INTERVAL)
+        result = {'state': state.get('state')}
+    if state.get('error'):
+        result['error'] = state['error']
+    return result
+
+
+async def _start_stream(data, stream_id=None):
+    """
+    Launch a stream from a start_hls_stream request body and return the
+    view's response. Registered cameras pass their name as the stream_id.
+    """
+    try:
+        options = parse_stream_options(data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
         print(f"Error parsing RTSP URL: {e}")
         return JsonResponse({'error': f'Error parsing RTSP URL: {str(e)}'}, status=400)
+    final_rtsp_url_for_ffmpeg = options['url']
+    requested_mode = options['mode']
+    renditions = options['renditions']
+    abr = options['abr']
+    low_latency = options['low_latency']
+    admission = options['admission']
+    idle_timeout = options['idle_timeout']
+    motion = options['motion']
+    record = options['record']
+    retention = options['retention']
+    ingest = options['ingest']
+    segment_store = options['segment_store']
+
+    # Most cameras already send H.264, which can be segmented without
+    # re-encoding; the probe is cached per camera so restarts skip it
+    probe = None
+    if requested_mode != 'transcode' or abr:
+        try:
+            probe = await probe_stream(final_rtsp_url_for_ffmpeg)
+        except Exception as e:
+            print(f"Error probing stream, falling back to transcoding: {e}")
+    if abr:
+        # A rendition ladder always needs an encode, from one shared decode
+        try:
+            ladder = normalize_ladder(renditions or settings.HLS_ABR_LADDER, probe)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        mode = 'transcode'
+        playlist_name = 'master.m3u8'
+    else:
+        ladder = None
+        mode = choose_mode(requested_mode, probe)
+        playlist_name = 'stream.m3u8'
+        if record and mode == 'copy' and PASSTHROUGH_CODECS[probe['video_codec']] != 'mpegts':
+            # Recording playlists are plain MPEG-TS; an fMP4 init segment
+            # would change under them when FFmpeg restarts
+            if requested_mode == 'copy':
+                return JsonResponse({'error': f"record cannot copy {probe['video_codec']}; use transcode"},
+                                    status=400)
+            mode = 'transcode'
+
+    stream_id = stream_id or str(uuid.uuid4())
+    supervisor = get_supervisor()
+    cost = stream_cost(mode, ladder)
+    try:
+        admitted = supervisor.admit(stream_id, cost, queue=admission == 'queue')
+    except CapacityError as e:
+        response = JsonResponse({'error': str(e)}, status=503)
+        response['Retry-After'] = '30'
+        return response
+
+    # Create a working directory for FFmpeg to write to. It has to outlive
+    # this request: FFmpeg and the uploader keep using it until the stream
+    # is stopped, so stop_hls_stream is responsible for removing it. The
+    # local store has FFmpeg write segments into its own directory instead.
+    temp_dir = tempfile.mkdtemp(prefix=f'hls_{stream_id}_')
+    stream_temp_dirs[stream_id] = temp_dir
+    output_dir = segment_store.output_dir(stream_id, temp_dir) if segment_store else temp_dir
 
-    stream_id = str(uuid.uuid4())
-    stream_dir = f"{settings.HLS_MEDIA_ROOT}/{stream_id}"
-    
-    # Create a temporary directory for FFmpeg to write to
-    with tempfile.TemporaryDirectory() as temp_dir:
-        playlist_path = os.path.join(temp_dir, 'stream.m3u8')
-        
-        ffmpeg_log_filename = f"ffmpeg_{stream_id}.log"
-        log_path = os.path.join(temp_dir, ffmpeg_log_filename)
-
-        ffmpeg_cmd = [
-            'ffmpeg',
-            '-fflags', 'nobuffer',
-            '-rtsp_transport', 'tcp',
-            '-rtsp_flags', 'prefer_tcp',
-            '-i', final_rtsp_url_for_ffmpeg,
-            '-c:v', 'libx264',
-            '-preset', 'ultrafast',
-            '-tune', 'zerolatency',
-            '-profile:v', 'baseline',
-            '-b:v', '2000k',
-            '-maxrate', '2500k',
-            '-bufsize', '5000k',
-            '-g', '30',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-f', 'hls',
-            '-hls_time', '2',
-            '-hls_list_size', '10',
-            '-hls_flags', 'delete_segments+append_list+independent_segments',
-            '-hls_segment_type', 'mpegts',
-            '-hls_segment_filename', os.path.join(temp_dir, 'stream%d.ts'),
-            playlist_path
-        ]
-        
+    ffmpeg_log_filename = f"ffmpeg_{stream_id}.log"
+    log_path = os.path.join(temp_dir, ffmpeg_log_filename)
+    # FFmpeg keeps the latest frame here for the snapshot API
+    snapshot_path = os.path.join(temp_dir, SNAPSHOT_NAME) if settings.HLS_SNAPSHOT_INTERVAL else None
+    recorder = Recorder(stream_id, retention) if record else None
+    pushed = None
+    ffmpeg_output = output_dir
+    if ingest == 'push':
+        pushed = segment_store.receive(stream_id, secrets.token_urlsafe(16), playlist_name, recorder)
+        ffmpeg_output = _ingest_location(stream_id, pushed.token, playlist_name)
+
+    if low_latency:
+        ffmpeg_cmd = build_llhls_command(final_rtsp_url_for_ffmpeg, mode, probe, settings.HLS_LL_PART_TARGET,
+                                         snapshot=snapshot_path)
+    elif ladder:
+        if pushed is None:
+            for rendition in ladder:
+                os.makedirs(os.path.join(output_dir, rendition['name']), exist_ok=True)
+        ffmpeg_cmd = build_abr_command(final_rtsp_url_for_ffmpeg, ffmpeg_output, ladder, probe,
+                                       snapshot=snapshot_path, push=pushed is not None)
+    else:
+        ffmpeg_cmd = build_hls_command(final_rtsp_url_for_ffmpeg, ffmpeg_output, mode, probe, motion=motion,
+                                       record=record, snapshot=snapshot_path, push=pushed is not None)
+
+    if low_latency:
+        store = LowLatencyHLSStore()
+        output_time = lambda: store.last_output
+        on_spawn = lambda process: _attach_ingest(stream_id, store, process)
+    elif pushed is not None:
+        output_time = lambda: pushed.last_received
+        on_spawn = None
+    else:
+        # Stalls show up as a playlist FFmpeg stops rewriting; with a
+        # ladder the master is written once, so watch the first variant
+        watched = os.path.join(output_dir, ladder[0]['name'], 'stream.m3u8') if ladder else \
+            os.path.join(output_dir, playlist_name)
+        output_time = lambda: _mtime(watched)
+        on_spawn = None
+    if motion:
+        detector = MotionDetector(stream_id)
+        if mode == 'transcode':
+            detector.on_idle = lambda idle: asyncio.ensure_future(_switch_encode(
+                stream_id, idle,
+                build_hls_command(final_rtsp_url_for_ffmpeg, ffmpeg_output, mode, probe, motion=True, idle=idle,
+                                  record=record, snapshot=snapshot_path, push=pushed is not None)))
+        on_spawn = lambda process: _attach_motion(stream_id, detector, process)
+    supervised = SupervisedProcess(
+        stream_id, ffmpeg_cmd, log_path, cost=cost, capture_stdout=low_latency or motion,
+        output_time=output_time, on_spawn=on_spawn, progress=True,
+        on_failed=lambda reason: asyncio.ensure_future(_supervision_failed(stream_id, reason))
+    )
+
+    if admitted:
         try:
-            log_file = open(log_path, "a")
-            process = subprocess.Popen(ffmpeg_cmd, stdout=log_file, stderr=log_file)
-            active_ffmpeg_processes[stream_id] = process
-
-            # Wait for the first playlist file to be generated
-            max_wait_time = 10  # Maximum time to wait in seconds
-            start_time = time.time()
-            while not os.path.exists(playlist_path):
-                if time.time() - start_time > max_wait_time:
-                    process.terminate()
-                    return JsonResponse({'error': 'Timeout waiting for stream to start'}, status=500)
-                time.sleep(0.5)
-
-            # Upload the initial playlist file
-            with open(playlist_path, 'rb') as f:
-                default_storage.save(f'{stream_dir}/stream.m3u8', ContentFile(f.read()))
-
-            # Start a background task to monitor and upload files
-            def monitor_and_upload():
-                while True:
-                    if not os.path.exists(playlist_path):
-                        time.sleep(0.5)
-                        continue
-                    
-                    # Upload playlist file
-                    with open(playlist_path, 'rb') as f:
-                        default_storage.save(f'{stream_dir}/stream.m3u8', ContentFile(f.read()))
-                    
-                    # Upload any new .ts files
-                    for filename in os.listdir(temp_dir):
-                        if filename.endswith('.ts'):
-                            file_path = os.path.join(temp_dir, filename)
-                            with open(file_path, 'rb') as f:
-                                default_storage.save(f'{stream_dir}/{filename}', ContentFile(f.read()))
-                    
-                    time.sleep(1)  # Check every second
-
-            import threading
-            monitor_thread = threading.Thread(target=monitor_and_upload, daemon=True)
-            monitor_thread.start()
-
-            return JsonResponse({
-                'stream_id': stream_id,
-                'playlist_url': f'{settings.MEDIA_URL}{stream_dir}/stream.m3u8',
-                'log_file': f'{settings.MEDIA_URL}{settings.FFMPEG_LOG_DIR}/{ffmpeg_log_filename}'
-            })
+            await supervised.spawn()
         except Exception as e:
+            supervisor.release(stream_id)
+            _remove_temp_dir(stream_id)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            if pushed is not None:
+                segment_store.stop(stream_id)
             return JsonResponse({'error': f"Failed to start FFmpeg: {str(e)}"}, status=500)
+    supervisor.add(supervised)
+    if pushed is not None:
+        pushed_outputs[stream_id] = pushed
+
+    stream_states[stream_id] = {
+        'state': 'starting' if admitted else 'queued',
+        'mode': mode,
+        'video_codec': probe.get('video_codec') if probe else None,
+        'renditions': [r['name'] for r in ladder] if ladder else None,
+        'low_latency': low_latency,
+        'store': segment_store.name if segment_store else 'memory',
+        'cost': cost,
+        'idle_timeout': idle_timeout or None,
+        'motion': motion,
+        'record': record,
+        'retention': retention if record else None,
+        'ingest': ingest,
+        'started_at': time.time(),
+    }
+    if motion:
+        motion_detectors[stream_id] = detector
+        stream_states[stream_id]['encode'] = 'full' if mode == 'transcode' else None
+    if record:
+        recorders[stream_id] = recorder
+    _ensure_idle_reaper()
+    if registry.cluster_enabled():
+        await _registry_update(registry.claim, stream_id, cost)
+    if low_latency:
+        llhls_stores[stream_id] = store
+        # Low-latency parts are served from memory, so the first one is enough
+        watcher = _watch_startup(stream_id, supervised, lambda timeout: store.wait_for(0, 0, timeout=timeout),
+                                 settings.HLS_START_TIMEOUT)
+        playlist_url = reverse('hls_serve', args=[stream_id, playlist_name])
+    else:
+        stream_segment_stores[stream_id] = segment_store
+        if pushed is not None:
+            watcher = _watch_startup(stream_id, supervised, _pushed_ready(pushed))
+        else:
+            watcher = _watch_startup(stream_id, supervised,
+                                     _published_ready(stream_id, segment_store, output_dir, playlist_name))
+        playlist_url = segment_store.playlist_url(stream_id, playlist_name)
+    if not admitted:
+        watcher = _start_when_admitted(stream_id, supervised, watcher)
+    startup_tasks[stream_id] = asyncio.ensure_future(watcher)
+
+    return JsonResponse({
+        'stream_id': stream_id,
+        'state': stream_states[stream_id]['state'],
+        'mode': mode,
+        'video_codec': probe.get('video_codec') if probe else None,
+        'renditions': ladder,
+        'low_latency': low_latency,
+        'store': stream_states[stream_id]['store'],
+        'playlist_url': playlist_url,
+        'status_url': reverse('hls_stream_status', args=[stream_id]),
+        'log_file': f'{settings.MEDIA_URL}{settings.FFMPEG_LOG_DIR}/{ffmpeg_log_filename}'
+    })
+
+
+def _ingest_location(stream_id, token, playlist_name):
+    # The hls_ingest URL FFmpeg writes the playlist and its segments under
+    path = reverse('hls_ingest', args=[stream_id, token, playlist_name])
+    return settings.HLS_INGEST_URL.rstrip('/') + posixpath.dirname(path)
+
+
+def is_stream_active(stream_id):
+    """Whether this node runs stream_id (queued, starting or ready)."""
+    state = stream_states.get(stream_id)
+    return state is not None and state['state'] in ('queued', 'starting', 'ready')
+
+
+def stream_state(stream_id):
+    """A copy of the state hls_stream_status reports for a stream this node knows, or None."""
+    state = stream_states.get(stream_id) or stream_history.get(stream_id)
+    return dict(state) if state is not None else None
+
+
+def all_stream_states():
+    """Copies of the states of every stream this node knows, by stream_id."""
+    states = {**stream_history, **stream_states}
+    return {stream_id: dict(state) for stream_id, state in states.items()}
+
 
-def hls_serve(request, stream_id, filename):
+def _remember_stopped(stream_id, state):
+    stream_history.pop(stream_id, None)
+    stream_history[stream_id] = state
+    while len(stream_history) > settings.HLS_STREAM_HISTORY:
+        stream_history.popitem(last=False)
+
+
+def stream_process(stream_id, cmd, temp_dir, cost, playlist_path):
+    """
+    The supervised FFmpeg of a stream started outside start_hls_stream (a
+    mosaic): it logs to the stream's working directory, counts as stalled
+    once it stops rewriting playlist_path and fails the stream when the
+    supervisor gives up on it.
+    """
+    return SupervisedProcess(
+        stream_id, cmd, os.path.join(temp_dir, f'ffmpeg_{stream_id}.log'), cost=cost,
+        output_time=lambda: _mtime(playlist_path), progress=True,
+        on_failed=lambda reason: asyncio.ensure_future(_supervision_failed(stream_id, reason))
+    )
+
+
+async def register_stream(stream_id, supervised, segment_store, output_dir, temp_dir, state, admitted,
+                          prepare=None):
+    """
+    Take over a stream started outside start_hls_stream whose supervised
+    FFmpeg (see stream_process) writes its playlist to output_dir, and
+    launch it in the background like any other: after `await prepare()`,
+    if given, and once the supervisor has admitted it. `state` is added to
+    its hls_stream_status; temp_dir is removed when it stops (stop_stream).
+    """
+    stream_temp_dirs[stream_id] = temp_dir
+    stream_segment_stores[stream_id] = segment_store
+    stream_states[stream_id] = {
+        'state': 'starting' if admitted else 'queued',
+        **state,
+        'store': segment_store.name,
+        'cost': supervised.cost,
+        'started_at': time.time(),
+    }
+    get_supervisor().add(supervised)
+    _ensure_idle_reaper()
+    if registry.cluster_enabled():
+        await _registry_update(registry.claim, stream_id, supervised.cost)
+    watcher = _watch_startup(stream_id, supervised, _published_ready(stream_id, segment_store, output_dir))
+    startup_tasks[stream_id] = asyncio.ensure_future(
+        _launch_registered(stream_id, supervised, watcher, admitted, prepare))
+
+
+async def _launch_registered(stream_id, supervised, watcher, admitted, prepare):
     try:
-        file_path = f"{settings.HLS_MEDIA_ROOT}/{stream_id}/{filename}"
-        if not default_storage.exists(file_path):
-            raise Http404("File does not exist")
+        if prepare is not None:
+            await prepare()
+    except asyncio.CancelledError:
+        watcher.close()
+        raise
+    if not admitted:
+        await _start_when_admitted(stream_id, supervised, watcher)
+        return
+    try:
+        await supervised.spawn()
+    except Exception as e:
+        watcher.close()
+        print(f"Stream {stream_id} failed to start: {e}")
+        stream_states[stream_id]['state'] = 'failed'
+        stream_states[stream_id]['error'] = str(e)
+        await _stop_process(stream_id)
+        startup_tasks.pop(stream_id, None)
+        return
+    await watcher
+
+
+def _ensure_idle_reaper():
+    global idle_reaper
+    if idle_reaper is None or idle_reaper.done() or idle_reaper.get_loop() is not asyncio.get_running_loop():
+        idle_reaper = asyncio.ensure_future(_reap_idle_streams())
+
+
+async def _reap_idle_streams():
+    """
+    Stop ready streams nobody has watched for their idle timeout. Exits
+    once no streams are left; the next start launches it again.
+    """
+    activity = get_activity()
+    while any(is_stream_active(stream_id) for stream_id in list(stream_states)):
+        await asyncio.sleep(settings.HLS_IDLE_CHECK_INTERVAL)
+        for stream_id, state in list(stream_states.items()):
+            timeout = state.get('idle_timeout')
+            if state['state'] != 'ready' or not timeout or activity.idle_for(stream_id) <= timeout:
+                continue
+            print(f"Stopping stream {stream_id}: no viewers for {timeout}s")
+            state['stopped_reason'] = 'idle'
+            try:
+                await stop_stream(stream_id)
+            except Exception as e:
+                print(f"Error stopping idle stream {stream_id}: {e}")
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _attach_ingest(stream_id, store, process):
+    # Called for every (re)start of a low-latency stream's FFmpeg
+    ingest_tasks[stream_id] = asyncio.ensure_future(ingest(store, process.stdout))
+
+
+def _attach_motion(stream_id, detector, process):
+    # Called for every (re)start of a motion-gated stream's FFmpeg
+    ingest_tasks[stream_id] = asyncio.ensure_future(detector.read(process.stdout))
+
+
+async def _switch_encode(stream_id, idle, cmd):
+    """
+    Re-launch a motion-gated stream's FFmpeg with the idle (static scene) or
+    full encode. Players see a discontinuity, as after any restart.
+    """
+    supervised = get_supervisor().get(stream_id)
+    if supervised is None or not is_stream_active(stream_id):
+        return
+    stream_states[stream_id]['encode'] = 'idle' if idle else 'full'
+    print(f"Stream {stream_id}: switching to the {'idle' if idle else 'full'} encode")
+    await supervised.replace(cmd)
+
+
+async def _start_when_admitted(stream_id, supervised, watcher):
+    """
+    Launch a queued stream once the supervisor has capacity for it, then
+    hand over to its normal startup watcher.
+    """
+    state = stream_states[stream_id]
+    try:
+        await get_supervisor().wait_admitted(stream_id)
+        state['state'] = 'starting'
+        await supervised.spawn()
+    except asyncio.CancelledError:
+        # Stopped while still queued
+        watcher.close()
+        raise
+    except Exception as e:
+        watcher.close()
+        print(f"Stream {stream_id} failed to start: {e}")
+        state['state'] = 'failed'
+        state['error'] = str(e)
+        await _stop_process(stream_id)
+        startup_tasks.pop(stream_id, None)
+        return
+    await watcher
+
+
+async def _watch_startup(stream_id, supervised, ready, timeout=None):
+    """
+    Track a freshly launched stream until it has servable output, then mark
+    it ready and hand it to the supervisor's health checks. `ready(timeout)`
+    is the stream's readiness probe: it waits up to `timeout` seconds and
+    returns whether the output is there. The stream fails if FFmpeg exits
+    first or `timeout` (default HLS_START_TIMEOUT + HLS_UPLOAD_TIMEOUT)
+    seconds pass.
+    """
+    state = stream_states[stream_id]
+    process = supervised.process
+    loop = asyncio.get_running_loop()
+    if timeout is None:
+        timeout = settings.HLS_START_TIMEOUT + settings.HLS_UPLOAD_TIMEOUT
+    try:
+        deadline = loop.time() + timeout
+        while not await ready(0.25):
+            if process.returncode is not None:
+                raise RuntimeError(f'FFmpeg exited with code {process.returncode}')
+            if loop.time() > deadline:
+                raise RuntimeError('Timeout waiting for stream to start')
+        state['state'] = 'ready'
+        state['ready_at'] = time.time()
+        # Viewers get a full idle timeout from here to show up
+        get_activity().touch(stream_id)
+        supervised.supervise()
+    except Exception as e:
+        print(f"Stream {stream_id} failed to start: {e}")
+        state['state'] = 'failed'
+        state['error'] = str(e)
+        await _stop_process(stream_id)
+    finally:
+        startup_tasks.pop(stream_id, None)
+
+
+async def _wait_event(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    return event.is_set()
+
+
+def _published_ready(stream_id, segment_store, output_dir, playlist_name='stream.m3u8'):
+    """
+    Readiness of a stream FFmpeg writes to a directory: its first playlist
+    (and therefore its first segment) is written, then published by its
+    segment store.
+    """
+    playlist_path = os.path.join(output_dir, playlist_name)
+    published = asyncio.Event()
+    publishing = False
+
+    async def ready(timeout):
+        nonlocal publishing
+        if not publishing:
+            if not os.path.exists(playlist_path):
+                await asyncio.sleep(timeout)
+                return False
+            loop = asyncio.get_running_loop()
+            segment_store.publish(
+                stream_id, output_dir, playlist_name,
+                on_published=lambda: loop.call_soon_threadsafe(published.set),
+                recorder=recorders.get(stream_id)
+            )
+            publishing = True
+        return await _wait_event(published, timeout)
+    return ready
+
+
+def _pushed_ready(pushed):
+    """Readiness of a stream FFmpeg pushes to hls_ingest: its first playlist is in storage."""
+    loop = asyncio.get_running_loop()
+    published = asyncio.Event()
+    pushed.on_published = lambda: loop.call_soon_threadsafe(published.set)
+    if pushed.playlists_published:
+        published.set()
+    return lambda timeout: _wait_event(published, timeout)
+
+
+async def _supervision_failed(stream_id, reason):
+    # The supervisor gave up restarting FFmpeg
+    state = stream_states.get(stream_id)
+    if state is not None:
+        state['state'] = 'failed'
+        state['error'] = reason
+    await _stop_process(stream_id)
+
+
+async def _stop_process(stream_id):
+    """
+    Stop a stream's FFmpeg process and upload polling, free its transcode
+    slot and remove its working directory.
+    """
+    await get_supervisor().stop(stream_id)
+    task = ingest_tasks.pop(stream_id, None)
+    if task is not None:
+        task.cancel()
+    store = llhls_stores.pop(stream_id, None)
+    if store is not None:
+        store.close()
+    motion_detectors.pop(stream_id, None)
+    pushed_outputs.pop(stream_id, None)
+    mosaic = active_mosaics.pop(stream_id, None)
+    if mosaic is not None:
+        await mosaic.close()
+    segment_store = stream_segment_stores.get(stream_id)
+    if segment_store is not None:
+        segment_store.stop(stream_id)
+    recorder = recorders.pop(stream_id, None)
+    if recorder is not None:
+        await recorder.close()
+    _remove_temp_dir(stream_id)
+    get_snapshot_cache().forget(stream_id)
+    metrics.forget_stream(stream_id)
+    state = stream_states.pop(stream_id, None)
+    if state is not None:
+        _remember_stopped(stream_id, state)
+    if registry.cluster_enabled():
+        await _registry_update(registry.release, stream_id, state.get('cost', 0) if state else 0)
+
 
-        if filename.endswith('.m3u8'):
-            content_type = 'application/vnd.apple.mpegurl'
-        elif filename.endswith('.ts'):
-            content_type = 'video/mp2t'
+async def _registry_update(update, stream_id, cost):
+    # Heartbeats repair the registry, so a failed update is not fatal
+    try:
+        await sync_to_async(update)(stream_id, cost)
+    except Exception as e:
+        print(f"Error updating stream registry for {stream_id}: {e}")
+
+
+async def remote_owner(request, stream_id):
+    """
+    The live node running stream_id when that is another node, so the
+    request should be forwarded there; None in single-node mode.
+    """
+    if not registry.cluster_enabled() or registry.is_forwarded(request) or _is_local(stream_id):
+        return None
+    node = await sync_to_async(registry.lookup_owner)(stream_id)
+    if node is None or node['node_id'] == settings.HLS_NODE_ID:
+        return None
+    return node
+
+
+def _is_local(stream_id):
+    return is_stream_active(stream_id) or stream_id in llhls_stores
+
+
+def is_stream_live(stream_id):
+    """
+    Whether a stream's storage prefix is still in use, here or (in
+    multi-node mode) on any live node, or holds recorded segments. The
+    orphan sweeper spares these.
+    """
+    if _is_local(stream_id):
+        return True
+    if registry.cluster_enabled() and registry.get_registry().owner(stream_id) is not None:
+        return True
+    # Recordings outlive their stream until recording.expire deletes them
+    return RecordedSegment.objects.filter(stream_id=stream_id).exists()
+
+
+def node_snapshot():
+    """This node's load and streams, as published by registry heartbeats."""
+    supervisor = get_supervisor()
+    activity = get_activity()
+    return {
+        'capacity': supervisor.capacity,
+        'used': supervisor.used,
+        'streams': {stream_id: activity.viewers(stream_id) for stream_id in list(stream_states)
+                    if is_stream_active(stream_id)},
+    }
+
+
+async def hls_stream_status(request, stream_id):
+    """
+    Returns: {"stream_id": ..., "state": "queued" | "starting" | "ready" | "failed" | "stopped",
+              "process": {"state", "uptime", "restarts", ...}, ...}
+    """
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return await registry.forward(request, node)
+    state = stream_state(stream_id)
+    if state is None:
+        return JsonResponse({'error': 'Unknown stream'}, status=404)
+    supervised = get_supervisor().get(stream_id)
+    process = supervised.stats() if supervised else None
+    return JsonResponse({'stream_id': stream_id, **state, 'process': process,
+                         **get_activity().stats(stream_id)})
+
+
+async def motion_events(request, stream_id):
+    """
+    Returns: {"stream_id": ..., "moving": ..., "idle": ..., "encode": "full" | "idle" | null,
+              "events": [{"start": ..., "end": ... | null, "peak_score": ...}, ...], ...}
+
+    Motion events of a motion-gated stream, oldest first, as Unix times; an
+    event still in progress has no end. With ?since=<Unix time> only events
+    still open or ended after it are listed.
+    """
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return await registry.forward(request, node)
+    detector = motion_detectors.get(stream_id)
+    if detector is None:
+        return JsonResponse({'error': 'Unknown stream, or it was started without motion'}, status=404)
+    try:
+        since = float(request.GET['since']) if 'since' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error': 'since must be a Unix time'}, status=400)
+    return JsonResponse({'stream_id': stream_id, **detector.stats(),
+                         'encode': stream_states[stream_id].get('encode'),
+                         'events': detector.events_since(since)})
+
+
+async def recordings(request, stream_id):
+    """
+    Returns: {"stream_id": ..., "recording": true | false, "segments": ..., "bytes": ...,
+              "start": ..., "end": ..., "playlist_url": ...}
+
+    What is recorded of a stream, with start and end as Unix times (null
+    when nothing is). The catalog lives in the database, so any node can
+    answer for any stream.
+    """
+    summary = await RecordedSegment.objects.filter(stream_id=stream_id).aaggregate(
+        segments=Count('id'), bytes=Sum('size'), first=Min('start'), last=Max(F('start') + F('duration')))
+    return JsonResponse({
+        'stream_id': stream_id,
+        'recording': is_stream_active(stream_id) and bool(stream_states[stream_id].get('record')),
+        'segments': summary['segments'],
+        'bytes': summary['bytes'] or 0,
+        'start': summary['first'],
+        'end': summary['last'],
+        'playlist_url': reverse('recording_playlist', args=[stream_id]),
+    })
+
+
+async def recording_playlist(request, stream_id):
+    """
+    An HLS playlist of a stream's recording from ?start= to ?end= (Unix
+    times; the whole recording by default). A range that reaches the
+    present of a stream still recording is an EVENT playlist that grows as
+    segments are uploaded; anything else is VOD. At most
+    HLS_RECORD_MAX_PLAYLIST segments are listed, from `start` on.
+    """
+    try:
+        start = float(request.GET.get('start', 0))
+        end = float(request.GET['end']) if 'end' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be Unix times'}, status=400)
+    if end is not None and end <= start:
+        return JsonResponse({'error': 'end must be after start'}, status=400)
+    segments = await sync_to_async(find_segments)(
+        stream_id, start, end if end is not None else float('inf'), settings.HLS_RECORD_MAX_PLAYLIST)
+    if not segments:
+        return JsonResponse({'error': 'Nothing recorded in that range'}, status=404)
+    recording = is_stream_active(stream_id) and bool(stream_states[stream_id].get('record'))
+    # A range the stream is still recording into grows until it is over
+    ended = not recording or (end is not None and end <= time.time()) or \
+        len(segments) == settings.HLS_RECORD_MAX_PLAYLIST
+    response = HttpResponse(build_playlist(stream_id, segments, ended), content_type=content_type('playlist.m3u8'))
+    response['Cache-Control'] = cache_control('playlist.m3u8')
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+def _snapshot(stream_id):
+    """Returns (Snapshot, None), or (None, why there is none)."""
+    if not is_stream_active(stream_id):
+        return None, 'Unknown or stopped stream'
+    if not settings.HLS_SNAPSHOT_INTERVAL:
+        return None, 'Snapshots are turned off'
+    entry = get_snapshot_cache().get(stream_id, os.path.join(stream_temp_dirs[stream_id], SNAPSHOT_NAME))
+    if entry is None:
+        return None, 'No snapshot yet'
+    return entry, None
+
+
+async def snapshot(request, stream_id):
+    """
+    The latest frame of a running stream as a JPEG, at most
+    HLS_SNAPSHOT_MAX_AGE seconds old, taken from the stream's own FFmpeg
+    rather than a new connection to the camera. Snapshots do not count as
+    watching a stream and do not start registered cameras.
+    """
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return await registry.forward(request, node)
+    entry, error = _snapshot(stream_id)
+    if entry is None:
+        return JsonResponse({'error': error}, status=404)
+    if entry.etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(entry.data, content_type='image/jpeg')
+    response['ETag'] = entry.etag
+    response['Last-Modified'] = http_date(entry.taken_at)
+    response['Cache-Control'] = f'public, max-age={settings.HLS_SNAPSHOT_MAX_AGE}'
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+async def snapshots(request):
+    """
+    GET ?ids=<stream_id>,<stream_id>,...
+    Returns: {"snapshots": {<stream_id>: {"taken_at": ..., "image": "data:image/jpeg;base64,..."}
+                                         | {"error": ...}, ...}}
+
+    The snapshots of up to HLS_SNAPSHOT_MAX_BATCH streams in one response,
+    for camera grids. Streams running on other nodes are fetched from them,
+    one request per node.
+    """
+    ids = [stream_id for stream_id in request.GET.get('ids', '').split(',') if stream_id]
+    if not ids:
+        return JsonResponse({'error': 'ids required'}, status=400)
+    if len(ids) > settings.HLS_SNAPSHOT_MAX_BATCH:
+        return JsonResponse({'error': f'At most {settings.HLS_SNAPSHOT_MAX_BATCH} ids'}, status=400)
+    results = {}
+    remote = {}
+    for stream_id in ids:
+        node = await remote_owner(request, stream_id)
+        if node is not None:
+            remote.setdefault(node['node_id'], (node, []))[1].append(stream_id)
+            continue
+        entry, error = _snapshot(stream_id)
+        if entry is None:
+            results[stream_id] = {'error': error}
         else:
-            content_type = 'application/octet-stream'
+            image = base64.b64encode(entry.data).decode()
+            results[stream_id] = {'taken_at': entry.taken_at, 'image': f'data:image/jpeg;base64,{image}'}
+
+    async def fetch(node, stream_ids):
+        path = f"{reverse('snapshots')}?{urlencode({'ids': ','.join(stream_ids)})}"
+        try:
+            results.update((await registry.get_json(node, path))['snapshots'])
+        except Exception as e:
+            for stream_id in stream_ids:
+                results[stream_id] = {'error': f"Node {node['node_id']} is unreachable: {e}"}
+
+    await asyncio.gather(*(fetch(node, stream_ids) for node, stream_ids in remote.values()))
+    response = JsonResponse({'snapshots': results})
+    response['Cache-Control'] = f'public, max-age={settings.HLS_SNAPSHOT_MAX_AGE}'
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+def list_streams(request):
+    """
+    Every stream this node knows about, with its FFmpeg process's state,
+    uptime, restart count and viewers, plus the node's transcode capacity.
+    """
+    supervisor = get_supervisor()
+    streams = []
+    for stream_id, state in all_stream_states().items():
+        supervised = supervisor.get(stream_id)
+        streams.append({
+            'stream_id': stream_id,
+            **state,
+            'process': supervised.stats() if supervised else None,
+            **get_activity().stats(stream_id),
+        })
+    return JsonResponse({
+        'capacity': supervisor.capacity,
+        'used': supervisor.used,
+        'queued': supervisor.queued(),
+        'streams': streams,
+    })
+
+def _segment_store_for(stream_id):
+    segment_store = stream_segment_stores.get(stream_id)
+    if segment_store is None:
+        # Not started by this process (e.g. before a restart)
+        local = get_segment_store('local')
+        segment_store = local if local.has_stream(stream_id) else get_segment_store('s3')
+    return segment_store
+
+
+async def hls_serve(request, stream_id, filename):
+    if filename.startswith('/') or '..' in filename.split('/'):
+        raise Http404("Invalid path")
+    started = time.monotonic()
+    store, response = await _serve(request, stream_id, filename)
+    kind = 'playlist' if filename.endswith('.m3u8') else 'segment'
+    metrics.SERVE_SECONDS.observe(time.monotonic() - started, store=store, kind=kind)
+    if store != 'proxy' and response.status_code < 400:
+        # Only streams this node runs, whose series go away when they stop
+        metrics.SERVE_REQUESTS.inc(stream_id=stream_id, kind=kind)
+    return response
+
+
+async def _serve(request, stream_id, filename):
+    """Returns (where the response came from, response)."""
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return 'proxy', await registry.forward(request, node)
+    if filename.endswith('.m3u8'):
+        # Players re-fetch the playlist for as long as they are watching
+        get_activity().touch(stream_id, _viewer_key(request))
+        if stream_id in camera_starts or not _is_local(stream_id):
+            response = await _start_camera_on_demand(request, stream_id)
+            if response is not None:
+                return 'camera', response
+    store = llhls_stores.get(stream_id)
+    if store is not None:
+        return 'memory', await _serve_low_latency(request, store, filename)
+    segment_store = _segment_store_for(stream_id)
+    return segment_store.name, await segment_store.serve(request, stream_id, filename)
+
+
+def _viewer_key(request):
+    client = request.headers.get('X-Forwarded-For', request.META.get('REMOTE_ADDR', ''))
+    return f"{client.split(',')[0].strip()} {request.headers.get('User-Agent', '')}"
+
 
-        file = default_storage.open(file_path)
-        response = FileResponse(file, content_type=content_type)
-        response['Access-Control-Allow-Origin'] = '*'
+async def _start_camera_on_demand(request, stream_id):
+    """
+    Start a registered camera's stream for the playlist request that is
+    waiting on it. Returns an error response, or None once the stream is
+    ready (or if stream_id is not a registered camera).
+    """
+    task = camera_starts.get(stream_id)
+    if task is None:
+        camera = await Camera.objects.filter(name=stream_id).afirst()
+        if camera is None:
+            return None
+        # Another request may have got there while the camera was looked up
+        task = camera_starts.get(stream_id)
+        if task is None:
+            if is_stream_active(stream_id):
+                return None
+            if registry.cluster_enabled() and not registry.is_forwarded(request):
+                node = await sync_to_async(registry.place_stream)(1)
+                if node is not None and node['node_id'] != settings.HLS_NODE_ID:
+                    # That node starts the camera when the forwarded request arrives
+                    return await registry.forward(request, node)
+                task = camera_starts.get(stream_id)
+                if task is None and is_stream_active(stream_id):
+                    return None
+        if task is None:
+            task = camera_starts[stream_id] = asyncio.ensure_future(_start_camera(camera))
+    try:
+        # The start carries on in the background if this request gives up
+        await asyncio.wait_for(asyncio.shield(task), timeout=settings.HLS_START_TIMEOUT + settings.HLS_UPLOAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        response = JsonResponse({'error': 'Camera is starting'}, status=503)
+        response['Retry-After'] = '2'
         return response
-    except Exception as e:
-        raise Http404(f"Error serving file: {str(e)}")
+    state = stream_state(stream_id) or {}
+    if state.get('state') != 'ready':
+        return JsonResponse({'error': state.get('error', 'Camera failed to start')}, status=503)
+    return None
+
+
+async def _start_camera(camera):
+    try:
+        response = await _start_stream(camera.start_request(), stream_id=camera.name)
+        if response.status_code != 200:
+            _remember_stopped(camera.name, {'state': 'failed', 'error': json.loads(response.content)['error']})
+            return
+        task = startup_tasks.get(camera.name)
+        if task is not None:
+            await task
+    finally:
+        camera_starts.pop(camera.name, None)
+
+
+async def _serve_low_latency(request, store, filename):
+    """
+    Serve a low-latency stream from memory. A playlist request with
+    _HLS_msn (and optionally _HLS_part) is held until that segment or part
+    exists; a request for the preload-hinted part is held until it is muxed.
+    """
+    if filename.endswith('.m3u8'):
+        msn = request.GET.get('_HLS_msn')
+        part = request.GET.get('_HLS_part')
+        if part is not None and msn is None:
+            return JsonResponse({'error': '_HLS_part requires _HLS_msn'}, status=400)
+        if msn is not None:
+            try:
+                msn = int(msn)
+                part = int(part) if part is not None else None
+            except ValueError:
+                return JsonResponse({'error': '_HLS_msn and _HLS_part must be integers'}, status=400)
+            try:
+                ready = await store.wait_for(msn, part)
+            except PlaylistRequestError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            if not ready and not store.closed:
+                return JsonResponse({'error': 'Timeout waiting for the requested segment'}, status=503)
+        body = store.playlist().encode()
+        caching = 'no-cache'
+    else:
+        body = await store.get_part(filename)
+        if body is None:
+            raise Http404("File does not exist")
+        caching = cache_control(filename)
+    response = HttpResponse(body, content_type=content_type(filename))
+    response['Cache-Control'] = caching
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+@csrf_exempt
+async def hls_ingest(request, stream_id, token, filename):
+    """
+    Where FFmpeg writes a stream started with "ingest": "push". PUT stores
+    a segment or playlist, DELETE drops a segment rotated out of the
+    playlist, and GET returns a playlist (FFmpeg reads it back on restart
+    for append_list). The token in the URL is the stream's own.
+    """
+    output = pushed_outputs.get(stream_id)
+    if output is None or not hmac.compare_digest(token, output.token) or '..' in filename.split('/'):
+        raise Http404("Unknown stream")
+    if request.method == 'PUT':
+        output.put(filename, request.body)
+        return HttpResponse(status=201)
+    if request.method == 'DELETE':
+        output.delete(filename)
+        return HttpResponse(status=204)
+    if request.method == 'GET':
+        data = output.get(filename)
+        if data is None:
+            raise Http404("No such playlist")
+        return HttpResponse(data, content_type=content_type(filename))
+    return JsonResponse({'error': 'PUT, DELETE or GET required'}, status=405)
+
 
 @csrf_exempt
-def stop_hls_stream(request, stream_id):
+async def stop_hls_stream(request, stream_id):
     """
-    Stop an HLS stream and clean up its files
+    Stop an HLS stream and clean up its files. S3 objects are deleted in
+    the background (see cleanup_stats).
     """
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return await registry.forward(request, node)
 
     try:
-        # Stop the FFmpeg process if it's running
-        if stream_id in active_ffmpeg_processes:
-            process = active_ffmpeg_processes[stream_id]
-            if process.poll() is None:  # If process is still running
-                process.terminate()
-                process.wait(timeout=5)  # Wait up to 5 seconds for process to terminate
-            del active_ffmpeg_processes[stream_id]
-
-        # Clean up S3 files
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
-
-        # List all objects in the stream directory
-        stream_prefix = f"{settings.HLS_MEDIA_ROOT}/{stream_id}/"
-        try:
-            response = s3_client.list_objects_v2(
-                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                Prefix=stream_prefix
-            )
-            
-            # Delete all objects in the stream directory
-            if 'Contents' in response:
-                objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
-                if objects_to_delete:
-                    s3_client.delete_objects(
-                        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                        Delete={'Objects': objects_to_delete}
-                    )
-        except ClientError as e:
-            print(f"Error cleaning up S3 files: {e}")
-            return JsonResponse({'error': 'Failed to clean up stream files'}, status=500)
-
+        await stop_stream(stream_id)
         return JsonResponse({'message': 'Stream stopped and cleaned up successfully'})
     except Exception as e:
         return JsonResponse({'error': f'Error stopping stream: {str(e)}'}, status=500)
+
+
+async def stop_stream(stream_id):
+    """
+    Stop a stream and delete its segments (for S3, by queueing them for the
+    cleanup worker).
+    """
+    # Stop the startup watcher and FFmpeg process if they are running
+    task = startup_tasks.pop(stream_id, None)
+    if task is not None:
+        task.cancel()
+    # Taken first: _stop_process moves it to stream_history
+    state = stream_states.get(stream_id) or stream_history.get(stream_id, {})
+    await _stop_process(stream_id)
+    get_activity().forget(stream_id)
+    if state:
+        state['state'] = 'stopped'
+    if state.get('low_latency'):
+        # Nothing of a low-latency stream is written to storage
+        return
+    if state.get('record'):
+        # The recording stays; only the live playlist goes
+        await sync_to_async(_segment_store_for(stream_id).delete_playlist)(stream_id)
+    else:
+        await sync_to_async(_segment_store_for(stream_id).delete)(stream_id)
+    stream_segment_stores.pop(stream_id, None)
+
+
+def cluster_nodes(request):
+    """
+    Live nodes of a multi-node deployment with their load, streams and
+    viewers, from the stream registry.
+    """
+    if not registry.cluster_enabled():
+        return JsonResponse({'node_id': settings.HLS_NODE_ID, 'nodes': []})
+    return JsonResponse({'node_id': settings.HLS_NODE_ID, 'nodes': registry.get_registry().nodes()})
+
+
+def cleanup_stats(request):
+    """
+    Progress of the background deletion of stopped streams' S3 objects
+    """
+    return JsonResponse(get_cleanup_worker().stats())
+
+
+def segment_cache_stats(request):
+    """
+    Size and hit/miss counters of the in-memory segment cache behind hls_serve
+    """
+    return JsonResponse(get_segment_cache().stats())
+
+
+def upload_stats(request):
+    """
+    Per-stream upload queue depth and latency from the shared upload scheduler
+    """
+    return JsonResponse({'streams': get_upload_scheduler().stats()})
+
+
+def _camera_json(camera):
+    return {
+        'name': camera.name,
+        'mode': camera.mode,
+        'store': camera.store or settings.HLS_SEGMENT_STORE,
+        'low_latency': camera.low_latency,
+        'abr': camera.abr,
+        'motion': camera.motion,
+        'record': camera.record,
+        'retention': camera.retention if camera.retention is not None else settings.HLS_RECORD_RETENTION,
+        'idle_timeout': camera.idle_timeout if camera.idle_timeout is not None else settings.HLS_IDLE_TIMEOUT,
+        'playlist_url': camera.playlist_url(),
+        'state': (stream_state(camera.name) or {}).get('state', 'idle'),
+    }
+
+
+@csrf_exempt
+async def cameras(request):
+    """
+    GET: every registered camera and whether its stream is running.
+    POST: {"name": ..., "url": ..., "username": ..., "password": ..., "mode": ...,
+           "store": ..., "low_latency": ..., "abr": ..., "motion": ..., "record": ..., "retention": ...,
+           "idle_timeout": ...}
+    registers a camera (or updates the one with that name). Nothing is
+    started: the camera's stream starts on the first request for its
+    playlist_url and stops again when nobody is watching.
+    """
+    if request.method == 'GET':
+        return JsonResponse({'cameras': [_camera_json(camera) async for camera in Camera.objects.all()]})
+    if request.method != 'POST':
+        return JsonResponse({'error': 'GET or POST required'}, status=405)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except Exception:
+        data = {}
+
+    fields = {
+        'url': data.get('url'),
+        'username': data.get('username') or '',
+        'password': data.get('password') or '',
+        'mode': data.get('mode', 'auto'),
+        'store': data.get('store') or '',
+        'low_latency': bool(data.get('low_latency')),
+        'abr': bool(data.get('abr')),
+        'motion': bool(data.get('motion')),
+        'record': bool(data.get('record')),
+        'retention': data.get('retention'),
+        'idle_timeout': data.get('idle_timeout'),
+    }
+    camera = Camera(name=data.get('name'), **fields)
+    try:
+        camera.full_clean(validate_unique=False)
+        # Checked now, as they will be when the camera's stream starts
+        parse_stream_options(fields)
+    except ValidationError as e:
+        return JsonResponse({'error': e.message_dict}, status=400)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    camera, created = await Camera.objects.aupdate_or_create(name=camera.name, defaults=fields)
+    return JsonResponse(_camera_json(camera), status=201 if created else 200)
+
+
+@csrf_exempt
+async def camera_detail(request, name):
+    """
+    GET: one registered camera. DELETE: stop its stream and unregister it.
+    """
+    camera = await Camera.objects.filter(name=name).afirst()
+    if camera is None:
+        return JsonResponse({'error': 'Unknown camera'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse(_camera_json(camera))
+    if request.method != 'DELETE':
+        return JsonResponse({'error': 'GET or DELETE required'}, status=405)
+    if is_stream_active(name):
+        await stop_stream(name)
+    await camera.adelete()
+    return JsonResponse({'message': 'Camera removed'})
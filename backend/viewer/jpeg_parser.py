@@ -0,0 +1,74 @@
+SOI = b'\xff\xd8'  # JPEG start-of-image marker
+EOI = b'\xff\xd9'  # JPEG end-of-image marker
+
+
+class JPEGFrameParser:
+    """
+    Incremental splitter for a concatenated JPEG (MJPEG) byte stream.
+
+    Input is appended to a single bytearray and scanning resumes where the
+    previous call stopped, so each byte is searched once no matter how the
+    stream is chunked. Every frame is copied out exactly once, and consumed
+    bytes are released from the front of the buffer in one step per feed().
+
+    `chunk_size` follows the observed frame size so callers can read roughly
+    a frame per read instead of many small 4 KB reads.
+    """
+    def __init__(self, min_chunk=4096, max_chunk=1 << 20):
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.chunk_size = min_chunk
+        self.frame_count = 0
+        self.avg_frame_size = None
+        self._buffer = bytearray()
+        self._start = -1  # offset of the current frame's SOI, -1 if none yet
+        self._scan = 0    # offset where the next marker search resumes
+
+    def feed(self, chunk):
+        """Append `chunk` and return the list of complete frames it finished."""
+        buf = self._buffer
+        buf += chunk
+        frames = []
+        with memoryview(buf) as view:
+            while True:
+                if self._start < 0:
+                    start = buf.find(SOI, self._scan)
+                    if start < 0:
+                        # Keep a trailing 0xFF in case a marker is split
+                        self._scan = max(len(buf) - 1, self._scan)
+                        break
+                    self._start = start
+                    self._scan = start + 2
+                end = buf.find(EOI, self._scan)
+                if end < 0:
+                    self._scan = max(len(buf) - 1, self._scan)
+                    break
+                frames.append(bytes(view[self._start:end + 2]))
+                self._start = -1
+                self._scan = end + 2
+        self._compact()
+        for frame in frames:
+            self._observe(len(frame))
+        return frames
+
+    def _compact(self):
+        cut = self._start if self._start >= 0 else self._scan
+        if cut:
+            # Deleting from the front of a bytearray is O(1) in CPython
+            del self._buffer[:cut]
+            self._scan -= cut
+            if self._start >= 0:
+                self._start -= cut
+
+    def _observe(self, size):
+        self.frame_count += 1
+        if self.avg_frame_size is None:
+            self.avg_frame_size = size
+        else:
+            self.avg_frame_size = 0.9 * self.avg_frame_size + 0.1 * size
+        target = 1 << int(self.avg_frame_size - 1).bit_length()
+        self.chunk_size = max(self.min_chunk, min(self.max_chunk, target))
+
+    def buffered(self):
+        return len(self._buffer)
+
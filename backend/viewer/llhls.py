@@ -0,0 +1,311 @@
+import asyncio
+import math
+import re
+import time
+from collections import deque
+from django.conf import settings
+from .fmp4 import BoxReader, parse_fragment, parse_init_segment
+
+PART_NAME = re.compile(r'^seg(\d+)\.part(\d+)\.m4s$')
+SEGMENT_NAME = re.compile(r'^seg(\d+)\.m4s$')
+
+# Segments whose parts are still listed in the playlist, counting the one
+# being written (RFC 8216bis asks for at least the last three target durations)
+PART_SEGMENTS = 3
+
+
+class PlaylistRequestError(ValueError):
+    """A blocking reload asked for a segment too far in the future."""
+
+
+class Part:
+    __slots__ = ('data', 'duration', 'independent', 'received_at')
+
+    def __init__(self, data, duration, independent):
+        self.data = data
+        self.duration = duration
+        self.independent = independent
+        self.received_at = time.time()
+
+
+class Segment:
+    def __init__(self, msn, init_name='init.mp4', discontinuity=False):
+        self.msn = msn
+        self.init_name = init_name
+        self.discontinuity = discontinuity
+        self.parts = []
+        self.complete = False
+        self.duration = 0.0
+        self._data = None
+
+    def add(self, part):
+        self.parts.append(part)
+        self.duration += part.duration
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = b''.join(part.data for part in self.parts)
+        return self._data
+
+
+class LowLatencyHLSStore:
+    """
+    In-memory LL-HLS media for one stream.
+
+    Fragments arrive from FFmpeg via add_fragment(); each one becomes a
+    partial segment and a new full segment is started at the first keyframe
+    after HLS_LL_SEGMENT_TARGET seconds. Only the last HLS_LL_WINDOW full
+    segments are kept. Everything runs on the event loop, so waiters are
+    woken through a per-update asyncio.Event rather than a lock.
+
+    If FFmpeg is restarted, its new output continues the same playlist
+    after an EXT-X-DISCONTINUITY, with the new init segment (init1.mp4,
+    init2.mp4, ...) in a fresh EXT-X-MAP.
+    """
+    def __init__(self, part_target=None, segment_target=None, window=None):
+        self.part_target = part_target or settings.HLS_LL_PART_TARGET
+        self.segment_target = segment_target or settings.HLS_LL_SEGMENT_TARGET
+        self.window = window or settings.HLS_LL_WINDOW
+        self.init_segment = None
+        self.init_name = None
+        self.inits = {}
+        self._init_count = 0
+        self.tracks = None
+        self.segments = deque()
+        self.closed = False
+        self.fragments_dropped = 0
+        self.last_output = None
+        self._next_msn = 0
+        self._discontinuity = False
+        self._discontinuity_sequence = 0
+        self._max_part = 0.0
+        self._max_segment = 0.0
+        self._updated = asyncio.Event()
+
+    def set_init_segment(self, data):
+        tracks = parse_init_segment(data)
+        if self.init_name is None:
+            self.init_name = 'init.mp4'
+        else:
+            # A restarted FFmpeg: its timeline starts over
+            self.source_ended()
+            self._discontinuity = True
+            # Never reused: segments still in the window may point at an
+            # older init that has not been pruned yet
+            self._init_count += 1
+            self.init_name = f'init{self._init_count}.mp4'
+        self.tracks = tracks
+        self.init_segment = data
+        self.inits[self.init_name] = data
+        self._notify()
+
+    def add_fragment(self, data, moof):
+        """Add one moof+mdat fragment (plus any boxes that preceded it)."""
+        info = parse_fragment(moof, self.tracks)
+        current = self.segments[-1] if self.segments and not self.segments[-1].complete else None
+        if info is None:
+            # No video samples (e.g. an audio-only fragment); keep it in
+            # the stream but it cannot start a segment
+            info = {'duration': 0.0, 'independent': False}
+        if current is None and not info['independent']:
+            # Segments must start on a keyframe
+            self.fragments_dropped += 1
+            return
+        if current is not None and info['independent'] and current.duration >= self.segment_target - 0.001:
+            self._complete(current)
+            current = None
+        if current is None:
+            current = Segment(self._next_msn, self.init_name, self._discontinuity)
+            self._discontinuity = False
+            self._next_msn += 1
+            self.segments.append(current)
+        current.add(Part(data, info['duration'], info['independent']))
+        self.last_output = time.time()
+        self._max_part = max(self._max_part, info['duration'])
+        self._notify()
+
+    def _complete(self, segment):
+        segment.complete = True
+        self._max_segment = max(self._max_segment, segment.duration)
+        while len(self.segments) > self.window:
+            if self.segments.popleft().discontinuity:
+                self._discontinuity_sequence += 1
+        in_use = {segment.init_name for segment in self.segments} | {self.init_name}
+        for name in [name for name in self.inits if name not in in_use]:
+            del self.inits[name]
+
+    def source_ended(self):
+        """FFmpeg's output ended: finish the open segment."""
+        if self.segments and not self.segments[-1].complete:
+            self._complete(self.segments[-1])
+            self._notify()
+
+    def close(self):
+        """The stream stopped: finish the open segment and release all waiters."""
+        self.source_ended()
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    @property
+    def target_duration(self):
+        return max(math.ceil(self.segment_target), round(self._max_segment))
+
+    @property
+    def part_target_duration(self):
+        return max(self.part_target, self._max_part)
+
+    def has(self, msn, part=None):
+        """Whether the playlist already contains segment `msn` (or its part `part`)."""
+        if not self.segments:
+            return False
+        last = self.segments[-1]
+        if msn < last.msn:
+            return True
+        if msn > last.msn:
+            return False
+        if last.complete:
+            return True
+        return part is not None and len(last.parts) > part
+
+    async def wait_for(self, msn, part=None, timeout=None):
+        """
+        Block until has(msn, part) (returns True), the stream closes or
+        `timeout` passes (returns False). Raises PlaylistRequestError when
+        `msn` is more than two segments ahead of the live edge.
+        """
+        if msn > self._next_msn + 1:
+            raise PlaylistRequestError(f'Segment {msn} is too far in the future')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout if timeout is not None else 3 * self.target_duration)
+        while not self.has(msn, part):
+            remaining = deadline - loop.time()
+            if self.closed or remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._updated.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def segment(self, msn):
+        for segment in self.segments:
+            if segment.msn == msn:
+                return segment
+        return None
+
+    def get(self, name):
+        """Bytes for an init segment, segN.m4s (complete segments) or segN.partM.m4s, else None."""
+        if name in self.inits:
+            return self.inits[name]
+        match = PART_NAME.match(name)
+        if match:
+            segment = self.segment(int(match.group(1)))
+            index = int(match.group(2))
+            if segment is not None and index < len(segment.parts):
+                return segment.parts[index].data
+            return None
+        match = SEGMENT_NAME.match(name)
+        if match:
+            segment = self.segment(int(match.group(1)))
+            if segment is not None and segment.complete:
+                return segment.data
+        return None
+
+    async def get_part(self, name, timeout=None):
+        """
+        Like get(), but a request for the part named in the preload hint is
+        held until that part exists, so players can ask for it early.
+        """
+        data = self.get(name)
+        match = PART_NAME.match(name)
+        if data is not None or not match:
+            return data
+        msn, index = int(match.group(1)), int(match.group(2))
+        try:
+            await self.wait_for(msn, index, timeout=timeout)
+        except PlaylistRequestError:
+            return None
+        # The segment may have been closed before reaching this part
+        return self.get(name)
+
+    def playlist(self):
+        part_target = self.part_target_duration
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            f'#EXT-X-TARGETDURATION:{self.target_duration}',
+            f'#EXT-X-PART-INF:PART-TARGET={part_target:.3f}',
+            f'#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * part_target:.3f}',
+            f'#EXT-X-MEDIA-SEQUENCE:{self.segments[0].msn if self.segments else 0}',
+        ]
+        if self._discontinuity_sequence:
+            lines.append(f'#EXT-X-DISCONTINUITY-SEQUENCE:{self._discontinuity_sequence}')
+        if not self.segments and self.init_name:
+            lines.append(f'#EXT-X-MAP:URI="{self.init_name}"')
+        with_parts = len(self.segments) - PART_SEGMENTS
+        init_name = None
+        for i, segment in enumerate(self.segments):
+            if segment.discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            if segment.init_name != init_name:
+                init_name = segment.init_name
+                lines.append(f'#EXT-X-MAP:URI="{init_name}"')
+            if i >= with_parts:
+                for index, part in enumerate(segment.parts):
+                    attributes = f'DURATION={part.duration:.3f},URI="seg{segment.msn}.part{index}.m4s"'
+                    if part.independent:
+                        attributes += ',INDEPENDENT=YES'
+                    lines.append(f'#EXT-X-PART:{attributes}')
+            if segment.complete:
+                lines.append(f'#EXTINF:{segment.duration:.3f},')
+                lines.append(f'seg{segment.msn}.m4s')
+        if self.closed:
+            lines.append('#EXT-X-ENDLIST')
+        else:
+            current = self.segments[-1] if self.segments and not self.segments[-1].complete else None
+            if current is not None:
+                hint = f'seg{current.msn}.part{len(current.parts)}.m4s'
+            else:
+                hint = f'seg{self._next_msn}.part0.m4s'
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{hint}"')
+        return '\n'.join(lines) + '\n'
+
+
+async def ingest(store, stream, chunk_size=65536):
+    """
+    Read one FFmpeg process's fragmented MP4 output from `stream` into
+    `store` until EOF. The store stays open, since the process may be
+    restarted into it.
+    """
+    reader = BoxReader()
+    have_init = False
+    header = []
+    pending = []
+    moof = None
+    try:
+        while True:
+            chunk = await stream.read(chunk_size)
+            if not chunk:
+                break
+            for box_type, data in reader.feed(chunk):
+                if not have_init:
+                    # ftyp + moov
+                    header.append(data)
+                    if box_type == b'moov':
+                        store.set_init_segment(b''.join(header))
+                        have_init = True
+                    continue
+                pending.append(data)
+                if box_type == b'moof':
+                    moof = data
+                elif box_type == b'mdat' and moof is not None:
+                    store.add_fragment(b''.join(pending), moof)
+                    pending = []
+                    moof = None
+    finally:
+        store.source_ended()
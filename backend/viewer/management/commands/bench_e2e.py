@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from unittest import mock
+import django
+from channels.testing import WebsocketCommunicator
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+from viewer import broadcast, hls_stream, metrics, uploader
+from viewer.benchmarks import (DelayedStorage, fake_ffmpeg_binary, filesystem_storages, looped_source_binary,
+                               make_test_clip)
+from viewer.consumers import StreamConsumer
+from viewer.rtsp import camera_key
+from viewer.upload_pool import get_upload_scheduler
+from .bench_start_load import percentile
+
+# Bump when the report's layout changes, so old baselines are not compared blindly
+REPORT_VERSION = 1
+
+
+def rounded(value, digits=4):
+    return round(value, digits) if value is not None else None
+
+
+class Command(BaseCommand):
+    help = ('Scale from 1 to N concurrent cameras through start_hls and the WebSocket consumer, with a '
+            'local camera and storage, and report CPU, memory, upload, segment latency and WebSocket '
+            'fps for each step as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=8, help='Cameras in the largest step')
+        parser.add_argument('--steps', help='Comma-separated camera counts (default: 1, 2, 4 ... --streams)')
+        parser.add_argument('--seconds', type=float, default=10, help='Measurement window per step')
+        parser.add_argument('--ffmpeg', help='Real FFmpeg binary; cameras become a looped lavfi test clip '
+                                             '(default: a fake that writes dummy segments and frames)')
+        parser.add_argument('--size', default='1280x720', help='Test clip size with --ffmpeg')
+        parser.add_argument('--fps', type=int, default=25, help='Test clip frame rate with --ffmpeg')
+        parser.add_argument('--storage-delay', type=float, default=0,
+                            help='Seconds added to every storage call, roughly one S3 round trip')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for streams to be ready')
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+        parser.add_argument('--baseline', help='A previous report to compare against')
+
+    def handle(self, *args, **options):
+        steps = self.steps(options)
+        work_dir = tempfile.mkdtemp(prefix='bench_e2e_')
+        try:
+            if options['ffmpeg']:
+                try:
+                    clip = make_test_clip(options['ffmpeg'], os.path.join(work_dir, 'camera.mp4'),
+                                          size=options['size'], fps=options['fps'])
+                except (OSError, subprocess.CalledProcessError) as e:
+                    raise CommandError(f'Could not encode the test clip (FFmpeg needs lavfi and libx264): {e}')
+                ffmpeg = looped_source_binary(options['ffmpeg'], clip, work_dir)
+            else:
+                ffmpeg = fake_ffmpeg_binary(work_dir)
+            # Streams are stopped between steps, not by the idle reaper or admission control
+            with override_settings(FFMPEG_BINARY=ffmpeg, STORAGES=filesystem_storages(f'{work_dir}/media'),
+                                   HLS_SEGMENT_STORE='s3', HLS_MAX_TRANSCODES=max(steps)), \
+                    mock.patch.object(uploader, 'default_storage',
+                                      DelayedStorage(default_storage, options['storage_delay'])):
+                results = asyncio.run(self.run(steps, options))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        report = {
+            'report_version': REPORT_VERSION,
+            'config': {
+                'source': 'looped lavfi testsrc2 clip' if options['ffmpeg'] else 'fake ffmpeg',
+                'size': options['size'] if options['ffmpeg'] else None,
+                'fps': options['fps'] if options['ffmpeg'] else None,
+                'seconds': options['seconds'],
+                'storage_delay': options['storage_delay'],
+                'steps': steps,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'results': results,
+        }
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+        else:
+            self.stdout.write(text)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                self.compare(json.load(f), report)
+
+    def steps(self, options):
+        if options['steps']:
+            try:
+                steps = sorted({int(n) for n in options['steps'].split(',')})
+            except ValueError:
+                raise CommandError('--steps must be comma-separated integers')
+        else:
+            steps, n = [], 1
+            while n < options['streams']:
+                steps.append(n)
+                n *= 2
+            steps.append(options['streams'])
+        if not steps or steps[0] < 1:
+            raise CommandError('Every step needs at least one camera')
+        return steps
+
+    async def run(self, steps, options):
+        results = []
+        for count in steps:
+            result = await self.run_step(count, options)
+            self.stderr.write(f"{count:>4} cameras: {result['ready']} ready, "
+                              f"{result['cpu_per_stream']['ffmpeg']} FFmpeg cores/stream, "
+                              f"{result['websocket_fps']['p50']} fps/client")
+            results.append(result)
+        return results
+
+    async def run_step(self, count, options):
+        client = AsyncClient()
+        urls = [f'rtsp://bench.local/cam{i}' for i in range(count)]
+        responses = await asyncio.gather(*(
+            client.post('/start_hls/', {'url': url, 'mode': 'transcode', 'idle_timeout': 0},
+                        content_type='application/json')
+            for url in urls
+        ))
+        streams = [r.json() for r in responses if r.status_code == 200]
+        stream_ids = [s['stream_id'] for s in streams]
+        deadline = time.monotonic() + options['timeout']
+        while time.monotonic() < deadline:
+            if all(hls_stream.stream_state(s)['state'] not in ('queued', 'starting') for s in stream_ids):
+                break
+            await asyncio.sleep(0.1)
+
+        sockets = []
+        try:
+            for url, stream_id in zip(urls, stream_ids):
+                sockets.append(await self.open_socket(url, stream_id))
+            return await self.measure(client, streams, sockets, options)
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
+            await asyncio.gather(*(hls_stream.stop_stream(s) for s in stream_ids))
+            # Let the MJPEG processes exit before the next step starts its own
+            for _ in range(50):
+                if not any(camera_key(url) in broadcast.active_broadcasters for url in urls):
+                    break
+                await asyncio.sleep(0.1)
+
+    async def open_socket(self, url, stream_id):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError('The WebSocket consumer refused the connection')
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'action': 'watch', 'stream_id': stream_id})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'url': url})
+        return communicator
+
+    def snapshot(self, stream_ids):
+        ffmpeg_cpu = 0.0
+        ffmpeg_memory = []
+        pids = [p.process.pid for p in hls_stream.get_supervisor().processes.values() if p.process]
+        pids += [b.process.pid for b in broadcast.active_broadcasters.values() if b.process]
+        for pid in pids:
+            ffmpeg_cpu += metrics.process_cpu_seconds(pid) or 0
+            memory = metrics.process_memory_bytes(pid)
+            if memory is not None:
+                ffmpeg_memory.append(memory)
+        times = os.times()
+        return {
+            'at': time.monotonic(),
+            'server_cpu': times.user + times.system,
+            'ffmpeg_cpu': ffmpeg_cpu,
+            'ffmpeg_memory': ffmpeg_memory,
+            'server_memory': metrics.process_memory_bytes(),
+            'upload_bytes': sum(metrics.UPLOAD_BYTES.value(stream_id=s) or 0 for s in stream_ids),
+        }
+
+    async def measure(self, client, streams, sockets, options):
+        stream_ids = [s['stream_id'] for s in streams]
+        lag = {'max': 0.0}
+        serve_latencies = []
+        measuring = True
+
+        async def monitor_loop_lag():
+            while measuring:
+                before = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag['max'] = max(lag['max'], time.perf_counter() - before - 0.01)
+
+        async def play(stream_id):
+            # Fetch the playlist and its newest segment through hls_serve once a second, like a player
+            while measuring:
+                started = time.perf_counter()
+                response = await client.get(reverse('hls_serve', args=[stream_id, 'stream.m3u8']))
+                if response.status_code == 200:
+                    uris = [line for line in response.content.decode().splitlines()
+                            if line and not line.startswith('#')]
+                    if uris:
+                        segment = await client.get(reverse('hls_serve', args=[stream_id, uris[-1]]))
+                        if segment.status_code == 200:
+                            serve_latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(1)
+
+        for communicator in sockets:
+            drain(communicator)
+        before = self.snapshot(stream_ids)
+        tasks = [asyncio.ensure_future(monitor_loop_lag())]
+        tasks += [asyncio.ensure_future(play(stream_id)) for stream_id in stream_ids]
+        await asyncio.sleep(options['seconds'])
+        measuring = False
+        await asyncio.gather(*tasks)
+        after = self.snapshot(stream_ids)
+        received = [drain(communicator) for communicator in sockets]
+
+        elapsed = after['at'] - before['at']
+        count = max(len(stream_ids), 1)
+        fps = [frames / elapsed for frames, _ in received]
+        uploads = get_upload_scheduler().stats()
+        upload_latency = [uploads[s]['avg_latency'] for s in stream_ids
+                          if s in uploads and uploads[s]['avg_latency'] is not None]
+        states = [hls_stream.stream_state(s)['state'] for s in stream_ids]
+        return {
+            'streams': len(streams),
+            'ready': states.count('ready'),
+            'failed': states.count('failed'),
+            'cpu_per_stream': {
+                'ffmpeg': rounded((after['ffmpeg_cpu'] - before['ffmpeg_cpu']) / elapsed / count),
+                'server': rounded((after['server_cpu'] - before['server_cpu']) / elapsed / count),
+            },
+            'memory_mb': {
+                'server': rounded(after['server_memory'] / 2 ** 20, 1) if after['server_memory'] else None,
+                'ffmpeg_per_process': rounded(statistics.mean(after['ffmpeg_memory']) / 2 ** 20, 1)
+                if after['ffmpeg_memory'] else None,
+            },
+            'upload_bytes_per_stream_per_second': rounded((after['upload_bytes'] - before['upload_bytes'])
+                                                          / elapsed / count, 1),
+            'upload_latency': {
+                'p50': rounded(statistics.median(upload_latency)) if upload_latency else None,
+                'max': rounded(max(upload_latency)) if upload_latency else None,
+            },
+            'segment_fetch_latency': {
+                'p50': rounded(statistics.median(serve_latencies)) if serve_latencies else None,
+                'p95': rounded(percentile(serve_latencies, 0.95)),
+            },
+            'websocket_fps': {
+                'p50': rounded(statistics.median(fps), 2) if fps else None,
+                'min': rounded(min(fps), 2) if fps else None,
+            },
+            'websocket_bytes_per_second': rounded(sum(size for _, size in received) / elapsed, 1),
+            'max_event_loop_lag': rounded(lag['max']),
+        }
+
+    def compare(self, baseline, report):
+        if baseline.get('report_version') != report['report_version']:
+            raise CommandError('The baseline was written by a different report version')
+        old_steps = {result['streams']: result for result in baseline['results']}
+        for result in report['results']:
+            old = old_steps.get(result['streams'])
+            if old is None:
+                continue
+            self.stdout.write(f"\n{result['streams']} cameras:")
+            for key, new_value, old_value in flatten(result, old):
+                change = f'{(new_value - old_value) / old_value:+.1%}' if old_value else ''
+                self.stdout.write(f'{key:>40}: {old_value} -> {new_value} {change}')
+
+
+def drain(communicator):
+    """
+    Count the frames (binary messages) a test WebSocket client has received
+    so far and discard them. Reads the communicator's queue directly, since
+    a timed-out receive_output() would cancel the consumer.
+    """
+    frames = size = 0
+    while not communicator.output_queue.empty():
+        message = communicator.output_queue.get_nowait()
+        if message.get('bytes') is not None:
+            frames += 1
+            size += len(message['bytes'])
+    return frames, size
+
+
+def flatten(new, old, prefix=''):
+    """Yield (dotted key, new, old) for every number both reports have."""
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            yield from flatten(value, old[key], f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)):
+            yield f'{prefix}{key}', value, old[key]
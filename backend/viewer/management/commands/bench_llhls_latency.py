@@ -0,0 +1,151 @@
+import asyncio
+import json
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+from viewer import hls_stream
+from viewer.benchmarks.timestamp_source import timestamp_frame
+from viewer.ffmpeg_commands import build_llhls_command
+from viewer.fmp4 import BoxReader, parse_fragment, parse_init_segment
+from viewer.llhls import LowLatencyHLSStore, ingest
+from .bench_start_load import percentile
+
+
+class Command(BaseCommand):
+    help = ('Encode a timestamped test source through the low-latency HLS pipeline and report '
+            'capture-to-client latency of each part, fetched the way an LL-HLS player does')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=20)
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--size', default='640x360')
+        parser.add_argument('--part-target', type=float, default=0.2)
+        parser.add_argument('--ffmpeg', help='FFmpeg binary to use (needs libx264)')
+        parser.add_argument('--drawtext', action='store_true',
+                            help='Also burn a readable wall clock into the video (needs libfreetype)')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        overrides = {'FFMPEG_BINARY': options['ffmpeg']} if options['ffmpeg'] else {}
+        with override_settings(**overrides):
+            report = asyncio.run(self.run(options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for key, value in report.items():
+            self.stdout.write(f'{key:>24}: {value}')
+
+    async def run(self, options):
+        width, height = (int(n) for n in options['size'].split('x'))
+        fps = options['fps']
+        source_args = [
+            '-f', 'rawvideo',
+            '-pix_fmt', 'gray',
+            '-video_size', f'{width}x{height}',
+            '-framerate', str(fps),
+            '-i', 'pipe:0',
+            '-pix_fmt', 'yuv420p',
+        ]
+        if options['drawtext']:
+            source_args += ['-vf', "drawtext=x=10:y=40:fontsize=32:fontcolor=white:text='%{localtime\\:%X}'"]
+        store = LowLatencyHLSStore(part_target=options['part_target'])
+        cmd = build_llhls_command(None, 'transcode', None, store.part_target, source_args=source_args)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise CommandError(f'Could not run FFmpeg: {e}')
+
+        stream_id = 'bench-llhls'
+        hls_stream.llhls_stores[stream_id] = store
+        ingest_task = asyncio.ensure_future(ingest(store, process.stdout))
+        captured = []
+        feeder = asyncio.ensure_future(self.feed(process.stdin, captured, width, height, fps))
+        try:
+            latencies, missed = await self.play(stream_id, store, captured, fps, options['seconds'])
+        finally:
+            feeder.cancel()
+            process.kill()
+            await process.wait()
+            ingest_task.cancel()
+            hls_stream.llhls_stores.pop(stream_id, None)
+
+        if not latencies:
+            raise CommandError('No parts were received; check that FFmpeg has libx264')
+        return {
+            'seconds': options['seconds'],
+            'frames_captured': len(captured),
+            'parts_received': len(latencies),
+            'parts_missed': missed,
+            'part_target': store.part_target,
+            'latency_min': round(min(latencies), 4),
+            'latency_p50': round(statistics.median(latencies), 4),
+            'latency_p95': round(percentile(latencies, 0.95), 4),
+            'latency_max': round(max(latencies), 4),
+        }
+
+    async def feed(self, stdin, captured, width, height, fps):
+        """Write frames in real time, remembering when each one was captured."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        index = 0
+        try:
+            while True:
+                await asyncio.sleep(max(started + index / fps - loop.time(), 0))
+                now = time.time()
+                captured.append(now)
+                stdin.write(timestamp_frame(width, height, now, index))
+                await stdin.drain()
+                index += 1
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def play(self, stream_id, store, captured, fps, seconds):
+        """
+        Follow the live edge like an LL-HLS player: a blocking playlist
+        reload for the next part, then the part itself. A part's latency is
+        the time from capturing its last frame to having it in hand.
+        """
+        client = AsyncClient()
+        playlist_url = reverse('hls_serve', args=[stream_id, 'stream.m3u8'])
+        deadline = time.time() + seconds
+        latencies = []
+        missed = 0
+        tracks = None
+        first_frame_time = None
+        msn, part = 0, 0
+        while time.time() < deadline:
+            response = await client.get(playlist_url, {'_HLS_msn': msn, '_HLS_part': part})
+            if response.status_code == 503:
+                continue
+            if response.status_code != 200 or store.closed:
+                break
+            if tracks is None:
+                tracks = parse_init_segment(store.init_segment)
+            response = await client.get(reverse('hls_serve', args=[stream_id, f'seg{msn}.part{part}.m4s']))
+            received = time.time()
+            if response.status_code == 404:
+                if store.segment(msn) is None:
+                    # Fell out of the window; jump back to the live edge
+                    missed += 1
+                    msn, part = store.segments[-1].msn, 0
+                else:
+                    # The segment ended before this part; continue with the next one
+                    msn, part = msn + 1, 0
+                continue
+            moof = next(box for box_type, box in BoxReader().feed(response.content) if box_type == b'moof')
+            info = parse_fragment(moof, tracks)
+            part += 1
+            if info is None:
+                continue
+            if first_frame_time is None:
+                first_frame_time = info['base_time']
+            last_frame = round((info['base_time'] - first_frame_time + info['duration']) * fps) - 1
+            if 0 <= last_frame < len(captured):
+                latencies.append(received - captured[last_frame])
+        return latencies, missed
@@ -0,0 +1,83 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from viewer.jpeg_parser import JPEGFrameParser, SOI, EOI
+
+
+def synthetic_mjpeg(frames, frame_size):
+    """
+    Build an MJPEG byte stream of `frames` JPEG-shaped frames. 0xFF bytes in
+    the payload are replaced so markers only appear at frame boundaries, as in
+    real entropy-coded JPEG data.
+    """
+    payload = os.urandom(frame_size).replace(b'\xff', b'\xfe')
+    frame = SOI + payload + EOI
+    return frame * frames
+
+
+def legacy_split(buffer, chunk):
+    # The frame loop StreamConsumer used before JPEGFrameParser
+    buffer += chunk
+    frames = []
+    while True:
+        start = buffer.find(SOI)
+        end = buffer.find(EOI, start)
+        if start != -1 and end != -1:
+            frames.append(buffer[start:end+2])
+            buffer = buffer[end+2:]
+        else:
+            break
+    return frames, buffer
+
+
+class Command(BaseCommand):
+    help = 'Replay an MJPEG byte stream through the frame splitter and report throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', help='Recorded MJPEG file (ffmpeg -i <camera> -f mjpeg out.mjpeg)')
+        parser.add_argument('--seconds', type=int, default=10, help='Seconds of video to synthesize')
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--frame-size', type=int, default=250_000,
+                            help='Bytes per synthesized frame (a 1080p JPEG at -q:v 5 is ~200-300 KB)')
+        parser.add_argument('--skip-legacy', action='store_true', help='Only run the new parser')
+
+    def handle(self, *args, **options):
+        if options['input']:
+            with open(options['input'], 'rb') as f:
+                stream = f.read()
+        else:
+            stream = synthetic_mjpeg(options['seconds'] * options['fps'], options['frame_size'])
+        fps = options['fps']
+
+        results = {'parser': self.run_parser(stream)}
+        if not options['skip_legacy']:
+            results['legacy'] = self.run_legacy(stream)
+
+        for name, (frames, elapsed) in results.items():
+            rate = frames / elapsed if elapsed else float('inf')
+            mbps = len(stream) / elapsed / 1e6 if elapsed else float('inf')
+            self.stdout.write(
+                f'{name:>7}: {frames} frames in {elapsed:.3f}s '
+                f'({rate:.0f} frames/s, {mbps:.0f} MB/s, {rate / fps:.1f}x realtime at {fps} fps)'
+            )
+
+    def run_parser(self, stream):
+        parser = JPEGFrameParser()
+        view = memoryview(stream)
+        frames = 0
+        offset = 0
+        started = time.perf_counter()
+        while offset < len(stream):
+            chunk = view[offset:offset + parser.chunk_size]
+            offset += len(chunk)
+            frames += len(parser.feed(chunk))
+        return frames, time.perf_counter() - started
+
+    def run_legacy(self, stream):
+        buffer = b''
+        frames = 0
+        started = time.perf_counter()
+        for offset in range(0, len(stream), 4096):
+            found, buffer = legacy_split(buffer, stream[offset:offset + 4096])
+            frames += len(found)
+        return frames, time.perf_counter() - started
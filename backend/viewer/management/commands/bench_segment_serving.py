@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+from viewer import segment_store
+from viewer.benchmarks import DelayedStorage, filesystem_storages
+from viewer.segment_cache import SegmentCache
+from .bench_start_load import percentile
+
+
+class Command(BaseCommand):
+    help = 'Compare hls_serve throughput for the local and S3 segment stores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segments', type=int, default=10)
+        parser.add_argument('--segment-bytes', type=int, default=500_000)
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--storage-delay', type=float, default=0.02,
+                            help='Seconds added to each storage call to stand in for S3 round trips')
+        parser.add_argument('--use-configured-storage', action='store_true',
+                            help='Benchmark the real default storage (e.g. the S3 bucket) instead of a stand-in')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(prefix='bench_serving_')
+        overrides = {'HLS_LOCAL_ROOT': os.path.join(work_dir, 'local')}
+        if not options['use_configured_storage']:
+            overrides['STORAGES'] = filesystem_storages(os.path.join(work_dir, 'storage'))
+        try:
+            with override_settings(**overrides):
+                report = asyncio.run(self.run(options))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, result in report.items():
+            self.stdout.write(name)
+            for key, value in result.items():
+                self.stdout.write(f'{key:>24}: {value}')
+
+    async def run(self, options):
+        payload = os.urandom(options['segment_bytes'])
+        names = [f'stream{i}.ts' for i in range(options['segments'])]
+
+        local = segment_store.LocalSegmentStore()
+        local_dir = local.output_dir('bench-local', None)
+        for name in names:
+            with open(os.path.join(local_dir, name), 'wb') as f:
+                f.write(payload)
+
+        storage = default_storage
+        if not options['use_configured_storage']:
+            storage = DelayedStorage(default_storage, options['storage_delay'])
+        for name in names:
+            storage.save(f'hls_media/bench-s3/{name}', ContentFile(payload))
+
+        report = {}
+        with mock.patch.dict(segment_store._stores, {'local': local}):
+            report['local'] = await self.measure('bench-local', names, options)
+        s3 = segment_store.StorageSegmentStore()
+        # Served like a stream running here, so storage reads fill the cache
+        s3._live.add('bench-s3')
+        with mock.patch.dict(segment_store._stores, {'s3': s3}), \
+                mock.patch.object(segment_store, 'default_storage', storage):
+            # Without the cache every request goes to storage...
+            uncached = SegmentCache(max_bytes=0)
+            with mock.patch.object(segment_store, 'get_segment_cache', return_value=uncached):
+                report['s3'] = await self.measure('bench-s3', names, options)
+            # ...with it, only the first request for each segment does
+            cached = SegmentCache(max_bytes=len(payload) * len(names) * 2)
+            with mock.patch.object(segment_store, 'get_segment_cache', return_value=cached):
+                report['s3_cached'] = await self.measure('bench-s3', names, options)
+                report['s3_cached']['cache_hit_ratio'] = cached.stats()['hit_ratio']
+        for name in names:
+            storage.delete(f'hls_media/bench-s3/{name}')
+        return report
+
+    async def measure(self, stream_id, names, options):
+        client = AsyncClient()
+        latencies = []
+        received = 0
+        remaining = iter(range(options['requests']))
+
+        async def worker():
+            nonlocal received
+            for i in remaining:
+                started = time.perf_counter()
+                response = await client.get(reverse('hls_serve', args=[stream_id, names[i % len(names)]]))
+                body = response.getvalue()
+                latencies.append(time.perf_counter() - started)
+                if response.status_code == 200:
+                    received += len(body)
+
+        began = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+        elapsed = time.perf_counter() - began
+        return {
+            'requests': len(latencies),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'megabytes_per_second': round(received / elapsed / 1e6, 1),
+            'latency_p50': round(statistics.median(latencies), 4),
+            'latency_p95': round(percentile(latencies, 0.95), 4),
+        }
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import shutil
+import statistics
+import tempfile
+import time
+from unittest import mock
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from viewer import hls_stream, probe
+from viewer.benchmarks import fake_ffmpeg_binary, filesystem_storages
+from viewer.models import CameraProbe
+from viewer.rtsp import build_rtsp_url, camera_key
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = 'Fire N concurrent start_hls requests and report start latency, readiness and event-loop lag'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=100)
+        parser.add_argument('--ffmpeg', help='FFmpeg binary to use (default: a fake that writes dummy segments)')
+        parser.add_argument('--ffprobe', help='ffprobe binary to use (default: the fake FFmpeg, or FFPROBE_BINARY '
+                                              'with --ffmpeg)')
+        parser.add_argument('--url', default='rtsp://bench.local/cam{i}', help='Camera URL template')
+        parser.add_argument('--bulk', action='store_true',
+                            help='Start every stream with one start_hls/bulk/ request instead of one request each')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Concurrent starts of a bulk request (default HLS_BULK_START_CONCURRENCY)')
+        parser.add_argument('--passes', type=int, default=1,
+                            help='Start and stop everything this many times, forgetting the in-memory probe '
+                                 'cache in between like a restart; later passes use the stored probes')
+        parser.add_argument('--timeout', type=float, default=30)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(prefix='bench_start_')
+        ffmpeg = options['ffmpeg'] or fake_ffmpeg_binary(work_dir)
+        overrides = {}
+        if options['ffprobe'] or not options['ffmpeg']:
+            overrides['FFPROBE_BINARY'] = options['ffprobe'] or ffmpeg
+        # The first pass probes every camera, as on a fresh install
+        keys = [probe._store_key(camera_key(build_rtsp_url(options['url'].format(i=i))))
+                for i in range(options['streams'])]
+        CameraProbe.objects.filter(key__in=keys).delete()
+        try:
+            # Admission control is not what is being measured here
+            with override_settings(FFMPEG_BINARY=ffmpeg, STORAGES=filesystem_storages(f'{work_dir}/media'),
+                                   HLS_MAX_TRANSCODES=options['streams'], HLS_BULK_START_MAX=options['streams'],
+                                   **overrides):
+                report = asyncio.run(self.run(options))
+        finally:
+            CameraProbe.objects.filter(key__in=keys).delete()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for key, value in report.items():
+            self.stdout.write(f'{key:>24}: {value}')
+
+    async def run(self, options):
+        client = AsyncClient()
+        lag = {'max': 0.0}
+        monitoring = True
+
+        async def monitor_loop_lag():
+            # A starved event loop shows up as sleeps that overshoot badly
+            while monitoring:
+                before = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag['max'] = max(lag['max'], time.perf_counter() - before - 0.01)
+
+        monitor = asyncio.ensure_future(monitor_loop_lag())
+        probes = {'count': 0}
+        run_ffprobe = probe._run_ffprobe
+
+        async def counted_ffprobe(url, transport='tcp'):
+            probes['count'] += 1
+            return await run_ffprobe(url, transport)
+
+        passes = []
+        with mock.patch.object(probe, '_run_ffprobe', counted_ffprobe):
+            for number in range(options['passes']):
+                if number:
+                    # What a restart keeps: only the stored probes
+                    probe.probe_cache.clear()
+                probes['count'] = 0
+                run_pass = self.bulk_pass if options['bulk'] else self.single_pass
+                result = await run_pass(client, options)
+                result['probes'] = probes['count']
+                passes.append(result)
+
+        monitoring = False
+        await monitor
+
+        report = {'streams': options['streams'], **passes[0]}
+        for number, result in enumerate(passes[1:], 2):
+            report[f'pass{number}_time_to_all_ready'] = result['time_to_all_ready']
+            report[f'pass{number}_probes'] = result['probes']
+        report['max_event_loop_lag'] = round(lag['max'], 4)
+        return report
+
+    async def single_pass(self, client, options):
+        async def start(i):
+            started = time.perf_counter()
+            response = await client.post(
+                '/start_hls/', {'url': options['url'].format(i=i)}, content_type='application/json'
+            )
+            return response, time.perf_counter() - started
+
+        began = time.perf_counter()
+        results = await asyncio.gather(*(start(i) for i in range(options['streams'])))
+        all_started = time.perf_counter() - began
+        latencies = [elapsed for _, elapsed in results]
+        stream_ids = [r.json()['stream_id'] for r, _ in results if r.status_code == 200]
+
+        deadline = time.perf_counter() + options['timeout']
+        while time.perf_counter() < deadline:
+            states = [hls_stream.stream_state(s)['state'] for s in stream_ids]
+            if all(state != 'starting' for state in states):
+                break
+            await asyncio.sleep(0.1)
+        all_ready = time.perf_counter() - began
+        states = [hls_stream.stream_state(s)['state'] for s in stream_ids]
+        await asyncio.gather(*(hls_stream.stop_stream(s) for s in stream_ids))
+        return self.summary(stream_ids, states, latencies, all_started, all_ready)
+
+    async def bulk_pass(self, client, options):
+        body = {'cameras': [{'url': options['url'].format(i=i)} for i in range(options['streams'])]}
+        if options['concurrency']:
+            body['concurrency'] = options['concurrency']
+        began = time.perf_counter()
+        response = await client.post('/start_hls/bulk/', body, content_type='application/json')
+        latencies = []
+        stream_ids = []
+        states = []
+        all_started = all_ready = None
+        try:
+            # Each line is read as the server sends it, so its arrival time is the event's
+            async with asyncio.timeout(options['timeout']):
+                async for chunk in response.streaming_content:
+                    for line in chunk.splitlines():
+                        event = json.loads(line)
+                        if 'status' in event:
+                            latencies.append(time.perf_counter() - began)
+                            if event['status'] == 200:
+                                stream_ids.append(event['stream_id'])
+                            if len(latencies) == options['streams']:
+                                all_started = time.perf_counter() - began
+                        elif 'state' in event:
+                            states.append(event['state'])
+        except TimeoutError:
+            pass
+        all_ready = time.perf_counter() - began
+        all_started = all_started or all_ready
+        await asyncio.gather(*(hls_stream.stop_stream(s) for s in stream_ids))
+        return self.summary(stream_ids, states, latencies, all_started, all_ready)
+
+    def summary(self, stream_ids, states, latencies, all_started, all_ready):
+        return {
+            'accepted': len(stream_ids),
+            'ready': states.count('ready'),
+            'failed': states.count('failed'),
+            'start_latency_p50': round(statistics.median(latencies), 4) if latencies else None,
+            'start_latency_p95': round(percentile(latencies, 0.95), 4) if latencies else None,
+            'start_latency_max': round(max(latencies), 4) if latencies else None,
+            'time_to_all_started': round(all_started, 3),
+            'time_to_all_ready': round(all_ready, 3),
+        }
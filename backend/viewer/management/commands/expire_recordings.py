@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from viewer.recording import expire
+
+
+class Command(BaseCommand):
+    help = 'Delete recorded segments whose retention has run out (e.g. from cron)'
+
+    def handle(self, *args, **options):
+        deleted, failed = expire()
+        self.stdout.write(f'Deleted {deleted} recorded segments')
+        if failed:
+            self.stderr.write(f'{failed} segments could not be deleted and will be retried')
@@ -0,0 +1,126 @@
+import json
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from viewer.benchmarks import fake_ffmpeg_binary
+
+
+def request(url, method='GET', body=None, timeout=30):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+class Command(BaseCommand):
+    help = 'Run several Daphne nodes on this machine sharing one stream registry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=3)
+        parser.add_argument('--base-port', type=int, default=8100)
+        parser.add_argument('--capacity', type=int, default=4, help='Transcode slots per node')
+        parser.add_argument('--ffmpeg', help='FFmpeg binary to use (default: a fake that writes dummy segments)')
+        parser.add_argument('--streams', type=int, default=6, help='Streams started by --check')
+        parser.add_argument('--check', action='store_true',
+                            help='Start, inspect and stop streams through different nodes, then exit')
+
+    def handle(self, *args, **options):
+        # Every node shares this project's database, so it needs the registry tables
+        call_command('migrate', verbosity=0)
+        work_dir = tempfile.mkdtemp(prefix='local_cluster_')
+        ffmpeg = options['ffmpeg'] or fake_ffmpeg_binary(work_dir)
+        secret = secrets.token_hex(32)
+        nodes = []
+        try:
+            for i in range(options['nodes']):
+                port = options['base_port'] + i
+                env = dict(
+                    os.environ,
+                    HLS_NODE_ID=f'node{i}',
+                    HLS_NODE_URL=f'http://127.0.0.1:{port}',
+                    HLS_CLUSTER_SECRET=secret,
+                    HLS_SEGMENT_STORE='local',
+                    HLS_LOCAL_ROOT=os.path.join(work_dir, f'node{i}'),
+                    HLS_MAX_TRANSCODES=str(options['capacity']),
+                    FFMPEG_BINARY=ffmpeg,
+                    FAKE_FFMPEG_SEGMENT_BYTES='1000',
+                )
+                log = open(os.path.join(work_dir, f'node{i}.log'), 'w')
+                process = subprocess.Popen(
+                    [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'backend.asgi:application'],
+                    cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+                )
+                nodes.append((f'http://127.0.0.1:{port}', process, log))
+            self.wait_for_nodes(nodes)
+            if options['check']:
+                self.stdout.write(json.dumps(self.run_check(nodes, options['streams']), indent=2))
+                return
+            for url, _, _ in nodes:
+                self.stdout.write(url)
+            self.stdout.write(f'Logs in {work_dir}; Ctrl-C to stop')
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for _, process, log in nodes:
+                process.terminate()
+                process.wait()
+                log.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def wait_for_nodes(self, nodes, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                status, _, body = request(f'{nodes[0][0]}/nodes/', timeout=2)
+                if status == 200 and len(json.loads(body)['nodes']) == len(nodes):
+                    return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise CommandError('Nodes did not all register within %ss' % timeout)
+
+    def run_check(self, nodes, count):
+        """
+        Start streams through the first node and follow each one through
+        the others: placement spreads them out and every request reaches
+        the node that runs the stream.
+        """
+        urls = [url for url, _, _ in nodes]
+        started = []
+        for i in range(count):
+            status, headers, body = request(f'{urls[0]}/start_hls/', 'POST',
+                                            {'url': f'rtsp://cluster.local/cam{i}', 'mode': 'transcode'})
+            if status != 200:
+                raise CommandError(f'Start failed with {status}: {body[:200]}')
+            started.append((json.loads(body), headers.get('X-HLS-Node', 'node0')))
+
+        report = {'placement': {}, 'ready': 0, 'playlists_served': 0, 'stopped': 0}
+        for i, (data, owner) in enumerate(started):
+            report['placement'][owner] = report['placement'].get(owner, 0) + 1
+            other = urls[(i + 1) % len(urls)]
+            for _ in range(100):
+                state = json.loads(request(f"{other}{data['status_url']}")[2])['state']
+                if state not in ('queued', 'starting'):
+                    break
+                time.sleep(0.1)
+            report['ready'] += state == 'ready'
+            status, _, body = request(f"{other}{data['playlist_url']}")
+            report['playlists_served'] += status == 200 and b'#EXTM3U' in body
+            status, _, _ = request(f"{urls[(i + 2) % len(urls)]}/stop_hls/{data['stream_id']}/", 'POST')
+            report['stopped'] += status == 200
+        report['streams'] = count
+        return report
@@ -0,0 +1,23 @@
+import json
+from django.core.management.base import BaseCommand
+from viewer.cleanup import get_cleanup_worker, sweep
+from viewer.hls_stream import is_stream_live
+
+
+class Command(BaseCommand):
+    help = 'Delete S3 prefixes of streams that no live node owns (e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the orphaned stream ids')
+        parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for deletion to finish')
+
+    def handle(self, *args, **options):
+        orphans = sweep(is_stream_live, dry_run=options['dry_run'])
+        for stream_id in orphans:
+            self.stdout.write(stream_id)
+        if options['dry_run'] or not orphans:
+            return
+        worker = get_cleanup_worker()
+        if not worker.wait_idle(options['timeout']):
+            self.stderr.write('Cleanup is still running')
+        self.stdout.write(json.dumps(worker.stats(), indent=2))
@@ -0,0 +1,244 @@
+import bisect
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, for latency histograms: sub-millisecond cache
+# hits up to multi-second S3 uploads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+
+class Metric:
+    """
+    A named family of values keyed by label values, rendered in the
+    Prometheus text format. Updates take a per-metric lock that is held for
+    a dict lookup and an addition, so they are cheap to call from upload
+    threads and the event loop alike and never await.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def remove(self, **labels):
+        """Drop every series whose labels match the given ones."""
+        positions = [(self.labels.index(name), str(value)) for name, value in labels.items()
+                     if name in self.labels]
+        if not positions:
+            return
+        with self._lock:
+            for key in [key for key in self._values if all(key[i] == value for i, value in positions)]:
+                del self._values[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, self._label_text(key), value) for key, value in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Publish a running total kept elsewhere (e.g. a stats() counter)."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), then sum and count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def value(self, **labels):
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return {'sum': series[1], 'count': series[2]} if series else None
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                samples.append((f'{self.name}_bucket', self._label_text(key, [('le', bound)]), cumulative))
+            samples.append((f'{self.name}_sum', self._label_text(key), total))
+            samples.append((f'{self.name}_count', self._label_text(key), count))
+        return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value) if value == value else 'NaN'
+    return str(value)
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in samples:
+            lines.append(f'{name}{labels} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def forget_stream(stream_id):
+    """Drop a stopped stream's series so /metrics does not grow without bound."""
+    for metric in _metrics:
+        metric.remove(stream_id=stream_id)
+
+
+def process_cpu_seconds(pid):
+    """User plus system CPU time of another process, from /proc; None where unavailable."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_memory_bytes(pid='self'):
+    """Resident memory of a process, from /proc; None where unavailable."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# FFmpeg encode progress, from -progress output
+ENCODE_FPS = Gauge('hls_encode_fps', 'Frames per second FFmpeg is encoding', ['stream_id'])
+ENCODE_SPEED = Gauge('hls_encode_speed', 'Encoding speed as a multiple of real time', ['stream_id'])
+ENCODE_BITRATE = Gauge('hls_encode_bitrate_kbps', 'Output bitrate FFmpeg reports', ['stream_id'])
+ENCODE_FRAMES = Gauge('hls_encode_frames', 'Frames encoded since FFmpeg last started', ['stream_id'])
+ENCODE_DROPPED_FRAMES = Gauge('hls_encode_dropped_frames', 'Frames FFmpeg dropped since it last started',
+                              ['stream_id'])
+FFMPEG_CPU = Gauge('hls_ffmpeg_cpu_seconds', 'CPU time used by the stream\'s current FFmpeg process',
+                   ['stream_id'])
+FFMPEG_MEMORY = Gauge('hls_ffmpeg_memory_bytes', 'Resident memory of the stream\'s FFmpeg process',
+                      ['stream_id'])
+STREAM_VIEWERS = Gauge('hls_stream_viewers', 'Players and WebSocket clients watching the stream', ['stream_id'])
+FFMPEG_RESTARTS = Gauge('hls_ffmpeg_restarts', 'Times the stream\'s FFmpeg process was restarted', ['stream_id'])
+MOTION_EVENTS = Counter('hls_motion_events_total', 'Motion events detected in the stream', ['stream_id'])
+MOTION_IDLE = Gauge('hls_motion_idle', '1 while a motion-gated stream\'s scene is static', ['stream_id'])
+
+# Segment uploads
+UPLOAD_SECONDS = Histogram('hls_upload_seconds', 'Time taken by one storage upload', ['stream_id', 'kind'])
+UPLOAD_BYTES = Counter('hls_upload_bytes_total', 'Bytes uploaded to storage', ['stream_id'])
+UPLOAD_FAILURES = Counter('hls_upload_failures_total', 'Uploads that raised an error', ['stream_id'])
+UPLOAD_DROPPED = Counter('hls_upload_dropped_segments_total',
+                         'Segments dropped because the upload queue was full', ['stream_id'])
+
+# Playback
+SERVE_SECONDS = Histogram('hls_serve_seconds', 'hls_serve response time', ['store', 'kind'])
+SERVE_REQUESTS = Counter('hls_serve_requests_total', 'hls_serve requests', ['stream_id', 'kind'])
+CACHE_HITS = Counter('hls_segment_cache_hits_total', 'Segment cache lookups served from memory')
+CACHE_MISSES = Counter('hls_segment_cache_misses_total', 'Segment cache lookups that went to storage')
+CACHE_HIT_RATIO = Gauge('hls_segment_cache_hit_ratio', 'Share of segment cache lookups served from memory')
+CACHE_BYTES = Gauge('hls_segment_cache_bytes', 'Bytes held by the segment cache')
+WS_FRAMES_SENT = Counter('ws_frames_sent_total', 'JPEG frames sent to WebSocket clients', ['camera'])
+WS_FRAMES_DROPPED = Counter('ws_frames_dropped_total', 'JPEG frames dropped for slow WebSocket clients',
+                            ['camera'])
+WS_BYTES_SENT = Counter('ws_bytes_sent_total', 'JPEG bytes sent to WebSocket clients', ['camera'])
+
+# Node
+STREAMS = Gauge('hls_streams', 'HLS streams on this node by state', ['state'])
+FFMPEG_PROCESSES = Gauge('hls_ffmpeg_processes', 'FFmpeg processes running on this node')
+TRANSCODE_CAPACITY = Gauge('hls_transcode_capacity', 'Transcode slots on this node')
+TRANSCODE_USED = Gauge('hls_transcode_used', 'Transcode slots in use on this node')
+UPLOAD_QUEUE_DEPTH = Gauge('hls_upload_queue_depth', 'Uploads waiting across every stream')
+CLEANUP_PENDING = Gauge('hls_cleanup_pending', 'Stopped streams\' prefixes waiting to be deleted')
+PROCESS_CPU = Counter('process_cpu_seconds_total', 'CPU time used by this server process')
+PROCESS_MEMORY = Gauge('process_resident_memory_bytes', 'Resident memory of this server process')
+CHILDREN_CPU = Counter('process_children_cpu_seconds_total', 'CPU time used by exited child processes')
+NODE_CPUS = Gauge('node_cpu_count', 'CPUs on this node')
+NODE_LOAD = Gauge('node_load_average', 'System load average', ['period'])
+UPTIME = Gauge('process_uptime_seconds', 'Seconds since this server process loaded its metrics')
+
+_loaded_at = time.monotonic()
+
+
+def collect_process():
+    """Refresh the gauges read from the OS at scrape time."""
+    times = os.times()
+    PROCESS_CPU.set_total(times.user + times.system)
+    CHILDREN_CPU.set_total(times.children_user + times.children_system)
+    NODE_CPUS.set(os.cpu_count() or 1)
+    UPTIME.set(round(time.monotonic() - _loaded_at, 1))
+    memory = process_memory_bytes()
+    if memory is not None:
+        PROCESS_MEMORY.set(memory)
+    try:
+        for period, load in zip(('1m', '5m', '15m'), os.getloadavg()):
+            NODE_LOAD.set(load, period=period)
+    except OSError:
+        pass
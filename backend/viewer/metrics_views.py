@@ -0,0 +1,52 @@
+# The Prometheus endpoint; the metrics themselves are defined in metrics.py
+from django.http import HttpResponse
+from . import metrics
+from .activity import get_activity
+from .cleanup import get_cleanup_worker
+from .hls_stream import all_stream_states, is_stream_active
+from .segment_cache import get_segment_cache
+from .supervisor import get_supervisor
+from .upload_pool import get_upload_scheduler
+
+
+async def prometheus_metrics(request):
+    """
+    Node and per-stream metrics in the Prometheus text format. Counters are
+    updated where the work happens; node figures are read at scrape time.
+    """
+    supervisor = get_supervisor()
+    activity = get_activity()
+    states = {state: 0 for state in ('queued', 'starting', 'ready', 'failed', 'stopped')}
+    for stream_id, state in all_stream_states().items():
+        states[state['state']] = states.get(state['state'], 0) + 1
+        if is_stream_active(stream_id):
+            metrics.STREAM_VIEWERS.set(activity.viewers(stream_id), stream_id=stream_id)
+    for state, count in states.items():
+        metrics.STREAMS.set(count, state=state)
+    running = 0
+    for stream_id, supervised in list(supervisor.processes.items()):
+        metrics.FFMPEG_RESTARTS.set(supervised.restarts, stream_id=stream_id)
+        process = supervised.process
+        if process is None or process.returncode is not None:
+            continue
+        running += 1
+        cpu = metrics.process_cpu_seconds(process.pid)
+        if cpu is not None:
+            metrics.FFMPEG_CPU.set(cpu, stream_id=stream_id)
+        memory = metrics.process_memory_bytes(process.pid)
+        if memory is not None:
+            metrics.FFMPEG_MEMORY.set(memory, stream_id=stream_id)
+    metrics.FFMPEG_PROCESSES.set(running)
+    metrics.TRANSCODE_CAPACITY.set(supervisor.capacity)
+    metrics.TRANSCODE_USED.set(supervisor.used)
+
+    cache = get_segment_cache().stats()
+    metrics.CACHE_HITS.set_total(cache['hits'])
+    metrics.CACHE_MISSES.set_total(cache['misses'])
+    if cache['hit_ratio'] is not None:
+        metrics.CACHE_HIT_RATIO.set(cache['hit_ratio'])
+    metrics.CACHE_BYTES.set(cache['bytes'])
+    metrics.UPLOAD_QUEUE_DEPTH.set(sum(queue['queue_depth'] for queue in get_upload_scheduler().stats().values()))
+    metrics.CLEANUP_PENDING.set(get_cleanup_worker().stats()['pending'])
+    metrics.collect_process()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Camera',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(unique=True)),
+                ('url', models.CharField(max_length=1000)),
+                ('username', models.CharField(blank=True, max_length=255)),
+                ('password', models.CharField(blank=True, max_length=255)),
+                ('mode', models.CharField(choices=[('auto', 'auto'), ('copy', 'copy'), ('transcode', 'transcode')], default='auto', max_length=16)),
+                ('store', models.CharField(blank=True, max_length=16)),
+                ('low_latency', models.BooleanField(default=False)),
+                ('abr', models.BooleanField(default=False)),
+                ('idle_timeout', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+    ]
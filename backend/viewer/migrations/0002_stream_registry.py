@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node_id', models.CharField(max_length=255, unique=True)),
+                ('url', models.CharField(max_length=1000)),
+                ('capacity', models.PositiveIntegerField(default=0)),
+                ('used', models.PositiveIntegerField(default=0)),
+                ('last_heartbeat', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StreamRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_id', models.CharField(max_length=255, unique=True)),
+                ('node_id', models.CharField(db_index=True, max_length=255)),
+                ('viewers', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0002_stream_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camera',
+            name='motion',
+            field=models.BooleanField(default=False),
+        ),
+    ]
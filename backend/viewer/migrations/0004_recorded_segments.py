@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0003_camera_motion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camera',
+            name='record',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='camera',
+            name='retention',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RecordedSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream_id', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=1000)),
+                ('start', models.FloatField()),
+                ('duration', models.FloatField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('discontinuity', models.BooleanField(default=False)),
+                ('expires_at', models.FloatField(db_index=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stream_id', 'start'], name='viewer_reco_stream__547ffe_idx')],
+            },
+        ),
+    ]
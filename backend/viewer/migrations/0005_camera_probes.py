@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0004_recorded_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CameraProbe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('video_codec', models.CharField(max_length=32)),
+                ('profile', models.CharField(blank=True, max_length=64)),
+                ('width', models.PositiveIntegerField(null=True)),
+                ('height', models.PositiveIntegerField(null=True)),
+                ('fps', models.FloatField(null=True)),
+                ('audio_codec', models.CharField(blank=True, max_length=32)),
+                ('transport', models.CharField(default='tcp', max_length=8)),
+                ('probed_at', models.FloatField()),
+            ],
+        ),
+    ]
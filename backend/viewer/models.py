@@ -0,0 +1,141 @@
+from django.db import models
+from django.urls import reverse
+
+
+class Camera(models.Model):
+    """
+    A camera registered for on-demand streaming. Nothing runs for it until a
+    player requests its playlist from hls_serve (the stream id is the
+    camera's name); the stream is then started on the spot and stopped again
+    once nobody has watched it for its idle timeout.
+    """
+    MODES = [('auto', 'auto'), ('copy', 'copy'), ('transcode', 'transcode')]
+
+    name = models.SlugField(unique=True)
+    url = models.CharField(max_length=1000)
+    username = models.CharField(max_length=255, blank=True)
+    password = models.CharField(max_length=255, blank=True)
+    mode = models.CharField(max_length=16, choices=MODES, default='auto')
+    # Empty means HLS_SEGMENT_STORE
+    store = models.CharField(max_length=16, blank=True)
+    low_latency = models.BooleanField(default=False)
+    abr = models.BooleanField(default=False)
+    motion = models.BooleanField(default=False)
+    record = models.BooleanField(default=False)
+    # Seconds recorded segments are kept; null means HLS_RECORD_RETENTION
+    retention = models.PositiveIntegerField(null=True, blank=True)
+    # Seconds without viewers before the stream stops; null means HLS_IDLE_TIMEOUT
+    idle_timeout = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def playlist_name(self):
+        return 'master.m3u8' if self.abr else 'stream.m3u8'
+
+    def playlist_url(self):
+        return reverse('hls_serve', args=[self.name, self.playlist_name])
+
+    def start_request(self):
+        """The start_hls_stream body this camera's stream is started with."""
+        data = {
+            'url': self.url,
+            'username': self.username or None,
+            'password': self.password or None,
+            'mode': self.mode,
+            'abr': self.abr,
+            'low_latency': self.low_latency,
+            'motion': self.motion,
+            'record': self.record,
+        }
+        if self.store:
+            data['store'] = self.store
+        if self.idle_timeout is not None:
+            data['idle_timeout'] = self.idle_timeout
+        if self.retention is not None:
+            data['retention'] = self.retention
+        return data
+
+
+class StreamNode(models.Model):
+    """A backend instance in a multi-node deployment, as of its last heartbeat."""
+    node_id = models.CharField(max_length=255, unique=True)
+    url = models.CharField(max_length=1000)
+    capacity = models.PositiveIntegerField(default=0)
+    used = models.PositiveIntegerField(default=0)
+    last_heartbeat = models.DateTimeField()
+
+    def __str__(self):
+        return self.node_id
+
+
+class StreamRecord(models.Model):
+    """Which node runs a stream, and how many viewers it had there."""
+    stream_id = models.CharField(max_length=255, unique=True)
+    node_id = models.CharField(max_length=255, db_index=True)
+    viewers = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.stream_id} on {self.node_id}'
+
+
+class RecordedSegment(models.Model):
+    """
+    One segment of a recorded stream, kept in storage until expires_at.
+    Times are Unix seconds, so ranges can be looked up with plain float
+    comparisons on the (stream_id, start) index.
+    """
+    stream_id = models.CharField(max_length=255)
+    key = models.CharField(max_length=1000)
+    start = models.FloatField()
+    duration = models.FloatField()
+    size = models.PositiveIntegerField(default=0)
+    # The first segment after a gap or an FFmpeg (re)start
+    discontinuity = models.BooleanField(default=False)
+    expires_at = models.FloatField(db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['stream_id', 'start'])]
+
+    def __str__(self):
+        return self.key
+
+
+class CameraProbe(models.Model):
+    """
+    A camera's last successful probe, so streams started after a restart
+    pick their encode without running ffprobe again. The key is a hash of
+    the camera's normalized URL, which includes its credentials.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    video_codec = models.CharField(max_length=32)
+    profile = models.CharField(max_length=64, blank=True)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    fps = models.FloatField(null=True)
+    audio_codec = models.CharField(max_length=32, blank=True)
+    # The RTSP transport the probe got through on
+    transport = models.CharField(max_length=8, default='tcp')
+    # Unix time, as for probe_cache
+    probed_at = models.FloatField()
+
+    def __str__(self):
+        return f'{self.video_codec} over {self.transport}'
+
+    def result(self):
+        """The probe in probe_stream's format."""
+        return {
+            'video_codec': self.video_codec,
+            'profile': self.profile or None,
+            'width': self.width,
+            'height': self.height,
+            'fps': self.fps,
+            'audio_codec': self.audio_codec or None,
+            'transport': self.transport,
+        }
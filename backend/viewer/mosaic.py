@@ -0,0 +1,221 @@
+import asyncio
+import math
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from .ffmpeg_commands import build_mosaic_command, build_tile_feed_command
+from .supervisor import SupervisedProcess
+
+# The file each tile feed keeps its source's newest frame in
+TILE_NAME = 'tile.jpg'
+
+# Tile feeds by source key, shared by every mosaic showing that source
+tile_feeds = {}
+# Running mosaics by stream id
+active_mosaics = {}
+
+
+def normalize_layout(layout, count):
+    """
+    Validate a mosaic layout for `count` sources, in grid cells:
+    {"columns": C, "rows": R, "tiles": [{"source": i, "x": 0, "y": 0, "w": 1, "h": 1}, ...]}.
+    Without "tiles" every source gets one cell, in order, on a grid of
+    "columns" (by default as square as possible). Tiles may span several
+    cells and leave cells empty, but not overlap or show a source twice.
+    Raises ValueError.
+    """
+    layout = layout or {}
+    if not isinstance(layout, dict):
+        raise ValueError('layout must be an object')
+    tiles = layout.get('tiles')
+    try:
+        if tiles is None:
+            columns = int(layout.get('columns', math.ceil(math.sqrt(count))))
+            if columns < 1:
+                raise ValueError
+            tiles = [{'source': i, 'x': i % columns, 'y': i // columns} for i in range(count)]
+        elif not isinstance(tiles, list) or not tiles:
+            raise ValueError
+        tiles = [{'source': int(tile['source']), 'x': int(tile.get('x', 0)), 'y': int(tile.get('y', 0)),
+                  'w': int(tile.get('w', 1)), 'h': int(tile.get('h', 1))} for tile in tiles]
+        columns = int(layout.get('columns', max(tile['x'] + tile['w'] for tile in tiles)))
+        rows = int(layout.get('rows', max(tile['y'] + tile['h'] for tile in tiles)))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('layout needs "columns" or "tiles" of {"source", "x", "y", "w", "h"}')
+    if not 1 <= columns <= settings.HLS_MOSAIC_MAX_SOURCES or not 1 <= rows <= settings.HLS_MOSAIC_MAX_SOURCES:
+        raise ValueError(f'A layout has 1 to {settings.HLS_MOSAIC_MAX_SOURCES} columns and rows')
+    cells = set()
+    for tile in tiles:
+        if not 0 <= tile['source'] < count:
+            raise ValueError(f"No source {tile['source']}")
+        if tile['x'] < 0 or tile['y'] < 0 or tile['w'] < 1 or tile['h'] < 1 or \
+                tile['x'] + tile['w'] > columns or tile['y'] + tile['h'] > rows:
+            raise ValueError(f"Tile of source {tile['source']} is outside the {columns}x{rows} grid")
+        covered = {(x, y) for x in range(tile['x'], tile['x'] + tile['w'])
+                   for y in range(tile['y'], tile['y'] + tile['h'])}
+        if covered & cells:
+            raise ValueError(f"Tile of source {tile['source']} overlaps another")
+        cells |= covered
+    if len({tile['source'] for tile in tiles}) != len(tiles):
+        raise ValueError('A source can only be shown once')
+    return {'columns': columns, 'rows': rows, 'tiles': tiles}
+
+
+def tile_rects(layout, width, height):
+    """Pixel (x, y, w, h) of each tile of a normalized layout, kept even for 4:2:0 video."""
+    cell_width = width // layout['columns'] // 2 * 2
+    cell_height = height // layout['rows'] // 2 * 2
+    return [(tile['x'] * cell_width, tile['y'] * cell_height, tile['w'] * cell_width, tile['h'] * cell_height)
+            for tile in layout['tiles']]
+
+
+def normalize_size(width, height):
+    """Validate a mosaic's output size; raises ValueError."""
+    max_width, max_height = settings.HLS_MOSAIC_MAX_SIZE
+    if not isinstance(width, int) or not isinstance(height, int) or isinstance(width, bool) or \
+            isinstance(height, bool) or not 64 <= width <= max_width or not 64 <= height <= max_height or \
+            width % 2 or height % 2:
+        raise ValueError(f'width and height must be even, from 64x64 to {max_width}x{max_height}')
+    return width, height
+
+
+class TileFeed:
+    """
+    One source's frames for mosaics: a supervised FFmpeg that decodes the
+    source once, small, and keeps its newest frame in a JPEG that every
+    mosaic showing the source reads (see build_tile_feed_command). It is
+    reference-counted by those mosaics and stops with the last one.
+    """
+    def __init__(self, key, label, url, probe=None, hls=False):
+        self.key = key
+        self.label = label
+        self.users = 0
+        self.directory = tempfile.mkdtemp(prefix='mosaic_tile_')
+        self.path = os.path.join(self.directory, TILE_NAME)
+        self.process = SupervisedProcess(
+            f'tile {label}', build_tile_feed_command(url, self.path, probe, hls),
+            os.path.join(self.directory, 'ffmpeg.log'), cost=0, output_time=self.frame_time
+        )
+
+    def frame_time(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def ready(self):
+        return os.path.exists(self.path)
+
+    async def start(self):
+        await self.process.spawn()
+        # A camera that drops out is reconnected; its tile freezes meanwhile
+        self.process.supervise()
+
+    async def stop(self):
+        await self.process.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        return {'source': self.label, 'ready': self.ready(), 'state': self.process.state,
+                'restarts': self.process.restarts, 'mosaics': self.users}
+
+
+async def acquire_feed(key, label, url, probe=None, hls=False):
+    """The running tile feed for a source, started if no mosaic shows it yet."""
+    feed = tile_feeds.get(key)
+    if feed is None:
+        feed = tile_feeds[key] = TileFeed(key, label, url, probe, hls)
+        try:
+            await feed.start()
+        except BaseException:
+            tile_feeds.pop(key, None)
+            await feed.stop()
+            raise
+    feed.users += 1
+    return feed
+
+
+async def release_feed(feed):
+    feed.users -= 1
+    if feed.users <= 0:
+        if tile_feeds.get(feed.key) is feed:
+            del tile_feeds[feed.key]
+        await feed.stop()
+
+
+class Mosaic:
+    """
+    A stream tiled from several sources. Each source's TileFeed keeps a
+    small current frame; the compositor, the stream's own supervised FFmpeg,
+    stacks those frames into one HLS output and keeps its newest frame at
+    frame_path. Changing the layout or size only swaps the compositor's
+    command line: the feeds, and their camera connections, keep running.
+    Tiles whose feed has no frame yet are black until it does.
+    """
+    def __init__(self, stream_id, feeds, layout, width, height, output_dir, frame_path):
+        self.stream_id = stream_id
+        self.feeds = feeds
+        self.layout = layout
+        self.width = width
+        self.height = height
+        self.output_dir = output_dir
+        self.frame_path = frame_path
+        self.supervised = None
+        self.layout_changes = 0
+        self._missing = set()
+        self._task = None
+
+    def command(self):
+        tiles = []
+        self._missing = set()
+        for tile, rect in zip(self.layout['tiles'], tile_rects(self.layout, self.width, self.height)):
+            feed = self.feeds[tile['source']]
+            if not feed.ready():
+                self._missing.add(tile['source'])
+            tiles.append((feed.path if feed.ready() else None, *rect))
+        return build_mosaic_command(tiles, self.output_dir, self.width, self.height, self.frame_path)
+
+    async def wait_for_feeds(self, timeout):
+        """Give the shown sources up to `timeout` seconds for their first frames."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        shown = [self.feeds[tile['source']] for tile in self.layout['tiles']]
+        while not all(feed.ready() for feed in shown) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    def start(self, supervised):
+        self.supervised = supervised
+        self._task = asyncio.ensure_future(self._fill_in())
+
+    async def _fill_in(self):
+        # Bring in tiles that started black once their feed has a frame
+        while True:
+            await asyncio.sleep(1)
+            if self._missing and self.supervised.state == 'running' and \
+                    any(self.feeds[source].ready() for source in self._missing):
+                await self.supervised.replace(self.command())
+
+    async def update(self, layout=None, width=None, height=None):
+        """Re-tile: only the compositor is restarted."""
+        self.layout = layout or self.layout
+        self.width = width or self.width
+        self.height = height or self.height
+        self.layout_changes += 1
+        await self.supervised.replace(self.command())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for feed in self.feeds:
+            await release_feed(feed)
+        self.feeds = []
+
+    def stats(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'layout': self.layout,
+            'layout_changes': self.layout_changes,
+            'sources': [feed.stats() for feed in self.feeds],
+        }
@@ -0,0 +1,207 @@
+# Mosaic endpoints: streams tiled from several sources (see mosaic.py)
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from . import registry
+from .hls_stream import (
+    all_stream_states, is_stream_active, register_stream, remote_owner, stop_stream, stream_process, stream_state
+)
+from .models import Camera
+from .mosaic import Mosaic, acquire_feed, active_mosaics, normalize_layout, normalize_size, release_feed
+from .probe import probe_stream
+from .rtsp import camera_key, camera_label
+from .snapshots import SNAPSHOT_NAME
+from .stream_options import parse_stream_options
+from .supervisor import CapacityError, get_supervisor
+
+
+@csrf_exempt
+async def mosaics(request):
+    """
+    GET: the mosaics running on this node.
+    POST: {"sources": [{"stream_id": ...} | {"camera": <name>} | {"url": ..., "username": ..., "password": ...}, ...],
+           "layout": {"columns": 4} | {"columns", "rows", "tiles": [{"source", "x", "y", "w", "h"}, ...]},
+           "width": 1920, "height": 1080, "store": ..., "idle_timeout": ..., "admission": ...}
+    Returns what start_hls_stream does, plus "mosaic_url".
+
+    Starts a stream that tiles up to HLS_MOSAIC_MAX_SOURCES sources into one
+    HLS output (see mosaic.py), so a wall of cameras is one player and one
+    download. Each source is decoded once, small, however many mosaics
+    show it; running streams are read from their own output (the lowest
+    ABR rendition), so their cameras are not opened again. A mosaic is a
+    stream like any other: status, stop_hls, hls_serve, snapshots, idle
+    timeout. WebSocket viewers can watch it as MJPEG with
+    {"mosaic": <stream_id>}. Its layout and size are changed through
+    mosaic_url without restarting the sources.
+    """
+    if request.method == 'GET':
+        states = all_stream_states()
+        return JsonResponse({'mosaics': {stream_id: {**states.get(stream_id, {}), **mosaic.stats()}
+                                         for stream_id, mosaic in active_mosaics.items()}})
+    if request.method != 'POST':
+        return JsonResponse({'error': 'GET or POST required'}, status=405)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except Exception:
+        data = {}
+    if registry.cluster_enabled() and not registry.is_forwarded(request):
+        node = await sync_to_async(registry.place_stream)(1)
+        if node is not None and node['node_id'] != settings.HLS_NODE_ID:
+            return await registry.forward(request, node)
+    return await _start_mosaic(data)
+
+
+async def _mosaic_source(source):
+    """(key, label, url, probe, hls) of a tile feed for one mosaic source; raises ValueError."""
+    if not isinstance(source, dict):
+        raise ValueError('Each source needs a stream_id, camera or url')
+    stream_id = source.get('stream_id')
+    camera = None
+    if source.get('camera') is not None:
+        camera = await Camera.objects.filter(name=source['camera']).afirst()
+        if camera is None:
+            raise ValueError(f"Unknown camera: {source['camera']}")
+        if is_stream_active(camera.name):
+            # Its stream is already running; read that rather than the camera
+            stream_id = camera.name
+    if stream_id is not None:
+        if is_stream_active(stream_id):
+            renditions = stream_state(stream_id).get('renditions')
+        else:
+            node = await sync_to_async(registry.lookup_owner)(stream_id) if registry.cluster_enabled() else None
+            if node is None:
+                raise ValueError(f'Unknown or stopped stream: {stream_id}')
+            state = await registry.get_json(node, reverse('hls_stream_status', args=[stream_id]))
+            renditions = state.get('renditions')
+        playlist = f'{renditions[-1]}/stream.m3u8' if renditions else 'stream.m3u8'
+        url = settings.HLS_INGEST_URL.rstrip('/') + reverse('hls_serve', args=[stream_id, playlist])
+        return f'stream:{stream_id}', f'stream {stream_id}', url, None, True
+    # Validated as starting a stream from it would be
+    camera_data = camera.start_request() if camera is not None else source
+    url = parse_stream_options({key: camera_data.get(key) for key in ('url', 'username', 'password')})['url']
+    probe = None
+    try:
+        # For the transport that works with this camera
+        probe = await probe_stream(url)
+    except Exception as e:
+        print(f"Error probing mosaic source {camera_label(url)}: {e}")
+    return camera_key(url), camera_label(url), url, probe, False
+
+
+async def _start_mosaic(data):
+    sources = data.get('sources')
+    if not isinstance(sources, list) or not sources:
+        return JsonResponse({'error': 'sources must be a non-empty list'}, status=400)
+    if len(sources) > settings.HLS_MOSAIC_MAX_SOURCES:
+        return JsonResponse({'error': f'At most {settings.HLS_MOSAIC_MAX_SOURCES} sources per mosaic'}, status=400)
+    default_width, default_height = settings.HLS_MOSAIC_SIZE
+    try:
+        # The options a mosaic shares with other streams
+        options = parse_stream_options({key: data[key] for key in ('store', 'admission', 'idle_timeout')
+                                        if key in data}, source=False)
+        width, height = normalize_size(data.get('width', default_width), data.get('height', default_height))
+        layout = normalize_layout(data.get('layout'), len(sources))
+        resolved = [await _mosaic_source(source) for source in sources]
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Error resolving mosaic sources: {e}'}, status=502)
+
+    segment_store = options['segment_store']
+    admission = options['admission']
+    idle_timeout = options['idle_timeout']
+    stream_id = str(uuid.uuid4())
+    supervisor = get_supervisor()
+    # The tile feeds decode small frames; the mosaic's own encode takes the slot
+    cost = 1
+    try:
+        admitted = supervisor.admit(stream_id, cost, queue=admission == 'queue')
+    except CapacityError as e:
+        response = JsonResponse({'error': str(e)}, status=503)
+        response['Retry-After'] = '30'
+        return response
+
+    temp_dir = tempfile.mkdtemp(prefix=f'hls_{stream_id}_')
+    output_dir = segment_store.output_dir(stream_id, temp_dir)
+    feeds = []
+    try:
+        for key, label, url, probe, hls in resolved:
+            feeds.append(await acquire_feed(key, label, url, probe, hls))
+    except Exception as e:
+        for feed in feeds:
+            await release_feed(feed)
+        supervisor.release(stream_id)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return JsonResponse({'error': f"Failed to start FFmpeg: {str(e)}"}, status=500)
+
+    # The newest frame serves snapshots and MJPEG viewers
+    mosaic = Mosaic(stream_id, feeds, layout, width, height, output_dir, os.path.join(temp_dir, SNAPSHOT_NAME))
+    supervised = stream_process(stream_id, mosaic.command(), temp_dir, cost, os.path.join(output_dir, 'stream.m3u8'))
+    mosaic.start(supervised)
+    active_mosaics[stream_id] = mosaic
+
+    async def feeds_ready():
+        # The compositor starts once the sources have had a moment to
+        # deliver their first frames
+        await mosaic.wait_for_feeds(settings.HLS_MOSAIC_FEED_WAIT)
+        supervised.cmd = mosaic.command()
+
+    await register_stream(stream_id, supervised, segment_store, output_dir, temp_dir,
+                          {'mode': 'transcode', 'mosaic': True, 'idle_timeout': idle_timeout or None},
+                          admitted, prepare=feeds_ready)
+
+    return JsonResponse({
+        'stream_id': stream_id,
+        'state': stream_state(stream_id)['state'],
+        'mode': 'transcode',
+        'store': segment_store.name,
+        'playlist_url': segment_store.playlist_url(stream_id, 'stream.m3u8'),
+        'status_url': reverse('hls_stream_status', args=[stream_id]),
+        'mosaic_url': reverse('mosaic_detail', args=[stream_id]),
+        **mosaic.stats(),
+    })
+
+
+@csrf_exempt
+async def mosaic_detail(request, stream_id):
+    """
+    GET: a mosaic's state, layout, size and sources.
+    PATCH: {"layout": ..., "width": ..., "height": ...} re-tiles a running
+    mosaic. Only its compositor restarts, so players see a discontinuity
+    of a second or so while the sources keep running.
+    DELETE: stop it, like stop_hls_stream.
+    """
+    node = await remote_owner(request, stream_id)
+    if node is not None:
+        return await registry.forward(request, node)
+    mosaic = active_mosaics.get(stream_id)
+    if mosaic is None:
+        return JsonResponse({'error': 'Unknown mosaic'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse({'stream_id': stream_id, **stream_state(stream_id), **mosaic.stats()})
+    if request.method == 'DELETE':
+        await stop_stream(stream_id)
+        return JsonResponse({'message': 'Mosaic stopped and cleaned up successfully'})
+    if request.method != 'PATCH':
+        return JsonResponse({'error': 'GET, PATCH or DELETE required'}, status=405)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except Exception:
+        data = {}
+    if stream_state(stream_id)['state'] != 'ready':
+        return JsonResponse({'error': 'Mosaic is not running yet'}, status=409)
+    try:
+        width, height = normalize_size(data.get('width', mosaic.width), data.get('height', mosaic.height))
+        layout = normalize_layout(data['layout'], len(mosaic.feeds)) if 'layout' in data else None
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    await mosaic.update(layout, width, height)
+    return JsonResponse({'stream_id': stream_id, **stream_state(stream_id), **mosaic.stats()})
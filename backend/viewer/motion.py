@@ -0,0 +1,97 @@
+import asyncio
+import time
+from collections import deque
+import numpy
+from django.conf import settings
+from . import metrics
+
+
+def changed_fraction(previous, frame, threshold):
+    """
+    Share of pixels whose luma changed by more than `threshold` between two
+    grayscale frames of the same size.
+    """
+    a = numpy.frombuffer(previous, numpy.uint8).astype(numpy.int16)
+    b = numpy.frombuffer(frame, numpy.uint8).astype(numpy.int16)
+    return numpy.count_nonzero(numpy.abs(a - b) > threshold) / a.size
+
+
+class MotionDetector:
+    """
+    Finds motion in the small grayscale frames a stream's FFmpeg writes to
+    stdout (see motion_output_args) and keeps an index of motion events.
+
+    A frame moves when more than HLS_MOTION_AREA of its pixels changed by
+    more than HLS_MOTION_PIXEL_THRESHOLD since the previous frame. An event
+    starts at the first moving frame and ends once nothing has moved for
+    HLS_MOTION_HOLD seconds. After HLS_MOTION_IDLE_AFTER seconds without
+    motion the scene is idle; `on_idle(idle)` is called whenever that
+    changes, so the stream can be re-encoded more cheaply.
+    """
+    def __init__(self, stream_id, on_idle=None):
+        self.stream_id = stream_id
+        self.on_idle = on_idle
+        width, height = settings.HLS_MOTION_SIZE
+        self.frame_bytes = width * height
+        self.previous = None
+        self.frames = 0
+        self.last_score = None
+        self.first_frame_at = None
+        self.last_motion_at = None
+        self.idle = False
+        self.events = deque(maxlen=settings.HLS_MOTION_MAX_EVENTS)
+
+    async def read(self, stream):
+        """Score frames from FFmpeg's stdout until it closes."""
+        try:
+            while True:
+                self.feed(await stream.readexactly(self.frame_bytes))
+        except asyncio.IncompleteReadError:
+            pass
+
+    def feed(self, frame, now=None):
+        now = time.time() if now is None else now
+        self.frames += 1
+        previous, self.previous = self.previous, frame
+        if previous is None:
+            self.first_frame_at = self.first_frame_at or now
+            return
+        score = changed_fraction(previous, frame, settings.HLS_MOTION_PIXEL_THRESHOLD)
+        self.last_score = round(score, 4)
+        event = self.current_event()
+        if score > settings.HLS_MOTION_AREA:
+            self.last_motion_at = now
+            if event is None:
+                event = {'start': now, 'end': None, 'peak_score': 0}
+                self.events.append(event)
+                metrics.MOTION_EVENTS.inc(stream_id=self.stream_id)
+            event['peak_score'] = max(event['peak_score'], self.last_score)
+        elif event is not None and now - self.last_motion_at >= settings.HLS_MOTION_HOLD:
+            event['end'] = self.last_motion_at
+
+        idle = now - (self.last_motion_at or self.first_frame_at) >= settings.HLS_MOTION_IDLE_AFTER
+        if idle != self.idle:
+            self.idle = idle
+            metrics.MOTION_IDLE.set(int(idle), stream_id=self.stream_id)
+            if self.on_idle:
+                self.on_idle(idle)
+
+    def current_event(self):
+        if self.events and self.events[-1]['end'] is None:
+            return self.events[-1]
+        return None
+
+    def events_since(self, since=None):
+        """Events still open or ended after `since` (a Unix time), oldest first."""
+        return [dict(event) for event in self.events
+                if since is None or event['end'] is None or event['end'] > since]
+
+    def stats(self):
+        return {
+            'moving': self.current_event() is not None,
+            'idle': self.idle,
+            'last_motion_at': self.last_motion_at,
+            'last_score': self.last_score,
+            'frames': self.frames,
+            'event_count': len(self.events),
+        }
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import time
+from django.conf import settings
+from .models import CameraProbe
+from .rtsp import camera_key
+
+# camera key -> (probed_at, result); CameraProbe rows back it across restarts
+probe_cache = {}
+# camera key -> in-flight probe, so concurrent starts share one ffprobe
+_pending_probes = {}
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _parse_rate(rate):
+    try:
+        num, den = rate.split('/')
+        return round(int(num) / int(den), 3) if int(den) else None
+    except (ValueError, AttributeError):
+        return None
+
+
+def parse_probe_output(output):
+    """
+    Reduce `ffprobe -of json -show_streams` output to the fields the HLS
+    pipeline cares about.
+    """
+    streams = json.loads(output).get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None:
+        raise ProbeError('No video stream found')
+    return {
+        'video_codec': video.get('codec_name'),
+        'profile': video.get('profile'),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'fps': _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')),
+        'audio_codec': audio.get('codec_name') if audio else None,
+    }
+
+
+async def _run_ffprobe(url, transport='tcp'):
+    cmd = [
+        settings.FFPROBE_BINARY,
+        '-v', 'error',
+        '-rtsp_transport', transport,
+        '-show_entries', 'stream=codec_type,codec_name,profile,width,height,avg_frame_rate,r_frame_rate',
+        '-of', 'json',
+        url
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=settings.HLS_PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise ProbeError('Timeout probing stream')
+    if process.returncode != 0:
+        raise ProbeError(stderr.decode(errors='ignore').strip() or f'ffprobe exited with {process.returncode}')
+    return parse_probe_output(stdout)
+
+
+def _store_key(key):
+    # Camera keys carry credentials; only their hash is written to the database
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def _stored_probe(key):
+    try:
+        return await CameraProbe.objects.filter(key=_store_key(key)).afirst()
+    except Exception as e:
+        print(f"Error reading the stored probe: {e}")
+        return None
+
+
+async def _store_probe(key, probed_at, result):
+    try:
+        await CameraProbe.objects.aupdate_or_create(key=_store_key(key), defaults={
+            'video_codec': result.get('video_codec') or '',
+            'profile': result.get('profile') or '',
+            'width': result.get('width'),
+            'height': result.get('height'),
+            'fps': result.get('fps'),
+            'audio_codec': result.get('audio_codec') or '',
+            'transport': result['transport'],
+            'probed_at': probed_at,
+        })
+    except Exception as e:
+        print(f"Error storing the probe: {e}")
+
+
+async def _probe(url, key):
+    """
+    (probed_at, result) from the camera's stored probe, or from running
+    ffprobe over each of HLS_PROBE_TRANSPORTS in turn, starting with the
+    one that worked last time.
+    """
+    stored = await _stored_probe(key)
+    if stored is not None and time.time() - stored.probed_at < settings.HLS_PROBE_CACHE_TTL:
+        return stored.probed_at, stored.result()
+    transports = list(settings.HLS_PROBE_TRANSPORTS)
+    if stored is not None and stored.transport in transports:
+        transports.remove(stored.transport)
+        transports.insert(0, stored.transport)
+    for transport in transports:
+        try:
+            result = await _run_ffprobe(url, transport)
+            break
+        except ProbeError as e:
+            error = e
+    else:
+        raise error
+    result['transport'] = transport
+    probed_at = time.time()
+    await _store_probe(key, probed_at, result)
+    return probed_at, result
+
+
+async def probe_stream(url):
+    """
+    Return codec details and the RTSP transport for a camera, probing it at
+    most once per HLS_PROBE_CACHE_TTL seconds, server restarts included.
+    Raises ProbeError if the probe fails.
+    """
+    key = camera_key(url)
+    cached = probe_cache.get(key)
+    if cached and time.time() - cached[0] < settings.HLS_PROBE_CACHE_TTL:
+        return cached[1]
+
+    pending = _pending_probes.get(key)
+    if pending is None:
+        pending = _pending_probes[key] = asyncio.ensure_future(_probe(url, key))
+        pending.add_done_callback(lambda task: _probe_done(key, task))
+    # Shielded for every caller, the first included: one that goes away
+    # leaves the probe running for the others
+    return (await asyncio.shield(pending))[1]
+
+
+def _probe_done(key, task):
+    _pending_probes.pop(key, None)
+    if not task.cancelled() and task.exception() is None:
+        probe_cache[key] = task.result()
@@ -0,0 +1,192 @@
+import asyncio
+import posixpath
+import threading
+import time
+from datetime import datetime, timezone
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.db.models import F
+from django.urls import reverse
+from .cleanup import DELETE_BATCH
+from .models import RecordedSegment
+from .upload_pool import get_s3_client
+
+# Segments further apart than this (seconds) are played with a discontinuity
+GAP_TOLERANCE = 1.0
+
+
+class Recorder:
+    """
+    Catalogs a recorded stream's segments as they reach storage.
+
+    add() is called from upload workers. Rows are collected there and
+    written with bulk_create from the event loop, on the ORM's sync thread,
+    so catalog writes neither hold up uploads nor contend for the database
+    from many threads. The first segment of a recording session starts a
+    discontinuity, since there was a gap (or a different recording) before it.
+    """
+    def __init__(self, stream_id, retention, loop=None):
+        self.stream_id = stream_id
+        self.retention = retention
+        self.loop = loop or asyncio.get_running_loop()
+        self.segments = 0
+        self._pending = []
+        self._first = True
+        self._lock = threading.Lock()
+        self._task = None
+
+    def add(self, key, start, duration, size, discontinuity=False):
+        with self._lock:
+            self._pending.append(RecordedSegment(
+                stream_id=self.stream_id, key=key, start=start, duration=duration, size=size,
+                discontinuity=discontinuity or self._first,
+                expires_at=start + duration + self.retention,
+            ))
+            self._first = False
+        try:
+            self.loop.call_soon_threadsafe(self._schedule)
+        except RuntimeError:
+            # The loop is gone (shutdown); nothing will flush these rows
+            pass
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await sync_to_async(RecordedSegment.objects.bulk_create)(batch)
+                self.segments += len(batch)
+            except Exception as e:
+                print(f"Error cataloging recorded segments of {self.stream_id}: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            await self._task
+        await self.flush()
+
+
+def find_segments(stream_id, start, end, limit=None):
+    """
+    The recorded segments of a stream that overlap [start, end), by start
+    time. The (stream_id, start) index bounds the scan: nothing starting
+    more than HLS_RECORD_MAX_SEGMENT before `start` can still overlap it.
+    """
+    rows = RecordedSegment.objects.filter(
+        stream_id=stream_id,
+        start__gte=start - settings.HLS_RECORD_MAX_SEGMENT,
+        start__lt=end,
+    ).annotate(end=F('start') + F('duration')).filter(end__gt=start).order_by('start')
+    return list(rows[:limit] if limit is not None else rows)
+
+
+def _program_date_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds')
+
+
+def build_playlist(stream_id, segments, ended=True):
+    """
+    An HLS playlist of recorded segments. A finished range is a VOD
+    playlist; an open one (the stream is still recording) is an EVENT
+    playlist the player keeps reloading. Every discontinuity, and the start,
+    carries the wall-clock time so players can show and seek by it.
+    """
+    target = max((segment.duration for segment in segments), default=2)
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{int(target + 0.999)}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        f"#EXT-X-PLAYLIST-TYPE:{'VOD' if ended else 'EVENT'}",
+    ]
+    previous_end = None
+    for segment in segments:
+        gap = previous_end is not None and abs(segment.start - previous_end) > GAP_TOLERANCE
+        if previous_end is not None and (segment.discontinuity or gap):
+            lines.append('#EXT-X-DISCONTINUITY')
+        if previous_end is None or segment.discontinuity or gap:
+            lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{_program_date_time(segment.start)}')
+        lines.append(f'#EXTINF:{segment.duration:.3f},')
+        lines.append(reverse('hls_serve', args=[stream_id, posixpath.basename(segment.key)]))
+        previous_end = segment.start + segment.duration
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def _delete_keys(client, bucket, keys):
+    """Delete storage objects; returns the keys that could not be deleted."""
+    if not bucket:
+        # No bucket (e.g. filesystem storage in development)
+        failed = set()
+        for key in keys:
+            try:
+                default_storage.delete(key)
+            except Exception:
+                failed.add(key)
+        return failed
+    response = client.delete_objects(
+        Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    return {error['Key'] for error in response.get('Errors', [])}
+
+
+def expire(client=None, bucket=None, now=None):
+    """
+    Delete recorded segments whose retention has run out, from storage and
+    from the catalog, one delete_objects batch at a time. Segments that
+    could not be deleted keep their rows and are retried on the next run.
+    Returns (deleted, failed) counts.
+    """
+    now = time.time() if now is None else now
+    bucket = bucket or settings.AWS_STORAGE_BUCKET_NAME
+    if bucket and client is None:
+        client = get_s3_client()
+    deleted = failed = 0
+    last_id = 0
+    while True:
+        batch = list(RecordedSegment.objects.filter(expires_at__lte=now, id__gt=last_id)
+                     .order_by('id').values_list('id', 'key')[:DELETE_BATCH])
+        if not batch:
+            return deleted, failed
+        last_id = batch[-1][0]
+        try:
+            errors = _delete_keys(client, bucket, [key for _, key in batch])
+        except Exception as e:
+            print(f"Error deleting expired recordings: {e}")
+            return deleted, failed + len(batch)
+        done = [row_id for row_id, key in batch if key not in errors]
+        RecordedSegment.objects.filter(id__in=done).delete()
+        deleted += len(done)
+        failed += len(batch) - len(done)
+
+
+_expirer = None
+
+
+def start_expiry():
+    """Run expire() every HLS_RECORD_EXPIRE_INTERVAL seconds from a daemon thread."""
+    global _expirer
+    if _expirer is not None or not settings.HLS_RECORD_EXPIRE_INTERVAL:
+        return
+
+    def run():
+        while True:
+            time.sleep(settings.HLS_RECORD_EXPIRE_INTERVAL)
+            try:
+                deleted, failed = expire()
+                if deleted or failed:
+                    print(f"Expired {deleted} recorded segments ({failed} failed)")
+            except Exception as e:
+                print(f"Recording expiry failed: {e}")
+            finally:
+                close_old_connections()
+
+    _expirer = threading.Thread(target=run, name='hls-record-expiry', daemon=True)
+    _expirer.start()
@@ -0,0 +1,356 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.utils import timezone
+from .models import StreamNode, StreamRecord
+
+# Set on requests one node forwards to another, so they are never forwarded again
+FORWARDED_HEADER = 'X-HLS-Forwarded'
+# Response headers worth passing back from the owning node
+PROXIED_HEADERS = ('ETag', 'Cache-Control', 'Retry-After', 'Access-Control-Allow-Origin', 'Content-Type',
+                   'Last-Modified')
+
+
+def cluster_enabled():
+    """Multi-node mode is on once this node knows the URL other nodes reach it at."""
+    return bool(settings.HLS_NODE_URL)
+
+
+class DatabaseRegistry:
+    """
+    Stream ownership and node heartbeats in Django's database, which every
+    node already shares. A node counts as alive while its last heartbeat is
+    younger than HLS_NODE_TIMEOUT.
+    """
+    name = 'db'
+
+    def heartbeat(self, node_id, url, capacity, used, streams):
+        """Record a node's load and the streams it runs ({stream_id: viewers})."""
+        with transaction.atomic():
+            StreamNode.objects.update_or_create(node_id=node_id, defaults={
+                'url': url, 'capacity': capacity, 'used': used, 'last_heartbeat': timezone.now(),
+            })
+            # The heartbeat is authoritative for this node's streams
+            StreamRecord.objects.filter(node_id=node_id).exclude(stream_id__in=list(streams)).delete()
+            StreamRecord.objects.bulk_create(
+                [StreamRecord(stream_id=stream_id, node_id=node_id, viewers=viewers)
+                 for stream_id, viewers in streams.items()],
+                update_conflicts=True, unique_fields=['stream_id'], update_fields=['node_id', 'viewers', 'updated_at']
+            )
+
+    def claim(self, stream_id, node_id, cost=0):
+        with transaction.atomic():
+            StreamRecord.objects.update_or_create(stream_id=stream_id, defaults={'node_id': node_id})
+            # Counted now so placements before the next heartbeat see it
+            StreamNode.objects.filter(node_id=node_id).update(used=F('used') + cost)
+
+    def release(self, stream_id, node_id, cost=0):
+        with transaction.atomic():
+            if StreamRecord.objects.filter(stream_id=stream_id, node_id=node_id).delete()[0]:
+                StreamNode.objects.filter(node_id=node_id, used__gte=cost).update(used=F('used') - cost)
+
+    def _alive(self):
+        cutoff = timezone.now() - timedelta(seconds=settings.HLS_NODE_TIMEOUT)
+        return StreamNode.objects.filter(last_heartbeat__gte=cutoff)
+
+    def owner(self, stream_id):
+        """The live node running a stream, or None."""
+        record = StreamRecord.objects.filter(stream_id=stream_id).first()
+        if record is None:
+            return None
+        node = self._alive().filter(node_id=record.node_id).first()
+        return _node_json(node.node_id, node.url, node.capacity, node.used) if node else None
+
+    def nodes(self):
+        """Every live node with its load, stream count and viewers."""
+        nodes = []
+        for node in self._alive():
+            records = StreamRecord.objects.filter(node_id=node.node_id)
+            nodes.append(_node_json(node.node_id, node.url, node.capacity, node.used,
+                                    streams=records.count(),
+                                    viewers=sum(records.values_list('viewers', flat=True))))
+        return nodes
+
+
+class RedisRegistry:
+    """
+    The same registry in Redis, for clusters that outgrow a shared SQL
+    database. Node and ownership keys expire after HLS_NODE_TIMEOUT unless
+    refreshed by heartbeats, so a dead node's streams disappear on their own.
+    """
+    name = 'redis'
+
+    def __init__(self, url=None):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured("HLS_REGISTRY = 'redis' needs the redis package")
+        self.client = redis.Redis.from_url(url or settings.HLS_REDIS_URL, decode_responses=True)
+
+    def heartbeat(self, node_id, url, capacity, used, streams):
+        ttl = settings.HLS_NODE_TIMEOUT
+        streams_key = f'hls:node:{node_id}:streams'
+        pipe = self.client.pipeline()
+        pipe.hset(f'hls:node:{node_id}', mapping={'url': url, 'capacity': capacity, 'used': used})
+        pipe.expire(f'hls:node:{node_id}', ttl)
+        pipe.sadd('hls:nodes', node_id)
+        pipe.delete(streams_key)
+        if streams:
+            pipe.hset(streams_key, mapping=streams)
+            pipe.expire(streams_key, ttl)
+        for stream_id in streams:
+            pipe.set(f'hls:stream:{stream_id}', node_id, ex=ttl)
+        pipe.execute()
+
+    def claim(self, stream_id, node_id, cost=0):
+        pipe = self.client.pipeline()
+        pipe.set(f'hls:stream:{stream_id}', node_id, ex=settings.HLS_NODE_TIMEOUT)
+        pipe.hincrby(f'hls:node:{node_id}', 'used', cost)
+        pipe.execute()
+
+    def release(self, stream_id, node_id, cost=0):
+        if self.client.get(f'hls:stream:{stream_id}') == node_id:
+            pipe = self.client.pipeline()
+            pipe.delete(f'hls:stream:{stream_id}')
+            pipe.hincrby(f'hls:node:{node_id}', 'used', -cost)
+            pipe.execute()
+        self.client.hdel(f'hls:node:{node_id}:streams', stream_id)
+
+    def _node(self, node_id):
+        node = self.client.hgetall(f'hls:node:{node_id}')
+        if not node:
+            return None
+        return _node_json(node_id, node['url'], int(node['capacity']), int(node['used']))
+
+    def owner(self, stream_id):
+        node_id = self.client.get(f'hls:stream:{stream_id}')
+        return self._node(node_id) if node_id else None
+
+    def nodes(self):
+        nodes = []
+        for node_id in self.client.smembers('hls:nodes'):
+            node = self._node(node_id)
+            if node is None:
+                self.client.srem('hls:nodes', node_id)
+                continue
+            viewers = self.client.hvals(f'hls:node:{node_id}:streams')
+            node['streams'] = len(viewers)
+            node['viewers'] = sum(int(v) for v in viewers)
+            nodes.append(node)
+        return nodes
+
+
+def _node_json(node_id, url, capacity, used, streams=0, viewers=0):
+    return {
+        'node_id': node_id,
+        'url': url,
+        'capacity': capacity,
+        'used': used,
+        'streams': streams,
+        'viewers': viewers,
+    }
+
+
+REGISTRIES = {
+    'db': DatabaseRegistry,
+    'redis': RedisRegistry,
+}
+_registry = None
+_owners = {}
+
+
+def get_registry():
+    global _registry
+    if _registry is None or _registry.name != settings.HLS_REGISTRY:
+        if settings.HLS_REGISTRY not in REGISTRIES:
+            raise ImproperlyConfigured(f'Unknown HLS_REGISTRY: {settings.HLS_REGISTRY}')
+        _registry = REGISTRIES[settings.HLS_REGISTRY]()
+    return _registry
+
+
+def lookup_owner(stream_id):
+    """
+    registry.owner() behind a short per-process cache, since hls_serve asks
+    on every request for a stream this node does not run.
+    """
+    cached = _owners.get(stream_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    node = get_registry().owner(stream_id)
+    if len(_owners) > 10000:
+        _owners.clear()
+    _owners[stream_id] = (time.monotonic() + settings.HLS_OWNER_CACHE_TTL, node)
+    return node
+
+
+def claim(stream_id, cost=0):
+    _owners.pop(stream_id, None)
+    get_registry().claim(stream_id, settings.HLS_NODE_ID, cost)
+
+
+def release(stream_id, cost=0):
+    _owners.pop(stream_id, None)
+    get_registry().release(stream_id, settings.HLS_NODE_ID, cost)
+
+
+def place_stream(cost):
+    """
+    The live node with the most free transcode slots that fits `cost`
+    (fewest streams on a tie), or None if none does.
+    """
+    candidates = [node for node in get_registry().nodes() if node['capacity'] - node['used'] >= cost]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda node: (node['capacity'] - node['used'], -node['streams']))
+
+
+def send_heartbeat(snapshot):
+    get_registry().heartbeat(settings.HLS_NODE_ID, settings.HLS_NODE_URL, **snapshot)
+
+
+_heartbeat_thread = None
+
+
+def start_heartbeat(snapshot):
+    """
+    Publish `snapshot()` ({"capacity", "used", "streams"}) every
+    HLS_HEARTBEAT_INTERVAL seconds from a daemon thread.
+    """
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        return
+
+    def run():
+        while True:
+            try:
+                send_heartbeat(snapshot())
+            except Exception as e:
+                print(f"Registry heartbeat failed: {e}")
+            finally:
+                close_old_connections()
+            time.sleep(settings.HLS_HEARTBEAT_INTERVAL)
+
+    _heartbeat_thread = threading.Thread(target=run, name='hls-registry-heartbeat', daemon=True)
+    _heartbeat_thread.start()
+
+
+def check_configuration():
+    """Refuse to join a cluster whose forwarded requests anyone could sign."""
+    if cluster_enabled() and not settings.HLS_CLUSTER_SECRET:
+        raise ImproperlyConfigured('HLS_NODE_URL is set but HLS_CLUSTER_SECRET is not')
+
+
+def _signature(node_id, timestamp, method, path):
+    message = f'{node_id}\n{timestamp}\n{method}\n{path}'.encode()
+    return hmac.new(settings.HLS_CLUSTER_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+def forwarded_by(method, path, node_id=None, now=None):
+    """
+    The FORWARDED_HEADER value with which a node vouches for a request it
+    relays: its id and the current time, signed together with the request's
+    method and path using the cluster's shared HLS_CLUSTER_SECRET.
+    """
+    node_id = node_id or settings.HLS_NODE_ID
+    timestamp = int(time.time() if now is None else now)
+    return f'{node_id}:{timestamp}:{_signature(node_id, timestamp, method, path)}'
+
+
+def verify_forwarded(value, method, path):
+    """Whether `value` is a FORWARDED_HEADER signed for this request in the last HLS_FORWARD_MAX_AGE seconds."""
+    if not settings.HLS_CLUSTER_SECRET:
+        return False
+    parts = value.rsplit(':', 2)
+    if len(parts) != 3 or not parts[0] or not parts[1].isdigit():
+        return False
+    node_id, timestamp, signature = parts
+    if abs(time.time() - int(timestamp)) > settings.HLS_FORWARD_MAX_AGE:
+        return False
+    return hmac.compare_digest(_signature(node_id, int(timestamp), method, path), signature)
+
+
+def is_forwarded(request):
+    # Only a fresh header signed for this very request counts; clients
+    # cannot use it to skip routing, nor replay one they have seen
+    return verify_forwarded(request.headers.get(FORWARDED_HEADER, ''), request.method, request.get_full_path())
+
+
+async def forward(request, node):
+    """Relay a request to the node that owns its stream and return that node's response."""
+    headers = {FORWARDED_HEADER: forwarded_by(request.method, request.get_full_path())}
+    for name in ('Content-Type', 'If-None-Match', 'User-Agent'):
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    # Keep the original client visible to the owner's viewer tracking
+    client = request.headers.get('X-Forwarded-For') or request.META.get('REMOTE_ADDR')
+    if client:
+        headers['X-Forwarded-For'] = client
+    url = node['url'].rstrip('/') + request.get_full_path()
+    outgoing = urllib.request.Request(url, data=request.body or None, method=request.method, headers=headers)
+
+    def fetch():
+        try:
+            with urllib.request.urlopen(outgoing, timeout=settings.HLS_PROXY_TIMEOUT) as upstream:
+                return upstream.status, upstream.headers, upstream.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    try:
+        status, upstream_headers, body = await sync_to_async(fetch, thread_sensitive=False)()
+    except (urllib.error.URLError, OSError) as e:
+        return HttpResponse(json.dumps({'error': f"Node {node['node_id']} is unreachable: {e}"}),
+                            status=502, content_type='application/json')
+    response = HttpResponse(body, status=status)
+    for name in PROXIED_HEADERS:
+        if name in upstream_headers:
+            response[name] = upstream_headers[name]
+    response['X-HLS-Node'] = node['node_id']
+    return response
+
+
+async def get_json(node, path):
+    """
+    GET `path` (with its query string) from another node as a forwarded
+    request and return the decoded JSON body. Raises on errors.
+    """
+    outgoing = urllib.request.Request(node['url'].rstrip('/') + path,
+                                      headers={FORWARDED_HEADER: forwarded_by('GET', path)})
+
+    def fetch():
+        with urllib.request.urlopen(outgoing, timeout=settings.HLS_PROXY_TIMEOUT) as upstream:
+            return json.loads(upstream.read())
+
+    return await sync_to_async(fetch, thread_sensitive=False)()
+
+
+async def post_json(node, path, data):
+    """
+    POST `data` as JSON to `path` on another node as a forwarded request.
+    Returns (status, decoded body); an unreachable node is a 502.
+    """
+    outgoing = urllib.request.Request(node['url'].rstrip('/') + path, data=json.dumps(data).encode(),
+                                      method='POST', headers={FORWARDED_HEADER: forwarded_by('POST', path),
+                                                              'Content-Type': 'application/json'})
+
+    def fetch():
+        try:
+            with urllib.request.urlopen(outgoing, timeout=settings.HLS_PROXY_TIMEOUT) as upstream:
+                return upstream.status, json.loads(upstream.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    try:
+        return await sync_to_async(fetch, thread_sensitive=False)()
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        return 502, {'error': f"Node {node['node_id']} is unreachable: {e}"}
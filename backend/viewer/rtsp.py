@@ -0,0 +1,72 @@
+from urllib.parse import urlparse, urlunparse
+
+
+class InvalidRTSPURL(ValueError):
+    pass
+
+
+def build_rtsp_url(url, username=None, password=None):
+    """
+    Merge optional credential overrides into a camera URL and return the URL
+    FFmpeg should open. Raises InvalidRTSPURL if the URL has no hostname.
+    """
+    parsed_url = urlparse(url)
+
+    final_hostname = parsed_url.hostname
+    if not final_hostname:
+        raise InvalidRTSPURL('Invalid RTSP URL: Hostname missing.')
+
+    # Determine the effective username and password
+    effective_username = username if username else parsed_url.username
+    effective_password = password if password else parsed_url.password
+
+    if not password and parsed_url.password and '@' in parsed_url.password:
+        effective_password = parsed_url.password.split('@', 1)[0]
+
+    netloc_parts = []
+    if effective_username:
+        userinfo = effective_username
+        if effective_password:
+            userinfo += f":{effective_password}"
+        netloc_parts.append(f"{userinfo}@")
+
+    netloc_parts.append(final_hostname)
+    if parsed_url.port:
+        netloc_parts.append(f":{parsed_url.port}")
+
+    return urlunparse((
+        parsed_url.scheme if parsed_url.scheme else 'rtsp',
+        "".join(netloc_parts),
+        parsed_url.path if parsed_url.path else '/',
+        parsed_url.params,
+        parsed_url.query,
+        parsed_url.fragment
+    ))
+
+
+def camera_key(url):
+    """
+    Normalize a URL returned by build_rtsp_url so that different spellings of
+    the same camera and credentials map to one key.
+    """
+    parsed_url = urlparse(url)
+    scheme = (parsed_url.scheme or 'rtsp').lower()
+    netloc = parsed_url.hostname
+    if parsed_url.port and not (scheme == 'rtsp' and parsed_url.port == 554):
+        netloc += f":{parsed_url.port}"
+    if parsed_url.username:
+        userinfo = parsed_url.username
+        if parsed_url.password:
+            userinfo += f":{parsed_url.password}"
+        netloc = f"{userinfo}@{netloc}"
+    path = parsed_url.path.rstrip('/') or '/'
+    return urlunparse((scheme, netloc, path, parsed_url.params, parsed_url.query, ''))
+
+
+def camera_label(url):
+    """A camera's host and path without credentials, safe to publish as a metric label."""
+    parsed_url = urlparse(url)
+    netloc = parsed_url.hostname or ''
+    if parsed_url.port:
+        netloc += f":{parsed_url.port}"
+    return netloc + (parsed_url.path.rstrip('/') or '/')
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+class CachedObject:
+    __slots__ = ('data', 'etag', 'expires')
+
+    def __init__(self, data, ttl):
+        self.data = data
+        self.etag = '"%s"' % hashlib.md5(data, usedforsecurity=False).hexdigest()
+        self.expires = time.monotonic() + ttl
+
+
+class SegmentCache:
+    """
+    Byte-bounded LRU cache of recent HLS playlists and segments, keyed by
+    storage path.
+
+    The uploader fills it as each object reaches storage and evicts
+    segments once they are deleted after rotating out, so hls_serve can
+    answer most requests without asking storage. Playlists change with every
+    segment and get a short TTL; segments never change under the same name
+    and are kept until rotated out, evicted as least recently used, or
+    HLS_CACHE_SEGMENT_TTL passes. Uploads happen on worker threads, so all
+    access is under a lock.
+    """
+    def __init__(self, max_bytes=None, playlist_ttl=None, segment_ttl=None):
+        self.max_bytes = max_bytes if max_bytes is not None else settings.HLS_CACHE_MAX_BYTES
+        self.playlist_ttl = playlist_ttl if playlist_ttl is not None else settings.HLS_CACHE_PLAYLIST_TTL
+        self.segment_ttl = segment_ttl if segment_ttl is not None else settings.HLS_CACHE_SEGMENT_TTL
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, path, data):
+        """
+        Cache `data` under `path` and return its CachedObject. Objects larger
+        than the whole cache are returned but not kept.
+        """
+        ttl = self.playlist_ttl if path.endswith('.m3u8') else self.segment_ttl
+        entry = CachedObject(bytes(data), ttl)
+        if len(entry.data) > self.max_bytes:
+            return entry
+        with self._lock:
+            self._remove(path)
+            self._entries[path] = entry
+            self.size += len(entry.data)
+            while self.size > self.max_bytes:
+                _, oldest = self._entries.popitem(last=False)
+                self.size -= len(oldest.data)
+                self.evictions += 1
+        return entry
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(path)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def evict(self, path):
+        with self._lock:
+            self._remove(path)
+
+    def evict_prefix(self, prefix):
+        with self._lock:
+            for path in [p for p in self._entries if p.startswith(prefix)]:
+                self._remove(path)
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'objects': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_segment_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SegmentCache()
+        return _cache
@@ -0,0 +1,225 @@
+import os
+import shutil
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.urls import reverse
+from django.utils.http import parse_etags
+from .cleanup import get_cleanup_worker
+from .segment_cache import CachedObject, get_segment_cache
+from .uploader import PushedOutput, SegmentUploader
+from .upload_pool import get_upload_scheduler
+
+
+def content_type(filename):
+    if filename.endswith('.m3u8'):
+        return 'application/vnd.apple.mpegurl'
+    elif filename.endswith('.ts'):
+        return 'video/mp2t'
+    elif filename.endswith('.m4s'):
+        return 'video/iso.segment'
+    elif filename.endswith('.mp4'):
+        return 'video/mp4'
+    return 'application/octet-stream'
+
+
+def cache_control(filename):
+    if filename.endswith('.m3u8'):
+        return f'public, max-age={settings.HLS_PLAYLIST_MAX_AGE}'
+    # Segment names are never reused within a stream
+    return 'public, max-age=31536000, immutable'
+
+
+def _finish(response, request, filename, etag):
+    """Add caching and CORS headers, or turn the response into a 304."""
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control(filename)
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+class StorageSegmentStore:
+    """
+    Segments in Django's default storage (S3 in production).
+
+    FFmpeg writes into the stream's private working directory, which a
+    SegmentUploader mirrors through the shared upload pool. Requests are
+    answered from the segment cache, falling back to storage; only what
+    streams running here read from storage goes back into the cache.
+    """
+    name = 's3'
+
+    def __init__(self):
+        # Streams this process uploads, between publish/receive and stop
+        self._live = set()
+
+    def remote_dir(self, stream_id):
+        return f"{settings.HLS_MEDIA_ROOT}/{stream_id}"
+
+    def output_dir(self, stream_id, work_dir):
+        return work_dir
+
+    def publish(self, stream_id, output_dir, playlist_name, on_published, recorder=None):
+        # The upload scheduler uploads each new segment once, then the
+        # playlist that references it
+        scheduler = get_upload_scheduler()
+        self._live.add(stream_id)
+        uploader = SegmentUploader(
+            output_dir, self.remote_dir(stream_id), playlist_name,
+            submit=scheduler.submitter(stream_id),
+            on_published=on_published,
+            cache=get_segment_cache(),
+            recorder=recorder
+        )
+        scheduler.register(stream_id, uploader)
+
+    def receive(self, stream_id, token, playlist_name, recorder=None):
+        """
+        Return a PushedOutput that uploads what the stream's FFmpeg pushes
+        to hls_ingest (authenticated by `token`) through the upload scheduler.
+        """
+        scheduler = get_upload_scheduler()
+        self._live.add(stream_id)
+        output = PushedOutput(
+            self.remote_dir(stream_id), token, playlist_name,
+            submit=scheduler.submitter(stream_id),
+            cache=get_segment_cache(),
+            recorder=recorder
+        )
+        scheduler.register(stream_id, output)
+        return output
+
+    def playlist_url(self, stream_id, playlist_name):
+        if settings.HLS_CACHE_MAX_BYTES:
+            # Through hls_serve, so players are answered from the segment cache
+            return reverse('hls_serve', args=[stream_id, playlist_name])
+        return f'{settings.MEDIA_URL}{self.remote_dir(stream_id)}/{playlist_name}'
+
+    def has_stream(self, stream_id):
+        return True
+
+    async def serve(self, request, stream_id, filename):
+        # Most requests are for objects this process uploaded moments ago
+        file_path = f"{self.remote_dir(stream_id)}/{filename}"
+        entry = get_segment_cache().get(file_path)
+        if entry is None:
+            # Storage reads don't touch the ORM, so they need not queue up
+            # behind each other on the shared sync thread
+            entry = await sync_to_async(self._read, thread_sensitive=False)(file_path, stream_id in self._live)
+        response = HttpResponse(entry.data, content_type=content_type(filename))
+        return _finish(response, request, filename, entry.etag)
+
+    def _read(self, file_path, cache):
+        try:
+            if not default_storage.exists(file_path):
+                raise Http404("File does not exist")
+            with default_storage.open(file_path) as file:
+                data = file.read()
+        except Exception as e:
+            raise Http404(f"Error serving file: {str(e)}")
+        if not cache:
+            # Nothing would evict it once the stream has stopped
+            return CachedObject(data, 0)
+        return get_segment_cache().put(file_path, data)
+
+    def stop(self, stream_id):
+        self._live.discard(stream_id)
+        get_upload_scheduler().unregister(stream_id)
+        get_segment_cache().evict_prefix(f"{self.remote_dir(stream_id)}/")
+
+    def delete(self, stream_id):
+        # Long streams leave thousands of objects; the cleanup worker pages
+        # through them in the background so stopping returns at once
+        get_cleanup_worker().schedule(f"{self.remote_dir(stream_id)}/")
+
+    def delete_playlist(self, stream_id, playlist_name='stream.m3u8'):
+        # A recorded stream's segments outlive it (see recording.expire)
+        default_storage.delete(f"{self.remote_dir(stream_id)}/{playlist_name}")
+
+
+class LocalSegmentStore:
+    """
+    Segments on this server's disk under HLS_LOCAL_ROOT (a tmpfs mount keeps
+    them in RAM).
+
+    FFmpeg writes straight into the served directory, so there is no copy
+    step, and its delete_segments flag removes rotated-out segments. Files
+    are served with FileResponse, or handed to nginx via X-Accel-Redirect
+    when HLS_LOCAL_ACCEL_REDIRECT is set so it can use sendfile.
+    """
+    name = 'local'
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root or settings.HLS_LOCAL_ROOT
+
+    def stream_dir(self, stream_id):
+        return os.path.join(self.root, stream_id)
+
+    def output_dir(self, stream_id, work_dir):
+        path = self.stream_dir(stream_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def publish(self, stream_id, output_dir, playlist_name, on_published, recorder=None):
+        # FFmpeg's playlist is servable as soon as it exists; recording
+        # needs storage, so there is never a recorder here
+        on_published()
+
+    def playlist_url(self, stream_id, playlist_name):
+        return reverse('hls_serve', args=[stream_id, playlist_name])
+
+    def has_stream(self, stream_id):
+        return os.path.isdir(self.stream_dir(stream_id))
+
+    async def serve(self, request, stream_id, filename):
+        # An absolute filename would make join drop the stream directory
+        stream_dir = os.path.realpath(self.stream_dir(stream_id))
+        path = os.path.realpath(os.path.join(stream_dir, filename))
+        if not path.startswith(stream_dir + os.sep):
+            raise Http404("Invalid path")
+        try:
+            file = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise Http404("File does not exist")
+        st = os.fstat(file.fileno())
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        if settings.HLS_LOCAL_ACCEL_REDIRECT:
+            file.close()
+            response = HttpResponse(content_type=content_type(filename))
+            response['X-Accel-Redirect'] = f'{settings.HLS_LOCAL_ACCEL_REDIRECT}{stream_id}/{filename}'
+        else:
+            response = FileResponse(file, content_type=content_type(filename))
+        response = _finish(response, request, filename, etag)
+        if response.status_code == 304:
+            file.close()
+        return response
+
+    def stop(self, stream_id):
+        pass
+
+    def delete(self, stream_id):
+        shutil.rmtree(self.stream_dir(stream_id), ignore_errors=True)
+
+
+SEGMENT_STORES = {
+    'local': LocalSegmentStore,
+    's3': StorageSegmentStore,
+}
+_stores = {}
+
+
+def get_segment_store(name=None):
+    """Return the shared instance of a segment store (default HLS_SEGMENT_STORE)."""
+    name = name or settings.HLS_SEGMENT_STORE
+    if name not in SEGMENT_STORES:
+        raise ValueError(f'Unknown segment store: {name}')
+    if name not in _stores:
+        _stores[name] = SEGMENT_STORES[name]()
+    return _stores[name]
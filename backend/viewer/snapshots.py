@@ -0,0 +1,76 @@
+import hashlib
+import os
+import time
+from django.conf import settings
+
+# The file each stream's FFmpeg keeps its latest frame in, in its working directory
+SNAPSHOT_NAME = 'snapshot.jpg'
+
+
+class Snapshot:
+    __slots__ = ('data', 'etag', 'taken_at', 'checked')
+
+    def __init__(self, data, taken_at):
+        self.data = data
+        self.etag = '"%s"' % hashlib.md5(data, usedforsecurity=False).hexdigest()
+        self.taken_at = taken_at
+        self.checked = time.monotonic()
+
+
+def read_snapshot(path):
+    """The JPEG FFmpeg last wrote to `path` and its Unix time, or None before the first one."""
+    try:
+        with open(path, 'rb') as f:
+            taken_at = os.fstat(f.fileno()).st_mtime
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    return (data, taken_at) if data else None
+
+
+class SnapshotCache:
+    """
+    The latest snapshot of each running stream.
+
+    FFmpeg rewrites a stream's snapshot file every HLS_SNAPSHOT_INTERVAL
+    seconds (see snapshot_output_args); the cache re-reads it at most once
+    per max_age (default HLS_SNAPSHOT_MAX_AGE), however many camera-grid
+    tiles ask for it in between. The file is a few tens of KB on local
+    disk, so it is read in the event loop.
+    """
+    def __init__(self, max_age=None):
+        self.max_age = max_age if max_age is not None else settings.HLS_SNAPSHOT_MAX_AGE
+        self.hits = 0
+        self.reads = 0
+        self._entries = {}
+
+    def get(self, stream_id, path):
+        """The stream's Snapshot, or None if FFmpeg has not written one yet."""
+        entry = self._entries.get(stream_id)
+        if entry is not None and time.monotonic() - entry.checked < self.max_age:
+            self.hits += 1
+            return entry
+        self.reads += 1
+        result = read_snapshot(path)
+        if result is None:
+            return entry
+        data, taken_at = result
+        if entry is not None and entry.taken_at == taken_at:
+            entry.checked = time.monotonic()
+        else:
+            entry = Snapshot(data, taken_at)
+            self._entries[stream_id] = entry
+        return entry
+
+    def forget(self, stream_id):
+        self._entries.pop(stream_id, None)
+
+
+_cache = None
+
+
+def get_snapshot_cache():
+    global _cache
+    if _cache is None:
+        _cache = SnapshotCache()
+    return _cache
@@ -0,0 +1,73 @@
+# Validation of start_hls_stream options, shared by everything that starts
+# streams or keeps their options for later (registered cameras, mosaics)
+from django.conf import settings
+from .ffmpeg_commands import normalize_ladder
+from .rtsp import build_rtsp_url
+from .segment_store import get_segment_store
+
+
+def parse_stream_options(data, source=True):
+    """
+    Validate the options of a start_hls_stream body and return them with
+    their defaults applied: "url" (credentials included), "mode",
+    "renditions", "abr", "low_latency", "admission", "idle_timeout",
+    "motion", "record", "retention", "ingest" and "segment_store" (None for
+    low-latency streams). With source=False the body names no camera.
+    Raises ValueError (or InvalidRTSPURL) with a message for the client.
+    """
+    mode = data.get('mode', 'auto')
+    renditions = data.get('renditions')
+    abr = bool(data.get('abr') or renditions)
+    low_latency = bool(data.get('low_latency'))
+    admission = data.get('admission', settings.HLS_ADMISSION_POLICY)
+    idle_timeout = data.get('idle_timeout', settings.HLS_IDLE_TIMEOUT)
+    motion = bool(data.get('motion'))
+    record = bool(data.get('record'))
+    retention = data.get('retention') or settings.HLS_RECORD_RETENTION
+    ingest = data.get('ingest')
+
+    if source and not data.get('url'):
+        raise ValueError('Missing RTSP URL')
+    if mode not in ('auto', 'copy', 'transcode'):
+        raise ValueError('mode must be auto, copy or transcode')
+    if admission not in ('reject', 'queue'):
+        raise ValueError('admission must be reject or queue')
+    if idle_timeout is not None and (not isinstance(idle_timeout, (int, float)) or idle_timeout < 0):
+        raise ValueError('idle_timeout must be a number of seconds')
+    if low_latency and abr:
+        raise ValueError('low_latency cannot be combined with abr')
+    if motion and (low_latency or abr):
+        raise ValueError('motion cannot be combined with low_latency or abr')
+    if record and (low_latency or abr):
+        raise ValueError('record cannot be combined with low_latency or abr')
+    if not isinstance(retention, (int, float)) or retention < 0:
+        raise ValueError('retention must be a number of seconds')
+    if renditions is not None:
+        # Checked here; fitted to the source's height once it is probed
+        normalize_ladder(renditions)
+    segment_store = None if low_latency else get_segment_store(data.get('store'))
+    if record and segment_store.name != 's3':
+        raise ValueError('record needs the s3 store')
+    if ingest is None:
+        # The local store and low-latency streams have no polling to replace
+        ingest = settings.HLS_INGEST if segment_store is not None and segment_store.name == 's3' else 'poll'
+    if ingest not in ('poll', 'push'):
+        raise ValueError('ingest must be poll or push')
+    if ingest == 'push' and (segment_store is None or segment_store.name != 's3'):
+        raise ValueError('push ingest needs the s3 store')
+    url = build_rtsp_url(data['url'], data.get('username'), data.get('password')) if source else None
+
+    return {
+        'url': url,
+        'mode': mode,
+        'renditions': renditions,
+        'abr': abr,
+        'low_latency': low_latency,
+        'admission': admission,
+        'idle_timeout': idle_timeout,
+        'motion': motion,
+        'record': record,
+        'retention': retention,
+        'ingest': ingest,
+        'segment_store': segment_store,
+    }
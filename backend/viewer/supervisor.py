@@ -0,0 +1,363 @@
+import asyncio
+import os
+import time
+from collections import deque
+from django.conf import settings
+from . import metrics
+
+
+class CapacityError(Exception):
+    """The node has no transcode capacity left for a new stream."""
+
+
+def stream_cost(mode, ladder=None):
+    """
+    Transcode slots a stream occupies: one per encode. Passthrough streams
+    only remux and are not counted.
+    """
+    if ladder:
+        return len(ladder)
+    return 0 if mode == 'copy' else 1
+
+
+def parse_progress(block):
+    """
+    Turn one block of FFmpeg -progress output ({"fps": "25.00",
+    "speed": "1.01x", ...}) into numbers; fields FFmpeg reports as N/A
+    are left out.
+    """
+    progress = {}
+    for key, field, convert in (('frame', 'frame', int), ('fps', 'fps', float),
+                                ('drop_frames', 'dropped_frames', int), ('total_size', 'total_size', int),
+                                ('out_time_us', 'out_time_us', int)):
+        try:
+            progress[field] = convert(block[key])
+        except (KeyError, ValueError):
+            pass
+    try:
+        progress['speed'] = float(block['speed'].rstrip('x'))
+    except (KeyError, ValueError):
+        pass
+    try:
+        progress['bitrate_kbps'] = float(block['bitrate'].split('kbits/s')[0])
+    except (KeyError, ValueError):
+        pass
+    return progress
+
+
+def default_capacity():
+    if settings.HLS_MAX_TRANSCODES is not None:
+        return settings.HLS_MAX_TRANSCODES
+    return (os.cpu_count() or 1) * settings.HLS_TRANSCODES_PER_CPU
+
+
+class SupervisedProcess:
+    """
+    One stream's FFmpeg process, restarted when it dies or stalls.
+
+    `output_time` returns when the stream last produced output (a playlist
+    mtime or the newest LL-HLS part); no new output for HLS_STALL_TIMEOUT
+    counts as a stall. Restarts back off exponentially from
+    HLS_RESTART_BACKOFF up to HLS_RESTART_BACKOFF_MAX, the backoff resets
+    after HLS_RESTART_RESET_AFTER seconds of healthy output, and after
+    HLS_RESTART_MAX_ATTEMPTS consecutive failures the process is given up on
+    and `on_failed(reason)` is called. `on_spawn(process)` runs after every
+    launch, including restarts.
+
+    With `progress`, FFmpeg reports encode progress on a pipe
+    (-progress pipe:N); the latest figures are kept in `progress` and
+    published as per-stream metrics. replace() swaps the command line of a
+    running process, e.g. to re-encode at another rate.
+    """
+    def __init__(self, stream_id, cmd, log_path, cost=1, capture_stdout=False, output_time=None,
+                 on_spawn=None, on_failed=None, progress=False):
+        self.stream_id = stream_id
+        self.cmd = cmd
+        self.log_path = log_path
+        self.cost = cost
+        self.capture_stdout = capture_stdout
+        self.output_time = output_time
+        self.on_spawn = on_spawn
+        self.on_failed = on_failed
+        self.report_progress = progress
+        self.process = None
+        self.state = 'starting'
+        self.started_at = None
+        self.spawned_at = None
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.last_exit_code = None
+        self.last_error = None
+        self.last_restart_at = None
+        self.progress = {}
+        self._task = None
+        self._progress_task = None
+        # Held while the process is checked or replaced, so a deliberate
+        # switch is not mistaken for a crash
+        self._lock = asyncio.Lock()
+
+    async def spawn(self):
+        cmd, read_fd, write_fd = self.cmd, None, None
+        if self.report_progress:
+            # Progress gets its own pipe, since stdout may carry the stream itself
+            read_fd, write_fd = os.pipe()
+            cmd = [cmd[0], '-progress', f'pipe:{write_fd}', *cmd[1:]]
+        try:
+            with open(self.log_path, "a") as log_file:
+                # Low-latency streams are read from FFmpeg's stdout as they are muxed
+                self.process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.PIPE if self.capture_stdout else log_file,
+                    stderr=log_file,
+                    pass_fds=(write_fd,) if write_fd is not None else ()
+                )
+        except BaseException:
+            if read_fd is not None:
+                os.close(read_fd)
+            raise
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+        self.progress = {}
+        if read_fd is not None:
+            self._progress_task = asyncio.ensure_future(self._read_progress(read_fd))
+        self.spawned_at = time.time()
+        if self.started_at is None:
+            self.started_at = self.spawned_at
+        if self.on_spawn:
+            self.on_spawn(self.process)
+        return self.process
+
+    async def _read_progress(self, fd):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                    os.fdopen(fd, 'rb', 0))
+        try:
+            block = {}
+            # Ends at EOF, when this process exits
+            async for line in reader:
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                block[key] = value
+                if key == 'progress':
+                    self._record_progress(parse_progress(block))
+                    block = {}
+        finally:
+            transport.close()
+
+    def _record_progress(self, progress):
+        self.progress = progress
+        for gauge, field in ((metrics.ENCODE_FPS, 'fps'), (metrics.ENCODE_SPEED, 'speed'),
+                             (metrics.ENCODE_BITRATE, 'bitrate_kbps'), (metrics.ENCODE_FRAMES, 'frame'),
+                             (metrics.ENCODE_DROPPED_FRAMES, 'dropped_frames')):
+            if field in progress:
+                gauge.set(progress[field], stream_id=self.stream_id)
+
+    def supervise(self):
+        """Start health checks; called once the stream has come up."""
+        self.state = 'running'
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def check(self):
+        """Return why the process needs a restart, or None if it is healthy."""
+        if self.process.returncode is not None:
+            return f'FFmpeg exited with code {self.process.returncode}'
+        last_output = self.output_time() if self.output_time else None
+        # A freshly (re)started process gets a full stall timeout to produce output
+        idle = time.time() - max(last_output or 0, self.spawned_at)
+        if idle > settings.HLS_STALL_TIMEOUT:
+            return f'No output for {idle:.0f}s'
+        return None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(settings.HLS_SUPERVISOR_INTERVAL)
+            async with self._lock:
+                problem = self.check()
+                if problem is not None:
+                    self.last_error = problem
+                    await self._terminate()
+            if problem is None:
+                if self.consecutive_failures and time.time() - self.spawned_at > settings.HLS_RESTART_RESET_AFTER:
+                    self.consecutive_failures = 0
+                continue
+
+            if self.consecutive_failures >= settings.HLS_RESTART_MAX_ATTEMPTS:
+                print(f"Stream {self.stream_id}: {problem}; giving up after {self.consecutive_failures} restarts")
+                self.state = 'failed'
+                if self.on_failed:
+                    self.on_failed(problem)
+                return
+
+            delay = min(settings.HLS_RESTART_BACKOFF * 2 ** self.consecutive_failures,
+                        settings.HLS_RESTART_BACKOFF_MAX)
+            print(f"Stream {self.stream_id}: {problem}; restarting in {delay:.1f}s")
+            self.state = 'restarting'
+            self.consecutive_failures += 1
+            await asyncio.sleep(delay)
+            try:
+                await self.spawn()
+            except Exception as e:
+                # The old, exited process stays in place, so the next check retries
+                self.last_error = f'Failed to restart FFmpeg: {e}'
+                continue
+            self.restarts += 1
+            self.last_restart_at = time.time()
+            self.state = 'running'
+
+    async def replace(self, cmd):
+        """
+        Run `cmd` from now on. A running process is stopped and `cmd` launched
+        straight away, which does not count as a restart; otherwise the next
+        (re)start picks it up.
+        """
+        self.cmd = cmd
+        if self.state != 'running':
+            return
+        async with self._lock:
+            await self._terminate()
+            try:
+                await self.spawn()
+            except Exception as e:
+                # The exited process stays in place, so the next check restarts it
+                self.last_error = f'Failed to restart FFmpeg: {e}'
+
+    async def _terminate(self):
+        process = self.process
+        if process is not None and process.returncode is None:
+            process.terminate()
+            try:
+                # Wait up to 5 seconds for process to terminate
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        if process is not None:
+            self.last_exit_code = process.returncode
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._terminate()
+        if self._progress_task is not None:
+            self._progress_task.cancel()
+            self._progress_task = None
+        self.state = 'stopped'
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'cost': self.cost,
+            'pid': self.process.pid if self.process else None,
+            'uptime': round(time.time() - self.spawned_at, 1) if self.spawned_at and self.state == 'running' else 0,
+            'started_at': self.started_at,
+            'restarts': self.restarts,
+            'last_restart_at': self.last_restart_at,
+            'last_exit_code': self.last_exit_code,
+            'last_error': self.last_error,
+            'progress': self.progress,
+        }
+
+
+class ProcessSupervisor:
+    """
+    Node-wide registry of supervised FFmpeg processes with admission
+    control: streams are admitted while their transcode cost fits in
+    `capacity` (default: HLS_TRANSCODES_PER_CPU per core, or
+    HLS_MAX_TRANSCODES). Beyond that, admit() either rejects or puts the
+    stream in a FIFO queue that is served as slots are released.
+    """
+    def __init__(self, capacity=None):
+        self._capacity = capacity
+        self.processes = {}
+        self.used = 0
+        self._admitted = {}
+        self._queue = deque()
+
+    @property
+    def capacity(self):
+        return self._capacity if self._capacity is not None else default_capacity()
+
+    def admit(self, stream_id, cost, queue=False):
+        """
+        Reserve `cost` slots for a stream. Returns True if admitted now,
+        False if queued (await wait_admitted); raises CapacityError if the
+        stream cannot be admitted or queued.
+        """
+        # Passthrough costs nothing, so it never waits behind transcodes
+        if cost == 0 or not self._queue and self.used + cost <= self.capacity:
+            self._admitted[stream_id] = cost
+            self.used += cost
+            return True
+        if cost > self.capacity:
+            raise CapacityError(f'Stream needs {cost} transcode slots; this node has {self.capacity}')
+        if not queue:
+            raise CapacityError('This node is at transcode capacity')
+        if len(self._queue) >= settings.HLS_ADMISSION_QUEUE_MAX:
+            raise CapacityError('The admission queue is full')
+        self._queue.append((stream_id, cost, asyncio.get_running_loop().create_future()))
+        return False
+
+    async def wait_admitted(self, stream_id, timeout=None):
+        future = next((f for s, _, f in self._queue if s == stream_id), None)
+        if future is None:
+            return
+        timeout = timeout if timeout is not None else settings.HLS_ADMISSION_QUEUE_TIMEOUT
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.release(stream_id)
+            raise CapacityError('Timed out waiting for transcode capacity')
+
+    def queued(self):
+        return [stream_id for stream_id, _, _ in self._queue]
+
+    def release(self, stream_id):
+        for item in self._queue:
+            if item[0] == stream_id:
+                self._queue.remove(item)
+                item[2].cancel()
+                break
+        self.used -= self._admitted.pop(stream_id, 0)
+        while self._queue and self.used + self._queue[0][1] <= self.capacity:
+            stream_id, cost, future = self._queue.popleft()
+            self._admitted[stream_id] = cost
+            self.used += cost
+            future.set_result(True)
+
+    def add(self, supervised):
+        self.processes[supervised.stream_id] = supervised
+
+    def get(self, stream_id):
+        return self.processes.get(stream_id)
+
+    async def stop(self, stream_id):
+        supervised = self.processes.pop(stream_id, None)
+        if supervised is not None:
+            await supervised.stop()
+        self.release(stream_id)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'used': self.used,
+            'queued': self.queued(),
+            'streams': {stream_id: p.stats() for stream_id, p in self.processes.items()},
+        }
+
+
+_supervisor = None
+
+
+def get_supervisor():
+    # Only touched from the event loop, so no lock is needed
+    global _supervisor
+    if _supervisor is None:
+        _supervisor = ProcessSupervisor()
+    return _supervisor
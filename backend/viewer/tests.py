@@ -1,7 +1,56 @@
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, Client, AsyncClient, RequestFactory, override_settings
 from django.urls import reverse
 import os
+import shutil
+import tempfile
+import sys
+import json
+import asyncio
+import threading
+import struct
+import time
+import http.server
+from io import StringIO
+from datetime import timedelta
+from asgiref.sync import async_to_sync, sync_to_async
+from django.utils import timezone
 from django.conf import settings
+from django.http import Http404
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from .uploader import PushedOutput, SegmentUploader, parse_playlist_uris, parse_segment_tags
+from .upload_pool import UploadScheduler, UploadJob, get_upload_scheduler
+from . import broadcast
+from . import envelope
+from .rtsp import build_rtsp_url, camera_key
+from .jpeg_parser import JPEGFrameParser
+from .delivery import FrameOutbox
+from .consumers import StreamConsumer
+from channels.testing import WebsocketCommunicator
+from unittest import mock
+from . import hls_stream
+from .benchmarks import fake_ffmpeg_binary, filesystem_storages
+from .benchmarks.fake_s3 import FakeS3Client
+from .benchmarks.looped_source import rewrite as rewrite_source
+from .benchmarks.timestamp_source import read_timestamp, timestamp_frame
+from .cleanup import CleanupWorker, sweep
+from . import probe as probe_module
+from .ffmpeg_commands import (build_abr_command, build_hls_command, build_llhls_command, build_mosaic_command,
+                              build_tile_feed_command, choose_mode, normalize_ladder)
+from .fmp4 import BoxReader, FragmentReader, codec_string, parse_fragment, parse_init_segment
+from .llhls import LowLatencyHLSStore, ingest
+from .segment_cache import SegmentCache, get_segment_cache
+from . import segment_store
+from .supervisor import CapacityError, ProcessSupervisor, SupervisedProcess, parse_progress, stream_cost
+from .activity import ViewerActivity, get_activity
+from .apps import _serving
+from .models import Camera, CameraProbe, RecordedSegment, StreamNode
+from . import mosaic as mosaic_module
+from .mosaic import normalize_layout, normalize_size, tile_rects
+from .motion import MotionDetector, changed_fraction
+from . import recording
+from .snapshots import SnapshotCache
+from . import metrics, registry
 
 class HlsStreamTests(TestCase):
     def setUp(self):
@@ -36,4 +85,2265 @@ class HlsStreamTests(TestCase):
         data = response.json()
         stream_id = data.get('stream_id')
         hls_dir = os.path.join(settings.HLS_MEDIA_ROOT, stream_id)
-        self.assertTrue(os.path.exists(hls_dir)) 
\ No newline at end of file
+        self.assertTrue(os.path.exists(hls_dir))
+
+
+class CountingStorage:
+    """In-memory storage stand-in that counts every write it receives."""
+    def __init__(self):
+        self.files = {}
+        self.saves = []
+        self.deletes = []
+
+    def save(self, name, content):
+        self.files[name] = content.read()
+        self.saves.append(name)
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+        self.deletes.append(name)
+
+    def exists(self, name):
+        return name in self.files
+
+
+class FakeHlsOutput:
+    """Writes segments and playlists the way FFmpeg's hls muxer does."""
+    def __init__(self, directory, list_size=10, delete_threshold=1):
+        self.directory = directory
+        self.list_size = list_size
+        self.delete_threshold = delete_threshold
+        self.sequence = 0
+
+    def write_segment(self, size=500_000):
+        name = f'stream{self.sequence}.ts'
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(os.urandom(size))
+        self.sequence += 1
+        first = max(0, self.sequence - self.list_size)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for i in range(first, self.sequence):
+            lines += ['#EXTINF:2.000000,', f'stream{i}.ts']
+        with open(os.path.join(self.directory, 'stream.m3u8'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        stale = first - self.delete_threshold - 1
+        if stale >= 0:
+            os.remove(os.path.join(self.directory, f'stream{stale}.ts'))
+
+
+class SegmentUploaderTests(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.storage = CountingStorage()
+        self.uploader = SegmentUploader(self.temp_dir, 'hls_media/test', storage=self.storage)
+        self.output = FakeHlsOutput(self.temp_dir)
+
+    def run_stream_minute(self, polls_per_segment=4):
+        # 30 segments of 2 s each, polled every 0.5 s like monitor_and_upload
+        for _ in range(30):
+            self.output.write_segment()
+            for _ in range(polls_per_segment):
+                self.uploader.poll()
+
+    def test_parse_playlist_uris(self):
+        text = '#EXTM3U\n#EXTINF:2.0,\nstream0.ts\n\n#EXTINF:2.0,\nstream1.ts\n'
+        self.assertEqual(parse_playlist_uris(text), ['stream0.ts', 'stream1.ts'])
+
+    def test_parse_playlist_uris_includes_init_segment(self):
+        text = '#EXTM3U\n#EXT-X-MAP:URI="init.mp4"\n#EXTINF:2.0,\nstream0.m4s\n'
+        self.assertEqual(parse_playlist_uris(text), ['init.mp4', 'stream0.m4s'])
+
+    def test_storage_writes_per_stream_minute(self):
+        self.run_stream_minute()
+        segment_saves = [n for n in self.storage.saves if n.endswith('.ts')]
+        playlist_saves = [n for n in self.storage.saves if n.endswith('.m3u8')]
+        # Each segment and each playlist revision is written exactly once
+        self.assertEqual(len(segment_saves), 30)
+        self.assertEqual(len(set(segment_saves)), 30)
+        self.assertEqual(len(playlist_saves), 30)
+        # Segments FFmpeg rotated off disk are removed remotely
+        self.assertEqual(len(self.storage.deletes), 30 - 10 - 1)
+        remote_segments = [n for n in self.storage.files if n.endswith('.ts')]
+        self.assertEqual(len(remote_segments), 11)
+
+    def test_playlist_written_after_its_segments(self):
+        missing = []
+        save = self.storage.save
+
+        def checked_save(name, content):
+            if name.endswith('.m3u8'):
+                data = content.read().decode()
+                content.seek(0)
+                for uri in parse_playlist_uris(data):
+                    if f'hls_media/test/{uri}' not in self.storage.files:
+                        missing.append(uri)
+            return save(name, content)
+
+        self.storage.save = checked_save
+        self.run_stream_minute(polls_per_segment=1)
+        self.assertEqual(missing, [])
+
+    def test_rewritten_segment_is_uploaded_again(self):
+        self.output.write_segment()
+        self.uploader.poll()
+        path = os.path.join(self.temp_dir, 'stream0.ts')
+        with open(path, 'wb') as f:
+            f.write(b'replaced')
+        os.utime(path, ns=(0, 0))
+        with open(os.path.join(self.temp_dir, 'stream.m3u8'), 'a') as f:
+            f.write('#EXT-X-ENDLIST\n')
+        self.uploader.poll()
+        self.assertEqual(self.storage.saves.count('hls_media/test/stream0.ts'), 2)
+        self.assertEqual(self.storage.files['hls_media/test/stream0.ts'], b'replaced')
+
+    def test_playlist_held_back_until_dropped_segment_is_stored(self):
+        dropped = []
+
+        def submit(kind, name, run, size=0, on_drop=None):
+            # The queue drops the first upload of stream0.ts
+            if name.endswith('stream0.ts') and not dropped:
+                dropped.append(name)
+                on_drop()
+            else:
+                run()
+
+        uploader = SegmentUploader(self.temp_dir, 'hls_media/test', storage=self.storage, submit=submit)
+        self.output.write_segment(size=10)
+        uploader.poll()
+        self.assertEqual(self.storage.saves, [])
+        uploader.poll()
+        self.assertEqual(self.storage.saves, ['hls_media/test/stream0.ts', 'hls_media/test/stream.m3u8'])
+
+
+class UploadSchedulerTests(SimpleTestCase):
+    def test_round_robin_across_streams(self):
+        scheduler = UploadScheduler(workers=1, max_queue=10, poll_interval=1)
+        order = []
+        done = threading.Event()
+        for i in range(3):
+            for stream_id in ('a', 'b'):
+                name = f'{stream_id}{i}'
+                scheduler.submit(stream_id, UploadJob('segment', name, lambda name=name: order.append(name)))
+        scheduler.submit('b', UploadJob('delete', 'done', done.set))
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(order, ['a0', 'b0', 'a1', 'b1', 'a2', 'b2'])
+        self.assertEqual(scheduler.stats()['a']['uploaded'], 3)
+
+    def test_backpressure_drops_oldest_segments_and_coalesces_playlists(self):
+        scheduler = UploadScheduler(workers=1, max_queue=3, poll_interval=1)
+        dropped = []
+        for i in range(5):
+            scheduler.submit('a', UploadJob('segment', f's{i}', lambda: None,
+                                            on_drop=lambda i=i: dropped.append(i)))
+            scheduler.submit('a', UploadJob('playlist', 'stream.m3u8', lambda: None))
+        stats = scheduler.stats()['a']
+        self.assertEqual(dropped, [0, 1])
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['superseded'], 4)
+        self.assertEqual(stats['queue_depth'], 4)
+
+    def test_uploader_jobs_keep_playlist_after_segments(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        scheduler = UploadScheduler(workers=1, max_queue=10, poll_interval=1)
+        storage = CountingStorage()
+        uploader = SegmentUploader(temp_dir, 'hls_media/a', storage=storage,
+                                   submit=scheduler.submitter('a'))
+        output = FakeHlsOutput(temp_dir)
+        for _ in range(3):
+            output.write_segment(size=10)
+            uploader.poll()
+        self.assertEqual(scheduler.stats()['a']['queue_depth'], 4)
+        done = threading.Event()
+        scheduler.submit('a', UploadJob('delete', 'done', done.set))
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(storage.saves, [
+            'hls_media/a/stream0.ts', 'hls_media/a/stream1.ts',
+            'hls_media/a/stream2.ts', 'hls_media/a/stream.m3u8',
+        ])
+
+
+# Emits one tiny JPEG-shaped frame every 10 ms, standing in for FFmpeg
+FAKE_MJPEG_SOURCE = (
+    'import sys, time\n'
+    'while True:\n'
+    '    sys.stdout.buffer.write(b"\\xff\\xd8" + b"x" * 100 + b"\\xff\\xd9")\n'
+    '    sys.stdout.buffer.flush()\n'
+    '    time.sleep(0.01)\n'
+)
+
+
+class FakeCameraBroadcaster(broadcast.MJPEGBroadcaster):
+    def build_command(self):
+        return [sys.executable, '-c', FAKE_MJPEG_SOURCE]
+
+
+class FakeViewer:
+    def __init__(self):
+        self.frames = []
+        self.events = []
+        self.got_frame = asyncio.Event()
+
+    def push_frame(self, jpeg, sequence=None, captured_at=None):
+        self.frames.append(jpeg)
+        self.got_frame.set()
+
+    def push_event(self, payload):
+        self.events.append(payload)
+
+
+class BroadcastTests(SimpleTestCase):
+    def test_camera_key_normalizes_url(self):
+        self.assertEqual(
+            camera_key(build_rtsp_url('RTSP://Cam.local:554/live/', 'admin', 'pw')),
+            camera_key(build_rtsp_url('rtsp://admin:pw@cam.local/live')),
+        )
+        self.assertNotEqual(
+            camera_key(build_rtsp_url('rtsp://cam.local/live', 'admin', 'pw')),
+            camera_key(build_rtsp_url('rtsp://cam.local/live', 'other', 'pw')),
+        )
+
+    async def test_viewers_share_one_process(self):
+        url = 'rtsp://cam.local/live'
+        first, second = FakeViewer(), FakeViewer()
+        a = broadcast.subscribe(url, first, broadcaster_class=FakeCameraBroadcaster)
+        b = broadcast.subscribe(url, second, broadcaster_class=FakeCameraBroadcaster)
+        self.assertIs(a, b)
+        await asyncio.wait_for(first.got_frame.wait(), 5)
+        await asyncio.wait_for(second.got_frame.wait(), 5)
+        process = a.process
+
+        await broadcast.unsubscribe(a, first)
+        self.assertIsNone(process.returncode)
+        await broadcast.unsubscribe(a, second)
+        self.assertIsNotNone(process.returncode)
+        self.assertNotIn(a.key, broadcast.active_broadcasters)
+        self.assertEqual(first.events[0], {'message': 'Streaming started'})
+
+
+class JPEGFrameParserTests(SimpleTestCase):
+    def make_frame(self, size):
+        return b'\xff\xd8' + bytes([i % 255 for i in range(size)]) + b'\xff\xd9'
+
+    def test_frames_split_at_every_chunk_boundary(self):
+        frames = [self.make_frame(50), self.make_frame(70), self.make_frame(10)]
+        stream = b'garbage' + frames[0] + frames[1] + b'\x00\xff' + frames[2]
+        for step in (1, 2, 3, 7, len(stream)):
+            parser = JPEGFrameParser()
+            out = []
+            for offset in range(0, len(stream), step):
+                out += parser.feed(stream[offset:offset + step])
+            self.assertEqual(out, frames, f'chunk size {step}')
+            self.assertLessEqual(parser.buffered(), 1)
+
+    def test_partial_frame_is_kept_until_complete(self):
+        parser = JPEGFrameParser()
+        frame = self.make_frame(100)
+        self.assertEqual(parser.feed(frame[:60]), [])
+        self.assertEqual(parser.feed(frame[60:]), [frame])
+        self.assertEqual(parser.buffered(), 0)
+
+    def test_chunk_size_follows_frame_size(self):
+        parser = JPEGFrameParser(min_chunk=4096, max_chunk=1 << 20)
+        frame = self.make_frame(200_000)
+        parser.feed(frame * 3)
+        self.assertEqual(parser.chunk_size, 262144)
+
+
+class FrameOutboxTests(SimpleTestCase):
+    async def test_slow_client_gets_latest_frame(self):
+        release = asyncio.Event()
+        sent = []
+
+        async def slow_send(kind, payload):
+            await release.wait()
+            sent.append(payload)
+
+        outbox = FrameOutbox(slow_send, mode='latest')
+        outbox.start()
+        outbox.put_frame(b'first')
+        await asyncio.sleep(0)  # the sender picks up 'first' and blocks
+        for i in range(10):
+            outbox.put_frame(f'frame{i}'.encode())
+        outbox.put_event({'message': 'kept'})
+        release.set()
+        await asyncio.sleep(0.05)
+        await outbox.stop()
+        self.assertEqual(sent, [b'first', b'frame9', {'message': 'kept'}])
+        self.assertEqual(outbox.stats()['frames_dropped'], 9)
+        self.assertEqual(outbox.stats()['frames_sent'], 2)
+
+    def test_unknown_delivery_mode(self):
+        with self.assertRaises(ValueError):
+            FrameOutbox(None, mode='bogus')
+
+
+class StreamConsumerTests(SimpleTestCase):
+    async def test_frames_reach_client_and_disconnect_stops_camera(self):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        with mock.patch.object(broadcast.MJPEGBroadcaster, 'build_command',
+                               FakeCameraBroadcaster.build_command):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            await communicator.send_json_to({'url': 'rtsp://cam.local/consumer-test'})
+            self.assertEqual(await communicator.receive_json_from(5), {'message': 'Streaming started'})
+            frame = await communicator.receive_from(5)
+            self.assertTrue(frame.startswith(b'\xff\xd8'))
+            key = camera_key('rtsp://cam.local/consumer-test')
+            process = broadcast.active_broadcasters[key].process
+            await communicator.disconnect()
+        self.assertNotIn(key, broadcast.active_broadcasters)
+        self.assertIsNotNone(process.returncode)
+
+
+class AsyncStartTests(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def test_status_unknown_stream(self):
+        response = Client().get(reverse('hls_stream_status', args=['nonexistent']))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_start_returns_immediately_and_becomes_ready(self):
+        settings_override = override_settings(
+            FFMPEG_BINARY=fake_ffmpeg_binary(self.work_dir),
+            STORAGES=filesystem_storages(os.path.join(self.work_dir, 'media')),
+        )
+        with settings_override, mock.patch.dict(os.environ, {
+            'FAKE_FFMPEG_STARTUP': '0.5', 'FAKE_FFMPEG_SEGMENT_BYTES': '1000'
+        }):
+            client = AsyncClient()
+            response = await client.post(reverse('start_hls_stream'), {'url': 'rtsp://cam.local/a'},
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(data['state'], 'starting')
+            stream_id = data['stream_id']
+            try:
+                for _ in range(100):
+                    status = (await client.get(data['status_url'])).json()
+                    if status['state'] != 'starting':
+                        break
+                    await asyncio.sleep(0.1)
+                self.assertEqual(status['state'], 'ready')
+                playlist = os.path.join(self.work_dir, 'media', settings.HLS_MEDIA_ROOT, stream_id, 'stream.m3u8')
+                self.assertTrue(os.path.exists(playlist))
+            finally:
+                await hls_stream._stop_process(stream_id)
+
+
+class PassthroughModeTests(TestCase):
+    H264 = {'video_codec': 'h264', 'profile': 'Main', 'width': 1920, 'height': 1080, 'fps': 25.0,
+            'audio_codec': 'aac'}
+    HEVC = {'video_codec': 'hevc', 'audio_codec': None}
+    MJPEG = {'video_codec': 'mjpeg', 'audio_codec': None}
+
+    def test_choose_mode(self):
+        self.assertEqual(choose_mode('auto', self.H264), 'copy')
+        self.assertEqual(choose_mode('auto', self.HEVC), 'copy')
+        self.assertEqual(choose_mode('auto', self.MJPEG), 'transcode')
+        self.assertEqual(choose_mode('copy', None), 'transcode')
+        self.assertEqual(choose_mode('transcode', self.H264), 'transcode')
+
+    def test_copy_command(self):
+        cmd = build_hls_command('rtsp://cam/a', '/tmp/out', 'copy', self.H264)
+        self.assertIn('copy', cmd[cmd.index('-c:v') + 1])
+        self.assertEqual(cmd[cmd.index('-c:a') + 1], 'copy')
+        self.assertNotIn('libx264', cmd)
+        self.assertEqual(cmd[cmd.index('-hls_segment_type') + 1], 'mpegts')
+
+    def test_hevc_copy_uses_fmp4(self):
+        cmd = build_hls_command('rtsp://cam/a', '/tmp/out', 'copy', self.HEVC)
+        self.assertEqual(cmd[cmd.index('-hls_segment_type') + 1], 'fmp4')
+        self.assertEqual(cmd[cmd.index('-tag:v') + 1], 'hvc1')
+        self.assertIn('-an', cmd)
+
+    def test_transcode_command(self):
+        cmd = build_hls_command('rtsp://cam/a', '/tmp/out', 'transcode', self.MJPEG)
+        self.assertEqual(cmd[cmd.index('-c:v') + 1], 'libx264')
+        self.assertEqual(cmd[-1], '/tmp/out/stream.m3u8')
+
+    def test_parse_probe_output(self):
+        output = json.dumps({'streams': [
+            {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080,
+             'avg_frame_rate': '25/1', 'profile': 'Main'},
+            {'codec_type': 'audio', 'codec_name': 'pcm_alaw'},
+        ]})
+        self.assertEqual(probe_module.parse_probe_output(output), {
+            'video_codec': 'h264', 'profile': 'Main', 'width': 1920, 'height': 1080,
+            'fps': 25.0, 'audio_codec': 'pcm_alaw',
+        })
+
+    async def test_probe_is_cached_per_camera(self):
+        calls = []
+
+        async def fake_ffprobe(url, transport='tcp'):
+            calls.append(url)
+            await asyncio.sleep(0.01)
+            return dict(self.H264)
+
+        probe_module.probe_cache.clear()
+        with mock.patch.object(probe_module, '_run_ffprobe', fake_ffprobe):
+            results = await asyncio.gather(
+                probe_module.probe_stream('rtsp://user:pw@cam.local/live'),
+                probe_module.probe_stream('rtsp://user:pw@cam.local:554/live'),
+            )
+            await probe_module.probe_stream('rtsp://user:pw@cam.local/live')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual((await CameraProbe.objects.aget()).result(), results[0])
+
+    async def test_cancelled_caller_leaves_the_shared_probe_running(self):
+        started = asyncio.Event()
+
+        async def fake_ffprobe(url, transport='tcp'):
+            started.set()
+            await asyncio.sleep(0.05)
+            return dict(self.H264)
+
+        probe_module.probe_cache.clear()
+        with mock.patch.object(probe_module, '_run_ffprobe', fake_ffprobe):
+            first = asyncio.ensure_future(probe_module.probe_stream('rtsp://cam.local/live'))
+            await started.wait()
+            second = asyncio.ensure_future(probe_module.probe_stream('rtsp://cam.local/live'))
+            await asyncio.sleep(0)
+            first.cancel()
+            self.assertEqual((await second)['video_codec'], 'h264')
+        self.assertTrue(first.cancelled())
+        self.assertEqual(probe_module._pending_probes, {})
+        self.assertIn(camera_key('rtsp://cam.local/live'), probe_module.probe_cache)
+
+
+class AbrLadderTests(SimpleTestCase):
+    LADDER = [
+        {'name': '360p', 'height': 360, 'video_bitrate': 800},
+        {'name': '1080p', 'height': 1080, 'video_bitrate': 5000},
+        {'name': '720p', 'height': 720, 'video_bitrate': 2800},
+    ]
+
+    def test_ladder_sorted_and_capped_at_source_height(self):
+        ladder = normalize_ladder(self.LADDER, {'height': 720})
+        self.assertEqual([r['name'] for r in ladder], ['720p', '360p'])
+
+    def test_invalid_ladders(self):
+        for ladder in ([], [{'name': '../x', 'height': 720, 'video_bitrate': 1}],
+                       [{'name': 'a', 'height': 721, 'video_bitrate': 1}],
+                       [{'name': 'a', 'height': 720}],
+                       [{'name': 'a', 'height': 720, 'video_bitrate': 1}] * 2):
+            with self.assertRaises(ValueError):
+                normalize_ladder(ladder)
+
+    def test_single_decode_multiple_encodes(self):
+        ladder = normalize_ladder(self.LADDER)
+        cmd = build_abr_command('rtsp://cam/a', '/tmp/out', ladder, {'audio_codec': 'aac'})
+        self.assertEqual(cmd.count('-i'), 1)
+        self.assertTrue(cmd[cmd.index('-filter_complex') + 1].startswith('[0:v]split=3'))
+        self.assertEqual(cmd[cmd.index('-b:v:1') + 1], '2800k')
+        self.assertEqual(cmd[cmd.index('-var_stream_map') + 1],
+                         'v:0,a:0,name:1080p v:1,a:1,name:720p v:2,a:2,name:360p')
+        self.assertEqual(cmd[-1], '/tmp/out/%v/stream.m3u8')
+
+    def test_uploader_follows_master_into_variants(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        outputs = []
+        for name in ('720p', '360p'):
+            os.makedirs(os.path.join(temp_dir, name))
+            outputs.append(FakeHlsOutput(os.path.join(temp_dir, name)))
+        storage = CountingStorage()
+        uploader = SegmentUploader(temp_dir, 'hls_media/abr', 'master.m3u8', storage=storage)
+        with open(os.path.join(temp_dir, 'master.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=3000000\n720p/stream.m3u8\n'
+                    '#EXT-X-STREAM-INF:BANDWIDTH=900000\n360p/stream.m3u8\n')
+        outputs[0].write_segment(size=10)
+        # The 360p variant has no playlist yet, so the master must wait
+        uploader.poll()
+        self.assertIn('hls_media/abr/720p/stream.m3u8', storage.files)
+        self.assertNotIn('hls_media/abr/master.m3u8', storage.files)
+        outputs[1].write_segment(size=10)
+        self.assertTrue(uploader.poll())
+        self.assertEqual(storage.saves[-1], 'hls_media/abr/master.m3u8')
+        for name in ('720p/stream0.ts', '720p/stream.m3u8', '360p/stream0.ts', '360p/stream.m3u8'):
+            self.assertIn(f'hls_media/abr/{name}', storage.files)
+        self.assertEqual(uploader.playlists_published, 1)
+        for _ in range(15):
+            for output in outputs:
+                output.write_segment(size=10)
+            uploader.poll()
+        self.assertEqual(uploader.playlists_published, 1)
+        remote_segments = [n for n in storage.files if n.endswith('.ts')]
+        self.assertEqual(len(remote_segments), 2 * 11)
+
+
+def mp4_box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def mp4_full_box(box_type, version, flags, payload):
+    return mp4_box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def fake_init_segment(timescale=90000, frame_duration=3000):
+    """ftyp + moov for a single video track whose samples default to non-sync"""
+    tkhd = mp4_full_box(b'tkhd', 0, 3, struct.pack('>III', 0, 0, 1) + bytes(68))
+    mdhd = mp4_full_box(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, 0) + bytes(4))
+    hdlr = mp4_full_box(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide') + bytes(13))
+    trak = mp4_box(b'trak', tkhd + mp4_box(b'mdia', mdhd + hdlr))
+    trex = mp4_full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, frame_duration, 0, 0x00010000))
+    moov = mp4_box(b'moov', mp4_full_box(b'mvhd', 0, 0, bytes(96)) + trak + mp4_box(b'mvex', trex))
+    return mp4_box(b'ftyp', b'isom\0\0\2\0isomiso6') + moov
+
+
+def fake_fragment(sequence, samples=6, keyframe=False, frame_duration=3000):
+    """Return (moof, moof + mdat) for `samples` frames, like FFmpeg's -frag_duration output"""
+    tfhd = mp4_full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+    tfdt = mp4_full_box(b'tfdt', 1, 0, struct.pack('>Q', sequence * samples * frame_duration))
+    first_flags = 0x02000000 if keyframe else 0x01010000
+    trun = mp4_full_box(b'trun', 0, 0x000205,
+                        struct.pack('>IiI', samples, 0, first_flags) + struct.pack('>I', 100) * samples)
+    moof = mp4_box(b'moof', mp4_full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)) +
+                   mp4_box(b'traf', tfhd + tfdt + trun))
+    return moof, moof + mp4_box(b'mdat', bytes(100 * samples))
+
+
+class FakeLowLatencyOutput:
+    """Feeds a LowLatencyHLSStore 200 ms fragments with a keyframe every second"""
+    def __init__(self, store, keyframe_every=5):
+        self.store = store
+        self.keyframe_every = keyframe_every
+        self.sequence = 0
+        store.set_init_segment(fake_init_segment())
+
+    def add(self, count=1):
+        for _ in range(count):
+            moof, data = fake_fragment(self.sequence, keyframe=self.sequence % self.keyframe_every == 0)
+            self.store.add_fragment(data, moof)
+            self.sequence += 1
+
+
+class LowLatencyHLSTests(SimpleTestCase):
+    def make_store(self, window=3):
+        return LowLatencyHLSStore(part_target=0.2, segment_target=2.0, window=window)
+
+    def test_box_reader_reassembles_split_boxes(self):
+        data = fake_init_segment() + fake_fragment(0, keyframe=True)[1]
+        reader = BoxReader()
+        boxes = []
+        for i in range(0, len(data), 7):
+            boxes += reader.feed(data[i:i + 7])
+        self.assertEqual([box_type for box_type, _ in boxes], [b'ftyp', b'moov', b'moof', b'mdat'])
+        self.assertEqual(b''.join(box for _, box in boxes), data)
+
+    def test_parse_fragment(self):
+        tracks = parse_init_segment(fake_init_segment())
+        self.assertEqual(tracks[1]['handler'], 'vide')
+        self.assertEqual(tracks[1]['timescale'], 90000)
+        info = parse_fragment(fake_fragment(5, keyframe=True)[0], tracks)
+        self.assertAlmostEqual(info['duration'], 0.2)
+        self.assertAlmostEqual(info['base_time'], 1.0)
+        self.assertEqual(info['samples'], 6)
+        self.assertTrue(info['independent'])
+        self.assertFalse(parse_fragment(fake_fragment(6)[0], tracks)['independent'])
+
+    def test_parts_and_segments(self):
+        store = self.make_store()
+        output = FakeLowLatencyOutput(store)
+        output.add(30)
+        playlist = store.playlist()
+        self.assertIn('#EXT-X-PART-INF:PART-TARGET=0.200', playlist)
+        self.assertIn('#EXT-X-TARGETDURATION:2', playlist)
+        self.assertIn('#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=0.600', playlist)
+        self.assertIn('#EXT-X-MAP:URI="init.mp4"', playlist)
+        self.assertIn('#EXT-X-PART:DURATION=0.200,URI="seg0.part0.m4s",INDEPENDENT=YES', playlist)
+        self.assertIn('#EXT-X-PART:DURATION=0.200,URI="seg0.part1.m4s"\n', playlist)
+        self.assertIn('#EXTINF:2.000,\nseg1.m4s', playlist)
+        # The third segment is still open until the next keyframe
+        self.assertNotIn('seg2.m4s', playlist)
+        self.assertTrue(playlist.endswith('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="seg2.part10.m4s"\n'))
+        self.assertEqual(store.get('seg0.m4s'), b''.join(p.data for p in store.segment(0).parts))
+        self.assertIsNone(store.get('seg2.m4s'))
+        self.assertIsNotNone(store.get('seg2.part9.m4s'))
+
+        output.add(100)
+        # Three full segments plus the open one
+        self.assertEqual([s.msn for s in store.segments], [9, 10, 11, 12])
+        self.assertIn('#EXT-X-MEDIA-SEQUENCE:9', store.playlist())
+        self.assertIsNone(store.get('seg0.m4s'))
+
+    def test_segments_start_on_a_keyframe(self):
+        store = self.make_store()
+        output = FakeLowLatencyOutput(store)
+        output.sequence = 3
+        output.add(2)
+        self.assertEqual(len(store.segments), 0)
+        self.assertEqual(store.fragments_dropped, 2)
+        output.add(1)
+        self.assertTrue(store.segment(0).parts[0].independent)
+
+    async def test_blocking_playlist_reload(self):
+        store = self.make_store()
+        output = FakeLowLatencyOutput(store)
+        output.add(2)
+        client = AsyncClient()
+        url = reverse('hls_serve', args=['ll-test', 'stream.m3u8'])
+        with mock.patch.dict(hls_stream.llhls_stores, {'ll-test': store}):
+            response = await client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
+            self.assertNotIn('seg0.part3.m4s"', response.content.decode())
+
+            request = asyncio.ensure_future(client.get(url, {'_HLS_msn': 0, '_HLS_part': 3}))
+            await asyncio.sleep(0.1)
+            self.assertFalse(request.done())
+            output.add(2)
+            response = await asyncio.wait_for(request, 5)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('URI="seg0.part3.m4s"', response.content.decode())
+
+            response = await client.get(url, {'_HLS_msn': 9})
+            self.assertEqual(response.status_code, 400)
+            response = await client.get(url, {'_HLS_part': 1})
+            self.assertEqual(response.status_code, 400)
+
+    async def test_preload_hint_part_is_held_until_muxed(self):
+        store = self.make_store()
+        output = FakeLowLatencyOutput(store)
+        output.add(1)
+        client = AsyncClient()
+        with mock.patch.dict(hls_stream.llhls_stores, {'ll-test': store}):
+            request = asyncio.ensure_future(
+                client.get(reverse('hls_serve', args=['ll-test', 'seg0.part1.m4s']))
+            )
+            await asyncio.sleep(0.1)
+            self.assertFalse(request.done())
+            output.add(1)
+            response = await asyncio.wait_for(request, 5)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, store.get('seg0.part1.m4s'))
+            response = await client.get(reverse('hls_serve', args=['ll-test', 'init.mp4']))
+            self.assertEqual(response['Content-Type'], 'video/mp4')
+
+    async def test_ingest_reads_ffmpeg_output(self):
+        data = fake_init_segment() + b''.join(
+            fake_fragment(i, keyframe=i % 5 == 0)[1] for i in range(12)
+        )
+        stream = asyncio.StreamReader()
+        for i in range(0, len(data), 1000):
+            stream.feed_data(data[i:i + 1000])
+        stream.feed_eof()
+        store = self.make_store()
+        await ingest(store, stream)
+        self.assertEqual(store.init_segment, fake_init_segment())
+        self.assertEqual([len(s.parts) for s in store.segments], [10, 2])
+        # FFmpeg exiting may just mean a restart, so the playlist stays live
+        self.assertTrue(all(s.complete for s in store.segments))
+        self.assertFalse(store.closed)
+        store.close()
+        self.assertTrue(store.playlist().endswith('#EXT-X-ENDLIST\n'))
+
+    def test_restart_continues_playlist_with_discontinuity(self):
+        store = self.make_store()
+        output = FakeLowLatencyOutput(store)
+        output.add(7)
+        FakeLowLatencyOutput(store).add(3)
+        playlist = store.playlist()
+        self.assertEqual([s.msn for s in store.segments], [0, 1])
+        self.assertTrue(store.segments[0].complete)
+        self.assertIn('#EXT-X-DISCONTINUITY\n#EXT-X-MAP:URI="init1.mp4"', playlist)
+        self.assertEqual(store.get('init1.mp4'), fake_init_segment())
+
+    def test_init_names_survive_pruning(self):
+        store = self.make_store()
+        FakeLowLatencyOutput(store).add(45)
+        for restart in range(1, 4):
+            FakeLowLatencyOutput(store).add(45)
+            # The previous init has rotated out of the window
+            self.assertEqual(list(store.inits), [f'init{restart}.mp4'])
+            self.assertEqual({s.init_name for s in store.segments}, {f'init{restart}.mp4'})
+        FakeLowLatencyOutput(store).add(5)
+        self.assertEqual(list(store.inits), ['init3.mp4', 'init4.mp4'])
+        self.assertIn('#EXT-X-MAP:URI="init4.mp4"', store.playlist())
+
+    def test_llhls_command(self):
+        cmd = build_llhls_command('rtsp://cam/a', 'copy', {'video_codec': 'h264', 'audio_codec': None})
+        self.assertEqual(cmd[cmd.index('-c:v') + 1], 'copy')
+        self.assertIn('-an', cmd)
+        self.assertEqual(cmd[cmd.index('-frag_duration') + 1], '200000')
+        self.assertEqual(cmd[-1], 'pipe:1')
+
+    def test_timestamp_source_round_trip(self):
+        frame = timestamp_frame(640, 360, 1760000000.123, index=7)
+        self.assertEqual(len(frame), 640 * 360)
+        self.assertAlmostEqual(read_timestamp(frame, 640), 1760000000.123, places=3)
+
+
+class SegmentCacheTests(SimpleTestCase):
+    # hls_serve checks unknown stream ids against the registered cameras
+    databases = {'default'}
+
+    def test_lru_by_bytes(self):
+        cache = SegmentCache(max_bytes=100, playlist_ttl=5, segment_ttl=60)
+        cache.put('s/0.ts', b'a' * 40)
+        cache.put('s/1.ts', b'b' * 40)
+        self.assertIsNotNone(cache.get('s/0.ts'))  # now most recently used
+        cache.put('s/2.ts', b'c' * 40)
+        self.assertIsNone(cache.get('s/1.ts'))
+        self.assertIsNotNone(cache.get('s/0.ts'))
+        self.assertEqual(cache.size, 80)
+        # Too big to keep at all, but still usable by the caller
+        entry = cache.put('s/big.ts', b'd' * 500)
+        self.assertEqual(entry.data, b'd' * 500)
+        self.assertIsNone(cache.get('s/big.ts'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 2, 1))
+
+    def test_playlists_expire_quickly(self):
+        cache = SegmentCache(max_bytes=1000, playlist_ttl=0, segment_ttl=60)
+        cache.put('s/stream.m3u8', b'#EXTM3U')
+        cache.put('s/0.ts', b'x')
+        self.assertIsNone(cache.get('s/stream.m3u8'))
+        self.assertIsNotNone(cache.get('s/0.ts'))
+        self.assertEqual(cache.size, 1)
+
+    def test_uploader_fills_and_evicts(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        output = FakeHlsOutput(temp_dir, list_size=3)
+        cache = SegmentCache(max_bytes=1 << 20, playlist_ttl=5, segment_ttl=60)
+        uploader = SegmentUploader(temp_dir, 'hls_media/c', storage=CountingStorage(), cache=cache)
+        output.write_segment(size=10)
+        uploader.poll()
+        with open(os.path.join(temp_dir, 'stream0.ts'), 'rb') as f:
+            self.assertEqual(cache.get('hls_media/c/stream0.ts').data, f.read())
+        self.assertIn(b'stream0.ts', cache.get('hls_media/c/stream.m3u8').data)
+        for _ in range(6):
+            output.write_segment(size=10)
+            uploader.poll()
+        self.assertIsNone(cache.get('hls_media/c/stream0.ts'))
+        self.assertIsNotNone(cache.get('hls_media/c/stream6.ts'))
+
+    def test_serve_from_cache_with_etag(self):
+        cache = SegmentCache(max_bytes=1 << 20, playlist_ttl=5, segment_ttl=60)
+        cache.put('hls_media/cached/stream0.ts', b'segment')
+        cache.put('hls_media/cached/stream.m3u8', b'#EXTM3U\nstream0.ts\n')
+        client = Client()
+        with mock.patch.object(segment_store, 'get_segment_cache', return_value=cache), \
+                mock.patch.object(segment_store.default_storage, 'exists', side_effect=AssertionError):
+            response = client.get(reverse('hls_serve', args=['cached', 'stream0.ts']))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'segment')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            etag = response['ETag']
+            response = client.get(reverse('hls_serve', args=['cached', 'stream0.ts']),
+                                  HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = client.get(reverse('hls_serve', args=['cached', 'stream.m3u8']))
+            self.assertEqual(response['Cache-Control'], f'public, max-age={settings.HLS_PLAYLIST_MAX_AGE}')
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_miss_reads_through_storage(self):
+        cache = SegmentCache(max_bytes=1 << 20, playlist_ttl=5, segment_ttl=60)
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        os.makedirs(os.path.join(work_dir, 'hls_media', 'stored'))
+        with open(os.path.join(work_dir, 'hls_media', 'stored', 'stream1.ts'), 'wb') as f:
+            f.write(b'from storage')
+        store = segment_store.get_segment_store('s3')
+        with override_settings(STORAGES=filesystem_storages(work_dir)), \
+                mock.patch.object(segment_store, 'get_segment_cache', return_value=cache):
+            # A stopped stream's objects are served but not cached again
+            response = Client().get(reverse('hls_serve', args=['stored', 'stream1.ts']))
+            self.assertEqual(response.content, b'from storage')
+            self.assertIsNone(cache.get('hls_media/stored/stream1.ts'))
+            store.receive('stored', 'token', 'stream.m3u8')
+            try:
+                response = Client().get(reverse('hls_serve', args=['stored', 'stream1.ts']))
+                self.assertEqual(response.content, b'from storage')
+                self.assertEqual(response['Content-Type'], 'video/mp2t')
+                self.assertEqual(cache.get('hls_media/stored/stream1.ts').data, b'from storage')
+                response = Client().get(reverse('hls_serve', args=['stored', 'missing.ts']))
+                self.assertEqual(response.status_code, 404)
+            finally:
+                store.stop('stored')
+            cache.evict_prefix('hls_media/stored/')
+            Client().get(reverse('hls_serve', args=['stored', 'stream1.ts']))
+            self.assertIsNone(cache.get('hls_media/stored/stream1.ts'))
+
+    def test_s3_playlist_url_goes_through_the_cache(self):
+        store = segment_store.get_segment_store('s3')
+        self.assertEqual(store.playlist_url('s', 'stream.m3u8'), reverse('hls_serve', args=['s', 'stream.m3u8']))
+        with override_settings(HLS_CACHE_MAX_BYTES=0):
+            self.assertEqual(store.playlist_url('s', 'stream.m3u8'),
+                             f'{settings.MEDIA_URL}{settings.HLS_MEDIA_ROOT}/s/stream.m3u8')
+
+
+class LocalSegmentStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.local_root = os.path.join(self.work_dir, 'local')
+
+    def test_serves_files_from_disk(self):
+        store = segment_store.LocalSegmentStore(self.local_root)
+        output_dir = store.output_dir('disk', self.work_dir)
+        with open(os.path.join(output_dir, 'stream0.ts'), 'wb') as f:
+            f.write(b'on disk')
+        with override_settings(HLS_LOCAL_ROOT=self.local_root):
+            client = Client()
+            response = client.get(reverse('hls_serve', args=['disk', 'stream0.ts']))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(b''.join(response.streaming_content), b'on disk')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            response = client.get(reverse('hls_serve', args=['disk', 'stream0.ts']),
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            response = client.get(reverse('hls_serve', args=['disk', 'stream9.ts']))
+            self.assertEqual(response.status_code, 404)
+            with override_settings(HLS_LOCAL_ACCEL_REDIRECT='/hls-local/'):
+                response = client.get(reverse('hls_serve', args=['disk', 'stream0.ts']))
+                self.assertEqual(response['X-Accel-Redirect'], '/hls-local/disk/stream0.ts')
+                self.assertEqual(response.content, b'')
+
+    def test_files_outside_the_stream_are_not_served(self):
+        store = segment_store.LocalSegmentStore(self.local_root)
+        store.output_dir('disk', self.work_dir)
+        secret = os.path.join(self.local_root, 'secret.txt')
+        with open(secret, 'w') as f:
+            f.write('secret')
+        with override_settings(HLS_LOCAL_ROOT=self.local_root):
+            client = Client()
+            for path in (f'/media/hls_media/disk/{secret}', f'/media/hls_media/disk//{secret}',
+                         '/media/hls_media/disk/../secret.txt', '/media/hls_media/disk/sub/../../secret.txt'):
+                self.assertEqual(client.get(path).status_code, 404, path)
+        # The store refuses them too, whatever the view lets through
+        request = RequestFactory().get('/')
+        for filename in (secret, '../secret.txt', 'sub/../../secret.txt', '.'):
+            with self.assertRaises(Http404):
+                async_to_sync(store.serve)(request, 'disk', filename)
+
+    def test_unknown_store_rejected(self):
+        response = Client().post(reverse('start_hls_stream'), {'url': 'rtsp://cam.local/a', 'store': 'ftp'},
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_local_stream_has_no_upload_step(self):
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(self.work_dir), HLS_LOCAL_ROOT=self.local_root), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000'}):
+            client = AsyncClient()
+            response = await client.post(reverse('start_hls_stream'),
+                                         {'url': 'rtsp://cam.local/a', 'mode': 'transcode', 'store': 'local'},
+                                         content_type='application/json')
+            data = response.json()
+            self.assertEqual(data['store'], 'local')
+            stream_id = data['stream_id']
+            self.assertEqual(data['playlist_url'], reverse('hls_serve', args=[stream_id, 'stream.m3u8']))
+            for _ in range(100):
+                status = (await client.get(data['status_url'])).json()
+                if status['state'] != 'starting':
+                    break
+                await asyncio.sleep(0.1)
+            self.assertEqual(status['state'], 'ready')
+            self.assertNotIn(stream_id, get_upload_scheduler().stats())
+            response = await client.get(data['playlist_url'])
+            self.assertIn('stream0.ts', b''.join(response.streaming_content).decode())
+
+            response = await client.post(reverse('stop_hls_stream', args=[stream_id]))
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(os.path.exists(os.path.join(self.local_root, stream_id)))
+
+
+class SupervisorTests(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.log_path = os.path.join(self.work_dir, 'ffmpeg.log')
+
+    async def test_admission(self):
+        supervisor = ProcessSupervisor(capacity=2)
+        self.assertTrue(supervisor.admit('a', stream_cost('transcode')))
+        self.assertTrue(supervisor.admit('copy', stream_cost('copy')))
+        with self.assertRaises(CapacityError):
+            supervisor.admit('abr', stream_cost('transcode', [{}, {}, {}]))
+        self.assertTrue(supervisor.admit('b', 1))
+        with self.assertRaises(CapacityError):
+            supervisor.admit('c', 1)
+        self.assertFalse(supervisor.admit('c', 1, queue=True))
+        self.assertFalse(supervisor.admit('d', 2, queue=True))
+        self.assertEqual(supervisor.queued(), ['c', 'd'])
+        # Full, with transcodes waiting: passthrough is still free
+        self.assertTrue(supervisor.admit('copy2', stream_cost('copy')))
+        self.assertEqual((supervisor.used, supervisor.queued()), (2, ['c', 'd']))
+        waiter = asyncio.ensure_future(supervisor.wait_admitted('c', timeout=1))
+        supervisor.release('a')
+        await waiter
+        self.assertEqual(supervisor.used, 2)
+        self.assertEqual(supervisor.queued(), ['d'])
+        with self.assertRaises(CapacityError):
+            await supervisor.wait_admitted('d', timeout=0.05)
+        self.assertEqual(supervisor.queued(), [])
+
+    async def test_crashing_process_is_restarted_then_given_up(self):
+        failed = []
+        supervised = SupervisedProcess(
+            'crash', [sys.executable, '-c', 'import sys; sys.exit(3)'], self.log_path,
+            on_failed=failed.append
+        )
+        with override_settings(HLS_SUPERVISOR_INTERVAL=0.05, HLS_RESTART_BACKOFF=0.01,
+                               HLS_RESTART_MAX_ATTEMPTS=2):
+            await supervised.spawn()
+            supervised.supervise()
+            for _ in range(100):
+                if failed:
+                    break
+                await asyncio.sleep(0.05)
+        self.assertEqual(failed, ['FFmpeg exited with code 3'])
+        self.assertEqual(supervised.restarts, 2)
+        self.assertEqual(supervised.stats()['state'], 'failed')
+        self.assertEqual(supervised.stats()['last_exit_code'], 3)
+
+    async def test_stalled_process_is_restarted(self):
+        spawned = []
+        supervised = SupervisedProcess(
+            'stall', [sys.executable, '-c', 'import time; time.sleep(30)'], self.log_path,
+            output_time=lambda: None, on_spawn=spawned.append
+        )
+        with override_settings(HLS_SUPERVISOR_INTERVAL=0.05, HLS_RESTART_BACKOFF=0.01, HLS_STALL_TIMEOUT=0.2):
+            await supervised.spawn()
+            supervised.supervise()
+            try:
+                for _ in range(100):
+                    if supervised.restarts:
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(supervised.restarts, 1)
+                self.assertEqual(len(spawned), 2)
+                self.assertIsNotNone(spawned[0].returncode)
+                self.assertTrue(supervised.last_error.startswith('No output'))
+            finally:
+                await supervised.stop()
+        self.assertIsNotNone(supervised.process.returncode)
+
+    async def test_start_rejected_at_capacity(self):
+        with mock.patch.object(hls_stream, 'get_supervisor', return_value=ProcessSupervisor(capacity=0)):
+            response = await AsyncClient().post(reverse('start_hls_stream'),
+                                                {'url': 'rtsp://cam.local/a', 'mode': 'transcode'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    async def test_queued_start_and_listing(self):
+        supervisor = ProcessSupervisor(capacity=1)
+        supervisor.admit('busy', 1)
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(self.work_dir),
+                               HLS_LOCAL_ROOT=os.path.join(self.work_dir, 'local')), \
+                mock.patch.object(hls_stream, 'get_supervisor', return_value=supervisor), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000'}):
+            client = AsyncClient()
+            response = await client.post(reverse('start_hls_stream'),
+                                         {'url': 'rtsp://cam.local/a', 'mode': 'transcode', 'store': 'local',
+                                          'admission': 'queue'},
+                                         content_type='application/json')
+            data = response.json()
+            self.assertEqual(data['state'], 'queued')
+            stream_id = data['stream_id']
+            try:
+                listing = (await client.get(reverse('list_streams'))).json()
+                self.assertEqual(listing['queued'], [stream_id])
+                self.assertEqual(listing['used'], 1)
+                supervisor.release('busy')
+                for _ in range(100):
+                    status = (await client.get(data['status_url'])).json()
+                    if status['state'] not in ('queued', 'starting'):
+                        break
+                    await asyncio.sleep(0.1)
+                self.assertEqual(status['state'], 'ready')
+                self.assertEqual(status['process']['state'], 'running')
+                listing = (await client.get(reverse('list_streams'))).json()
+                stream = next(s for s in listing['streams'] if s['stream_id'] == stream_id)
+                self.assertEqual(stream['process']['restarts'], 0)
+                self.assertEqual(listing['used'], 1)
+            finally:
+                await client.post(reverse('stop_hls_stream', args=[stream_id]))
+            self.assertEqual(supervisor.used, 0)
+
+    def test_admission_policy_validated(self):
+        response = Client().post(reverse('start_hls_stream'), {'url': 'rtsp://cam.local/a', 'admission': 'maybe'},
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ViewerActivityTests(SimpleTestCase):
+    def test_hold_and_touch(self):
+        activity = ViewerActivity()
+        self.assertEqual(activity.idle_for('s'), 0)
+        with mock.patch('viewer.activity.time.monotonic', return_value=100):
+            activity.touch('s')
+        with mock.patch('viewer.activity.time.monotonic', return_value=130):
+            self.assertEqual(activity.idle_for('s'), 30)
+            activity.hold('s')
+            activity.hold('s')
+            activity.release('s')
+        with mock.patch('viewer.activity.time.monotonic', return_value=500):
+            self.assertEqual(activity.stats('s'), {'viewers': 1, 'idle_for': 0})
+            activity.release('s')
+        with mock.patch('viewer.activity.time.monotonic', return_value=510):
+            self.assertEqual(activity.idle_for('s'), 10)
+
+    async def test_websocket_watch_holds_stream(self):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'action': 'watch', 'stream_id': 'watched'})
+        self.assertEqual(await communicator.receive_json_from(), {'watching': ['watched']})
+        self.assertEqual(get_activity().stats('watched')['viewers'], 1)
+        await communicator.disconnect()
+        self.assertEqual(get_activity().stats('watched')['viewers'], 0)
+        get_activity().forget('watched')
+
+
+class IdleStreamTests(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.local_root = os.path.join(self.work_dir, 'local')
+        self.settings_override = override_settings(
+            FFMPEG_BINARY=fake_ffmpeg_binary(self.work_dir), HLS_LOCAL_ROOT=self.local_root,
+            HLS_IDLE_CHECK_INTERVAL=0.05,
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        patcher = mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def wait_for_state(self, client, stream_id, states=('queued', 'starting')):
+        for _ in range(100):
+            status = (await client.get(reverse('hls_stream_status', args=[stream_id]))).json()
+            if status['state'] not in states:
+                return status
+            await asyncio.sleep(0.05)
+        return status
+
+    async def test_unwatched_stream_is_stopped(self):
+        client = AsyncClient()
+        response = await client.post(reverse('start_hls_stream'),
+                                     {'url': 'rtsp://cam.local/a', 'mode': 'transcode', 'store': 'local',
+                                      'idle_timeout': 0.5},
+                                     content_type='application/json')
+        data = response.json()
+        stream_id = data['stream_id']
+        try:
+            self.assertEqual((await self.wait_for_state(client, stream_id))['state'], 'ready')
+            # A player re-fetching the playlist keeps it running
+            for _ in range(10):
+                self.assertEqual((await client.get(data['playlist_url'])).status_code, 200)
+                await asyncio.sleep(0.1)
+            self.assertEqual(hls_stream.stream_states[stream_id]['state'], 'ready')
+            status = await self.wait_for_state(client, stream_id, states=('ready',))
+            self.assertEqual(status['state'], 'stopped')
+            self.assertEqual(status['stopped_reason'], 'idle')
+            self.assertFalse(os.path.exists(os.path.join(self.local_root, stream_id)))
+        finally:
+            await hls_stream._stop_process(stream_id)
+
+    async def test_invalid_idle_timeout(self):
+        response = await AsyncClient().post(reverse('start_hls_stream'),
+                                            {'url': 'rtsp://cam.local/a', 'idle_timeout': 'soon'},
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_registered_camera_starts_on_first_playlist_request(self):
+        client = AsyncClient()
+        response = await client.post(reverse('cameras'),
+                                     {'name': 'lobby', 'url': 'rtsp://cam.local/lobby', 'mode': 'transcode',
+                                      'store': 'local', 'idle_timeout': 1},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        camera = response.json()
+        self.assertEqual(camera['state'], 'idle')
+        self.assertEqual(camera['playlist_url'], reverse('hls_serve', args=['lobby', 'stream.m3u8']))
+        try:
+            with mock.patch.object(hls_stream, '_start_stream', wraps=hls_stream._start_stream) as start:
+                first, second = await asyncio.gather(client.get(camera['playlist_url']),
+                                                     client.get(camera['playlist_url']))
+            self.assertEqual(start.call_count, 1)
+            for response in (first, second):
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('stream0.ts', b''.join(response.streaming_content).decode())
+            listing = (await client.get(reverse('cameras'))).json()
+            self.assertEqual(listing['cameras'][0]['state'], 'ready')
+        finally:
+            response = await client.delete(reverse('camera_detail', args=['lobby']))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('lobby', hls_stream.stream_states)
+        self.assertEqual(hls_stream.stream_state('lobby')['state'], 'stopped')
+        self.assertFalse(await Camera.objects.filter(name='lobby').aexists())
+
+    @override_settings(HLS_STREAM_HISTORY=2)
+    async def test_stopped_streams_are_not_kept_forever(self):
+        self.addCleanup(hls_stream.stream_history.clear)
+        for stream_id in ('a', 'b', 'c'):
+            hls_stream.stream_states[stream_id] = {'state': 'failed', 'error': 'gone'}
+            await hls_stream.stop_stream(stream_id)
+            self.assertNotIn(stream_id, hls_stream.stream_states)
+        self.assertEqual(list(hls_stream.stream_history), ['b', 'c'])
+        self.assertIsNone(hls_stream.stream_state('a'))
+        response = await AsyncClient().get(reverse('hls_stream_status', args=['c']))
+        self.assertEqual(response.json()['state'], 'stopped')
+
+    async def test_unregistered_stream_is_not_started(self):
+        response = await AsyncClient().get(reverse('hls_serve', args=['nobody', 'stream.m3u8']))
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('nobody', hls_stream.stream_states)
+
+    def test_invalid_camera_rejected(self):
+        client = Client()
+        response = client.post(reverse('cameras'), {'name': 'bad name', 'url': 'rtsp://cam.local/a'},
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = client.post(reverse('cameras'), {'name': 'cam', 'url': 'rtsp://'},
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = client.post(reverse('cameras'), {'name': 'cam', 'url': 'rtsp://cam.local/a', 'mode': 'fast'},
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        # Registered cameras are held to the same rules as start_hls
+        for options in ({'motion': True, 'abr': True}, {'record': True, 'store': 'local'}, {'store': 'ftp'}):
+            body = {'name': 'cam', 'url': 'rtsp://cam.local/a', **options}
+            response = client.post(reverse('cameras'), body, content_type='application/json')
+            start = client.post(reverse('start_hls_stream'), body, content_type='application/json')
+            self.assertEqual((response.status_code, response.json()), (start.status_code, start.json()))
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Camera.objects.exists())
+
+
+class FakeNodeHandler(http.server.BaseHTTPRequestHandler):
+    """Stands in for another backend node; records what it was sent"""
+    received = []
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        type(self).received.append((self.command, self.path, self.headers, body))
+        payload = json.dumps({'node': 'other', 'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamRegistryTests(TestCase):
+    def setUp(self):
+        self.registry = registry.DatabaseRegistry()
+        registry._owners.clear()
+        self.addCleanup(registry._owners.clear)
+
+    def test_heartbeats_ownership_and_placement(self):
+        self.registry.heartbeat('a', 'http://a', capacity=4, used=3, streams={'s1': 2, 's2': 0})
+        self.registry.heartbeat('b', 'http://b', capacity=4, used=1, streams={'s3': 5})
+        self.assertEqual(self.registry.owner('s1')['node_id'], 'a')
+        nodes = {node['node_id']: node for node in self.registry.nodes()}
+        self.assertEqual((nodes['a']['streams'], nodes['a']['viewers']), (2, 2))
+        self.assertEqual(registry.place_stream(1)['node_id'], 'b')
+        self.assertIsNone(registry.place_stream(4))
+
+        self.registry.claim('s4', 'b', cost=2)
+        self.assertEqual(self.registry.owner('s4')['used'], 3)
+        # With equal free slots, the node running fewer streams wins
+        self.assertEqual(registry.place_stream(1)['node_id'], 'a')
+        self.registry.release('s4', 'b', cost=2)
+        self.assertIsNone(self.registry.owner('s4'))
+        self.assertEqual(registry.place_stream(1)['node_id'], 'b')
+
+        # The next heartbeat replaces a node's stream list
+        self.registry.heartbeat('a', 'http://a', capacity=4, used=1, streams={'s2': 1})
+        self.assertIsNone(self.registry.owner('s1'))
+        StreamNode.objects.filter(node_id='b').update(last_heartbeat=timezone.now() - timedelta(minutes=5))
+        self.assertIsNone(self.registry.owner('s3'))
+        self.assertEqual([node['node_id'] for node in self.registry.nodes()], ['a'])
+
+    def test_viewers_counted_per_player(self):
+        activity = ViewerActivity()
+        activity.touch('s', '10.0.0.1 Safari')
+        activity.touch('s', '10.0.0.1 Safari')
+        activity.touch('s', '10.0.0.2 Chrome')
+        activity.hold('s')
+        self.assertEqual(activity.viewers('s'), 3)
+        with override_settings(HLS_VIEWER_WINDOW=0):
+            self.assertEqual(activity.viewers('s'), 1)
+
+    async def test_requests_forwarded_to_owning_node(self):
+        FakeNodeHandler.received = []
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeNodeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        other_url = f'http://127.0.0.1:{server.server_port}'
+
+        with override_settings(HLS_NODE_ID='here', HLS_NODE_URL='http://127.0.0.1:1', HLS_CLUSTER_SECRET='s3cret'):
+            await sync_to_async(self.registry.heartbeat)('here', 'http://127.0.0.1:1', capacity=1, used=1, streams={})
+            await sync_to_async(self.registry.heartbeat)('other', other_url, capacity=8, used=0,
+                                                         streams={'remote': 0})
+            client = AsyncClient()
+            response = await client.get(reverse('hls_stream_status', args=['remote']))
+            self.assertEqual(response['X-HLS-Node'], 'other')
+            self.assertEqual(response.json()['path'], '/hls_status/remote/')
+            response = await client.get(reverse('hls_serve', args=['remote', 'stream.m3u8']) + '?_HLS_msn=3')
+            self.assertEqual(response.json()['path'], '/media/hls_media/remote/stream.m3u8?_HLS_msn=3')
+            response = await client.post(reverse('stop_hls_stream', args=['remote']))
+            self.assertEqual(response.status_code, 200)
+            # New streams go to the node with free capacity
+            response = await client.post(reverse('start_hls_stream'), {'url': 'rtsp://cam.local/a'},
+                                         content_type='application/json')
+            self.assertEqual(response['X-HLS-Node'], 'other')
+            # Forwarded requests are handled where they land
+            path = reverse('hls_stream_status', args=['remote'])
+            response = await client.get(path, headers={registry.FORWARDED_HEADER: registry.forwarded_by('GET', path)})
+            self.assertEqual(response.status_code, 404)
+            # A header without a valid, fresh signature for this request is still routed to the owner
+            for spoofed in ('other', 'other:' + '0' * 64, 'other:1:' + '0' * 64,
+                            registry.forwarded_by('GET', path, 'other', now=time.time() - 60),
+                            registry.forwarded_by('POST', path, 'other'),
+                            registry.forwarded_by('GET', reverse('hls_stream_status', args=['x']), 'other')):
+                response = await client.get(path, headers={registry.FORWARDED_HEADER: spoofed})
+                self.assertEqual(response['X-HLS-Node'], 'other')
+            headers = FakeNodeHandler.received[3][2]
+            self.assertTrue(registry.verify_forwarded(headers[registry.FORWARDED_HEADER], 'POST', '/start_hls/'))
+            self.assertFalse(registry.verify_forwarded(headers[registry.FORWARDED_HEADER], 'POST', '/stop_hls/a/'))
+
+        methods = [(method, path) for method, path, _, _ in FakeNodeHandler.received]
+        self.assertEqual(methods, [
+            ('GET', '/hls_status/remote/'),
+            ('GET', '/media/hls_media/remote/stream.m3u8?_HLS_msn=3'),
+            ('POST', '/stop_hls/remote/'),
+            ('POST', '/start_hls/'),
+        ] + [('GET', '/hls_status/remote/')] * 6)
+        self.assertEqual(json.loads(FakeNodeHandler.received[3][3]), {'url': 'rtsp://cam.local/a'})
+
+    def test_cluster_needs_an_explicit_secret(self):
+        with override_settings(HLS_NODE_URL='http://127.0.0.1:1', HLS_CLUSTER_SECRET=None):
+            with self.assertRaises(ImproperlyConfigured):
+                registry.check_configuration()
+            self.assertFalse(registry.verify_forwarded('other:1:' + '0' * 64, 'GET', '/'))
+        with override_settings(HLS_NODE_URL='http://127.0.0.1:1', HLS_CLUSTER_SECRET='s3cret'):
+            registry.check_configuration()
+
+
+class CleanupTests(SimpleTestCase):
+    def make_objects(self, client, prefix, count, age=0):
+        modified = timezone.now() - timedelta(seconds=age)
+        for i in range(count):
+            client.put_object(Bucket='bucket', Key=f'{prefix}stream{i:05}.ts', LastModified=modified)
+
+    def test_fake_s3_pagination(self):
+        client = FakeS3Client()
+        self.make_objects(client, 'hls_media/a/', 3)
+        self.make_objects(client, 'hls_media/b/', 2)
+        page = client.list_objects_v2(Bucket='bucket', Prefix='hls_media/a/', MaxKeys=2)
+        self.assertTrue(page['IsTruncated'])
+        page = client.list_objects_v2(Bucket='bucket', Prefix='hls_media/a/', MaxKeys=2,
+                                      ContinuationToken=page['NextContinuationToken'])
+        self.assertEqual([obj['Key'] for obj in page['Contents']], ['hls_media/a/stream00002.ts'])
+        page = client.list_objects_v2(Bucket='bucket', Prefix='hls_media/', Delimiter='/', MaxKeys=1)
+        self.assertEqual(page['CommonPrefixes'], [{'Prefix': 'hls_media/a/'}])
+        page = client.list_objects_v2(Bucket='bucket', Prefix='hls_media/', Delimiter='/', MaxKeys=1,
+                                      ContinuationToken=page['NextContinuationToken'])
+        self.assertEqual(page['CommonPrefixes'], [{'Prefix': 'hls_media/b/'}])
+        self.assertFalse(page['IsTruncated'])
+
+    def test_deletes_in_batches_and_spares_newer_objects(self):
+        client = FakeS3Client()
+        self.make_objects(client, 'hls_media/s/', 2500, age=60)
+        client.put_object(Bucket='bucket', Key='hls_media/s/restarted.ts')
+        client.put_object(Bucket='bucket', Key='hls_media/other/stream0.ts')
+        worker = CleanupWorker(client, 'bucket', workers=4)
+        worker.schedule('hls_media/s/', before=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(worker.wait_idle(10))
+        self.assertEqual(sorted(client.objects), ['hls_media/other/stream0.ts', 'hls_media/s/restarted.ts'])
+        self.assertEqual(client.calls['delete_objects'], 3)
+        self.assertEqual(worker.stats(), {'pending': 0, 'prefixes_cleaned': 1, 'deleted_objects': 2500,
+                                          'failed_objects': 0, 'last_error': None})
+
+    def test_failed_prefix_is_retried(self):
+        client = FakeS3Client()
+        self.make_objects(client, 'hls_media/s/', 10)
+        delete_objects = client.delete_objects
+        attempts = []
+
+        def flaky_delete(**kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionError('S3 unavailable')
+            return delete_objects(**kwargs)
+
+        client.delete_objects = flaky_delete
+        worker = CleanupWorker(client, 'bucket', workers=1)
+        with override_settings(HLS_CLEANUP_RETRY_DELAY=0.01):
+            worker.schedule('hls_media/s/')
+            self.assertTrue(worker.wait_idle(10))
+        self.assertEqual(client.objects, {})
+        self.assertEqual(worker.stats()['prefixes_cleaned'], 1)
+        self.assertEqual(len(attempts), 2)
+
+    def test_sweep_finds_orphans(self):
+        client = FakeS3Client()
+        self.make_objects(client, 'hls_media/orphan/', 5, age=3600)
+        self.make_objects(client, 'hls_media/live/', 5, age=3600)
+        self.make_objects(client, 'hls_media/recent/', 5, age=3600)
+        client.put_object(Bucket='bucket', Key='hls_media/recent/stream.m3u8')
+        worker = CleanupWorker(client, 'bucket')
+        with override_settings(HLS_CLEANUP_ORPHAN_AGE=600):
+            self.assertEqual(sweep(lambda stream_id: stream_id == 'live', worker, dry_run=True), ['orphan'])
+            self.assertEqual(len(client.objects), 16)
+            self.assertEqual(sweep(lambda stream_id: stream_id == 'live', worker), ['orphan'])
+        self.assertTrue(worker.wait_idle(10))
+        self.assertFalse(any(key.startswith('hls_media/orphan/') for key in client.objects))
+        self.assertEqual(len(client.objects), 11)
+
+    async def test_stop_returns_before_cleanup(self):
+        client = FakeS3Client(delay=0.2)
+        self.make_objects(client, 'hls_media/slow/', 2500, age=60)
+        worker = CleanupWorker(client, 'bucket', workers=4)
+        with mock.patch.object(segment_store, 'get_cleanup_worker', return_value=worker):
+            started = time.monotonic()
+            response = await AsyncClient().post(reverse('stop_hls_stream', args=['slow']))
+            self.assertLess(time.monotonic() - started, 0.2)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await sync_to_async(worker.wait_idle)(10))
+        self.assertEqual(client.objects, {})
+
+
+class MetricsTests(TestCase):
+    def make_metric(self, cls, *args, **kwargs):
+        metric = cls(*args, **kwargs)
+        self.addCleanup(metrics._metrics.remove, metric)
+        return metric
+
+    def test_render(self):
+        counter = self.make_metric(metrics.Counter, 'test_requests_total', 'Requests', ['path'])
+        histogram = self.make_metric(metrics.Histogram, 'test_seconds', 'Latency', buckets=(0.1, 1))
+        counter.inc(path='/a')
+        counter.inc(2, path='say "hi"')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        text = metrics.render()
+        self.assertIn('# TYPE test_requests_total counter\ntest_requests_total{path="/a"} 1\n', text)
+        self.assertIn('test_requests_total{path="say \\"hi\\""} 2', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1\ntest_seconds_bucket{le="1"} 2\n'
+                      'test_seconds_bucket{le="+Inf"} 3\ntest_seconds_sum 5.55\ntest_seconds_count 3', text)
+        counter.remove(path='/a')
+        self.assertIsNone(counter.value(path='/a'))
+
+    def test_counters_are_thread_safe(self):
+        counter = self.make_metric(metrics.Counter, 'test_threads_total', 'Increments')
+
+        def work():
+            for _ in range(10000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(), 40000)
+
+    def test_parse_progress(self):
+        self.assertEqual(
+            parse_progress({'frame': '250', 'fps': '24.97', 'bitrate': '1024.3kbits/s', 'total_size': 'N/A',
+                            'drop_frames': '2', 'speed': '0.998x', 'progress': 'continue'}),
+            {'frame': 250, 'fps': 24.97, 'bitrate_kbps': 1024.3, 'dropped_frames': 2, 'speed': 0.998}
+        )
+        self.assertEqual(parse_progress({'bitrate': 'N/A', 'speed': 'N/A'}), {})
+
+    async def test_websocket_frames_are_counted_per_camera(self):
+        async def send(kind, payload):
+            pass
+
+        before = metrics.WS_FRAMES_SENT.value(camera='cam.local/metrics') or 0
+        outbox = FrameOutbox(send, label='cam.local/metrics')
+        outbox.start()
+        outbox.put_frame(b'jpeg')
+        await asyncio.sleep(0.05)
+        await outbox.stop()
+        self.assertEqual(metrics.WS_FRAMES_SENT.value(camera='cam.local/metrics'), before + 1)
+
+    async def test_stream_metrics(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        client = AsyncClient()
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir),
+                               HLS_LOCAL_ROOT=os.path.join(work_dir, 'local')), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}):
+            data = (await client.post(reverse('start_hls_stream'),
+                                      {'url': 'rtsp://cam.local/metrics', 'mode': 'transcode', 'store': 'local'},
+                                      content_type='application/json')).json()
+            stream_id = data['stream_id']
+            try:
+                for _ in range(100):
+                    if (metrics.ENCODE_FPS.value(stream_id=stream_id) is not None
+                            and hls_stream.stream_states[stream_id]['state'] == 'ready'):
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual((await client.get(data['playlist_url'])).status_code, 200)
+                response = await client.get(reverse('metrics'))
+                self.assertEqual(response.status_code, 200)
+                text = response.content.decode()
+                self.assertIn(f'hls_encode_fps{{stream_id="{stream_id}"}} 25.0', text)
+                self.assertIn(f'hls_encode_speed{{stream_id="{stream_id}"}} 1.0', text)
+                self.assertIn(f'hls_serve_requests_total{{stream_id="{stream_id}",kind="playlist"}} 1', text)
+                self.assertIn('hls_serve_seconds_count{store="local",kind="playlist"}', text)
+                self.assertIn('hls_ffmpeg_processes ', text)
+                self.assertIn('hls_streams{state="ready"} ', text)
+                self.assertIn('process_cpu_seconds_total', text)
+                self.assertEqual(hls_stream.stream_states[stream_id]['state'], 'ready')
+                self.assertEqual(hls_stream.get_supervisor().get(stream_id).stats()['progress']['fps'], 25.0)
+            finally:
+                await hls_stream.stop_stream(stream_id)
+            self.assertNotIn(f'stream_id="{stream_id}"', (await client.get(reverse('metrics'))).content.decode())
+
+
+class EndToEndBenchmarkTests(SimpleTestCase):
+    databases = {'default'}
+
+    def test_looped_source_replaces_the_camera(self):
+        cmd = build_hls_command('rtsp://cam.local/a', '/tmp/out')[1:]
+        args = rewrite_source(cmd, '/tmp/clip.mp4')
+        self.assertNotIn('-rtsp_transport', args)
+        self.assertNotIn('rtsp://cam.local/a', args)
+        i = args.index('-i')
+        self.assertEqual(args[i - 3:i + 2], ['-re', '-stream_loop', '-1', '-i', '/tmp/clip.mp4'])
+        self.assertEqual(args[-1], cmd[-1])
+
+    def test_report(self):
+        output = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output), ignore_errors=True)
+        with mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}):
+            call_command('bench_e2e', steps='1,2', seconds=1.5, output=output, stderr=StringIO())
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual([result['streams'] for result in report['results']], [1, 2])
+        for result in report['results']:
+            self.assertEqual(result['ready'], result['streams'])
+            self.assertGreater(result['websocket_fps']['p50'], 0)
+            self.assertGreater(result['upload_bytes_per_stream_per_second'], 0)
+
+
+def avc_init_segment():
+    """An init segment whose only track is H.264 Constrained Baseline level 3.0"""
+    avcc = mp4_box(b'avcC', bytes([1, 0x42, 0xE0, 0x1E, 0xFF, 0xE0, 0]))
+    avc1 = mp4_box(b'avc1', bytes(78) + avcc)
+    stsd = mp4_full_box(b'stsd', 0, 0, struct.pack('>I', 1) + avc1)
+    stbl = mp4_box(b'stbl', stsd)
+    trak = mp4_box(b'trak', mp4_box(b'mdia', mp4_box(b'minf', stbl)))
+    return mp4_box(b'ftyp', b'isom\0\0\2\0') + mp4_box(b'moov', trak)
+
+
+class MSEStreamTests(SimpleTestCase):
+    def test_fragment_reader_splits_on_box_boundaries(self):
+        init = fake_init_segment()
+        fragments = [mp4_box(b'styp', b'msdh') + fake_fragment(0, keyframe=True)[1], fake_fragment(1)[1]]
+        data = init + b''.join(fragments)
+        reader = FragmentReader()
+        groups = []
+        for i in range(0, len(data), 7):
+            groups += reader.feed(data[i:i + 7])
+        self.assertEqual(groups, [('init', init), ('fragment', fragments[0]), ('fragment', fragments[1])])
+        tracks = parse_init_segment(init)
+        self.assertTrue(parse_fragment(groups[1][1], tracks)['independent'])
+
+    def test_codec_string(self):
+        self.assertEqual(codec_string(avc_init_segment()), 'avc1.42E01E')
+        self.assertIsNone(codec_string(fake_init_segment()))
+
+    async def test_slow_client_resumes_at_keyframe(self):
+        release = asyncio.Event()
+        sent = []
+
+        async def slow_send(kind, payload):
+            await release.wait()
+            sent.append((kind, payload))
+
+        outbox = FrameOutbox(slow_send)
+        outbox.start()
+        outbox.put_init(b'init')
+        outbox.put_media(b'late', keyframe=False)
+        with override_settings(WS_MSE_MAX_BACKLOG=3):
+            outbox.put_media(b'k0', keyframe=True)
+            for i in range(5):
+                outbox.put_media(f'p{i}'.encode(), keyframe=False)
+            outbox.put_media(b'k1', keyframe=True)
+            outbox.put_media(b'p5', keyframe=False)
+        release.set()
+        await asyncio.sleep(0.05)
+        await outbox.stop()
+        # 'late' preceded any keyframe, the backlog (and p2) went at p2, and
+        # p3 and p4 were skipped while waiting for k1
+        self.assertEqual(sent, [('init', b'init'), ('media', b'k1'), ('media', b'p5')])
+        self.assertEqual(outbox.stats()['frames_dropped'], 7)
+
+    async def test_late_joiner_gets_init_and_latest_keyframe(self):
+        init = fake_init_segment()
+        fragments = [fake_fragment(i, keyframe=i % 5 == 0)[1] for i in range(12)]
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        source = os.path.join(work_dir, 'camera.mp4')
+        with open(source, 'wb') as f:
+            f.write(init + b''.join(fragments))
+        script = (f'import sys, time\nsys.stdout.buffer.write(open({source!r}, "rb").read())\n'
+                  'sys.stdout.buffer.flush()\ntime.sleep(30)\n')
+        url = 'rtsp://cam.local/mse-test'
+        first = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        late = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        with mock.patch.object(broadcast.FMP4Broadcaster, 'build_command', lambda self: [sys.executable, '-c', script]), \
+                mock.patch.object(broadcast.FMP4Broadcaster, 'prepare', mock.AsyncMock()):
+            await first.connect()
+            await first.receive_json_from()
+            await first.send_json_to({'url': url, 'format': 'fmp4', 'delivery': 'queue'})
+            self.assertEqual(await first.receive_json_from(5), {'message': 'Streaming started'})
+            self.assertEqual(await first.receive_json_from(5),
+                             {'mse': {'mime': f'video/mp4; codecs="{broadcast.DEFAULT_MSE_CODEC}"'}})
+            self.assertEqual(await first.receive_from(5), init)
+            self.assertEqual(await first.receive_from(5), fragments[0])
+            broadcaster = broadcast.active_broadcasters[f"fmp4:{camera_key(url)}"]
+            for _ in range(100):
+                if broadcaster.frame_count == len(fragments):
+                    break
+                await asyncio.sleep(0.01)
+
+            await late.connect()
+            await late.receive_json_from()
+            await late.send_json_to({'url': url, 'format': 'fmp4'})
+            self.assertEqual(await late.receive_json_from(5), {'mse': {'mime': broadcaster.mime}})
+            self.assertEqual(await late.receive_from(5), init)
+            self.assertEqual(await late.receive_from(5), fragments[10])
+            self.assertEqual(await late.receive_from(5), fragments[11])
+            self.assertEqual(await late.receive_json_from(5), {'message': 'Streaming started'})
+            process = broadcaster.process
+            await first.disconnect()
+            await late.disconnect()
+        self.assertNotIn(broadcaster.key, broadcast.active_broadcasters)
+        self.assertIsNotNone(process.returncode)
+
+    async def test_unknown_format(self):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/')
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'url': 'rtsp://cam.local/a', 'format': 'h265-raw'})
+        self.assertIn('Unknown format', (await communicator.receive_json_from())['error'])
+        await communicator.disconnect()
+
+
+class FramedStreamTests(SimpleTestCase):
+    def test_pack_and_unpack(self):
+        message = (envelope.pack(envelope.JPEG, 3, b'jpeg', 7, 1700000000.25) + b'jpeg'
+                   + envelope.pack(envelope.EVENT, 0, b'{}') + b'{}')
+        self.assertEqual(envelope.HEADER.size, 19)
+        self.assertEqual(list(envelope.unpack(message)), [
+            (envelope.JPEG, 3, 7, 1700000000.25, b'jpeg'),
+            (envelope.EVENT, 0, 0, None, b'{}'),
+        ])
+        with self.assertRaises(ValueError):
+            list(envelope.unpack(message[:-1]))
+
+    async def test_writer_coalesces_small_envelopes(self):
+        sent = []
+
+        async def send(data):
+            sent.append(data)
+
+        writer = envelope.EnvelopeWriter(send, max_bytes=100, max_delay=0.05)
+        for i in range(3):
+            await writer.write(envelope.JPEG, 1, b'x' * 10, i + 1)
+        self.assertEqual(sent, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual([e[2] for e in envelope.unpack(sent[0])], [1, 2, 3])
+        # Filling the batch sends it at once
+        await writer.write(envelope.JPEG, 1, b'x' * 10, 4)
+        await writer.write(envelope.JPEG, 2, b'y' * 100, 1)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual([e[1:3] for e in envelope.unpack(sent[1])], [(1, 4), (2, 1)])
+        self.assertEqual(writer.stats()['envelopes_sent'], 5)
+        writer.close()
+
+    async def receive_envelopes(self, communicator, count, timeout=5):
+        envelopes = []
+        while len(envelopes) < count:
+            envelopes += envelope.unpack(await communicator.receive_from(timeout))
+        return envelopes
+
+    def event(self, item):
+        self.assertEqual(item[0], envelope.EVENT)
+        return json.loads(item[4])
+
+    async def test_several_cameras_on_one_socket(self):
+        communicator = WebsocketCommunicator(StreamConsumer.as_asgi(), '/ws/stream/',
+                                             subprotocols=[envelope.SUBPROTOCOL])
+        urls = ['rtsp://cam.local/framed-a', 'rtsp://cam.local/framed-b']
+        with mock.patch.object(broadcast.MJPEGBroadcaster, 'build_command',
+                               FakeCameraBroadcaster.build_command):
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, envelope.SUBPROTOCOL)
+            (hello,) = await self.receive_envelopes(communicator, 1)
+            self.assertEqual(self.event(hello), {'message': 'WebSocket connection established.'})
+            await communicator.send_json_to({'action': 'configure', 'batch_bytes': 4096, 'batch_delay': 10})
+            self.assertEqual(self.event((await self.receive_envelopes(communicator, 1))[0]),
+                             {'configured': {'batch_bytes': 4096, 'batch_delay': settings.WS_BATCH_MAX_DELAY}})
+            started = time.time()
+            for url in urls:
+                await communicator.send_json_to({'action': 'subscribe', 'url': url})
+
+            channels = {}
+            frames = {}
+            while len(frames) < 2 or min(len(f) for f in frames.values()) < 5:
+                for item in await self.receive_envelopes(communicator, 1):
+                    frame_type, channel, sequence, captured_at, payload = item
+                    if frame_type == envelope.EVENT:
+                        event = self.event(item)
+                        if 'subscribed' in event:
+                            channels[event['subscribed']['channel']] = event['subscribed']['camera']
+                        continue
+                    self.assertIn(channel, channels)
+                    self.assertTrue(payload.startswith(b'\xff\xd8'))
+                    self.assertGreaterEqual(captured_at, started)
+                    frames.setdefault(channel, []).append(sequence)
+            self.assertEqual(sorted(channels.values()), ['cam.local/framed-a', 'cam.local/framed-b'])
+            for sequences in frames.values():
+                self.assertEqual(sequences, sorted(sequences))
+            self.assertGreater(await self.stats(communicator), 1)
+
+            await communicator.send_json_to({'action': 'unsubscribe', 'channel': 1})
+            keys = [camera_key(url) for url in urls]
+            for _ in range(100):
+                if keys[0] not in broadcast.active_broadcasters:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertNotIn(keys[0], broadcast.active_broadcasters)
+            process = broadcast.active_broadcasters[keys[1]].process
+            await communicator.disconnect()
+        self.assertNotIn(keys[1], broadcast.active_broadcasters)
+        self.assertIsNotNone(process.returncode)
+
+    async def stats(self, communicator):
+        # Envelopes per message, once batching has coalesced some of them
+        await communicator.send_json_to({'action': 'stats'})
+        while True:
+            for item in await self.receive_envelopes(communicator, 1):
+                if item[0] == envelope.EVENT and 'stats' in self.event(item):
+                    connection = self.event(item)['stats']['connection']
+                    return connection['envelopes_sent'] / connection['messages_sent']
+
+
+@override_settings(HLS_MOTION_PIXEL_THRESHOLD=25, HLS_MOTION_AREA=0.1, HLS_MOTION_HOLD=2, HLS_MOTION_IDLE_AFTER=10)
+class MotionGatingTests(SimpleTestCase):
+    def test_changed_fraction(self):
+        previous = bytes([100] * 8)
+        frame = bytes([100, 100, 110, 130, 100, 0, 100, 100])
+        self.assertEqual(changed_fraction(previous, frame, 25), 0.25)
+
+    def test_events_and_idle(self):
+        changes = []
+        detector = MotionDetector('motion-unit', on_idle=changes.append)
+        still, moved = bytes(100), bytes([255] * 50 + [0] * 50)
+        detector.feed(still, now=0)
+        detector.feed(moved, now=1)
+        detector.feed(moved, now=2)
+        self.assertTrue(detector.stats()['moving'])
+        detector.feed(moved, now=2.5)
+        self.assertEqual(detector.events_since(), [{'start': 1, 'end': None, 'peak_score': 0.5}])
+        detector.feed(moved, now=3)
+        self.assertEqual(detector.events_since()[0]['end'], 1)
+        self.assertEqual(detector.events_since(since=1), [])
+        self.assertEqual(changes, [])
+        detector.feed(moved, now=11)
+        self.assertEqual(changes, [True])
+        self.assertTrue(detector.stats()['idle'])
+        detector.feed(still, now=12)
+        self.assertEqual(changes, [True, False])
+        self.assertEqual(len(detector.events_since()), 2)
+
+    def test_motion_commands(self):
+        self.assertEqual(build_hls_command('rtsp://cam.local/a', '/tmp/out'),
+                         build_hls_command('rtsp://cam.local/a', '/tmp/out', motion=False))
+        cmd = build_hls_command('rtsp://cam.local/a', '/tmp/out', motion=True, idle=True)
+        self.assertEqual(cmd[cmd.index('-f'):cmd.index('-f') + 3], ['-f', 'rawvideo', '-'])
+        self.assertLess(cmd.index('rawvideo'), cmd.index('-c:v'))
+        self.assertEqual(cmd[cmd.index('-b:v') + 1], '250k')
+        self.assertEqual(cmd[cmd.index('-r') + 1], '2')
+        self.assertNotIn('-skip_frame', cmd)
+        copy = build_hls_command('rtsp://cam.local/a', '/tmp/out', 'copy', {'video_codec': 'h264'}, motion=True)
+        self.assertLess(copy.index('-skip_frame'), copy.index('-i'))
+        self.assertEqual(copy[-1], '/tmp/out/stream.m3u8')
+
+    async def test_static_scene_switches_encode(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        client = AsyncClient()
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir), HLS_MOTION_FPS=10,
+                               HLS_MOTION_HOLD=0.3, HLS_MOTION_IDLE_AFTER=1,
+                               HLS_LOCAL_ROOT=os.path.join(work_dir, 'local')), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1',
+                                             'FAKE_FFMPEG_MOTION_SECONDS': '0.5'}):
+            response = await client.post(reverse('start_hls_stream'),
+                                         {'url': 'rtsp://cam.local/motion', 'mode': 'transcode',
+                                          'store': 'local', 'motion': True},
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            stream_id = response.json()['stream_id']
+            state = hls_stream.stream_states[stream_id]
+            try:
+                supervised = hls_stream.get_supervisor().get(stream_id)
+                first_pid = supervised.process.pid
+                for _ in range(100):
+                    if state['encode'] == 'idle':
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(state['encode'], 'idle')
+                self.assertIn('250k', supervised.cmd)
+                # Each new fake FFmpeg starts with motion again
+                for _ in range(100):
+                    if state['encode'] == 'full' and supervised.process.pid != first_pid:
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(state['encode'], 'full')
+                self.assertNotIn('250k', supervised.cmd)
+                self.assertEqual(supervised.restarts, 0)
+
+                data = (await client.get(reverse('motion_events', args=[stream_id]))).json()
+                self.assertGreaterEqual(len(data['events']), 2)
+                self.assertIsNotNone(data['events'][0]['end'])
+                self.assertEqual(data['encode'], 'full')
+            finally:
+                await hls_stream.stop_stream(stream_id)
+        self.assertEqual((await client.get(reverse('motion_events', args=[stream_id]))).status_code, 404)
+
+    async def test_motion_needs_plain_hls(self):
+        response = await AsyncClient().post(reverse('start_hls_stream'),
+                                            {'url': 'rtsp://cam.local/a', 'motion': True, 'low_latency': True},
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ListRecorder:
+    """Collects what a SegmentUploader hands its recorder."""
+    def __init__(self):
+        self.segments = []
+
+    def add(self, key, start, duration, size, discontinuity=False):
+        self.segments.append((key, start, duration, size, discontinuity))
+
+
+class RecordingTests(TestCase):
+    def make_segments(self, stream_id, starts, duration=2.0, expires_at=1e12):
+        RecordedSegment.objects.bulk_create([
+            RecordedSegment(stream_id=stream_id, key=f'hls_media/{stream_id}/stream{int(start)}.ts',
+                            start=start, duration=duration, size=100, expires_at=expires_at)
+            for start in starts
+        ])
+
+    def test_parse_segment_tags(self):
+        text = ('#EXTM3U\n#EXT-X-PROGRAM-DATE-TIME:2026-01-01T00:00:00.500+0000\n#EXTINF:2.000000,\n'
+                'stream10.ts\n#EXT-X-DISCONTINUITY\n#EXTINF:1.5,\nstream11.ts\n')
+        self.assertEqual(parse_segment_tags(text), {
+            'stream10.ts': {'duration': 2.0, 'program_date_time': 1767225600.5, 'discontinuity': False},
+            'stream11.ts': {'duration': 1.5, 'program_date_time': None, 'discontinuity': True},
+        })
+
+    def test_uploader_keeps_recorded_segments(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        storage, recorder = CountingStorage(), ListRecorder()
+        uploader = SegmentUploader(temp_dir, 'hls_media/rec', storage=storage, recorder=recorder)
+        output = FakeHlsOutput(temp_dir)
+        for _ in range(30):
+            output.write_segment(size=1000)
+            uploader.poll()
+        self.assertEqual(storage.deletes, [])
+        self.assertEqual(len([name for name in storage.files if name.endswith('.ts')]), 30)
+        self.assertEqual([segment[0] for segment in recorder.segments],
+                         [f'hls_media/rec/stream{i}.ts' for i in range(30)])
+        key, start, duration, size, discontinuity = recorder.segments[0]
+        self.assertEqual((duration, size, discontinuity), (2.0, 1000, False))
+        self.assertLess(abs(start + duration - time.time()), 10)
+
+    def test_find_segments_and_playlist(self):
+        # Two runs of 2 s segments with a gap between them
+        self.make_segments('rec', [1000 + 2 * i for i in range(50)] + [1200 + 2 * i for i in range(10)])
+        self.make_segments('other', [1000 + 2 * i for i in range(50)])
+        segments = recording.find_segments('rec', 1091, 1205)
+        self.assertEqual([segment.start for segment in segments], [1090, 1092, 1094, 1096, 1098, 1200, 1202, 1204])
+        self.assertEqual(len(recording.find_segments('rec', 0, 1e12, limit=5)), 5)
+
+        playlist = recording.build_playlist('rec', segments)
+        lines = playlist.splitlines()
+        self.assertIn('#EXT-X-PLAYLIST-TYPE:VOD', lines)
+        self.assertEqual(lines[-1], '#EXT-X-ENDLIST')
+        self.assertEqual(lines.count('#EXT-X-DISCONTINUITY'), 1)
+        self.assertEqual([line for line in lines if line.startswith('#EXT-X-PROGRAM-DATE-TIME')],
+                         ['#EXT-X-PROGRAM-DATE-TIME:1970-01-01T00:18:10.000+00:00',
+                          '#EXT-X-PROGRAM-DATE-TIME:1970-01-01T00:20:00.000+00:00'])
+        self.assertEqual(lines[lines.index('#EXT-X-DISCONTINUITY') + 3], '/media/hls_media/rec/stream1200.ts')
+
+    async def test_recording_views(self):
+        await sync_to_async(self.make_segments)('rec', [1000 + 2 * i for i in range(10)])
+        client = AsyncClient()
+        data = (await client.get(reverse('recordings', args=['rec']))).json()
+        self.assertEqual((data['segments'], data['bytes'], data['start'], data['end'], data['recording']),
+                         (10, 1000, 1000, 1020, False))
+        url = reverse('recording_playlist', args=['rec'])
+        response = await client.get(url, {'start': 1004, 'end': 1010})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode().count('.ts'), 3)
+        self.assertIn('#EXT-X-ENDLIST', response.content.decode())
+        self.assertEqual((await client.get(url, {'start': 'soon'})).status_code, 400)
+        self.assertEqual((await client.get(url, {'start': 5000})).status_code, 404)
+
+    def test_expire_deletes_in_batches(self):
+        client = FakeS3Client()
+        self.make_segments('old', range(0, 2 * 1500, 2), expires_at=100)
+        self.make_segments('new', range(0, 20, 2), expires_at=1e12)
+        for key in RecordedSegment.objects.values_list('key', flat=True):
+            client.put_object(Bucket='bucket', Key=key)
+        self.assertEqual(recording.expire(client, 'bucket', now=200), (1500, 0))
+        self.assertEqual(client.calls['delete_objects'], 2)
+        self.assertEqual(set(RecordedSegment.objects.values_list('stream_id', flat=True)), {'new'})
+        self.assertEqual(len(client.objects), 10)
+
+    def test_sweeper_spares_recordings(self):
+        self.assertFalse(hls_stream.is_stream_live('rec'))
+        self.make_segments('rec', [1000])
+        self.assertTrue(hls_stream.is_stream_live('rec'))
+
+    def test_background_tasks_run_in_server_processes_only(self):
+        for argv, run_main, serving in ((['/usr/bin/daphne', 'backend.asgi:application'], None, True),
+                                        (['/venv/lib/daphne/__main__.py', '-p', '8000'], None, True),
+                                        (['/usr/bin/uvicorn', 'backend.asgi:application'], None, True),
+                                        (['/usr/bin/pytest'], None, False),
+                                        (['/usr/bin/celery', 'worker'], None, False),
+                                        (['-c'], None, False),
+                                        ([], None, False),
+                                        (['manage.py', 'runserver'], 'true', True),
+                                        (['manage.py', 'runserver'], None, False),
+                                        (['manage.py', 'runserver', '--noreload'], None, True),
+                                        (['manage.py', 'migrate'], None, False),
+                                        (['manage.py', 'expire_recordings'], 'true', False)):
+            environ = {'RUN_MAIN': run_main} if run_main else {}
+            with mock.patch.object(sys, 'argv', argv), mock.patch.dict(os.environ, environ):
+                if not run_main:
+                    os.environ.pop('RUN_MAIN', None)
+                self.assertEqual(_serving(), serving, argv)
+        with override_settings(HLS_SERVING=True), mock.patch.object(sys, 'argv', ['/usr/bin/celery']):
+            self.assertTrue(_serving())
+
+    async def test_recorded_stream_outlives_stop(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        client = AsyncClient()
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir),
+                               STORAGES=filesystem_storages(os.path.join(work_dir, 'storage'))), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}):
+            response = await client.post(reverse('start_hls_stream'),
+                                         {'url': 'rtsp://cam.local/rec', 'mode': 'transcode', 'store': 's3',
+                                          'record': True, 'retention': 60},
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            stream_id = response.json()['stream_id']
+            try:
+                self.assertIn('epoch', hls_stream.get_supervisor().get(stream_id).cmd)
+                for _ in range(100):
+                    if hls_stream.stream_states[stream_id]['state'] == 'ready':
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(hls_stream.stream_states[stream_id]['state'], 'ready')
+                self.assertTrue((await client.get(reverse('recordings', args=[stream_id]))).json()['recording'])
+            finally:
+                await hls_stream.stop_stream(stream_id)
+            segments = [segment async for segment in RecordedSegment.objects.filter(stream_id=stream_id)]
+            self.assertGreaterEqual(len(segments), 1)
+            self.assertTrue(segments[0].discontinuity)
+            self.assertAlmostEqual(segments[0].expires_at, segments[0].start + segments[0].duration + 60)
+            storage_dir = os.path.join(work_dir, 'storage', 'hls_media', stream_id)
+            self.assertNotIn('stream.m3u8', os.listdir(storage_dir))
+            self.assertIn(os.path.basename(segments[0].key), os.listdir(storage_dir))
+            response = await client.get(reverse('recording_playlist', args=[stream_id]))
+            self.assertIn('#EXT-X-ENDLIST', response.content.decode())
+            segment_url = response.content.decode().splitlines()[-2]
+            self.assertEqual((await client.get(segment_url)).status_code, 200)
+
+    async def test_record_needs_storage(self):
+        for options in ({'store': 'local'}, {'low_latency': True}):
+            response = await AsyncClient().post(reverse('start_hls_stream'),
+                                                {'url': 'rtsp://cam.local/a', 'record': True, **options},
+                                                content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+
+class SnapshotTests(SimpleTestCase):
+    def test_snapshot_commands(self):
+        path = '/tmp/work/snapshot.jpg'
+        cmd = build_hls_command('rtsp://cam.local/a', '/tmp/out', snapshot=path)
+        self.assertEqual(cmd[cmd.index('image2') - 1:cmd.index(path) + 1],
+                         ['-f', 'image2', '-update', '1', '-atomic_writing', '1', path])
+        self.assertLess(cmd.index(path), cmd.index('-c:v'))
+        self.assertNotIn('-skip_frame', cmd)
+        self.assertEqual(cmd[-1], '/tmp/out/stream.m3u8')
+        copy = build_hls_command('rtsp://cam.local/a', '/tmp/out', 'copy', {'video_codec': 'h264'}, snapshot=path)
+        self.assertLess(copy.index('-skip_frame'), copy.index('-i'))
+        ladder = normalize_ladder(settings.HLS_ABR_LADDER)
+        abr = build_abr_command('rtsp://cam.local/a', '/tmp/out', ladder, snapshot=path)
+        self.assertLess(abr.index(path), abr.index('-filter_complex'))
+        llhls = build_llhls_command('rtsp://cam.local/a', snapshot=path)
+        self.assertLess(llhls.index(path), llhls.index('-movflags'))
+
+    def test_cache_rereads_after_max_age(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        path = os.path.join(temp_dir, 'snapshot.jpg')
+        cache = SnapshotCache(max_age=0.2)
+        self.assertIsNone(cache.get('cam', path))
+        with open(path, 'wb') as f:
+            f.write(b'first')
+        first = cache.get('cam', path)
+        self.assertEqual(first.data, b'first')
+        with open(path, 'wb') as f:
+            f.write(b'second')
+        os.utime(path, (first.taken_at + 1, first.taken_at + 1))
+        for _ in range(10):
+            self.assertIs(cache.get('cam', path), first)
+        self.assertEqual((cache.reads, cache.hits), (2, 10))
+        time.sleep(0.2)
+        self.assertEqual(cache.get('cam', path).data, b'second')
+
+    async def test_snapshot_endpoints(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        client = AsyncClient()
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir),
+                               HLS_LOCAL_ROOT=os.path.join(work_dir, 'local')), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}):
+            response = await client.post(reverse('start_hls_stream'),
+                                         {'url': 'rtsp://cam.local/snap', 'mode': 'transcode', 'store': 'local'},
+                                         content_type='application/json')
+            stream_id = response.json()['stream_id']
+            try:
+                for _ in range(100):
+                    if hls_stream.stream_states[stream_id]['state'] == 'ready':
+                        break
+                    await asyncio.sleep(0.05)
+                response = await client.get(reverse('snapshot', args=[stream_id]))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'image/jpeg')
+                self.assertTrue(response.content.startswith(b'\xff\xd8'))
+                self.assertEqual(response['Cache-Control'], f'public, max-age={settings.HLS_SNAPSHOT_MAX_AGE}')
+                again = await client.get(reverse('snapshot', args=[stream_id]),
+                                         headers={'If-None-Match': response['ETag']})
+                self.assertEqual(again.status_code, 304)
+
+                response = await client.get(reverse('snapshots'), {'ids': f'{stream_id},missing'})
+                results = response.json()['snapshots']
+                self.assertTrue(results[stream_id]['image'].startswith('data:image/jpeg;base64,'))
+                self.assertEqual(results['missing'], {'error': 'Unknown or stopped stream'})
+            finally:
+                await hls_stream.stop_stream(stream_id)
+        self.assertEqual((await client.get(reverse('snapshot', args=[stream_id]))).status_code, 404)
+        self.assertEqual((await client.get(reverse('snapshots'))).status_code, 400)
+
+
+class PushIngestTests(SimpleTestCase):
+    playlist = b'#EXTM3U\n#EXT-X-PROGRAM-DATE-TIME:2026-01-01T00:00:00.000+0000\n#EXTINF:2.000000,\nstream0.ts\n'
+
+    def make_output(self, **kwargs):
+        self.storage = CountingStorage()
+        self.cache = kwargs.pop('cache', None) or SegmentCache()
+        return PushedOutput('hls_media/push', 'token', storage=self.storage, cache=self.cache, **kwargs)
+
+    def test_push_command(self):
+        location = 'http://127.0.0.1:8000/ingest/cam/token'
+        cmd = build_hls_command('rtsp://cam.local/a', location, push=True)
+        self.assertEqual(cmd[cmd.index('-method') + 1], 'PUT')
+        self.assertEqual(cmd[cmd.index('-hls_segment_filename') + 1], f'{location}/stream%d.ts')
+        self.assertEqual(cmd[-1], f'{location}/stream.m3u8')
+        self.assertNotIn('-method', build_hls_command('rtsp://cam.local/a', '/tmp/out'))
+        abr = build_abr_command('rtsp://cam.local/a', location, normalize_ladder(settings.HLS_ABR_LADDER), push=True)
+        self.assertEqual(abr[-1], f'{location}/%v/stream.m3u8')
+        self.assertIn('-method', abr)
+
+    def test_segments_then_playlist_from_memory(self):
+        published = []
+        output = self.make_output(on_published=lambda: published.append(1))
+        output.put('stream0.ts', b'segment')
+        self.assertEqual(self.cache.get('hls_media/push/stream0.ts').data, b'segment')
+        output.put('stream.m3u8', self.playlist)
+        self.assertEqual(self.storage.saves, ['hls_media/push/stream0.ts', 'hls_media/push/stream.m3u8'])
+        self.assertEqual(self.cache.get('hls_media/push/stream.m3u8').data, self.playlist)
+        self.assertEqual(output.get('stream.m3u8'), self.playlist)
+        self.assertEqual(published, [1])
+        output.delete('stream0.ts')
+        self.assertEqual(self.storage.deletes, ['hls_media/push/stream0.ts'])
+        self.assertIsNone(self.cache.get('hls_media/push/stream0.ts'))
+
+    def test_dropped_segment_is_a_gap_in_the_stored_playlist(self):
+        def submit(kind, name, run, size=0, on_drop=None):
+            if name.endswith('stream0.ts'):
+                if on_drop:
+                    on_drop()
+                return
+            run()
+
+        output = self.make_output(submit=submit)
+        output.put('stream0.ts', b'segment')
+        output.put('stream1.ts', b'segment')
+        output.put('stream.m3u8', self.playlist + b'#EXTINF:2.000000,\nstream1.ts\n')
+        self.assertEqual(self.storage.files['hls_media/push/stream.m3u8'].decode().splitlines()[-4:],
+                         ['#EXT-X-GAP', 'stream0.ts', '#EXTINF:2.000000,', 'stream1.ts'])
+
+    def test_master_waits_for_its_variants(self):
+        output = self.make_output(playlist_name='master.m3u8')
+        output.put('master.m3u8', b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1\n720p/stream.m3u8\n')
+        self.assertEqual(self.storage.saves, [])
+        output.put('720p/stream0.ts', b'segment')
+        output.put('720p/stream.m3u8', self.playlist)
+        self.assertEqual(self.storage.saves, ['hls_media/push/720p/stream0.ts', 'hls_media/push/720p/stream.m3u8',
+                                              'hls_media/push/master.m3u8'])
+
+    def test_recorded_segments_are_cataloged_once(self):
+        recorder = ListRecorder()
+        output = self.make_output(recorder=recorder)
+        output.put('stream0.ts', b'segment')
+        output.put('stream.m3u8', self.playlist)
+        output.put('stream.m3u8', self.playlist + b'#EXTINF:2.000000,\nstream1.ts\n')
+        self.assertEqual(recorder.segments, [('hls_media/push/stream0.ts', 1767225600.0, 2.0, 7, False)])
+        output.delete('stream0.ts')
+        self.assertEqual(self.storage.deletes, [])
+
+    async def test_ingest_view(self):
+        output = self.make_output(cache=get_segment_cache())
+        self.addCleanup(get_segment_cache().evict_prefix, 'hls_media/push/')
+        client = AsyncClient()
+        with mock.patch.dict(hls_stream.pushed_outputs, {'push': output}):
+            url = reverse('hls_ingest', args=['push', 'token', 'stream0.ts'])
+            wrong = reverse('hls_ingest', args=['push', 'guess', 'stream0.ts'])
+            self.assertEqual((await client.put(wrong, b'x', content_type='video/mp2t')).status_code, 404)
+            self.assertEqual((await client.put(url, b'segment', content_type='video/mp2t')).status_code, 201)
+            playlist_url = reverse('hls_ingest', args=['push', 'token', 'stream.m3u8'])
+            self.assertEqual((await client.get(playlist_url)).status_code, 404)
+            await client.put(playlist_url, self.playlist, content_type='application/vnd.apple.mpegurl')
+            self.assertEqual((await client.get(playlist_url)).content, self.playlist)
+            # Viewers get the segment from memory, whatever storage is doing
+            response = await client.get(reverse('hls_serve', args=['push', 'stream0.ts']))
+            self.assertEqual(response.content, b'segment')
+            self.assertEqual((await client.delete(url)).status_code, 204)
+        self.assertEqual(self.storage.deletes, ['hls_media/push/stream0.ts'])
+
+    async def test_push_needs_storage(self):
+        response = await AsyncClient().post(reverse('start_hls_stream'),
+                                            {'url': 'rtsp://cam.local/a', 'store': 'local', 'ingest': 'push'},
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkStartTests(TestCase):
+    H264 = {'video_codec': 'h264', 'profile': 'Main', 'width': 1280, 'height': 720, 'fps': 25.0,
+            'audio_codec': None}
+
+    def setUp(self):
+        probe_module.probe_cache.clear()
+        self.addCleanup(probe_module.probe_cache.clear)
+
+    async def test_stored_probe_survives_a_restart(self):
+        calls = []
+
+        async def fake_ffprobe(url, transport='tcp'):
+            calls.append(transport)
+            return dict(self.H264)
+
+        with mock.patch.object(probe_module, '_run_ffprobe', fake_ffprobe):
+            first = await probe_module.probe_stream('rtsp://user:pw@cam.local/live')
+            probe_module.probe_cache.clear()
+            again = await probe_module.probe_stream('rtsp://user:pw@cam.local:554/live')
+        self.assertEqual(calls, ['tcp'])
+        self.assertEqual(first, {**self.H264, 'transport': 'tcp'})
+        self.assertEqual(again, first)
+        stored = await CameraProbe.objects.aget()
+        self.assertNotIn('pw', stored.key)
+
+    async def test_probe_remembers_the_transport_that_worked(self):
+        calls = []
+
+        async def fake_ffprobe(url, transport='tcp'):
+            calls.append(transport)
+            if transport == 'tcp':
+                raise probe_module.ProbeError('461 Unsupported transport')
+            return dict(self.H264)
+
+        with mock.patch.object(probe_module, '_run_ffprobe', fake_ffprobe):
+            result = await probe_module.probe_stream('rtsp://cam.local/udp')
+            # Once stale, the camera is probed again over what worked last time
+            await CameraProbe.objects.aupdate(probed_at=0)
+            probe_module.probe_cache.clear()
+            await probe_module.probe_stream('rtsp://cam.local/udp')
+        self.assertEqual(calls, ['tcp', 'udp', 'udp'])
+        cmd = build_hls_command('rtsp://cam.local/udp', '/tmp/out', 'copy', result)
+        self.assertEqual(cmd[cmd.index('-rtsp_transport') + 1], 'udp')
+        self.assertNotIn('-rtsp_flags', cmd)
+
+    async def test_bulk_start_streams_status_lines(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        body = {
+            'defaults': {'mode': 'transcode', 'store': 'local'},
+            'cameras': [{'url': 'rtsp://cam.local/bulk1'}, {'url': 'rtsp://cam.local/bulk2'}, {'mode': 'copy'}],
+            'concurrency': 2,
+        }
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir), HLS_MAX_TRANSCODES=2,
+                               HLS_LOCAL_ROOT=os.path.join(work_dir, 'local')), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}):
+            response = await AsyncClient().post(reverse('bulk_start_hls_streams'), body,
+                                                content_type='application/json')
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            events = [json.loads(chunk) async for chunk in response.streaming_content]
+        stream_ids = [event['stream_id'] for event in events if event.get('status') == 200]
+        for stream_id in stream_ids:
+            await hls_stream.stop_stream(stream_id)
+        started = {event['index']: event for event in events if 'status' in event}
+        self.assertEqual(started[2], {'index': 2, 'status': 400, 'error': 'Missing RTSP URL'})
+        self.assertEqual(started[0]['mode'], 'transcode')
+        self.assertEqual(len(stream_ids), 2)
+        ready = [event for event in events if event.get('state') == 'ready' and 'status' not in event]
+        self.assertEqual(sorted(event['index'] for event in ready), [0, 1])
+        done = events[-1]
+        self.assertEqual((done['done'], done['cameras'], done['started'], done['ready'], done['failed']),
+                         (True, 3, 2, 2, 1))
+
+    async def test_bulk_start_validation(self):
+        client = AsyncClient()
+        for body in ({'cameras': []}, {'cameras': ['rtsp://cam.local/a']},
+                     {'cameras': [{'url': 'rtsp://cam.local/a'}], 'concurrency': 0}):
+            response = await client.post(reverse('bulk_start_hls_streams'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+
+class MosaicTests(TestCase):
+    H264 = {'video_codec': 'h264', 'profile': 'Main', 'width': 1280, 'height': 720, 'fps': 25.0,
+            'audio_codec': None}
+
+    def test_layouts(self):
+        grid = normalize_layout(None, 5)
+        self.assertEqual((grid['columns'], grid['rows']), (3, 2))
+        self.assertEqual([(tile['x'], tile['y']) for tile in grid['tiles']], [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1)])
+        # One large tile and two small ones beside it
+        spans = normalize_layout({'tiles': [{'source': 1, 'w': 2, 'h': 2}, {'source': 0, 'x': 2},
+                                            {'source': 2, 'x': 2, 'y': 1}]}, 3)
+        self.assertEqual((spans['columns'], spans['rows']), (3, 2))
+        self.assertEqual(tile_rects(spans, 1920, 1080), [(0, 0, 1280, 1080), (1280, 0, 640, 540),
+                                                         (1280, 540, 640, 540)])
+        self.assertEqual(tile_rects(normalize_layout({'columns': 3}, 3), 1000, 600)[2], (664, 0, 332, 600))
+        for layout in ({'tiles': [{'source': 0, 'w': 2}, {'source': 1, 'x': 1}]},
+                       {'tiles': [{'source': 0}, {'source': 0, 'x': 1}]},
+                       {'tiles': [{'source': 3}]},
+                       {'columns': 1, 'tiles': [{'source': 0, 'x': 1}]},
+                       {'columns': 0}, {'tiles': []}, 'grid'):
+            with self.assertRaises(ValueError):
+                normalize_layout(layout, 2)
+        for size in ((1921, 1080), (32, 32), ('1920', 1080), (7680, 4320)):
+            with self.assertRaises(ValueError):
+                normalize_size(*size)
+
+    def test_mosaic_commands(self):
+        layout = normalize_layout({'columns': 2}, 3)
+        tiles = [(path, *rect) for path, rect in zip(['/tiles/a.jpg', None, '/tiles/c.jpg'],
+                                                      tile_rects(layout, 1920, 1080))]
+        cmd = build_mosaic_command(tiles, '/tmp/out', 1920, 1080, '/tmp/work/snapshot.jpg')
+        self.assertEqual(cmd[cmd.index('/tiles/a.jpg') - 8:cmd.index('/tiles/a.jpg')],
+                         ['-re', '-f', 'image2', '-loop', '1', '-framerate', str(settings.HLS_MOSAIC_FPS), '-i'])
+        # A source without a frame yet is a black tile
+        self.assertIn('lavfi', cmd)
+        graph = cmd[cmd.index('-filter_complex') + 1]
+        self.assertIn('xstack=inputs=3:layout=0_0|960_0|0_540:fill=black', graph)
+        self.assertIn('pad=1920:1080', graph)
+        self.assertLess(cmd.index('/tmp/work/snapshot.jpg'), cmd.index('-c:v'))
+        self.assertEqual(cmd[-1], '/tmp/out/stream.m3u8')
+        single = build_mosaic_command([('/tiles/a.jpg', 0, 0, 960, 540)], '/tmp/out', 1920, 1080)
+        self.assertNotIn('xstack', single[single.index('-filter_complex') + 1])
+        self.assertNotIn('-update', single)
+
+        feed = build_tile_feed_command('rtsp://cam.local/a', '/tiles/a.jpg', self.H264)
+        self.assertLess(feed.index('-skip_loop_filter'), feed.index('-i'))
+        self.assertEqual(feed[feed.index('-vf') + 1],
+                         f'fps={settings.HLS_MOSAIC_FPS},scale=-2:{settings.HLS_MOSAIC_TILE_HEIGHT}')
+        self.assertEqual(feed[-1], '/tiles/a.jpg')
+        hls = build_tile_feed_command('http://127.0.0.1:8000/hls/cam/stream.m3u8', '/tiles/b.jpg', hls=True)
+        self.assertEqual(hls[hls.index('-i') - 2:hls.index('-i')], ['-live_start_index', '-1'])
+        self.assertNotIn('-rtsp_transport', hls)
+
+    async def test_mosaic_lifecycle(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        client = AsyncClient()
+
+        async def fake_ffprobe(url, transport='tcp'):
+            return dict(self.H264)
+
+        body = {'sources': [{'url': 'rtsp://cam.local/m1'}, {'url': 'rtsp://cam.local/m2'}], 'store': 'local'}
+        with override_settings(FFMPEG_BINARY=fake_ffmpeg_binary(work_dir), HLS_MAX_TRANSCODES=2,
+                               HLS_LOCAL_ROOT=os.path.join(work_dir, 'local')), \
+                mock.patch.dict(os.environ, {'FAKE_FFMPEG_SEGMENT_BYTES': '1000', 'FAKE_FFMPEG_STARTUP': '0.1'}), \
+                mock.patch.object(probe_module, '_run_ffprobe', fake_ffprobe):
+            response = await client.post(reverse('mosaics'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            started = response.json()
+            stream_id = started['stream_id']
+            try:
+                self.assertEqual(started['layout']['columns'], 2)
+                self.assertEqual(len(mosaic_module.tile_feeds), 2)
+                for _ in range(100):
+                    if hls_stream.stream_states[stream_id]['state'] != 'starting':
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertEqual(hls_stream.stream_states[stream_id]['state'], 'ready')
+                feeds = dict(mosaic_module.tile_feeds)
+                pids = {key: feed.process.process.pid for key, feed in feeds.items()}
+
+                # Side by side becomes one above the other; the sources keep running
+                response = await client.patch(started['mosaic_url'], {'layout': {'columns': 1}, 'width': 1280,
+                                                                      'height': 1440},
+                                              content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual((response.json()['layout']['rows'], response.json()['layout_changes']), (2, 1))
+                self.assertEqual(mosaic_module.tile_feeds, feeds)
+                self.assertEqual({key: feed.process.process.pid for key, feed in feeds.items()}, pids)
+                self.assertEqual(hls_stream.get_supervisor().get(stream_id).restarts, 0)
+                response = await client.patch(started['mosaic_url'], {'layout': {'columns': 0}},
+                                              content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+                response = await client.get(reverse('mosaics'))
+                self.assertEqual(list(response.json()['mosaics']), [stream_id])
+            finally:
+                response = await client.delete(reverse('mosaic_detail', args=[stream_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mosaic_module.tile_feeds, {})
+        self.assertEqual((await client.get(reverse('mosaic_detail', args=[stream_id]))).status_code, 404)
+
+    async def test_mosaic_validation(self):
+        client = AsyncClient()
+        too_many = [{'url': f'rtsp://cam.local/{i}'} for i in range(settings.HLS_MOSAIC_MAX_SOURCES + 1)]
+        for body in ({}, {'sources': []}, {'sources': too_many}, {'sources': ['rtsp://cam.local/a']},
+                     {'sources': [{'stream_id': 'missing'}]}, {'sources': [{'camera': 'missing'}]},
+                     {'sources': [{'url': 'rtsp://cam.local/a'}], 'width': 1921}):
+            response = await client.post(reverse('mosaics'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
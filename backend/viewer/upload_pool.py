@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import deque
+import boto3
+from botocore.config import Config
+from django.conf import settings
+from . import metrics
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the process-wide boto3 S3 client.
+
+    boto3 clients are thread-safe, so one client with a connection pool sized
+    for the upload workers is shared by every stream and request instead of
+    paying for a new session and TLS handshake each time.
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            session = boto3.session.Session(
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME
+            )
+            _s3_client = session.client(
+                's3',
+                config=Config(max_pool_connections=settings.HLS_UPLOAD_WORKERS * 2)
+            )
+        return _s3_client
+
+
+class UploadJob:
+    def __init__(self, kind, name, run, size=0, on_drop=None):
+        self.kind = kind  # 'segment', 'playlist' or 'delete'
+        self.name = name
+        self.run = run
+        self.size = size
+        self.on_drop = on_drop
+        self.queued_at = time.monotonic()
+
+    def drop(self):
+        if self.on_drop:
+            self.on_drop()
+
+
+class StreamUploadQueue:
+    """
+    Pending upload jobs for one stream.
+
+    Jobs for a stream run one at a time and in order, which is what keeps a
+    playlist from reaching storage before the segments it references.
+    """
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.jobs = deque()
+        self.busy = False
+        self.closed = False
+        self.uploader = None
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.bytes_uploaded = 0
+        self.last_latency = None
+        self.avg_latency = None
+        self.last_duration = None
+
+    def pending_segments(self):
+        return sum(1 for job in self.jobs if job.kind == 'segment')
+
+    def record(self, job, duration):
+        latency = time.monotonic() - job.queued_at
+        self.last_latency = latency
+        self.last_duration = duration
+        # Exponentially weighted so the figure follows S3 getting slower
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.jobs),
+            'in_flight': self.busy,
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'superseded': self.superseded,
+            'bytes_uploaded': self.bytes_uploaded,
+            'last_latency': self.last_latency,
+            'avg_latency': self.avg_latency,
+            'last_upload_duration': self.last_duration,
+        }
+
+
+class UploadScheduler:
+    """
+    Process-wide upload scheduler shared by every HLS stream.
+
+    A single poller thread asks each registered SegmentUploader for changes and
+    a bounded pool of worker threads performs the storage calls. Streams with
+    pending work are served round-robin, one job at a time, so a busy camera
+    cannot starve the others. When S3 falls behind, superseded playlist
+    revisions are coalesced and the oldest pending segments are dropped once a
+    stream has more than max_queue of them waiting.
+    """
+    def __init__(self, workers=None, max_queue=None, poll_interval=None):
+        self.workers = workers or settings.HLS_UPLOAD_WORKERS
+        self.max_queue = max_queue or settings.HLS_UPLOAD_MAX_QUEUE
+        self.poll_interval = poll_interval or settings.HLS_UPLOAD_POLL_INTERVAL
+        self._cond = threading.Condition()
+        self._streams = {}
+        self._ready = deque()
+        self._threads = []
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'hls-upload-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        poller = threading.Thread(target=self._poll, name='hls-upload-poller', daemon=True)
+        poller.start()
+        self._threads.append(poller)
+
+    def _queue(self, stream_id):
+        queue = self._streams.get(stream_id)
+        if queue is None:
+            queue = self._streams[stream_id] = StreamUploadQueue(stream_id)
+        return queue
+
+    def register(self, stream_id, uploader):
+        """Start polling an uploader; its jobs are routed to this stream's queue."""
+        with self._cond:
+            queue = self._queue(stream_id)
+            queue.uploader = uploader
+            queue.closed = False
+        self.start()
+
+    def unregister(self, stream_id, discard=True):
+        """Stop polling a stream, optionally throwing away its pending uploads."""
+        with self._cond:
+            queue = self._streams.get(stream_id)
+            if queue is None:
+                return
+            queue.uploader = None
+            queue.closed = True
+            if discard:
+                while queue.jobs:
+                    queue.jobs.popleft().drop()
+            if not queue.jobs and not queue.busy:
+                del self._streams[stream_id]
+                if stream_id in self._ready:
+                    self._ready.remove(stream_id)
+
+    def submitter(self, stream_id):
+        """Return a submit callable for SegmentUploader bound to one stream."""
+        def submit(kind, name, run, size=0, on_drop=None):
+            self.submit(stream_id, UploadJob(kind, name, run, size, on_drop))
+        return submit
+
+    def submit(self, stream_id, job):
+        with self._cond:
+            queue = self._queue(stream_id)
+            if queue.closed:
+                job.drop()
+                return
+            if job.kind == 'playlist':
+                # Only the newest playlist matters; it is queued behind every
+                # segment it references, so older revisions can be skipped.
+                kept = deque()
+                for pending in queue.jobs:
+                    if pending.kind == 'playlist' and pending.name == job.name:
+                        queue.superseded += 1
+                    else:
+                        kept.append(pending)
+                queue.jobs = kept
+            queue.jobs.append(job)
+            while queue.pending_segments() > self.max_queue:
+                self._drop_oldest_segment(queue)
+            self._mark_ready(queue)
+
+    def _drop_oldest_segment(self, queue):
+        for pending in queue.jobs:
+            if pending.kind == 'segment':
+                queue.jobs.remove(pending)
+                queue.dropped += 1
+                metrics.UPLOAD_DROPPED.inc(stream_id=queue.stream_id)
+                pending.drop()
+                print(f"Upload queue full for stream {queue.stream_id}, dropped {pending.name}")
+                return
+
+    def _mark_ready(self, queue):
+        if queue.jobs and not queue.busy and queue.stream_id not in self._ready:
+            self._ready.append(queue.stream_id)
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                queue = self._streams[self._ready.popleft()]
+                job = queue.jobs.popleft()
+                queue.busy = True
+            started = time.monotonic()
+            ok = True
+            try:
+                job.run()
+            except Exception as e:
+                ok = False
+                print(f"Error uploading {job.name}: {e}")
+            duration = time.monotonic() - started
+            if ok:
+                metrics.UPLOAD_SECONDS.observe(duration, stream_id=queue.stream_id, kind=job.kind)
+                metrics.UPLOAD_BYTES.inc(job.size, stream_id=queue.stream_id)
+            else:
+                metrics.UPLOAD_FAILURES.inc(stream_id=queue.stream_id)
+            with self._cond:
+                queue.busy = False
+                queue.record(job, duration)
+                if ok:
+                    queue.uploaded += 1
+                    queue.bytes_uploaded += job.size
+                else:
+                    queue.failed += 1
+                    job.drop()
+                if queue.closed and not queue.jobs:
+                    self._streams.pop(queue.stream_id, None)
+                else:
+                    self._mark_ready(queue)
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                uploaders = [q.uploader for q in self._streams.values() if q.uploader is not None]
+            for uploader in uploaders:
+                try:
+                    uploader.poll()
+                except Exception as e:
+                    print(f"Error polling {uploader.local_dir}: {e}")
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        with self._cond:
+            return {stream_id: queue.stats() for stream_id, queue in self._streams.items()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_upload_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = UploadScheduler()
+        return _scheduler
@@ -0,0 +1,409 @@
+import os
+import posixpath
+import re
+import threading
+import time
+from datetime import datetime
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+
+def _run_inline(kind, name, run, size=0, on_drop=None):
+    run()
+
+
+_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+
+def parse_playlist_uris(text):
+    """
+    Return the URIs referenced by an m3u8 playlist, in playlist order,
+    including fMP4 init segments (EXT-X-MAP) and alternate renditions
+    (EXT-X-MEDIA) named in tag attributes.
+    """
+    uris = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith(('#EXT-X-MAP:', '#EXT-X-MEDIA:')):
+            match = _URI_ATTRIBUTE.search(line)
+            if match and match.group(1) not in uris:
+                uris.append(match.group(1))
+        elif line and not line.startswith('#'):
+            uris.append(line)
+    return uris
+
+
+def mark_gaps(text, missing):
+    """
+    Return playlist `text` with an EXT-X-GAP tag before each media segment
+    URI in `missing`, so players skip those segments instead of failing on
+    them.
+    """
+    lines = []
+    for line in text.splitlines():
+        if line.strip() in missing:
+            lines.append('#EXT-X-GAP')
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def parse_segment_tags(text):
+    """
+    Map each media segment URI of a playlist to its EXTINF `duration`, its
+    EXT-X-PROGRAM-DATE-TIME as a Unix time (`program_date_time`, None when
+    untagged) and whether an EXT-X-DISCONTINUITY precedes it.
+    """
+    segments = {}
+    tags = {'duration': None, 'program_date_time': None, 'discontinuity': False}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            try:
+                tags['duration'] = float(line[len('#EXTINF:'):].split(',')[0])
+            except ValueError:
+                pass
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            try:
+                tags['program_date_time'] = datetime.fromisoformat(
+                    line[len('#EXT-X-PROGRAM-DATE-TIME:'):]).timestamp()
+            except ValueError:
+                pass
+        elif line == '#EXT-X-DISCONTINUITY':
+            tags['discontinuity'] = True
+        elif line and not line.startswith('#'):
+            segments[line] = tags
+            tags = {'duration': None, 'program_date_time': None, 'discontinuity': False}
+    return segments
+
+
+class SegmentUploader:
+    """
+    Mirrors one FFmpeg HLS output directory into storage, including nested
+    master/variant layouts (e.g. master.m3u8 -> 720p/stream.m3u8 -> 720p/*.ts).
+
+    FFmpeg only lists a segment in the playlist once it has finished writing
+    it, so a playlist diff tells us exactly which segments are complete. Each
+    segment is uploaded once (tracked by name, size, mtime and inode), the
+    playlist is written only after every segment it references is in storage,
+    and segments FFmpeg has rotated out of the directory are deleted remotely.
+    A playlist revision listing a segment whose upload was dropped or failed
+    is held back; the next poll uploads the segment again and republishes.
+
+    Storage calls go through `submit(kind, name, run, size, on_drop)`, which
+    runs them inline by default; streams pass the shared UploadScheduler's
+    submitter so the writes happen on its worker pool, in submission order.
+    With a `cache` (a SegmentCache), every object written is also cached
+    under its storage path, and rotated segments are evicted as they are
+    deleted.
+
+    With a `recorder` (a recording.Recorder) rotated segments stay in
+    storage, and each segment is passed to `recorder.add()` once uploaded,
+    with its time and duration from the playlist.
+    """
+
+    def __init__(self, local_dir, remote_dir, playlist_name='stream.m3u8', storage=None, submit=None,
+                 on_published=None, cache=None, recorder=None):
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.playlist_name = playlist_name
+        self.storage = storage if storage is not None else default_storage
+        self.submit = submit if submit is not None else _run_inline
+        # Called (from whichever thread ran the upload) each time a playlist
+        # revision lands in storage
+        self.on_published = on_published
+        self.cache = cache
+        self.recorder = recorder
+        self.playlists_published = 0
+        # segment name -> (size, mtime_ns, inode) of the uploaded copy
+        self.uploaded = {}
+        # segment names whose upload has completed
+        self.in_storage = set()
+        # playlist name -> last published bytes / segments it referenced
+        self._last_playlists = {}
+        self._referenced = {}
+        # Reentrant: inline uploads run while poll() holds it
+        self._lock = threading.RLock()
+
+    def remote_name(self, name):
+        return f'{self.remote_dir}/{name}'
+
+    def poll(self):
+        """
+        Publish whatever changed since the last call.
+        Returns True if a new playlist was written to storage.
+        """
+        with self._lock:
+            published = self._publish_playlist(self.playlist_name)
+            if published:
+                referenced = set()
+                for names in self._referenced.values():
+                    referenced |= names
+                self._delete_rotated(referenced)
+            return published
+
+    def _publish_playlist(self, name):
+        """
+        Upload one playlist after everything it references. A master playlist
+        references variant playlists, which are published first, in turn.
+        """
+        try:
+            with open(os.path.join(self.local_dir, name), 'rb') as f:
+                playlist = f.read()
+        except FileNotFoundError:
+            return False
+
+        base = posixpath.dirname(name)
+        text = playlist.decode('utf-8', errors='ignore')
+        tags = parse_segment_tags(text) if self.recorder is not None else {}
+        referenced = []
+        for uri in parse_playlist_uris(text):
+            path = posixpath.normpath(posixpath.join(base, uri))
+            if path.startswith('../') or path.startswith('/') or '://' in uri:
+                continue
+            referenced.append(path)
+            if uri in tags:
+                tags[path] = tags.pop(uri)
+
+        changed = False
+        for child in referenced:
+            if child.endswith('.m3u8'):
+                changed |= self._publish_playlist(child)
+                if child not in self._last_playlists:
+                    # The variant is not in storage yet; neither is its master
+                    return changed
+
+        if playlist == self._last_playlists.get(name):
+            return changed
+
+        segments = [path for path in referenced if not path.endswith('.m3u8')]
+        for segment in segments:
+            if not self._upload_segment(segment, tags.get(segment)):
+                # Not on disk yet (or already gone); retry on the next poll
+                # rather than publishing a playlist that points at nothing.
+                return changed
+
+        on_done = self._published if name == self.playlist_name else None
+        self._last_playlists[name] = playlist
+        self._save_playlist(name, playlist, segments, on_done=on_done)
+        self._referenced[name] = set(segments)
+        return True
+
+    def _upload_segment(self, name, tags=None):
+        path = os.path.join(self.local_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return name in self.uploaded
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        if self.uploaded.get(name) == signature:
+            return True
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.uploaded[name] = signature
+        on_done = None
+        if self.recorder is not None and tags and tags['duration'] is not None:
+            # Without a program date time, FFmpeg finished the file as the segment ended
+            start = tags['program_date_time'] or st.st_mtime - tags['duration']
+            on_done = lambda: self.recorder.add(self.remote_name(name), start, tags['duration'],
+                                                len(data), tags['discontinuity'])
+        self._save('segment', name, data, on_drop=lambda: self._forget(name, signature), on_done=on_done)
+        return True
+
+    def _save(self, kind, name, data, on_drop=None, on_done=None):
+        remote = self.remote_name(name)
+        if kind == 'segment':
+            self.in_storage.discard(name)
+
+        def run():
+            self.storage.save(remote, ContentFile(data))
+            if kind == 'segment':
+                self.in_storage.add(name)
+            if self.cache is not None:
+                self.cache.put(remote, data)
+            if on_done:
+                on_done()
+
+        self.submit(kind, remote, run, size=len(data), on_drop=on_drop)
+
+    def _save_playlist(self, name, data, segments, on_done=None):
+        """
+        Queue a playlist behind the segments it lists. A stream's uploads run
+        in order, so when it runs each of them is stored, dropped or failed;
+        `_storable(name, data, missing)` decides what is written instead of
+        a playlist pointing at missing segments.
+        """
+        remote = self.remote_name(name)
+
+        def run():
+            missing = [segment for segment in segments if segment not in self.in_storage]
+            body = self._storable(name, data, missing) if missing else data
+            if body is None:
+                return
+            self.storage.save(remote, ContentFile(body))
+            if self.cache is not None:
+                self.cache.put(remote, body)
+            if on_done:
+                on_done()
+
+        self.submit('playlist', remote, run, size=len(data))
+
+    def _storable(self, name, data, missing):
+        # Held back; the next poll uploads the missing segments again
+        print(f"Holding back {self.remote_name(name)}: {len(missing)} listed segment(s) not in storage")
+        with self._lock:
+            self._last_playlists.pop(name, None)
+        return None
+
+    def _published(self):
+        self.playlists_published += 1
+        if self.on_published:
+            self.on_published()
+
+    def _forget(self, name, signature):
+        # A dropped or failed upload is retried the next time the playlist changes
+        if self.uploaded.get(name) == signature:
+            del self.uploaded[name]
+
+    def _delete_rotated(self, referenced):
+        # FFmpeg's delete_segments keeps a segment on disk for a little while
+        # after it leaves the playlist, so wait for the local file to go away
+        # before removing the remote copy a player may still be fetching.
+        for name in list(self.uploaded):
+            if name in referenced:
+                continue
+            if os.path.exists(os.path.join(self.local_dir, name)):
+                continue
+            del self.uploaded[name]
+            self.in_storage.discard(name)
+            remote = self.remote_name(name)
+            if self.recorder is not None:
+                # Recorded segments stay until their retention runs out
+                if self.cache is not None:
+                    self.cache.evict(remote)
+                continue
+            self.submit('delete', remote, lambda remote=remote: self._delete(remote))
+
+    def _delete(self, remote):
+        try:
+            self.storage.delete(remote)
+        except Exception as e:
+            print(f"Error deleting rotated segment {remote}: {e}")
+        if self.cache is not None:
+            self.cache.evict(remote)
+
+
+class PushedOutput(SegmentUploader):
+    """
+    Receives an FFmpeg HLS output pushed over HTTP (see hls_ingest) and
+    hands it to storage straight from memory, with no working directory
+    to poll.
+
+    Each object is cached as it arrives, so hls_serve can answer with it
+    at once, and queued for upload. A stream's uploads run in order and
+    FFmpeg sends a segment before the playlist that lists it, so storage
+    still never has a playlist pointing at a missing segment. A playlist
+    referencing variant playlists that have not arrived yet (an ABR
+    master) is held until they have. Segments FFmpeg deletes are deleted
+    remotely, unless a `recorder` keeps them, in which case each is
+    cataloged once it is both uploaded and listed in a playlist. A pushed
+    segment whose upload was dropped or failed cannot be sent again, so
+    playlists listing it are stored with it marked as an EXT-X-GAP.
+    """
+
+    def __init__(self, remote_dir, token, playlist_name='stream.m3u8', **kwargs):
+        super().__init__(None, remote_dir, playlist_name, **kwargs)
+        # Part of the ingest URL, so only this stream's FFmpeg can write here
+        self.token = token
+        self.last_received = None
+        # playlist name -> newest bytes, read back by FFmpeg for append_list
+        self.playlists = {}
+        self._held = {}
+        # Recording: segments uploaded but not yet listed, and listed but not yet uploaded
+        self._stored = {}
+        self._tags = {}
+        self._listed = set()
+
+    def poll(self):
+        # FFmpeg pushes; there is nothing to poll
+        return False
+
+    def put(self, name, data):
+        self.last_received = time.time()
+        if not name.endswith('.m3u8'):
+            if self.cache is not None:
+                self.cache.put(self.remote_name(name), data)
+            on_done = (lambda: self._segment_stored(name, len(data))) if self.recorder is not None else None
+            self._save('segment', name, data, on_done=on_done)
+            return
+        with self._lock:
+            self.playlists[name] = data
+            self._held[name] = data
+            # Publish whatever is complete, variants before the master that lists them
+            ready = True
+            while ready:
+                ready = [held for held in self._held
+                         if all(child in self.playlists and child not in self._held
+                                for child in self._variants(held))]
+                for held in ready:
+                    self._publish(held, self._held.pop(held))
+
+    def get(self, name):
+        return self.playlists.get(name)
+
+    def delete(self, name):
+        self.in_storage.discard(name)
+        with self._lock:
+            self._listed.discard(name)
+            self._stored.pop(name, None)
+            self._tags.pop(name, None)
+        remote = self.remote_name(name)
+        if self.recorder is not None:
+            # Recorded segments stay until their retention runs out
+            if self.cache is not None:
+                self.cache.evict(remote)
+            return
+        self.submit('delete', remote, lambda: self._delete(remote))
+
+    def _variants(self, name):
+        base = posixpath.dirname(name)
+        text = self.playlists[name].decode('utf-8', errors='ignore')
+        return [posixpath.normpath(posixpath.join(base, uri)) for uri in parse_playlist_uris(text)
+                if uri.endswith('.m3u8')]
+
+    def _publish(self, name, data):
+        if self.cache is not None:
+            self.cache.put(self.remote_name(name), data)
+        base = posixpath.dirname(name)
+        segments = [posixpath.normpath(posixpath.join(base, uri))
+                    for uri in parse_playlist_uris(data.decode('utf-8', errors='ignore')) if not uri.endswith('.m3u8')]
+        self._save_playlist(name, data, segments, on_done=self._published if name == self.playlist_name else None)
+        if self.recorder is None:
+            return
+        for uri, tags in parse_segment_tags(data.decode('utf-8', errors='ignore')).items():
+            path = posixpath.normpath(posixpath.join(base, uri))
+            if path in self._listed or tags['duration'] is None:
+                continue
+            self._listed.add(path)
+            if path in self._stored:
+                self._record(path, self._stored.pop(path), tags)
+            else:
+                self._tags[path] = tags
+
+    def _storable(self, name, data, missing):
+        print(f"Marking {len(missing)} segment(s) missing from storage as gaps in {self.remote_name(name)}")
+        base = posixpath.dirname(name)
+        missing = {posixpath.relpath(segment, base or '.') for segment in missing}
+        return mark_gaps(data.decode('utf-8', errors='ignore'), missing).encode()
+
+    def _segment_stored(self, name, size):
+        # Runs on an upload worker once the segment is in storage
+        with self._lock:
+            tags = self._tags.pop(name, None)
+            if tags is None:
+                self._stored[name] = size
+                return
+        self._record(name, size, tags)
+
+    def _record(self, name, size, tags):
+        start = tags['program_date_time'] or time.time() - tags['duration']
+        self.recorder.add(self.remote_name(name), start, tags['duration'], size, tags['discontinuity'])
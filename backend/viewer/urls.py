@@ -1,8 +1,27 @@
 from django.urls import path, re_path
-from . import hls_stream
+from . import hls_stream, metrics_views, mosaic_views
 
 urlpatterns = [
     path('start_hls/', hls_stream.start_hls_stream, name='start_hls_stream'),
+    path('start_hls/bulk/', hls_stream.bulk_start_hls_streams, name='bulk_start_hls_streams'),
     path('stop_hls/<str:stream_id>/', hls_stream.stop_hls_stream, name='stop_hls_stream'),
+    path('hls_status/<str:stream_id>/', hls_stream.hls_stream_status, name='hls_stream_status'),
+    path('motion/<str:stream_id>/', hls_stream.motion_events, name='motion_events'),
+    path('recordings/<str:stream_id>/', hls_stream.recordings, name='recordings'),
+    path('recordings/<str:stream_id>/playlist.m3u8', hls_stream.recording_playlist, name='recording_playlist'),
+    path('snapshot/<str:stream_id>.jpg', hls_stream.snapshot, name='snapshot'),
+    path('snapshots/', hls_stream.snapshots, name='snapshots'),
+    path('streams/', hls_stream.list_streams, name='list_streams'),
+    path('nodes/', hls_stream.cluster_nodes, name='cluster_nodes'),
+    path('mosaics/', mosaic_views.mosaics, name='mosaics'),
+    path('mosaics/<str:stream_id>/', mosaic_views.mosaic_detail, name='mosaic_detail'),
+    path('cameras/', hls_stream.cameras, name='cameras'),
+    path('cameras/<slug:name>/', hls_stream.camera_detail, name='camera_detail'),
+    path('upload_stats/', hls_stream.upload_stats, name='upload_stats'),
+    path('cleanup_stats/', hls_stream.cleanup_stats, name='cleanup_stats'),
+    path('cache_stats/', hls_stream.segment_cache_stats, name='segment_cache_stats'),
+    path('metrics/', metrics_views.prometheus_metrics, name='metrics'),
+    re_path(r'^ingest/(?P<stream_id>[\w-]+)/(?P<token>[\w-]+)/(?P<filename>.+)$', hls_stream.hls_ingest,
+            name='hls_ingest'),
     re_path(r'^media/hls_media/(?P<stream_id>[\w-]+)/(?P<filename>.+)$', hls_stream.hls_serve, name='hls_serve'),
 ]
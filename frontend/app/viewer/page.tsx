@@ -25,7 +25,11 @@ import {
 import { useMobile } from '@/hooks/use-mobile';
 import { ThemeToggle } from '@/components/theme-toggle';
 import { ScrollArea } from '@/components/ui/scroll-area';
-import { startHLSStream, getHLSStreamUrl } from '@/lib/api';
+import {
+	startHLSStream,
+	getHLSStreamUrl,
+	waitForHLSStreamReady,
+} from '@/lib/api';
 import Hls from 'hls.js';
 
 // Define the stream type
@@ -166,6 +170,7 @@ export default function ViewerPage() {
 					newStream.username,
 					newStream.password
 				);
+				await waitForHLSStreamReady(response.stream_id);
 				const streamId = `stream-${Date.now()}`;
 				const videoRef = createRef<HTMLVideoElement>();
 
@@ -32,6 +32,30 @@ export const stopHLSStream = async (streamId: string) => {
   }
 };
 
+export const getHLSStreamStatus = async (streamId: string) => {
+  const response = await axios.get(`${API_BASE_URL}/hls_status/${streamId}/`);
+  return response.data;
+};
+
+// start_hls returns while FFmpeg is still starting; resolve once the first
+// segment is available (or reject if the stream failed to start).
+export const waitForHLSStreamReady = async (
+  streamId: string,
+  timeoutMs = 30000,
+  intervalMs = 500
+) => {
+  const deadline = Date.now() + timeoutMs;
+  while (Date.now() < deadline) {
+    const status = await getHLSStreamStatus(streamId);
+    if (status.state === "ready") return status;
+    if (status.state !== "starting") {
+      throw new Error(status.error || `Stream ${status.state}`);
+    }
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+  throw new Error("Timed out waiting for stream to start");
+};
+
 export const getHLSStreamUrl = (streamId: string) => {
   return `${API_BASE_URL}/media/hls_media/${streamId}/stream.m3u8`;
 };